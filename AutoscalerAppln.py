@@ -0,0 +1,349 @@
+###############################################
+#
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose: Broker autoscaling controller
+#
+# Created: Spring 2023
+#
+###############################################
+
+
+# Each broker group has one leader, the /brokers/<group> node. With Enabled=True
+# in the [Autoscale] section of config.ini, the leader and any extra instance of
+# the group register under /broker_instances/<group> and report their
+# throughput, number of subscribers and backlog under /autoscale/load/<group>.
+# The subscribers of a group are split across its instances.
+#
+# This controller runs on a broker host. Every ReportInterval it reads the load
+# reports and, per group, lets the BrokerAutoscaler decide how many instances
+# the group needs. It starts the extra instances as local BrokerAppln processes
+# (--scale_out) and stops them again when the load drops: first it removes the
+# instance node so that its subscribers move to the other instances, then,
+# after DrainPeriod seconds, it terminates the process. It only ever stops the
+# instances it started itself, never the leader of a group.
+
+# import the needed packages
+import os     # for OS functions
+import sys    # for syspath and system exception
+import time   # for sleep
+import argparse # for argument parsing
+import configparser # for configuration parsing
+import logging # for logging. Use it in place of print statements.
+from CS6381_MW.AsyncLogging import setup_logging # logs written by a listener thread
+import subprocess # to start the broker instances
+
+from CS6381_MW.BrokerAutoscaler import BrokerAutoscaler
+
+# Objects to interact with Zookeeper
+from CS6381_MW.InMemoryZooKeeper import zookeeper_client # kazoo client, or the in-memory stand-in for inmemory:// addresses
+from kazoo.exceptions import NoNodeError
+import json
+
+
+##################################
+#       AutoscalerAppln class
+##################################
+class AutoscalerAppln ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, logger):
+    self.logger = logger  # internal logger for print statements
+    self.zk_client = None
+    self.autoscaler = None # decides on the number of instances
+    self.groups = None # broker groups we take care of
+    self.check_interval = None # seconds between two decisions, the report interval of the brokers
+    self.cooldown = None # seconds after a change of a group before we change it again
+    self.drain_period = None # seconds an instance keeps forwarding after we removed its node
+    self.broker_args = None # arguments passed on to the broker instances we start
+    self.next_port = None # port of the next instance we start
+    self.log_dir = None # where the output of the instances goes
+    self.launched = {} # group -> list of (name, process) of the instances we started
+    self.draining = [] # (time to terminate, name, process) of the instances being stopped
+    self.last_change_time = {} # group -> time of its last scale out/in
+    self.num_launched = 0
+
+  ########################################
+  # configure/initialize
+  ########################################
+  def configure (self, args):
+    ''' Initialize the object '''
+
+    try:
+      self.logger.info ("AutoscalerAppln::configure")
+
+      config = configparser.ConfigParser ()
+      config.read (args.config)
+      if (config["Discovery"]["Strategy"] != 'ZooKeeper' or config["Dissemination"]["Strategy"] != 'Broker'):
+        raise ValueError ("Autoscaling needs the ZooKeeper discovery and Broker dissemination strategies")
+
+      self.groups = [group for group in config['GroupToTopicMapping']] if args.groups == None else args.groups.split (',')
+
+      self.check_interval = 2.0
+      if config.has_section ('Rebalance'):
+        self.check_interval = config['Rebalance'].getfloat ('ReportInterval', self.check_interval)
+
+      section = config['Autoscale'] if config.has_section ('Autoscale') else {}
+      self.autoscaler = BrokerAutoscaler (
+        scale_out_load=float (section.get ('ScaleOutLoad', 20000)),
+        scale_in_fraction=float (section.get ('ScaleInFraction', 0.5)),
+        max_backlog=float (section.get ('MaxBacklog', 0.2)),
+        min_instances=int (section.get ('MinInstances', 1)),
+        max_instances=int (section.get ('MaxInstances', 4)))
+      self.cooldown = float (section.get ('Cooldown', 30.0))
+      self.drain_period = float (section.get ('DrainPeriod', 5.0))
+
+      self.next_port = args.base_port
+      self.log_dir = args.log_dir
+      self.broker_args = ["-a", args.addr, "-z", args.zookeeper, "-c", args.config, "-j", args.dht_json_path, "-t", str (args.broker_timeout), "-l", str (args.loglevel)]
+
+      self.zk_client = zookeeper_client (args.zookeeper)
+      self.zk_client.start ()
+
+      self.logger.info ("AutoscalerAppln::configure - configuration complete")
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # get_instance_reports
+  #
+  # The latest load report of every running instance of the group. An
+  # instance that did not report lately has nothing to forward
+  ########################################
+  def get_instance_reports (self, group):
+    try:
+      instances = self.zk_client.get_children ('/broker_instances/' + group)
+    except NoNodeError:
+      return {}
+
+    reports = {}
+    for instance in instances:
+      reports[instance] = {}
+      try:
+        data_bytes, _ = self.zk_client.get ('/autoscale/load/' + group + '/' + instance)
+      except NoNodeError:
+        continue
+      report = json.loads (data_bytes.decode ('utf-8'))
+      if (time.time () - report['time'] < 3 * self.check_interval):
+        reports[instance] = report
+
+    return reports
+
+  ########################################
+  # scale_group
+  ########################################
+  def scale_group (self, group):
+    reports = self.get_instance_reports (group)
+
+    # no leader yet, nothing to scale
+    if (len (reports) == 0):
+      return
+
+    current = len (reports)
+    desired = self.autoscaler.desired_instances (reports)
+    if (desired == current):
+      return
+    if (time.time () - self.last_change_time.get (group, 0) < self.cooldown):
+      return
+
+    self.logger.info ("AutoscalerAppln::scale_group - {}: {} -> {} instances, load {:.0f} deliveries/s".format (group, current, desired, self.autoscaler.group_load (reports)))
+    if (desired > current):
+      for i in range (desired - current):
+        self.start_instance (group)
+    else:
+      for i in range (current - desired):
+        self.stop_instance (group)
+    self.last_change_time[group] = time.time ()
+
+  ########################################
+  # start_instance
+  ########################################
+  def start_instance (self, group):
+    name = "{}-scale{}".format (group, self.num_launched)
+    port = self.next_port
+    self.num_launched += 1
+    self.next_port += 1
+
+    command = [sys.executable, os.path.join (os.path.dirname (os.path.abspath (__file__)), "BrokerAppln.py"),
+               "-n", name, "-g", group, "-p", str (port), "--scale_out"] + self.broker_args
+    log_file = open (os.path.join (self.log_dir, name + ".log"), "w")
+    process = subprocess.Popen (command, stdout=log_file, stderr=subprocess.STDOUT)
+    log_file.close ()
+
+    self.launched.setdefault (group, []).append ((name, process))
+    self.logger.info ("AutoscalerAppln::start_instance - started {} on port {} (pid {})".format (name, port, process.pid))
+
+  ########################################
+  # stop_instance
+  #
+  # The last instance we started goes first
+  ########################################
+  def stop_instance (self, group):
+    if (len (self.launched.get (group, [])) == 0):
+      return
+
+    name, process = self.launched[group].pop ()
+    try:
+      self.zk_client.delete ('/broker_instances/' + group + '/' + name)
+    except NoNodeError:
+      pass
+
+    self.draining.append ((time.time () + self.drain_period, name, process))
+    self.logger.info ("AutoscalerAppln::stop_instance - draining {}".format (name))
+
+  ########################################
+  # reap_instances
+  #
+  # Terminate the drained instances, forget the ones that are gone
+  ########################################
+  def reap_instances (self):
+    now = time.time ()
+    for entry in [entry for entry in self.draining if entry[0] <= now]:
+      entry[2].terminate ()
+      self.draining.remove (entry)
+      self.logger.info ("AutoscalerAppln::reap_instances - stopped {}".format (entry[1]))
+
+    # an instance stops on its own once the publishers are done
+    for group, instances in self.launched.items ():
+      self.launched[group] = [(name, process) for name, process in instances if process.poll () == None]
+
+  ########################################
+  # shutdown
+  ########################################
+  def shutdown (self):
+    for instances in self.launched.values ():
+      for name, process in instances:
+        process.terminate ()
+    for entry in self.draining:
+      entry[2].terminate ()
+    self.zk_client.stop ()
+    self.zk_client.close ()
+
+  ########################################
+  # driver program
+  ########################################
+  def driver (self):
+    ''' Driver program '''
+
+    try:
+      self.logger.info ("AutoscalerAppln::driver")
+      self.dump ()
+
+      try:
+        while True:
+          for group in self.groups:
+            self.scale_group (group)
+          self.reap_instances ()
+          time.sleep (self.check_interval)
+
+      finally:
+        self.shutdown ()
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # dump the contents of the object
+  ########################################
+  def dump (self):
+    ''' Pretty print '''
+
+    try:
+      self.logger.info ("**********************************")
+      self.logger.info ("AutoscalerAppln::dump")
+      self.logger.info ("------------------------------")
+      self.logger.info ("     Groups: {}".format (self.groups))
+      self.logger.info ("     Scale out above: {} deliveries/s or backlog {}".format (self.autoscaler.scale_out_load, self.autoscaler.max_backlog))
+      self.logger.info ("     Instances: {} to {}".format (self.autoscaler.min_instances, self.autoscaler.max_instances))
+      self.logger.info ("     Interval: {} s, cooldown {} s, drain {} s".format (self.check_interval, self.cooldown, self.drain_period))
+      self.logger.info ("**********************************")
+
+    except Exception as e:
+      raise e
+
+
+###################################
+#
+# Parse command line arguments
+#
+###################################
+def parseCmdLineArgs ():
+  # instantiate a ArgumentParser object
+  parser = argparse.ArgumentParser (description="Broker Autoscaler")
+
+  parser.add_argument ("-a", "--addr", default="localhost", help="IP addr the broker instances advertise (default: localhost)")
+
+  parser.add_argument ("-p", "--base_port", type=int, default=5600, help="Port of the first broker instance we start, the next ones count up from there, default=5600")
+
+  parser.add_argument ("-g", "--groups", default=None, help="Comma separated broker groups to scale, default all groups of config.ini")
+
+  parser.add_argument ("-c", "--config", default="config.ini", help="configuration file (default: config.ini)")
+
+  parser.add_argument ("-z", "--zookeeper", default='localhost:2181', help="Address of the Zookeeper instance")
+
+  parser.add_argument ("-j", "--dht_json_path", type=str, default='dht.json', help="Passed on to the broker instances")
+
+  parser.add_argument ("-t", "--broker_timeout", type=int, default=20, help="Timeout of the broker instances for receiving publications, default 20")
+
+  parser.add_argument ("-o", "--log_dir", default=".", help="Directory for the output of the broker instances, default .")
+
+  parser.add_argument ("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+
+  parser.add_argument ("--log_json", action="store_true", help="Write the logs as JSON lines, with the fields of every record, default: plain text")
+
+  return parser.parse_args()
+
+
+###################################
+#
+# Main program
+#
+###################################
+def main ():
+  try:
+    # obtain a system wide logger and initialize it to debug level to begin with
+    logging.info ("Main - acquire a child logger and then log messages in the child")
+    logger = logging.getLogger ("AutoscalerAppln")
+
+    # first parse the arguments
+    logger.debug ("Main: parse command line arguments")
+    args = parseCmdLineArgs ()
+
+    # reset the log level to as specified
+    logger.debug ("Main: resetting log level to {}".format (args.loglevel))
+    logger.setLevel (args.loglevel)
+    setup_logging (level=logging.DEBUG, structured=args.log_json)
+    logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
+
+    # Obtain the autoscaler application
+    logger.debug ("Main: obtain the autoscaler appln object")
+    autoscaler_app = AutoscalerAppln (logger)
+
+    # configure the object
+    logger.debug ("Main: configure the autoscaler appln object")
+    autoscaler_app.configure (args)
+
+    # now invoke the driver program
+    logger.debug ("Main: invoke the autoscaler appln driver")
+    autoscaler_app.driver ()
+
+  except Exception as e:
+    logger.error ("Exception caught in main - {}".format (e))
+    return
+
+
+###################################
+#
+# Main entry point
+#
+###################################
+if __name__ == "__main__":
+
+  # set underlying default logging capabilities, written off the event loop
+  setup_logging (level=logging.DEBUG)
+
+  main ()
@@ -24,6 +24,7 @@ import time   # for sleep
 import argparse # for argument parsing
 import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
+from CS6381_MW.AsyncLogging import setup_logging # logs written by a listener thread
 
 # Import our topic selector. Feel free to use alternate way to
 # get your topics of interest
@@ -38,8 +39,8 @@ from CS6381_MW import discovery_pb2
 from enum import Enum  # for an enumeration we are using to describe what state we are in
 
 # Objects to interact with Zookeeper
-from kazoo.client import KazooClient
-from kazoo.exceptions import NodeExistsError
+from CS6381_MW.InMemoryZooKeeper import zookeeper_client # kazoo client, or the in-memory stand-in for inmemory:// addresses
+from kazoo.exceptions import NodeExistsError, NoNodeError
 import json
 
 
@@ -58,7 +59,8 @@ class BrokerAppln ():
     ISREADY = 3,
     LOOKUP_ALL_PUBLISHERS = 4,
     RECEIVE_AND_DISSEMINATE = 5,
-    COMPLETED = 6
+    COMPLETED = 6,
+    STANDBY = 7
 
   ########################################
   # constructor
@@ -75,16 +77,28 @@ class BrokerAppln ():
     # Zookeeper-related variables
     self.zk_client = None
     self.discovery = None
-    self.discovery_leader_addr = None 
-    self.discovery_leader_port = None
-    self.discovery_leader_sync_port = None
+    self.static_discovery_leaders = '' # Leaders in [Discovery] of config.ini, used without ZooKeeper
     self.addr = None
     self.port = None
     self.zk_am_broker_leader = False
+    self.hot_standby = False # standbys connect to the publishers and mirror the last values
+    self.zk_session_timeout = 10.0 # how long ZooKeeper takes to notice a crashed leader
+    self.election_won_time = None
 
     # Load-balancing-related variables
     self.group = None
     self.topics_assigned = None
+    self.topics_looked_up = [] # topics we asked the discovery service about
+    self.rebalance = None # Static or Adaptive assignment of topics to groups
+    self.load_report_interval = None # seconds between reports of our load per topic
+    self.overlap_period = None # seconds we keep forwarding a topic moved to another group
+    self.topic_rates = {} # topic -> smoothed {'msgs': per sec, 'bytes': per sec}
+    self.load_node_created = False
+
+    # Autoscaling-related variables
+    self.autoscale = False # the group may run extra broker instances
+    self.scale_out = False # we are an extra instance started by the autoscaler
+    self.instance_load_node_created = False
 
   ########################################
   # configure/initialize
@@ -111,6 +125,7 @@ class BrokerAppln ():
       config.read (args.config)
       self.lookup = config["Discovery"]["Strategy"]
       self.dissemination = config["Dissemination"]["Strategy"]
+      self.static_discovery_leaders = config["Discovery"].get("Leaders", self.static_discovery_leaders)
 
       # Now setup up our underlying middleware object to which we delegate
       # everything
@@ -122,27 +137,59 @@ class BrokerAppln ():
       # Get the group and the topics the broker is assigned to
       self.group = args.group
       self.topics_assigned = config['GroupToTopicMapping'][self.group].split(',')
-
+      self.scale_out = args.scale_out
+
+      # Hot standby brokers
+      if config.has_section('Broker'):
+        self.hot_standby = config['Broker'].getboolean('HotStandby', self.hot_standby)
+        self.zk_session_timeout = config['Broker'].getfloat('SessionTimeout', self.zk_session_timeout)
+
+      # With the Adaptive strategy, the discovery leader moves topics between the groups
+      self.rebalance = 'Static'
+      self.load_report_interval = 2.0
+      self.overlap_period = 5.0
+      if config.has_section('Rebalance'):
+        self.rebalance = config['Rebalance'].get('Strategy', self.rebalance)
+        self.load_report_interval = config['Rebalance'].getfloat('ReportInterval', self.load_report_interval)
+        self.overlap_period = config['Rebalance'].getfloat('OverlapPeriod', self.overlap_period)
+
+      # With autoscaling we report our fan-out, so we need to know our subscribers
+      if config.has_section('Autoscale'):
+        self.autoscale = config['Autoscale'].getboolean('Enabled', self.autoscale)
+      if(self.autoscale):
+        self.mw_obj.monitor_subscribers()
 
       # Connect to Zookeeper to establish connection with Primary Discovery and do broker leader election within the group
       if(self.lookup == 'ZooKeeper'):
         self.zookeeper_addr = args.zookeeper
-        self.zk_client = KazooClient(hosts=self.zookeeper_addr)
+        self.zk_client = zookeeper_client(self.zookeeper_addr, timeout=self.zk_session_timeout)
         self.zk_client.start()
 
         # Do an election for primary broker
-        # If not leader, keep spinning here until you are a leader
+        # If not leader, keep spinning here until you are a leader (unless we are a hot standby)
         # Then proceed to getting discovery, registering, lookup, etc.
-        self.conduct_broker_leader_election()
+        # An extra instance started by the autoscaler does not take part in the election
+        if(not self.scale_out):
+          self.conduct_broker_leader_election()
+
+          while not self.zk_am_broker_leader and not self.hot_standby:
+            time.sleep(0.5)
+
+          # Let subscribers connect to us ahead of time, whether we lead the group or not
+          if(self.hot_standby):
+            self.create_broker_replica_node()
 
-        while not self.zk_am_broker_leader:
-          time.sleep(0.5)
+          # The leader is the first instance of the group the subscribers are split across
+          if(self.autoscale and self.zk_am_broker_leader):
+            self.create_broker_instance_node()
 
-        # Get discovery Service
-        self.set_up_connection_to_discovery_leader()
+        # Use the current topic to group mapping and follow its changes
+        if(self.rebalance == 'Adaptive'):
+          self.set_up_watch_for_topic_mapping()
 
-        # Set up a watch for the primary discovery
-        self.set_up_watch_for_primary_discovery()
+        # Follow the discovery leader and connect to it once there is one
+        self.mw_obj.watch_discovery_leader(self.zk_client, self.static_discovery_leaders)
+        self.mw_obj.wait_for_discovery_leader()
       
       self.logger.info ("BrokerAppln::configure - configuration complete")
       
@@ -162,6 +209,13 @@ class BrokerAppln ():
         # if we get triggered, this means a discovery node has died, so we need to elect a new discovery leader and subscribe to it if we are not the leader
         self.zk_am_broker_leader = self.register_broker_with_zookeeper()        
 
+        # A hot standby is already connected to everybody, it only has to start forwarding
+        if(self.zk_am_broker_leader and self.state == self.State.STANDBY):
+          self.election_won_time = time.time()
+          self.mw_obj.start_forwarding()
+          if(self.autoscale):
+            self.create_broker_instance_node()
+
     return
   
 
@@ -194,82 +248,211 @@ class BrokerAppln ():
 
 
   ########################################
-  # set_up_connection_to_discovery_leader
+  # create_broker_replica_node
+  #
+  # Every broker of a group, leader or standby, has a node
+  # /broker_replicas/<group>/<name> so that subscribers can connect to
+  # all of them and do not have to wait for a new leader to show up
   ########################################
-  def set_up_connection_to_discovery_leader(self):
-    # If exists, get value, set up watch
-    # If doesn't exist, spin until it is created
-    discovery_leader_path = '/discovery/leader'
+  def create_broker_replica_node(self):
+    data_dict = {
+      'addr': self.addr,
+      'port': self.port,
+      'name': self.name
+    }
+    data_bytes = json.dumps(data_dict).encode('utf-8')
+    self.zk_client.create('/broker_replicas/' + self.group + '/' + self.name, ephemeral=True, makepath=True, value=data_bytes)
+    return
 
-    # spin while we are waiting for primary discovery to appear
-    while True:
-      if(self.zk_client.exists(discovery_leader_path)):
-        # Retrieve info about the leader
-        leader_info = self.get_data_about_discovery_leader()
 
-        # update discovery leader info
-        self.discovery_leader_addr = leader_info['addr']
-        self.discovery_leader_port = leader_info['port']
-        self.discovery_leader_sync_port = leader_info['sub_port']
-        
-        # Connect to the new discovery and subscribe for updates from it
-        self.mw_obj.connect_to_discovery_leader(leader_info['addr'], leader_info['port'], leader_info['sub_port'])
-        break
+  ########################################
+  # create_broker_instance_node
+  #
+  # With autoscaling, every broker that forwards for a group has a node
+  # /broker_instances/<group>/<name>. The subscribers of the group are
+  # split across these instances
+  ########################################
+  def create_broker_instance_node(self):
+    data_dict = {
+      'addr': self.addr,
+      'port': self.port,
+      'name': self.name
+    }
+    data_bytes = json.dumps(data_dict).encode('utf-8')
+    self.zk_client.create('/broker_instances/' + self.group + '/' + self.name, ephemeral=True, makepath=True, value=data_bytes)
+    return
 
-      else:
-        # Node does not exist yet, so we wait
-        time.sleep(1)
+
+  ########################################
+  # set_up_watch_for_topic_mapping
+  #
+  # The discovery leader stores the topic to group mapping in
+  # /rebalance/mapping. Until there is one, we use the one of config.ini.
+  # The watch runs in a kazoo thread, so it only hands the topics of our
+  # group to the event loop, which applies them
+  ########################################
+  def set_up_watch_for_topic_mapping(self):
+    self.mw_obj.watch_zk_events()
+
+    @self.zk_client.DataWatch('/rebalance/mapping')
+    def watch_topic_mapping(data, stat):
+      if(data == None):
+        return
+
+      mapping = json.loads(data.decode('utf-8'))
+      self.logger.info(f"Topic mapping version {mapping['version']}: {mapping['groups']}")
+      self.mw_obj.post_zk_event('mapping', mapping['groups'].get(self.group, []))
+      return
 
 
   ########################################
-  # set_up_watch_for_primary_discovery
+  # handle_zk_event
+  #
+  # Upcall from the event loop of the middleware with the latest event of
+  # a kind posted by our ZooKeeper watches
   ########################################
-  def set_up_watch_for_primary_discovery(self):
-    # Set up a watch for discovery leader to get notified when it changes
-    @self.zk_client.ChildrenWatch('/discovery')
-    def watch_discovery_children(children):
-      # No children means the discovery died, so we can disconnect from the old one
-      if (len(children) == 0):
-        # Disconnect from the old one if there is an old one
-        if(self.discovery_leader_addr != None):
-          self.mw_obj.disconnect_from_old_discovery_leader(self.discovery_leader_addr, self.discovery_leader_port, self.discovery_leader_sync_port)
+  def handle_zk_event(self, kind, payload):
+    if(kind == 'mapping'):
+      self.apply_topic_mapping(payload)
+    return
 
-        # Update the info about the discovery leader
-        self.discovery_leader_addr = None
-        self.discovery_leader_port = None
-        self.discovery_leader_sync_port = None
 
-        return
+  ########################################
+  # apply_topic_mapping
+  #
+  # Start forwarding the topics moved to our group and keep forwarding the
+  # ones moved away for the overlap period, so that no data is lost while
+  # the broker of the other group connects to their publishers
+  ########################################
+  def apply_topic_mapping(self, new_topics):
+    added = [topic for topic in new_topics if topic not in self.topics_assigned]
+    removed = [topic for topic in self.topics_assigned if topic not in new_topics]
+    if(len(added) == 0 and len(removed) == 0):
+      return
 
-      # There is a child, so there is a primary discovery
-      else:
-        # Retrieve info about the leader
-        leader_info = self.get_data_about_discovery_leader()
+    self.logger.info(f"BrokerAppln::apply_topic_mapping - topics added: {added}, removed: {removed}")
+    self.topics_assigned = list(new_topics)
 
-        # If the leader has changed, connect to the new leader
-        if(leader_info['addr'] != self.discovery_leader_addr):
-        
-          # Disconnect from old one if we are still connected (i.e. )
-          if(self.discovery_leader_addr != None):
-            self.mw_obj.disconnect_from_old_discovery_leader(self.discovery_leader_addr, self.discovery_leader_port, self.discovery_leader_sync_port)
-          
-          # Connect to the new discovery and subscribe for updates from it
-          self.mw_obj.connect_to_discovery_leader(leader_info['addr'], leader_info['port'], leader_info['sub_port'])
-
-          # Update info about discovery leader
-          self.discovery_leader_addr = leader_info['addr'] 
-          self.discovery_leader_port = leader_info['port']
-          self.discovery_leader_sync_port = leader_info['sub_port']
+    # Before our lookup there is nothing else to do, the lookup uses the new topics.
+    # A hot standby is subscribed already, just like a broker that forwards
+    if(self.state != self.State.RECEIVE_AND_DISSEMINATE and self.state != self.State.STANDBY):
+      return
+
+    self.mw_obj.subscribe_to_topics(added)
+    self.mw_obj.connect_to_publishers(self.find_publishers_of_topics(added))
+    self.mw_obj.retire_topics(removed, time.time() + self.overlap_period)
+    return
+
+
+  ########################################
+  # find_publishers_of_topics
+  #
+  # ip:port of the publishers of the given topics. Every publisher has an
+  # ownership strength node <name>-<sequence> under /topic/<topic> and
+  # its address in /pubs/<name>
+  ########################################
+  def find_publishers_of_topics(self, topics):
+    ipports = set()
+    for topic in topics:
+      try:
+        children = self.zk_client.get_children('/topic/' + topic)
+      except NoNodeError:
+        continue
+
+      for child in children:
+        try:
+          pub_data, _ = self.zk_client.get('/pubs/' + child[:child.rfind('-')])
+        except NoNodeError:
+          continue
+        pub_info = json.loads(pub_data.decode('utf-8'))
+        ipports.add(pub_info['addr'] + ':' + str(pub_info['port']))
+
+    return list(ipports)
+
+
+  ########################################
+  # report_topic_load
+  #
+  # Upcall from the middleware with the messages and bytes forwarded per
+  # topic during the last elapsed seconds, and how many of these messages
+  # found others queued behind them
+  ########################################
+  def report_topic_load(self, topic_stats, backlogged, elapsed):
+    if(self.zk_client == None):
       return
 
+    if(self.rebalance == 'Adaptive'):
+      self.report_topic_rates(topic_stats, elapsed)
+    if(self.autoscale):
+      self.report_instance_load(topic_stats, backlogged, elapsed)
+    return
+
+
+  ########################################
+  # report_topic_rates
+  #
+  # The smoothed rates go to /rebalance/load/<group> for the discovery
+  # leader to rebalance on
+  ########################################
+  def report_topic_rates(self, topic_stats, elapsed):
+    # Exponentially weighted moving average, so that a single burst does not move topics around
+    smoothing = 0.5
+    report = {}
+    for topic in self.topics_assigned:
+      msgs, num_bytes = topic_stats.get(topic, (0, 0))
+      old_rates = self.topic_rates.get(topic, {'msgs': msgs / elapsed, 'bytes': num_bytes / elapsed})
+      self.topic_rates[topic] = {
+        'msgs': smoothing * msgs / elapsed + (1 - smoothing) * old_rates['msgs'],
+        'bytes': smoothing * num_bytes / elapsed + (1 - smoothing) * old_rates['bytes']
+      }
+      report[topic] = self.topic_rates[topic]
+
+    data_bytes = json.dumps(report).encode('utf-8')
+    path = '/rebalance/load/' + self.group
+    if(not self.load_node_created):
+      try:
+        self.zk_client.create(path, ephemeral=True, makepath=True, value=data_bytes)
+        self.load_node_created = True
+        return
+      except NodeExistsError:
+        # left behind by the previous leader of our group until its session expires
+        self.load_node_created = True
+
+    # no need to wait for ZooKeeper on the data path
+    self.zk_client.set_async(path, data_bytes)
+    return
+
 
   ########################################
-  # get_data_about_discovery_leader
+  # report_instance_load
+  #
+  # Our throughput, fan-out and backlog go to /autoscale/load/<group>/<name>
+  # for the autoscaler. The report carries its time, a broker that has
+  # nothing to forward does not report
   ########################################
-  def get_data_about_discovery_leader(self):
-    disc_leader_data, _ = self.zk_client.get('/discovery/leader')
-    data_dict = json.loads(disc_leader_data.decode('utf-8'))
-    return data_dict
+  def report_instance_load(self, topic_stats, backlogged, elapsed):
+    msgs = sum(stats[0] for stats in topic_stats.values())
+    num_bytes = sum(stats[1] for stats in topic_stats.values())
+    report = {
+      'msgs': msgs / elapsed,
+      'bytes': num_bytes / elapsed,
+      'subscribers': self.mw_obj.num_subscribers,
+      'backlog': backlogged / msgs if msgs > 0 else 0.0,
+      'time': time.time()
+    }
+
+    data_bytes = json.dumps(report).encode('utf-8')
+    path = '/autoscale/load/' + self.group + '/' + self.name
+    if(not self.instance_load_node_created):
+      try:
+        self.zk_client.create(path, ephemeral=True, makepath=True, value=data_bytes)
+        self.instance_load_node_created = True
+        return
+      except NodeExistsError:
+        self.instance_load_node_created = True
+
+    self.zk_client.set_async(path, data_bytes)
+    return
 
 
 
@@ -285,6 +468,17 @@ class BrokerAppln ():
       # dump our contents (debugging purposes)
       self.dump ()
 
+      # An extra instance does not register, the subscribers find it in ZooKeeper
+      if(self.scale_out):
+        self.start_scale_out()
+        return
+
+      # A hot standby subscribes to the publishers of our group right away but only
+      # mirrors their publications until it becomes the leader of the group
+      if(self.hot_standby and not self.zk_am_broker_leader):
+        self.start_standby()
+        return
+
       # the next thing we should be doing is to register with the discovery
       # service. But because we are simply delegating everything to an event loop
       # that will call us back, we will need to know when we get called back as to
@@ -310,6 +504,60 @@ class BrokerAppln ():
     except Exception as e:
       raise e
 
+  ########################################
+  # start_standby
+  ########################################
+  def start_standby(self):
+    self.logger.info ("BrokerAppln::start_standby - hot standby for {}".format (self.group))
+    self.state = self.State.STANDBY
+    self.mw_obj.forwarding = False
+
+    # The publishers come from ZooKeeper, new ones from the updates of the discovery leader
+    self.mw_obj.connect_to_publishers(self.find_publishers_of_topics(self.topics_assigned))
+    self.mw_obj.subscribe_to_topics(self.topics_assigned)
+
+    # We may have won the election in the meantime
+    if(self.zk_am_broker_leader):
+      self.election_won_time = time.time()
+      self.mw_obj.start_forwarding()
+
+    self.mw_obj.event_loop (timeout=None)
+    self.logger.info ("BrokerAppln::driver completed")
+    return
+
+
+  ########################################
+  # start_scale_out
+  ########################################
+  def start_scale_out(self):
+    self.logger.info ("BrokerAppln::start_scale_out - extra instance for {}".format (self.group))
+
+    # Same publishers and topics as the leader of our group
+    self.mw_obj.connect_to_publishers(self.find_publishers_of_topics(self.topics_assigned))
+    self.mw_obj.subscribe_to_topics(self.topics_assigned)
+    self.state = self.State.RECEIVE_AND_DISSEMINATE
+
+    # Only now that we receive the publications let subscribers move to us
+    self.create_broker_instance_node()
+
+    self.mw_obj.event_loop (timeout=None)
+    self.logger.info ("BrokerAppln::driver completed")
+    return
+
+
+  ########################################
+  # handle_takeover
+  #
+  # Upcall from the middleware when we forward our first publication as
+  # the new leader. We still register with the discovery service so that
+  # new subscribers find us
+  ########################################
+  def handle_takeover(self):
+    self.logger.info ("BrokerAppln::handle_takeover - forwarding {:.1f} ms after winning the election".format (1000 * (time.time() - self.election_won_time)))
+    self.state = self.State.REGISTER
+    return 0
+
+
   ########################################
   # generic invoke method called as part of upcall
   #
@@ -362,7 +610,8 @@ class BrokerAppln ():
         # Send the lookup request to receive info about all publishers
         # we will need to subscribe to all of them
         # self.mw_obj.send_allpub_lookup_request()
-        self.mw_obj.send_lookup_request(self.topics_assigned)
+        self.topics_looked_up = list(self.topics_assigned)
+        self.mw_obj.send_lookup_request(self.topics_looked_up)
 
         # Block until we receive the lookup response
         return None
@@ -435,13 +684,15 @@ class BrokerAppln ():
     try:
       self.logger.info ("BrokerAppln::isready_response")
 
-      # Notice how we get that loop effect with the sleep (10)
+      # Notice how we get that loop effect with the timeout
       # by an interaction between the event loop and these
       # upcall methods.
       if not isready_resp.status:
-        # discovery service is not ready yet
+        # discovery service is not ready yet. Check again soon: the publishers
+        # start as soon as it is, and we only receive what they publish once
+        # we looked them up. The event loop waits for us rather than a sleep
         self.logger.debug ("BrokerAppln::driver - Not ready yet; check again")
-        time.sleep (10)  # sleep between calls so that we don't make excessive calls
+        return 100
 
       else:
         # we got the go ahead
@@ -467,6 +718,12 @@ class BrokerAppln ():
 
       # Now we subscribe/connect to all publishers
       self.mw_obj.connect_to_publishers(lookup_resp.addressesToConnectTo)
+      self.mw_obj.subscribe_to_topics(self.topics_assigned)
+
+      # Topics moved to our group while we were waiting for the response
+      missed_topics = [topic for topic in self.topics_assigned if topic not in self.topics_looked_up]
+      if(len(missed_topics) > 0 and self.zk_client != None):
+        self.mw_obj.connect_to_publishers(self.find_publishers_of_topics(missed_topics))
 
       # Once we are subscribed, we transition to state RECEIVE_AND_DISSEMINATE
       self.state = self.State.RECEIVE_AND_DISSEMINATE
@@ -491,6 +748,10 @@ class BrokerAppln ():
       self.logger.info ("     Name: {}".format (self.name))
       self.logger.info ("     Lookup: {}".format (self.lookup))
       self.logger.info ("     Dissemination: {}".format (self.dissemination))
+      self.logger.info ("     Group: {}".format (self.group))
+      self.logger.info ("     Topics: {}".format (self.topics_assigned))
+      self.logger.info ("     Rebalance: {}".format (self.rebalance))
+      self.logger.info ("     Autoscale: {}{}".format (self.autoscale, " (extra instance)" if self.scale_out else ""))
       self.logger.info ("**********************************")
 
     except Exception as e:
@@ -528,7 +789,18 @@ def parseCmdLineArgs ():
 
   # group assignment for load balancing
   parser.add_argument("-g", "--group", choices=['group1', 'group2', 'group3'], help="What group the broker is assigned to")
+
+  # started by the autoscaler as an extra instance of the group
+  parser.add_argument("--scale_out", action="store_true", default=False, help="Run as an extra broker instance of the group, without leader election and registration (see AutoscalerAppln.py)")
   
+  parser.add_argument ("--metrics_port", type=int, default=0, help="Serve the event loop metrics in the Prometheus text format on this port (http://localhost:<port>/metrics), default 0: no metrics")
+
+  parser.add_argument ("--trace", default=None, help="Write the publications we receive, with the time they came in, to this trace file (compressed if it ends in .gz) for PublisherAppln.py --replay, default none")
+
+  parser.add_argument ("--log_json", action="store_true", help="Write the logs as JSON lines, with the fields of every record, default: plain text")
+
+  parser.add_argument ("--log_every", type=int, default=100, help="Log 1 in N of the messages per topic, default 100")
+
   return parser.parse_args()
 
 
@@ -550,6 +822,7 @@ def main ():
     # reset the log level to as specified
     logger.debug ("Main: resetting log level to {}".format (args.loglevel))
     logger.setLevel (args.loglevel)
+    setup_logging (level=logging.DEBUG, structured=args.log_json)
     logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
 
     # Obtain a Broker application
@@ -580,9 +853,8 @@ def main ():
 ###################################
 if __name__ == "__main__":
 
-  # set underlying default logging capabilities
-  logging.basicConfig (level=logging.DEBUG,
-                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  # set underlying default logging capabilities, written off the event loop
+  setup_logging (level=logging.DEBUG)
 
 
   main ()
\ No newline at end of file
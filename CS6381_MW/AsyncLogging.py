@@ -0,0 +1,114 @@
+###############################################
+#
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose: Logging of the applications and middleware off their event loops
+#
+# Created: Spring 2023
+#
+###############################################
+
+# Every application sets up its logging with setup_logging in place of
+# logging.basicConfig. The only handler of the root logger puts the records
+# in a queue (QueueHandler) and a QueueListener thread formats and writes
+# them to stderr, so a slow terminal or log file never stalls an event loop.
+#
+# With --log_json every record is written as one JSON object per line: its
+# time, level, logger and message plus whatever was passed with extra=,
+# e.g., extra={"topic": topic}, so the logs can be filtered by machine.
+#
+# The logs of the message paths go through a LogSampler, which lets 1 in N
+# messages per key (e.g., topic) through (--log_every), and use %-style
+# arguments, so that nothing is formatted for a record that is not emitted.
+
+import copy
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# arguments that cannot change before the listener formats the record
+IMMUTABLE_TYPES = (str, bytes, int, float, bool, type (None))
+
+# attributes of every record, the others came with extra=
+STANDARD_ATTRIBUTES = set (vars (logging.LogRecord ("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+listener = None # the QueueListener writing the records
+handler = None # its handler
+
+
+##################################
+# JSON lines formatter
+##################################
+class JsonFormatter (logging.Formatter):
+
+  def format (self, record):
+    entry = {"time": record.created, "level": record.levelname, "logger": record.name, "message": record.getMessage ()}
+    for key, value in record.__dict__.items ():
+      if key not in STANDARD_ATTRIBUTES:
+        entry[key] = value
+    if record.exc_info:
+      entry["exception"] = self.formatException (record.exc_info)
+    return json.dumps (entry, default=str)
+
+
+##################################
+# queue handler leaving the formatting to the listener
+##################################
+class LazyQueueHandler (logging.handlers.QueueHandler):
+
+  # QueueHandler formats the whole record right away, in case it has to
+  # cross to another process. Ours stays in the process, so only the message
+  # of a record whose arguments could still change is merged here, and the
+  # rest (time, exception) is left to the formatter of the listener
+  def prepare (self, record):
+    args = record.args if isinstance (record.args, tuple) else (record.args,)
+    if all (isinstance (arg, IMMUTABLE_TYPES) for arg in args):
+      return record
+    record = copy.copy (record)
+    record.msg = record.getMessage ()
+    record.args = None
+    return record
+
+
+########################################
+# setup_logging
+#
+# The first call starts the listener, later ones (once the command line is
+# parsed) only change the format
+########################################
+def setup_logging (level=logging.DEBUG, structured=False):
+  global listener, handler
+
+  if listener == None:
+    log_queue = queue.SimpleQueue ()
+    handler = logging.StreamHandler () # stderr, as with basicConfig
+    listener = logging.handlers.QueueListener (log_queue, handler)
+    root = logging.getLogger ()
+    root.addHandler (LazyQueueHandler (log_queue))
+    root.setLevel (level)
+    listener.start ()
+    # registered before the metrics sink and traces, so stopped after them
+    atexit.register (listener.stop)
+
+  handler.setFormatter (JsonFormatter () if structured else logging.Formatter (FORMAT))
+
+
+##################################
+# 1 in N messages per key
+##################################
+class LogSampler ():
+
+  def __init__ (self, every=1):
+    self.every = max (1, every)
+    self.counts = {} # key -> messages seen
+
+  # True for the first message of a key and every N-th one after it
+  def sample (self, key):
+    count = self.counts.get (key, 0)
+    self.counts[key] = count + 1
+    return count % self.every == 0
@@ -0,0 +1,79 @@
+###############################################
+#
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose: Decide how many broker instances a broker group needs
+#
+# Created: Spring 2023
+#
+###############################################
+
+# Every broker instance of a group (the leader and the extra instances the
+# autoscaler started) forwards all the topics of the group, the subscribers
+# are split across them. What an instance pays for is the fan-out, so its load
+# is the number of messages it forwards per second times the number of
+# subscribers connected to it. Next to that, the instances report the fraction
+# of the messages that found more messages queued behind them on the SUB
+# socket (backlog), i.e., how often the broker did not keep up.
+#
+#   - scale out when an instance carries more than scale_out_load or has a
+#     backlog above max_backlog, to as many instances as the load of the group
+#     needs (at least one more)
+#   - scale in, one instance at a time, when the group load would still stay
+#     below scale_in_fraction of scale_out_load on one instance less
+#
+# The gap between the two thresholds keeps the group from flapping.
+
+import math
+
+##################################
+#       BrokerAutoscaler class
+##################################
+class BrokerAutoscaler ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, scale_out_load=20000, scale_in_fraction=0.5, max_backlog=0.2, min_instances=1, max_instances=4):
+    self.scale_out_load = scale_out_load # deliveries per second above which an instance is overloaded
+    self.scale_in_fraction = scale_in_fraction # of scale_out_load, below which we remove an instance
+    self.max_backlog = max_backlog # fraction of messages that found others queued
+    self.min_instances = min_instances
+    self.max_instances = max_instances
+
+  ########################################
+  # instance_load
+  #
+  # report: {'msgs': per sec, 'bytes': per sec, 'subscribers': n, 'backlog': fraction}
+  ########################################
+  def instance_load (self, report):
+    return report.get ('msgs', 0) * max (report.get ('subscribers', 0), 1)
+
+  ########################################
+  # group_load
+  ########################################
+  def group_load (self, reports):
+    return sum (self.instance_load (report) for report in reports.values ())
+
+  ########################################
+  # desired_instances
+  #
+  # reports: instance name -> latest report, one entry per running instance
+  ########################################
+  def desired_instances (self, reports):
+    current = len (reports)
+    if current == 0:
+      return self.min_instances
+
+    total = self.group_load (reports)
+    busiest = max (self.instance_load (report) for report in reports.values ())
+    backlog = max (report.get ('backlog', 0) for report in reports.values ())
+
+    desired = current
+    if busiest > self.scale_out_load or backlog > self.max_backlog:
+      desired = max (current + 1, math.ceil (total / self.scale_out_load))
+    elif current > 1 and total / (current - 1) < self.scale_in_fraction * self.scale_out_load:
+      desired = current - 1
+
+    return min (max (desired, self.min_instances), self.max_instances)
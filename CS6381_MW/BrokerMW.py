@@ -25,12 +25,19 @@ import os     # for OS functions
 import sys    # for syspath and system exception
 import time   # for sleep
 import logging # for logging. Use it in place of print statements.
+import threading # the ZooKeeper watches run in the kazoo threads
+import collections
 import zmq  # ZMQ sockets
+from zmq.utils.monitor import recv_monitor_message # events of the PUB socket
 import json # for reading the dht.json file
-import random # for choosing a random DHT node to contact
 
 # import serialization logic
 from CS6381_MW import discovery_pb2
+from CS6381_MW.DhtRing import DhtRing
+from CS6381_MW.DiscoveryLeaderResolver import DiscoveryLeaderResolver
+from CS6381_MW.LoopMetrics import LoopMetrics, create_socket
+from CS6381_MW.TraceFile import TraceWriter
+from CS6381_MW.AsyncLogging import LogSampler
 #from CS6381_MW import topic_pb2  # you will need this eventually
 
 # import any other packages you need.
@@ -57,11 +64,36 @@ class BrokerMW ():
 
     # Zookeeper-related fields
     self.disc_sub_socket = None # Socket for subscribing to updates from discovery
+    self.leader_resolver = None # follows the discovery leader
+    self.zk_event_pair = None # PAIR socket on which the event loop receives the ZooKeeper watch events
+    self.zk_event_sender = None # its peer, written to from the kazoo threads
+    self.zk_event_lock = threading.Lock () # kazoo runs watches and async completions in different threads
+    self.zk_event_generation = collections.Counter () # kind of event -> generation of the latest one posted
+    self.zk_applied_generation = {} # kind of event -> generation of the latest one handled
+    self.loop_metrics = None # how the event loop spends its time, with --metrics_port
+    self.trace = None # where the publications we receive are written, with --trace
+    self.log_sampler = LogSampler () # which of the messages we log, 1 in --log_every per topic
     # self.discovery_leader_addr = None 
     # self.discovery_leader_port = None
     # self.discovery_leader_sync_port = None
     self.ipports_connected_to = set()
 
+    # Load-balancing-related fields
+    self.topics_subscribed = set() # topics we forward (one SUB filter each)
+    self.retiring_topics = {} # topic moved to another group -> time until which we keep forwarding it
+    self.topic_stats = {} # topic -> [messages, bytes] since the last load report
+    self.last_report_time = time.time ()
+
+    # Autoscaling-related fields
+    self.backlogged_msgs = 0 # messages since the last load report that found others queued behind them
+    self.pub_monitor = None # socket monitor of the PUB socket, to count our subscribers
+    self.num_subscribers = 0
+
+    # Hot standby-related fields
+    self.forwarding = True # a hot standby receives the publications but does not forward them
+    self.takeover_pending = False # set when a standby has become the leader of its group
+    self.last_values = {} # topic -> latest publication (last value cache)
+
   ########################################
   # configure/initialize
   ########################################
@@ -76,6 +108,7 @@ class BrokerMW ():
       self.port = args.port
       self.addr = args.addr
       self.timeout = args.timeout * 1000 # timeout for receiving data when subscribed in ms
+      self.log_sampler = LogSampler (args.log_every)
 
       # path to the DHT.json file
       self.dht_json_path = args.dht_json_path
@@ -84,6 +117,15 @@ class BrokerMW ():
       self.logger.debug ("BrokerMW::configure - obtain ZMQ context")
       context = zmq.Context ()  # returns a singleton object
 
+      # keep track of the event loop if asked to
+      if args.metrics_port:
+        self.loop_metrics = LoopMetrics (self.logger, args.name, ["handle_bytes_on_req_socket", "handle_discovery_leader_change", "handle_zk_events", "handle_sync_update_from_disc_leader", "handle_event_on_pub_monitor", "handle_bytes_on_sub_socket"])
+        self.loop_metrics.serve (args.metrics_port)
+
+      # and trace the publications we receive if asked to
+      if args.trace:
+        self.trace = TraceWriter (self.logger, args.trace)
+
       # get the ZMQ poller object
       self.logger.debug ("BrokerMW::configure - obtain the poller")
       self.poller = zmq.Poller ()
@@ -92,15 +134,18 @@ class BrokerMW ():
       # PUB is needed because we publish topic data
       # SUB is neded for subscribing to all data
       self.logger.debug ("BrokerMW::configure - obtain REQ, PUB, and SUB sockets")
-      self.req = context.socket (zmq.REQ)
-      self.pub = context.socket (zmq.PUB)
-      self.sub = context.socket (zmq.SUB)
+      self.req = create_socket (context, zmq.REQ, self.loop_metrics, "req")
+      self.pub = create_socket (context, zmq.PUB, self.loop_metrics, "pub")
+      self.sub = create_socket (context, zmq.SUB, self.loop_metrics, "sub")
 
       # Register both REQ and SUB sockets with poller
       # Will be handled in different way
       self.logger.debug ("BrokerMW::configure - register the REQ socket for incoming replies")
       self.poller.register (self.req, zmq.POLLIN)
       self.poller.register (self.sub, zmq.POLLIN)
+      if self.loop_metrics != None:
+        self.loop_metrics.watch (self.req, "handle_bytes_on_req_socket")
+        self.loop_metrics.watch (self.sub, "handle_bytes_on_sub_socket")
       
       # Now connect ourselves to the discovery service. Recall that the IP/port were
       # supplied in our argument parsing. Best practices of ZQM suggest that the
@@ -110,12 +155,9 @@ class BrokerMW ():
       # if we are using DHT lookup, we are connecting to a random node in DHT file
       # otherwise, we are connecting to the discovery service specified in the parameters
       if (self.upcall_obj.lookup == "DHT"):
-        f = open(self.dht_json_path)
-        dht_file = json.load(f) # get dht.hson as a dictionary
-        dht_nodes_number = len(dht_file['dht'])
-        self.dht_num = dht_nodes_number
-        random_index = random.randint(0, dht_nodes_number-1)
-        randomly_chosen_dht = dht_file['dht'][random_index]
+        dht_ring = DhtRing.load(self.dht_json_path) # uses the binary ring descriptor when it is up to date
+        self.dht_num = len(dht_ring)
+        randomly_chosen_dht = dht_ring.random_node()
         self.logger.debug (f"PublisherMW::configure - connect to DHT Discovery service: {randomly_chosen_dht}")
         connect_str = "tcp://" + randomly_chosen_dht['IP'] + ":" + str(randomly_chosen_dht['port'])
         self.req.connect (connect_str)
@@ -126,9 +168,11 @@ class BrokerMW ():
 
       elif (self.upcall_obj.lookup == "ZooKeeper"):
         # Set up a SUB socket to later connect to a discovery
-        self.disc_sub_socket = context.socket (zmq.SUB)
+        self.disc_sub_socket = create_socket (context, zmq.SUB, self.loop_metrics, "disc_sub")
         # Add the sub socket to the poller
         self.poller.register (self.disc_sub_socket, zmq.POLLIN)
+        if self.loop_metrics != None:
+          self.loop_metrics.watch (self.disc_sub_socket, "handle_sync_update_from_disc_leader")
         
         # Make the subscriber listen for topics sub and unsub
         # sub is for used for notifying subs of new entities they need to subscribe to
@@ -162,7 +206,11 @@ class BrokerMW ():
       while self.handle_events:  # it starts with a True value
         # poll for events. We give it an infinite timeout.
         # The return value is a socket to event mask mapping
+        if self.loop_metrics != None:
+          self.loop_metrics.before_poll ()
         events = dict (self.poller.poll (timeout=timeout))
+        if self.loop_metrics != None:
+          self.loop_metrics.after_poll (events)
 
         # Unlike the previous starter code, here we are never returning from
         # the event loop but handle everything in the same locus of control
@@ -184,10 +232,22 @@ class BrokerMW ():
           timeout = self.handle_bytes_on_req_socket ()
 
 
+        elif self.leader_resolver != None and self.leader_resolver.socket in events:
+          # The discovery leader changed, keep the timeout we had
+          self.handle_discovery_leader_change()
+
+        elif self.zk_event_pair != None and self.zk_event_pair in events:
+          # A ZooKeeper watch fired, keep the timeout we had
+          self.handle_zk_events ()
+
         elif self.disc_sub_socket in events:
           # Received an update from the discovery leader
           timeout = self.handle_sync_update_from_disc_leader()
 
+        # a subscriber connected or went away, nothing changes for the timeout
+        elif self.pub_monitor in events:
+          self.handle_event_on_pub_monitor ()
+
         # publishers have published the data
         elif self.sub in events:
             timeout = self.handle_bytes_on_sub_socket ()
@@ -252,16 +312,75 @@ class BrokerMW ():
 
       # let us first receive all the bytes
       bytesRcvd = self.sub.recv ()
-      data_string = bytesRcvd.decode()
-      self.logger.info ("BrokerMW::handle_bytes_on_sub_socket – RECEIVED DATA: %s", data_string)
+      if self.trace != None:
+        self.trace.write (bytesRcvd)
+      # only the topic is needed, the rest is forwarded as is
+      topic = bytesRcvd[:bytesRcvd.find (b':')].decode ()
+      if self.log_sampler.sample (topic):
+        self.logger.info ("BrokerMW::handle_bytes_on_sub_socket - received %d bytes on topic %s", len (bytesRcvd), topic, extra={"topic": topic})
+
+      # topics handed over to another group are only forwarded until their overlap period ends
+      if self.retiring_topics:
+        self.unsubscribe_from_retired_topics ()
+      if topic not in self.topics_subscribed:
+        if self.loop_metrics != None:
+          self.loop_metrics.drop ("not_assigned")
+        return self.timeout if self.forwarding else None
+
+      # a hot standby only keeps the last value cache up to date
+      self.last_values[topic] = bytesRcvd
+      if not self.forwarding:
+        return None
+
+      timeout = self.timeout
+      if self.takeover_pending:
+        timeout = self.take_over (topic)
 
       self.pub.send (bytesRcvd)
+
+      # keep track of the load per topic and let the application report it now and then
+      stats = self.topic_stats.setdefault (topic, [0, 0])
+      stats[0] += 1
+      stats[1] += len (bytesRcvd)
+      if self.sub.getsockopt (zmq.EVENTS) & zmq.POLLIN:
+        self.backlogged_msgs += 1
+      now = time.time ()
+      if now - self.last_report_time >= self.upcall_obj.load_report_interval:
+        self.upcall_obj.report_topic_load (self.topic_stats, self.backlogged_msgs, now - self.last_report_time)
+        self.topic_stats = {}
+        self.backlogged_msgs = 0
+        self.last_report_time = now
     
-      return self.timeout
+      return timeout
     
     except Exception as e:
       raise e  
 
+  ########################################
+  # monitor_subscribers
+  #
+  # ZMQ does not tell a PUB socket who is connected, its socket monitor
+  # does. Used to report our fan-out to the autoscaler
+  ########################################
+  def monitor_subscribers (self):
+    self.pub_monitor = self.pub.get_monitor_socket (zmq.EVENT_ACCEPTED | zmq.EVENT_DISCONNECTED)
+    self.poller.register (self.pub_monitor, zmq.POLLIN)
+    if self.loop_metrics != None:
+      self.loop_metrics.watch (self.pub_monitor, "handle_event_on_pub_monitor")
+    return
+
+  #################################################################
+  # handle_event_on_pub_monitor
+  #################################################################
+  def handle_event_on_pub_monitor (self):
+    event = recv_monitor_message (self.pub_monitor)
+    if event['event'] == zmq.EVENT_ACCEPTED:
+      self.num_subscribers += 1
+    elif event['event'] == zmq.EVENT_DISCONNECTED:
+      self.num_subscribers = max (self.num_subscribers - 1, 0)
+    self.logger.debug ("BrokerMW::handle_event_on_pub_monitor - %d subscribers", self.num_subscribers)
+    return
+
   ########################################
   # register with the discovery service
   #
@@ -315,7 +434,7 @@ class BrokerMW ():
       # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
       # a real string
       buf2send = disc_req.SerializeToString ()
-      self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
+      self.logger.debug ("Stringified serialized buf = %s", buf2send)
 
       # now send this to our discovery service
       self.logger.debug ("BrokerMW::register - send stringified buffer to Discovery service")
@@ -366,7 +485,7 @@ class BrokerMW ():
       # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
       # a real string
       buf2send = disc_req.SerializeToString ()
-      self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
+      self.logger.debug ("Stringified serialized buf = %s", buf2send)
 
       # now send this to our discovery service
       self.logger.debug ("BrokerMW::is_ready - send stringified buffer to Discovery service")
@@ -412,7 +531,7 @@ class BrokerMW ():
       # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
       # a real string
       buf2send = disc_req.SerializeToString ()
-      self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
+      self.logger.debug ("Stringified serialized buf = %s", buf2send)
 
       # now send this to our discovery service
       self.logger.debug ("BrokerMW::send_allpub_lookup_request - send stringified buffer to Discovery service")
@@ -457,7 +576,7 @@ class BrokerMW ():
       # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
       # a real string
       buf2send = disc_req.SerializeToString ()
-      self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
+      self.logger.debug ("Stringified serialized buf = %s", buf2send)
 
       # now send this to our discovery service
       self.logger.debug ("BrokerMW::lookup - send stringified buffer to Discovery service")
@@ -482,12 +601,11 @@ class BrokerMW ():
 
       # connect to every publisher we are interested in
       for ipport in addressesToConnectTo:
+        if ipport in self.ipports_connected_to:
+          continue
         self.sub.connect ("tcp://" + ipport)
         self.ipports_connected_to.add(ipport)
 
-      # Subscribe to all topics
-      self.sub.setsockopt (zmq.SUBSCRIBE, bytes("", 'utf-8'))
-
       self.logger.info ("BrokerMW::connect_to_publishers – Connected to all of them!")
       self.logger.info("BrokerMW::connect_to_publishers – Connected to the following addresses: %s", str(addressesToConnectTo))
     
@@ -495,6 +613,87 @@ class BrokerMW ():
       raise e      
 
             
+  ########################################
+  # subscribe_to_topics
+  #
+  # The publishers we connect to may publish topics of other groups too, so
+  # we only subscribe to (and forward) the topics assigned to our group
+  ########################################
+  def subscribe_to_topics (self, topiclist):
+    ''' subscribe_to_topics '''
+
+    try:
+      self.logger.info ("BrokerMW::subscribe_to_topics - %s", str (topiclist))
+
+      for topic in topiclist:
+        # a topic handed back to us during its overlap period is simply kept
+        self.retiring_topics.pop (topic, None)
+        if topic not in self.topics_subscribed:
+          # the publishers send "topic:data", the colon keeps "light" from matching "lightning"
+          self.sub.setsockopt (zmq.SUBSCRIBE, bytes (topic + ":", 'utf-8'))
+          self.topics_subscribed.add (topic)
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # retire_topics
+  #
+  # Topics moved to another group. We keep forwarding them until the given
+  # time so that nothing is lost while the new broker connects to the publishers
+  ########################################
+  def retire_topics (self, topiclist, until):
+    ''' retire_topics '''
+
+    try:
+      self.logger.info ("BrokerMW::retire_topics - %s", str (topiclist))
+
+      for topic in topiclist:
+        if topic in self.topics_subscribed:
+          self.retiring_topics[topic] = until
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # unsubscribe_from_retired_topics
+  ########################################
+  def unsubscribe_from_retired_topics (self):
+    now = time.time ()
+    for topic, until in list (self.retiring_topics.items ()):
+      if now < until:
+        continue
+      self.logger.info ("BrokerMW::unsubscribe_from_retired_topics - overlap period of %s is over", topic)
+      self.sub.setsockopt (zmq.UNSUBSCRIBE, bytes (topic + ":", 'utf-8'))
+      self.topics_subscribed.discard (topic)
+      del self.retiring_topics[topic]
+      self.topic_stats.pop (topic, None)
+      self.last_values.pop (topic, None)
+
+  ########################################
+  # start_forwarding
+  #
+  # Called when the hot standby we are has won the election of its group.
+  # The actual switch happens in the event loop with the next publication
+  ########################################
+  def start_forwarding (self):
+    self.takeover_pending = True
+    self.forwarding = True
+
+  ########################################
+  # take_over
+  #
+  # Our subscribers are already connected to us, so we replay the last value
+  # of every other topic (whatever the old leader may not have forwarded
+  # before it died) and let the application register with the discovery service
+  ########################################
+  def take_over (self, current_topic):
+    self.takeover_pending = False
+    for topic, last_value in self.last_values.items ():
+      if topic != current_topic:
+        self.pub.send (last_value)
+    return self.upcall_obj.handle_takeover ()
+
   ########################################
   # set upcall handle
   #
@@ -515,6 +714,110 @@ class BrokerMW ():
     self.handle_events = False
 
 
+  ########################################
+  # watch_discovery_leader
+  #
+  # Follow the discovery leader through ZooKeeper, or the static endpoints
+  # (Leaders in the [Discovery] section of config.ini) without it
+  ########################################
+  def watch_discovery_leader(self, zk_client, static_leaders):
+    self.leader_resolver = DiscoveryLeaderResolver(self.logger, zmq.Context.instance(), DiscoveryLeaderResolver.parse_static_leaders(static_leaders))
+    self.poller.register(self.leader_resolver.socket, zmq.POLLIN)
+    if self.loop_metrics != None:
+      self.loop_metrics.watch (self.leader_resolver.socket, "handle_discovery_leader_change")
+    self.leader_resolver.start(zk_client)
+    return
+
+
+  ########################################
+  # watch_zk_events
+  #
+  # ZooKeeper watch events get to the event loop through an inproc pipe,
+  # so that only the thread of the event loop uses our sockets and state
+  ########################################
+  def watch_zk_events(self):
+    context = zmq.Context.instance()
+    pipe = "inproc://zk-events-" + str (id (self))
+    self.zk_event_pair = context.socket (zmq.PAIR)
+    self.zk_event_pair.bind (pipe)
+    self.zk_event_sender = context.socket (zmq.PAIR)
+    self.zk_event_sender.connect (pipe)
+    self.poller.register (self.zk_event_pair, zmq.POLLIN)
+    if self.loop_metrics != None:
+      self.loop_metrics.watch (self.zk_event_pair, "handle_zk_events")
+    return
+
+
+  ########################################
+  # post_zk_event
+  #
+  # Called from the kazoo threads, hands the event to the event loop.
+  # Events of the same kind are full snapshots, so only the latest one
+  # of a kind is handled
+  ########################################
+  def post_zk_event(self, kind, payload):
+    with self.zk_event_lock:
+      self.zk_event_generation[kind] += 1
+      event = {'kind': kind, 'generation': self.zk_event_generation[kind], 'payload': payload}
+      self.zk_event_sender.send (json.dumps (event).encode ('utf-8'))
+    return
+
+
+  ########################################
+  # handle_zk_events
+  #
+  # Take all the events queued up so far and make one upcall per kind
+  # with the latest of them
+  ########################################
+  def handle_zk_events(self):
+    latest = {}
+    while True:
+      try:
+        bytesRcvd = self.zk_event_pair.recv (zmq.NOBLOCK)
+      except zmq.Again:
+        break
+      event = json.loads (bytesRcvd.decode ('utf-8'))
+      if event['kind'] not in latest or event['generation'] > latest[event['kind']]['generation']:
+        latest[event['kind']] = event
+
+    for kind, event in latest.items ():
+      if event['generation'] <= self.zk_applied_generation.get (kind, 0):
+        continue
+      self.zk_applied_generation[kind] = event['generation']
+      self.upcall_obj.handle_zk_event (kind, event['payload'])
+    return
+
+
+  ########################################
+  # wait_for_discovery_leader
+  #
+  # Block until there is a discovery leader and connect to it
+  ########################################
+  def wait_for_discovery_leader(self):
+    self.leader_resolver.wait_for_leader()
+    self.handle_discovery_leader_change()
+    return
+
+
+  ########################################
+  # handle_discovery_leader_change
+  #
+  # Called from the event loop when the discovery leader may have changed
+  ########################################
+  def handle_discovery_leader_change(self):
+    change = self.leader_resolver.handle_event()
+    if change == None:
+      return
+
+    old, new = change
+    self.logger.info("BrokerMW::handle_discovery_leader_change - from {} to {}".format(old, new))
+    if(old != None):
+      self.disconnect_from_old_discovery_leader(old['addr'], old['port'], old['sub_port'])
+    if(new != None):
+      self.connect_to_discovery_leader(new['addr'], new['port'], new['sub_port'])
+    return
+
+
   ########################################
   # connect_to_discovery_leader
   #
@@ -555,8 +858,19 @@ class BrokerMW ():
     beginning_of_payload = (bytesRcvd.find(':') + 1)
     update_type = bytesRcvd[:(beginning_of_payload-1)]
     string_received = bytesRcvd[beginning_of_payload:]
-    data_dict = json.loads(string_received)
+    data = json.loads(string_received)
 
+    # after a burst of ZooKeeper events the discovery leader sends all the changes in one message
+    for data_dict in (data if isinstance(data, list) else [data]):
+      self.apply_sync_update(update_type, data_dict)
+
+    return None
+
+
+  ########################################
+  # apply_sync_update
+  ########################################
+  def apply_sync_update(self, update_type, data_dict):
     ipport = data_dict['addr'] + ':' + str(data_dict['port'])
 
     # New broker or pub has joined
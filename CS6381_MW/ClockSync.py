@@ -0,0 +1,210 @@
+###############################################
+#
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose: Offset of our clock from the clock of the discovery service
+#
+# Created: Spring 2023
+#
+###############################################
+
+# A latency is the clock of the subscriber when a publication comes in minus
+# the clock of the publisher when it went out, so any offset between the two
+# clocks ends up in every measurement. Started with --clock_sync <seconds>, a
+# publisher or subscriber estimates the offset of its clock from the clock of
+# the discovery node it talks to (the leader with ZooKeeper), NTP-style:
+#
+#    t1  request sent (our clock)       t2  request received (discovery)
+#    t4  response received (our clock)  t3  response sent (discovery)
+#
+#    offset = ((t2 - t1) + (t3 - t4)) / 2      delay = (t4 - t1) - (t3 - t2)
+#
+# and the true offset is within delay / 2 of the estimate. Every <seconds> a
+# thread makes a burst of exchanges over a REQ socket of its own and keeps the
+# one with the smallest delay (the least queueing on the way). The drift of
+# our clock is the slope of the offsets of the last bursts, and the error
+# bound grows by the frequency tolerance of NTP (15 ppm) after each burst.
+#
+# Our clock is the monotonic clock plus the wall clock at the start, so that
+# a step of the wall clock in the middle of a run does not end up in the
+# latencies. Publishers stamp their publications with it plus the offset, as
+# integer ns on the clock of the discovery node, and subscribers compare
+# them to theirs. Without --clock_sync, or before the first burst, the
+# offset is 0 and the error unknown (None).
+#
+# With the DHT lookup publishers and subscribers may talk to different
+# discovery nodes, whose clocks are then taken to agree.
+
+import time
+import atexit
+import threading
+import collections
+import zmq
+
+from CS6381_MW import discovery_pb2
+
+PHI = 15e-6 # frequency tolerance of NTP, how fast an estimate gets stale
+MAX_DRIFT = 500e-6 # larger slopes are noise, NTP gives up beyond 500 ppm
+
+
+##################################
+#       ClockSync class
+##################################
+class ClockSync ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, logger, samples=8, bursts=8, timeout=1.0):
+    self.logger = logger
+    self.samples = samples # exchanges per burst
+    self.bursts = collections.deque (maxlen=bursts) # best exchange of the last bursts, (monotonic ns, offset, delay)
+    self.timeout = timeout # seconds we wait for a response
+    self.interval = None
+    self.base_ns = time.time_ns () - time.monotonic_ns () # our clock is the monotonic one plus this
+
+    # (monotonic ns of the estimate, offset there, drift, error bound there),
+    # replaced as a whole so the event loop reads it without a lock
+    self.estimate = (0, 0, 0.0, None)
+
+    self.endpoint = None # the discovery node we synchronize with
+    self.changed = threading.Event () # a new endpoint or time to stop
+    self.stopped = False
+    self.thread = None
+
+  ########################################
+  # our clock corrected by the estimate: (ns since the epoch, offset applied,
+  # error bound or None)
+  ########################################
+  def stamp (self):
+    mono = time.monotonic_ns ()
+    at, offset, drift, error = self.estimate
+    offset += int (drift * (mono - at))
+    if error != None:
+      error += int (PHI * (mono - at))
+    return mono + self.base_ns + offset, offset, error
+
+  def now_ns (self):
+    return self.stamp ()[0]
+
+  ########################################
+  # a time.time () value, e.g., when a round was due, on the corrected clock
+  ########################################
+  def reference_ns (self, wall_time):
+    return self.now_ns () + int ((wall_time - time.time ()) * 1e9)
+
+  ########################################
+  # the discovery node to synchronize with, e.g., a new leader
+  ########################################
+  def set_server (self, endpoint):
+    if endpoint != self.endpoint:
+      self.endpoint = endpoint
+      self.changed.set ()
+
+  ########################################
+  # start the exchanges, a burst every interval seconds
+  ########################################
+  def start (self, context, interval):
+    self.interval = interval
+    self.thread = threading.Thread (target=self.run, args=(context,), name="ClockSync", daemon=True)
+    self.thread.start ()
+    atexit.register (self.close)
+    self.logger.info ("ClockSync::start - estimating the offset of our clock every {} s".format (interval))
+
+  def close (self):
+    if self.thread == None or self.stopped:
+      return
+    self.stopped = True
+    self.changed.set ()
+    self.thread.join (self.timeout + 1)
+
+  ########################################
+  # the thread
+  ########################################
+  def run (self, context):
+    socket = None
+    endpoint = None
+    while not self.stopped:
+      # another discovery node, another clock
+      if self.endpoint != endpoint:
+        if socket != None:
+          socket.close ()
+          socket = None
+        endpoint = self.endpoint
+        self.bursts.clear ()
+
+      if endpoint != None:
+        if socket == None:
+          socket = context.socket (zmq.REQ)
+          socket.setsockopt (zmq.LINGER, 0)
+          # we may send again when a response got lost, and ignore it if it comes late
+          socket.setsockopt (zmq.REQ_RELAXED, 1)
+          socket.setsockopt (zmq.REQ_CORRELATE, 1)
+          socket.connect (endpoint)
+        self.burst (socket, endpoint)
+
+      self.changed.wait (self.interval)
+      self.changed.clear ()
+
+    if socket != None:
+      socket.close ()
+
+  ########################################
+  # a burst of exchanges, the one with the smallest delay is kept
+  ########################################
+  def burst (self, socket, endpoint):
+    disc_req = discovery_pb2.DiscoveryReq ()
+    disc_req.msg_type = discovery_pb2.TYPE_CLOCK
+    disc_req.clock_req.SetInParent ()
+    buf2send = disc_req.SerializeToString ()
+
+    best = None
+    for i in range (self.samples):
+      if self.stopped or self.endpoint != endpoint:
+        return
+      t1 = time.monotonic_ns ()
+      socket.send (buf2send)
+      if not socket.poll (self.timeout * 1000):
+        self.logger.warning ("ClockSync::burst - no response from {} within {} s".format (endpoint, self.timeout))
+        return
+      disc_resp = discovery_pb2.DiscoveryResp ()
+      disc_resp.ParseFromString (socket.recv ())
+      t4 = time.monotonic_ns ()
+      if disc_resp.msg_type != discovery_pb2.TYPE_CLOCK:
+        continue
+
+      t2 = disc_resp.clock_resp.receive_ns
+      t3 = disc_resp.clock_resp.transmit_ns
+      offset = ((t2 - (t1 + self.base_ns)) + (t3 - (t4 + self.base_ns))) // 2
+      delay = max ((t4 - t1) - (t3 - t2), 0)
+      if best == None or delay < best[2]:
+        best = ((t1 + t4) // 2, offset, delay)
+
+    if best != None:
+      self.bursts.append (best)
+      self.update ()
+
+  ########################################
+  # a new estimate from the bursts
+  ########################################
+  def update (self):
+    at, measured, delay = self.bursts[-1]
+    offset = measured
+    drift = 0.0
+
+    # the slope of the offsets over time (least squares), once there are
+    # enough bursts to tell it from the noise
+    if len (self.bursts) >= 3:
+      mean_at = sum (burst[0] for burst in self.bursts) / len (self.bursts)
+      mean_offset = sum (burst[1] for burst in self.bursts) / len (self.bursts)
+      variance = sum ((burst[0] - mean_at) ** 2 for burst in self.bursts)
+      if variance > 0:
+        drift = sum ((burst[0] - mean_at) * (burst[1] - mean_offset) for burst in self.bursts) / variance
+        drift = max (-MAX_DRIFT, min (MAX_DRIFT, drift))
+        offset = int (mean_offset + drift * (at - mean_at))
+
+    # the fit may lie off the last measurement, which is only known within delay / 2
+    error = delay // 2 + abs (offset - measured)
+    self.estimate = (at, offset, drift, error)
+    self.logger.info ("ClockSync::update - offset {:.3f} ms, error bound {:.3f} ms, drift {:.1f} ppm".format (offset / 1e6, error / 1e6, drift * 1e6))
@@ -0,0 +1,423 @@
+###############################################
+#
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose: In-memory model of the DHT ring shared by all middleware entities
+#
+# Created: Spring 2023
+#
+###############################################
+
+# Every entity that uses the DHT lookup strategy needs some view of the ring
+# described by the dht.json file. The discovery nodes need it to build their
+# finger tables and the publishers, subscribers and brokers need it to pick a
+# discovery node to talk to.
+#
+# Rather than each middleware object parsing the JSON file and scanning all the
+# nodes in a nested loop, we keep the nodes sorted by hash in this class and
+# answer successor queries with a binary search (bisect). Building a finger
+# table is therefore O(m log N) for m bits of hash and N nodes in the ring.
+#
+# Parsing a large JSON file is itself slow, so the first time we load a ring we
+# save a compact binary descriptor of it next to the JSON file (dht.json ->
+# dht.ring). Subsequent loads use the descriptor as long as the JSON file has
+# not changed since (we remember its size and modification time).
+#
+# With only a handful of discovery nodes hashed once each, the share of the
+# hash space owned by each node is very uneven. So a physical node may be
+# placed on the ring at several positions (virtual nodes or tokens). The
+# positions either come from the "vnodes" list of a node in the dht.json file
+# (see DHT_utils/exp_generator.py) or are derived here from the number of
+# virtual nodes we are asked to use, scaled by the optional "capacity" of the
+# node. The node owns a key if the first token at or after the key is one of
+# its tokens. Without virtual nodes every node has exactly one token, its hash.
+
+import os     # for OS functions
+import json   # for reading the dht.json file
+import array  # for compact storage of hashes and ports
+import struct # for the header of the binary ring descriptor
+import random # for choosing a random DHT node to contact
+import bisect # for binary search over the sorted hashes
+import hashlib  # for the secure hash library
+
+
+# magic and version of the binary ring descriptor
+RING_CACHE_MAGIC = b'DHTR'
+RING_CACHE_VERSION = 2
+
+# header: magic, version, bits of hash, num of nodes, num of explicit tokens, json size, json mtime (ns), length of string blob
+RING_CACHE_HEADER = struct.Struct ('<4sHHIIqqI')
+
+
+#################
+# hash value
+#
+# Module-level version of the hash function used across the system so that
+# the ring and its users agree on how ids are mapped to the ring
+#################
+def hash_func (id, bits_hash=48):
+  # first get the digest from hashlib and then take the desired number of bytes from the
+  # lower end of the 256 bits hash. Big or little endian does not matter.
+  hash_digest = hashlib.sha256 (bytes (id, "utf-8")).digest ()  # this is how we get the digest or hash value
+  # figure out how many bytes to retrieve
+  num_bytes = int (bits_hash/8)  # otherwise we get float which we cannot use below
+  hash_val = int.from_bytes (hash_digest[:num_bytes], "big")  # take lower N number of bytes
+  return hash_val
+
+
+#################
+# token hash
+#
+# Position of the i-th token of a node (i >= 1, the 0-th is the hash of
+# the node), the same whether the ring derives it or exp_generator.py
+# writes it to the dht file
+#################
+def token_hash (node, i, bits_hash=48):
+  return hash_func (node['id'] + ":" + node['IP'] + ":" + str (node['port']) + "#" + str (i), bits_hash)
+
+
+##################################
+#       DhtRing class
+##################################
+class DhtRing ():
+
+  ########################################
+  # constructor
+  #
+  # nodes is a list of dictionaries as found in the dht.json file, i.e.,
+  # with keys id, hash, IP, port and host, and optionally vnodes (list of
+  # token hashes) and capacity (relative weight, default 1)
+  ########################################
+  def __init__ (self, nodes, bits_hash=48, virtual_nodes=1):
+    self.bits_hash = bits_hash
+    self.address_space = 2 ** bits_hash
+    self.virtual_nodes = virtual_nodes
+    self.nodes = sorted (nodes, key=lambda d: d['hash'])  # nodes sorted by hash
+    self.hashes = [node['hash'] for node in self.nodes]  # sorted hashes used for bisect
+    self.id_to_node = {node['id']: node for node in self.nodes}
+
+    # the tokens of all nodes sorted by hash, along with the node owning each of them
+    tokens = []
+    for node in self.nodes:
+      for token in self.node_tokens (node):
+        tokens.append ((token, node))
+    tokens.sort (key=lambda t: t[0])
+    self.token_hashes = [token for token, node in tokens]
+    self.token_nodes = [node for token, node in tokens]
+
+  ########################################
+  # number of nodes in the ring
+  ########################################
+  def __len__ (self):
+    return len (self.nodes)
+
+  ########################################
+  # node_tokens
+  #
+  # Positions of a node on the ring. The first one is always the hash of
+  # the node so that a ring without virtual nodes is unchanged.
+  ########################################
+  def node_tokens (self, node):
+    if node.get ('vnodes'):
+      return node['vnodes']
+
+    tokens = [node['hash']]
+    for i in range (1, self.num_tokens (node)):
+      tokens.append (token_hash (node, i, self.bits_hash))
+    return tokens
+
+  ########################################
+  # num_tokens
+  #
+  # How many positions a node without explicit tokens gets: the number of
+  # virtual nodes scaled by its capacity
+  ########################################
+  def num_tokens (self, node):
+    return max (1, int (round (self.virtual_nodes * node.get ('capacity', 1))))
+
+  ########################################
+  # is_virtual
+  #
+  # True if some node has more than one position on the ring
+  ########################################
+  def is_virtual (self):
+    return len (self.token_hashes) > len (self.nodes)
+
+  ########################################
+  # load
+  #
+  # Load the ring from the JSON file, preferring the binary descriptor
+  # next to it if it is up to date.
+  ########################################
+  @classmethod
+  def load (cls, json_path, bits_hash=48, use_cache=True, virtual_nodes=1):
+    cache_path = cls.cache_path_for (json_path)
+    json_stat = os.stat (json_path)
+
+    if use_cache:
+      ring = cls.read_cache (cache_path, json_stat, bits_hash, virtual_nodes)
+      if ring is not None:
+        return ring
+
+    # descriptor is missing or stale, so parse the JSON file
+    with open (json_path) as f:
+      dht_file = json.load (f)  # get dht.json as a dictionary
+
+    ring = cls (dht_file['dht'], bits_hash, virtual_nodes)
+
+    if use_cache:
+      ring.write_cache (cache_path, json_stat)
+
+    return ring
+
+  ########################################
+  # cache_path_for
+  #
+  # dht.json -> dht.ring in the same directory
+  ########################################
+  @staticmethod
+  def cache_path_for (json_path):
+    return os.path.splitext (json_path)[0] + '.ring'
+
+  ########################################
+  # read_cache
+  #
+  # Returns the ring stored in the binary descriptor or None if the
+  # descriptor does not exist or does not correspond to the JSON file
+  ########################################
+  @classmethod
+  def read_cache (cls, cache_path, json_stat, bits_hash, virtual_nodes=1):
+    try:
+      with open (cache_path, 'rb') as f:
+        buf = f.read ()
+    except OSError:
+      return None
+
+    if len (buf) < RING_CACHE_HEADER.size:
+      return None
+
+    magic, version, bits, count, num_tokens, json_size, json_mtime, blob_len = RING_CACHE_HEADER.unpack_from (buf, 0)
+    if (magic != RING_CACHE_MAGIC or version != RING_CACHE_VERSION or bits != bits_hash
+        or json_size != json_stat.st_size or json_mtime != json_stat.st_mtime_ns):
+      return None
+
+    # hashes and ports are stored as two arrays of unsigned ints
+    offset = RING_CACHE_HEADER.size
+    hashes = array.array ('Q')
+    hashes.frombytes (buf[offset:offset + 8*count])
+    offset += 8*count
+    ports = array.array ('I')
+    ports.frombytes (buf[offset:offset + 4*count])
+    offset += 4*count
+
+    # capacities and the explicit tokens (vnodes) of the nodes, if any
+    capacities = array.array ('d')
+    capacities.frombytes (buf[offset:offset + 8*count])
+    offset += 8*count
+    token_counts = array.array ('I')
+    token_counts.frombytes (buf[offset:offset + 4*count])
+    offset += 4*count
+    tokens = array.array ('Q')
+    tokens.frombytes (buf[offset:offset + 8*num_tokens])
+    offset += 8*num_tokens
+
+    # followed by the id, IP and host of every node separated by newlines
+    strings = buf[offset:offset + blob_len].decode ('utf-8').split ('\n')
+    if len (hashes) != count or len (strings) != 3*count or len (tokens) != num_tokens:
+      return None
+
+    nodes = []
+    token_offset = 0
+    for idx in range (count):
+      node = {
+        'id': strings[3*idx],
+        'hash': hashes[idx],
+        'IP': strings[3*idx + 1],
+        'port': ports[idx],
+        'host': strings[3*idx + 2]
+      }
+      if capacities[idx] != 1:
+        node['capacity'] = capacities[idx]
+      if token_counts[idx]:
+        node['vnodes'] = tokens[token_offset:token_offset + token_counts[idx]].tolist ()
+        token_offset += token_counts[idx]
+      nodes.append (node)
+
+    # the nodes were saved in sorted order already, so sorting them again is cheap
+    return cls (nodes, bits_hash, virtual_nodes)
+
+  ########################################
+  # write_cache
+  #
+  # Save the binary descriptor. Failing to do so (e.g., read-only
+  # directory) is not an error, we just parse the JSON next time.
+  ########################################
+  def write_cache (self, cache_path, json_stat):
+    hashes = array.array ('Q', self.hashes)
+    ports = array.array ('I', [node.get ('port') or 0 for node in self.nodes])
+    capacities = array.array ('d', [node.get ('capacity', 1) for node in self.nodes])
+    token_counts = array.array ('I', [len (node.get ('vnodes') or []) for node in self.nodes])
+    tokens = array.array ('Q')
+    for node in self.nodes:
+      tokens.extend (node.get ('vnodes') or [])
+    strings = []
+    for node in self.nodes:
+      strings.extend ([node['id'], node['IP'], node.get ('host', '')])
+    blob = '\n'.join (strings).encode ('utf-8')
+
+    header = RING_CACHE_HEADER.pack (RING_CACHE_MAGIC, RING_CACHE_VERSION, self.bits_hash, len (self.nodes), len (tokens),
+                                     json_stat.st_size, json_stat.st_mtime_ns, len (blob))
+
+    tmp_path = cache_path + '.tmp' + str (os.getpid ())
+    try:
+      with open (tmp_path, 'wb') as f:
+        f.write (header)
+        f.write (hashes.tobytes ())
+        f.write (ports.tobytes ())
+        f.write (capacities.tobytes ())
+        f.write (token_counts.tobytes ())
+        f.write (tokens.tobytes ())
+        f.write (blob)
+      os.replace (tmp_path, cache_path)  # atomic so concurrent readers never see half a file
+    except OSError:
+      try:
+        os.remove (tmp_path)
+      except OSError:
+        pass
+
+  ########################################
+  # successor_index
+  #
+  # Index of the first node whose hash is greater than or equal to the
+  # given hash, wrapping around to the first node of the ring. This is
+  # the order of the physical nodes (by their own hash), e.g., to find
+  # the neighbours of a node.
+  ########################################
+  def successor_index (self, hash_val):
+    idx = bisect.bisect_left (self.hashes, hash_val)
+    if idx == len (self.hashes):
+      idx = 0
+    return idx
+
+  ########################################
+  # successor_token_index
+  #
+  # Same as above over the tokens of all nodes
+  ########################################
+  def successor_token_index (self, hash_val):
+    idx = bisect.bisect_left (self.token_hashes, hash_val)
+    if idx == len (self.token_hashes):
+      idx = 0
+    return idx
+
+  ########################################
+  # successor
+  #
+  # The node responsible for the given hash
+  ########################################
+  def successor (self, hash_val):
+    return self.token_nodes[self.successor_token_index (hash_val)]
+
+  ########################################
+  # finger_table_tokens
+  #
+  # The i-th finger of a token h is the token succeeding (h + 2^i).
+  # Returns (token hash, node owning it) for every finger.
+  ########################################
+  def finger_table_tokens (self, my_hash):
+    fingers = []
+    for i in range (self.bits_hash):
+      new_hash = (my_hash + (2 ** i)) % self.address_space
+      idx = self.successor_token_index (new_hash)
+      fingers.append ((self.token_hashes[idx], self.token_nodes[idx]))
+    return fingers
+
+  ########################################
+  # finger_table_nodes
+  ########################################
+  def finger_table_nodes (self, my_hash):
+    return [node for token, node in self.finger_table_tokens (my_hash)]
+
+  ########################################
+  # tokens_of
+  #
+  # Sorted positions of the given node on the ring
+  ########################################
+  def tokens_of (self, id):
+    node = self.find_node (id)
+    if node is None:
+      return []
+    return sorted (self.node_tokens (node))
+
+  ########################################
+  # key_shares
+  #
+  # Fraction of the hash space owned by every node. A token owns the
+  # keys between the previous token (exclusive) and itself (inclusive).
+  ########################################
+  def key_shares (self):
+    shares = {node['id']: 0 for node in self.nodes}
+    num_tokens = len (self.token_hashes)
+    for idx in range (num_tokens):
+      owned = (self.token_hashes[idx] - self.token_hashes[idx - 1]) % self.address_space
+      if num_tokens == 1:
+        owned = self.address_space
+      shares[self.token_nodes[idx]['id']] += owned
+    return {id: owned / self.address_space for id, owned in shares.items ()}
+
+  ########################################
+  # find_node
+  #
+  # Returns the node with the given id or None
+  ########################################
+  def find_node (self, id):
+    return self.id_to_node.get (id)
+
+  ########################################
+  # add_node
+  #
+  # Insert a node (and its tokens) keeping everything sorted, e.g., to
+  # model nodes joining the ring
+  ########################################
+  def add_node (self, node):
+    if node['id'] in self.id_to_node:
+      raise ValueError ("DhtRing::add_node - node {} is already in the ring".format (node['id']))
+
+    idx = bisect.bisect_left (self.hashes, node['hash'])
+    self.hashes.insert (idx, node['hash'])
+    self.nodes.insert (idx, node)
+    self.id_to_node[node['id']] = node
+
+    for token in self.node_tokens (node):
+      idx = bisect.bisect_left (self.token_hashes, token)
+      self.token_hashes.insert (idx, token)
+      self.token_nodes.insert (idx, node)
+
+  ########################################
+  # remove_node
+  #
+  # Remove a node (and its tokens), e.g., to model nodes leaving the ring
+  ########################################
+  def remove_node (self, id):
+    node = self.id_to_node.pop (id)
+
+    idx = bisect.bisect_left (self.hashes, node['hash'])
+    while self.nodes[idx] is not node:
+      idx += 1
+    del self.hashes[idx]
+    del self.nodes[idx]
+
+    for token in self.node_tokens (node):
+      idx = bisect.bisect_left (self.token_hashes, token)
+      while self.token_nodes[idx] is not node:
+        idx += 1
+      del self.token_hashes[idx]
+      del self.token_nodes[idx]
+    return node
+
+  ########################################
+  # random_node
+  ########################################
+  def random_node (self):
+    return random.choice (self.nodes)
@@ -0,0 +1,155 @@
+###############################################
+#
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose: Keep track of the discovery leader for publishers, subscribers and brokers
+#
+# Created: Spring 2023
+#
+###############################################
+
+# The discovery leader stores its endpoints in the ephemeral /discovery/leader
+# node. Rather than listing /discovery and reading the node again on every
+# change (or polling for it every second until it shows up), we keep one data
+# watch on the node: ZooKeeper hands us the endpoints of a new leader together
+# with the watch, one round trip after the old leader is gone. The endpoints
+# are cached for as long as our ZooKeeper session lives, which is our lease on
+# them; while the connection is only suspended we keep using them.
+#
+# Watches run in the kazoo threads, the ZMQ sockets of the middleware belong to
+# the thread of its event loop. So a change only wakes up the event loop through
+# an inproc PAIR socket the middleware polls, and the middleware moves its own
+# sockets over to the new leader from there.
+#
+# Without ZooKeeper (it cannot be reached when we start, or our session was
+# lost) we fall back to a static list of discovery endpoints, the Leaders entry
+# of the [Discovery] section of config.ini: addr:port:sub_port separated by
+# commas, the preferred one first.
+
+import threading
+import json
+import zmq
+
+from kazoo.protocol.states import KazooState
+
+
+##################################
+#       DiscoveryLeaderResolver class
+##################################
+class DiscoveryLeaderResolver ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, logger, context, static_leaders=None):
+    self.logger = logger
+    self.static_leaders = static_leaders if static_leaders != None else [] # endpoints to use without ZooKeeper
+    self.zk_client = None
+    self.leader = None # endpoints {'addr', 'port', 'sub_port'} the middleware is connected to
+    self.latest = None # endpoints we learned about last, not handled by the event loop yet
+    self.lock = threading.Lock () # watches and the state listener run in different kazoo threads
+    self.leader_known = threading.Event () # set once we know of a leader
+
+    # wake up the event loop of the middleware
+    pipe = "inproc://discovery-leader-" + str (id (self))
+    self.socket = context.socket (zmq.PAIR)
+    self.socket.bind (pipe)
+    self.sender = context.socket (zmq.PAIR)
+    self.sender.connect (pipe)
+
+  ########################################
+  # parse_static_leaders
+  #
+  # "addr:port:sub_port,addr:port:sub_port" -> list of endpoints
+  ########################################
+  @staticmethod
+  def parse_static_leaders (spec):
+    leaders = []
+    for entry in spec.split (','):
+      if entry.strip () == '':
+        continue
+      addr, port, sub_port = entry.strip ().split (':')
+      leaders.append ({'addr': addr, 'port': int (port), 'sub_port': int (sub_port)})
+    return leaders
+
+  ########################################
+  # start
+  ########################################
+  def start (self, zk_client):
+    self.zk_client = zk_client
+    if zk_client == None or zk_client.state != KazooState.CONNECTED:
+      self.logger.info ("DiscoveryLeaderResolver::start - no ZooKeeper, using the static discovery endpoints")
+      self.use_static_leader ()
+      return
+
+    zk_client.add_listener (self.zk_state_changed)
+    zk_client.DataWatch ('/discovery/leader', self.leader_node_changed)
+
+  ########################################
+  # leader_node_changed
+  #
+  # Called by kazoo with the data of /discovery/leader, None if there is no leader
+  ########################################
+  def leader_node_changed (self, data, stat):
+    if data == None:
+      self.post (None)
+    else:
+      self.post (json.loads (data.decode ('utf-8')))
+
+  ########################################
+  # zk_state_changed
+  #
+  # Our session is our lease on the cached leader. Once it is lost, the
+  # static endpoints are all we have until the data watch fires again
+  ########################################
+  def zk_state_changed (self, state):
+    if state == KazooState.LOST and len (self.static_leaders) > 0:
+      self.use_static_leader ()
+
+  ########################################
+  # use_static_leader
+  ########################################
+  def use_static_leader (self):
+    if len (self.static_leaders) > 0:
+      self.post (self.static_leaders[0])
+
+  ########################################
+  # post
+  #
+  # Remember the endpoints and wake up the event loop. Only the latest
+  # endpoints matter, so the event loop may get several wake ups for one change
+  ########################################
+  def post (self, leader):
+    with self.lock:
+      self.latest = leader
+      self.sender.send (b'')
+    if leader != None:
+      self.leader_known.set ()
+
+  ########################################
+  # handle_event
+  #
+  # Called by the event loop, returns the (old, new) endpoints if the
+  # leader changed since it was called last, None otherwise
+  ########################################
+  def handle_event (self):
+    while True:
+      try:
+        self.socket.recv (zmq.NOBLOCK)
+      except zmq.Again:
+        break
+
+    with self.lock:
+      latest = self.latest
+
+    if latest == self.leader:
+      return None
+    old, self.leader = self.leader, latest
+    return old, latest
+
+  ########################################
+  # wait_for_leader
+  ########################################
+  def wait_for_leader (self, timeout=None):
+    return self.leader_known.wait (timeout)
@@ -25,13 +25,18 @@ import logging # for logging. Use it in place of print statements.
 import zmq  # ZMQ sockets
 import json # for reading the dht.json file
 import uuid # for creating unique identity strings
-import hashlib  # for the secure hash library
+import bisect # for routing over the tokens of virtual nodes
+import collections # for counting the requests we handle
+import threading # the ZooKeeper watches run in the threads of kazoo
 
 from CS6381_MW import discovery_pb2
+from CS6381_MW.DhtRing import DhtRing, hash_func
+from CS6381_MW.LoopMetrics import LoopMetrics, create_socket
 
 
 # A class that defines a data structure used for finger table
 class FingerTableEntry():
+  __slots__ = ('hash', 'node_info', 'dealer_socket') # fingers are many and often shared, keep them small
   def __init__(self, hash, corresponding_node_info):
     self.hash = hash
     self.node_info = corresponding_node_info
@@ -51,12 +56,40 @@ class DiscoveryMW ():
     self.port = None
     self.finger_table = [] # finger table for DHT ring
     self.dht_json_path = None
+    self.dht_ring = None # sorted view of the DHT ring
     self.my_dht_hash = None
+    self.my_tokens = [] # our positions on the ring when virtual nodes are used, sorted
+    self.token_successor = {} # our token -> finger table entry of the token right after it
+    self.routing_entries = [] # finger table entries of other nodes sorted by hash, used to route with virtual nodes
+    self.routing_hashes = []
+    self.request_load = collections.Counter () # "message type:handled/forwarded" -> number of requests
+    self.addr = None # our advertised IP address (needed if we join a ring we are not listed in)
+    self.context = None # ZMQ context, kept to create dealer sockets as the ring changes
+    self.loop_metrics = None # how the event loop spends its time, with --metrics_port
+
+    # Dynamic DHT membership (Chord-style join/leave and periodic ring maintenance)
+    self.dht_maintenance = False # whether we run stabilize/fix_fingers/check_predecessor
+    self.my_dht_node = None # our own node info in the same format as the dht.json entries
+    self.predecessor = None # node info of our predecessor, None if unknown
+    self.successor_list = [] # our first few successors, used to route around a failed successor
+    self.dealer_sockets = {} # node id -> DEALER socket connected to that node
+    self.pending_dht_requests = {} # request id -> details of a maintenance request awaiting a response
+    self.next_dht_request_id = 1
+    self.next_finger_to_fix = 1 # finger 0 (our successor) is maintained by stabilize
+    self.next_maintenance_time = None
+    self.joining = False # True until we learn our successor when joining an existing ring
+    self.failed_nodes = {} # node id -> when we found it failed, so that stale info from other nodes does not bring it back
+    self.bootstrap = None # addr:port of a node used to join the ring
 
     # Zookeeper-related fields
     self.sync_pub_socket = None # Socket for publishing updates in case you are a leader
     self.sync_pub_port = None # Port for the pub socket
     self.sync_sub_socket = None # Socket for subscribing to updates from the leader discovery
+    self.zk_event_pair = None # PAIR socket on which the event loop receives the ZooKeeper watch events
+    self.zk_event_sender = None # its peer, written to from the kazoo threads
+    self.zk_event_lock = threading.Lock () # kazoo runs watches and async completions in different threads
+    self.zk_event_generation = collections.Counter () # kind of event -> generation of the latest one posted
+    self.zk_applied_generation = {} # kind of event -> generation of the latest one handled
     
 
 
@@ -72,10 +105,18 @@ class DiscoveryMW ():
       
       # Set the port to bind to
       self.port = args.port
+      self.addr = args.addr
 
       # Next get the ZMQ context
       self.logger.debug ("DiscoveryMW::configure - obtain ZMQ context")
       context = zmq.Context ()  # returns a singleton object
+      self.context = context
+
+      # keep track of the event loop if asked to, whatever comes in on a
+      # dealer socket is a reply to a request we sent or forwarded
+      if args.metrics_port:
+        self.loop_metrics = LoopMetrics (self.logger, args.name, ["handle_request", "handle_state_sync_request", "handle_zk_events"], other="dealer_reply")
+        self.loop_metrics.serve (args.metrics_port)
 
       # get the ZMQ poller object
       self.logger.debug ("DiscoveryMW::configure - obtain the poller")
@@ -83,11 +124,13 @@ class DiscoveryMW ():
       
       # Now acquire the ROUTER
       self.logger.debug ("DiscoveryMW::configure - obtain ROUTER socket")
-      self.router = context.socket (zmq.ROUTER)
+      self.router = create_socket (context, zmq.ROUTER, self.loop_metrics, "router")
 
       # Listen for incoming requests on Router Socket
       self.logger.debug ("DiscoveryMW::configure - register the ROUTER socket for incoming replies")
       self.poller.register (self.router, zmq.POLLIN)
+      if self.loop_metrics != None:
+        self.loop_metrics.watch (self.router, "handle_request")
 
       # Set up dht-related arguments
       self.dht_json_path = args.dht_json_path
@@ -95,40 +138,54 @@ class DiscoveryMW ():
 
       # If using DHT Lookup
       if(self.upcall_obj.lookup == "DHT"):
+        # Ring maintenance parameters come from the [DHT] section of config.ini
+        self.dht_maintenance = self.upcall_obj.dht_maintenance
+        self.bootstrap = args.bootstrap
+        if self.loop_metrics != None:
+          self.loop_metrics.queue ("pending_dht_requests", lambda: len (self.pending_dht_requests))
+
         # Set up the finger table
         # Set up the table entries
         self.set_up_finger_table()
         
-        # Set up a socket for each entry
+        # Set up a socket for each distinct node in the finger table
+        # Many fingers point to the same node, so those entries share a socket
         for entry in self.finger_table:
-          # Create Socket
-          entry.dealer_socket = context.socket(zmq.DEALER)
-          
-          # Bind the socket to the address of the corresponding node
-          dealer_bind_str = "tcp://" + entry.node_info['IP'] + ":" + str(entry.node_info['port'])
-          entry.dealer_socket.connect(dealer_bind_str)
-
-          # Set identity of the socket
-          dealer_uuid = bytes(uuid.uuid4().hex, 'utf-8')
-          entry.dealer_socket.setsockopt(zmq.IDENTITY, dealer_uuid)
-
-          # register the dealer socket with poller
-          self.poller.register (entry.dealer_socket, zmq.POLLIN)
+          entry.dealer_socket = self.get_dealer_socket(entry.node_info)
 
       # If using ZooKeeper lookup
       elif(self.upcall_obj.lookup == 'ZooKeeper'):
         # set up sockets
         self.sync_pub_port = args.sub_port
-        self.sync_pub_socket = context.socket(zmq.PUB)
+        self.sync_pub_socket = create_socket (context, zmq.PUB, self.loop_metrics, "sync_pub")
         bind_string = "tcp://*:" + str(self.sync_pub_port)
         self.sync_pub_socket.bind (bind_string)
         
-        self.sync_sub_socket = context.socket(zmq.SUB)
+        self.sync_sub_socket = create_socket (context, zmq.SUB, self.loop_metrics, "sync_sub")
+
+        # ZooKeeper watch events get to the event loop through an inproc pipe,
+        # so that only the thread of the event loop uses our sockets and state
+        pipe = "inproc://zk-events-" + str (id (self))
+        self.zk_event_pair = context.socket (zmq.PAIR)
+        self.zk_event_pair.bind (pipe)
+        self.zk_event_sender = context.socket (zmq.PAIR)
+        self.zk_event_sender.connect (pipe)
+        self.poller.register (self.zk_event_pair, zmq.POLLIN)
+        if self.loop_metrics != None:
+          self.loop_metrics.watch (self.sync_sub_socket, "handle_state_sync_request")
+          self.loop_metrics.watch (self.zk_event_pair, "handle_zk_events")
       
       # Now bind to the socket for incoming requests. We are ready to accept requests from anyone, so the string is tcp://*:*
       self.logger.debug ("DiscoveryMW::configure - bind to the socket and port")
       bind_str = "tcp://*:" + str(self.port)
       self.router.bind (bind_str)
+
+      # If we are not part of the ring yet, ask an existing node for our successor
+      if self.joining:
+        self.join_ring()
+
+      if self.dht_maintenance:
+        self.next_maintenance_time = time.monotonic() + self.upcall_obj.dht_stabilize_interval
       
       self.logger.debug ("DiscoveryMW::configure completed")
 
@@ -138,46 +195,86 @@ class DiscoveryMW ():
   ########################################
   # set_up_finger_table
   ########################################
-  def set_up_finger_table(self):
-    f = open(self.dht_json_path)
-    dht_file = json.load(f) # get dht.hson as a dictionary
+  def set_up_finger_table(self, dht_ring=None):
+    # Load the ring (sorted by hash) from the dht file or its binary descriptor,
+    # unless we are given one (e.g., by the DHT simulator)
+    if dht_ring is None:
+      dht_ring = DhtRing.load(self.dht_json_path, virtual_nodes=self.upcall_obj.dht_virtual_nodes)
+    self.dht_ring = dht_ring
+    self.finger_table = []
+    if self.dht_ring.is_virtual() and self.dht_maintenance:
+      raise ValueError ("DiscoveryMW::set_up_finger_table - virtual nodes are only supported with Static DHT maintenance")
+
+    # Find yourself in the ring and get the hash
+    my_node = self.dht_ring.find_node(self.name)
+    if my_node is None:
+      if not self.dht_maintenance:
+        raise ValueError (f"DiscoveryMW::set_up_finger_table - node {self.name} is not in {self.dht_json_path}")
+
+      # We are a new node joining a running ring. Hash ourselves the same way the
+      # experiment generator hashes the nodes in the dht file
+      my_node = {
+        'id': self.name,
+        'hash': hash_func(self.name + ":" + self.addr + ":" + str(self.port)),
+        'IP': self.addr,
+        'port': self.port,
+        'host': ''
+      }
+      self.my_dht_node = my_node
+      self.my_dht_hash = my_node['hash']
 
-    # Sort DHT nodes by hash
-    dht_file['dht'] = sorted(dht_file['dht'], key=lambda d: d['hash']) 
+      # Until we hear back from the ring, we are alone and every finger points to ourselves
+      for i in range(self.dht_ring.bits_hash):
+        self.finger_table.append(FingerTableEntry(my_node['hash'], my_node))
+      self.joining = (len(self.dht_ring) > 0 or self.bootstrap is not None)
+      return
 
-    # Find yourself in the dht file and get the hash
-    for dht_info in dht_file['dht']:
-      if(dht_info['id'] == self.name):
-        self.my_dht_hash = dht_info['hash']
-        break
+    self.my_dht_node = my_node
+    self.my_dht_hash = my_node['hash']
 
-    # Populate the finger table
-    address_space = (2 ** 48)
-    for i in range(0, 48):
-      new_hash = (self.my_dht_hash + (2 ** i)) % address_space
-      
-      # go over all dhts and find the smallest entry that is largest or equal to new hash
-      successor = {
-          'id': '',
-          'hash': address_space,
-          'IP': '',
-          'port': 0,
-          'host': ''
-      }
-      for dht_node in dht_file['dht']:
-          if(dht_node['hash'] >= new_hash and successor['hash'] > dht_node['hash']):
-              successor = dht_node
-      
-      # if we haven't found a hash that is larger, then we assign 
-      # it to the first node in the ring
-      if(successor['hash'] == address_space):
-          successor = dht_file['dht'][0]
-          
-      self.finger_table.append(FingerTableEntry(successor['hash'], successor))
+    # Populate the finger table, each finger is found with a binary search over the ring
+    if self.dht_ring.is_virtual():
+      self.set_up_virtual_routing()
+    else:
+      # consecutive fingers often point to the same node, those share one entry
+      for successor in self.dht_ring.finger_table_nodes(self.my_dht_hash):
+        if not self.finger_table or self.finger_table[-1].node_info is not successor:
+          entry = FingerTableEntry(successor['hash'], successor)
+        self.finger_table.append(entry)
+
+    # Our neighbours according to the dht file
+    my_index = self.dht_ring.successor_index(self.my_dht_hash)
+    num_nodes = len(self.dht_ring)
+    if num_nodes > 1:
+      self.predecessor = self.dht_ring.nodes[(my_index - 1) % num_nodes]
+      list_size = min(self.upcall_obj.dht_successor_list_size, num_nodes - 1)
+      self.successor_list = [self.dht_ring.nodes[(my_index + i) % num_nodes] for i in range(1, list_size + 1)]
     
     # for entry in self.finger_table:
     #   self.logger.info(str([entry.hash, entry.node_info]))
 
+  ########################################
+  # set_up_virtual_routing
+  #
+  # With virtual nodes we own several tokens, each with its own fingers.
+  # The finger table is the union of those (sorted by token hash).
+  ########################################
+  def set_up_virtual_routing(self):
+    self.my_tokens = self.dht_ring.tokens_of(self.name)
+    self.token_successor = {}
+    entries = {} # token hash -> finger table entry, several fingers often share a token
+    for token in self.my_tokens:
+      fingers = self.dht_ring.finger_table_tokens(token)
+      for finger_hash, node in fingers:
+        if finger_hash not in entries:
+          entries[finger_hash] = FingerTableEntry(finger_hash, node)
+      # the first finger of a token is the token right after it
+      self.token_successor[token] = entries[fingers[0][0]]
+
+    self.finger_table = [entries[finger_hash] for finger_hash in sorted(entries)]
+    self.routing_entries = [entry for entry in self.finger_table if entry.node_info['id'] != self.name]
+    self.routing_hashes = [entry.hash for entry in self.routing_entries]
+
 
 
 
@@ -189,18 +286,35 @@ class DiscoveryMW ():
     try:
       self.logger.info ("DiscoveryMW::event_loop - run the event loop")
 
+      # When we run DHT ring maintenance, the poll also wakes up for the next
+      # maintenance round. So we remember by when the application expects to
+      # hear something and only make the timeout upcall once that has passed.
+      deadline = self.compute_deadline (timeout)
+
       # we are using a class variable called "handle_events" which is set to
       # True but can be set out of band to False in order to exit this forever
       # loop
       while self.handle_events:  # it starts with a True value
         # poll for events. We give it an infinite timeout.
         # The return value is a socket to event mask mapping
-        events = dict (self.poller.poll (timeout=timeout))
+        poll_timeout = timeout
+        if self.dht_maintenance:
+          poll_timeout = self.time_until_next_wakeup (deadline)
+        if self.loop_metrics != None:
+          self.loop_metrics.before_poll ()
+        events = dict (self.poller.poll (timeout=poll_timeout))
+        if self.loop_metrics != None:
+          self.loop_metrics.after_poll (events)
         
         request_handled = False
 
         # check if a timeout has occurred. We know this is the case when
         # the event mask is empty
+        if not events and self.dht_maintenance and (deadline is None or time.monotonic () < deadline):
+          # we only woke up to maintain the ring
+          self.run_dht_maintenance_if_due ()
+          continue
+
         if not events:
           # we are ready to shut down because everybody has already registered
           timeout = self.upcall_obj.stop_appln()
@@ -216,20 +330,40 @@ class DiscoveryMW ():
           timeout = self.handle_state_sync_request ()
           request_handled = True
 
+        if (not request_handled) and (self.zk_event_pair in events):
+          # ZooKeeper watches have fired, the application timeout keeps running
+          self.handle_zk_events ()
+          request_handled = True
+
         if (self.upcall_obj.lookup == "DHT") and (not request_handled):
           # check all dealer sockets in case we are using DHT ring
-          for entry in self.finger_table:
-            # if we receive something on a dealer socket, it is a response to q request we sent earlier
-            # a Discovery node is never an originator of that request, so we send it back using router. It will go back to either another Discovery node
-            if entry.dealer_socket in events:
-              message = entry.dealer_socket.recv_multipart()
-              self.router.send_multipart(message)
+          for dealer_socket in list(self.dealer_sockets.values()):
+            # if we receive something on a dealer socket, it is a response to a request we sent earlier
+            if dealer_socket in events:
+              message = dealer_socket.recv_multipart()
+              if len(message) == 2 and message[0] == b'':
+                # No identity frames left, so we originated this request ourselves (ring maintenance)
+                self.handle_dht_response(message[-1])
+              else:
+                # Otherwise we forwarded it on behalf of someone else, so we send it back using router.
+                # It will go back to either another Discovery node or the original requester
+                self.router.send_multipart(message)
               request_handled = True
               break
           
         if not request_handled:
           raise Exception ("Unknown event after poll")
 
+        # an event was handled, so the application timeout starts over
+        deadline = self.compute_deadline (timeout)
+
+        if self.dht_maintenance:
+          self.run_dht_maintenance_if_due ()
+        elif self.pending_dht_requests:
+          # without maintenance the only requests we send are the replicate
+          # ones, drop those that never got a response
+          self.expire_dht_requests ()
+
       self.logger.info ("DiscoveryMW::event_loop - out of the event loop")
     except Exception as e:
       raise e
@@ -245,9 +379,10 @@ class DiscoveryMW ():
 
       # Receive all frames
       framesRcvd = self.router.recv_multipart()
+      receive_ns = time.time_ns () # for a clock request
       bytesRcvd = framesRcvd[-1]
       self.logger.debug ("DiscoveryMW::handle_request – received bytes and frames")
-      self.logger.debug (f"DiscoveryMW::handle_request – frames received: {framesRcvd}")
+      self.logger.debug ("DiscoveryMW::handle_request – frames received: %s", framesRcvd)
 
       # now use protobuf to deserialize the bytes
       # The way to do this is to first allocate the space for the
@@ -256,12 +391,16 @@ class DiscoveryMW ():
       disc_req = discovery_pb2.DiscoveryReq ()
       disc_req.ParseFromString (bytesRcvd)
 
+      # keep track of the load on this node (a forwarded DHT register is counted as forwarded instead)
+      if not (disc_req.msg_type == discovery_pb2.TYPE_REGISTER and self.upcall_obj.lookup == "DHT" and not disc_req.do_read_or_write):
+        self.request_load[discovery_pb2.MsgTypes.Name (disc_req.msg_type) + ":handled"] += 1
+
       # demultiplex the message based on the message type but let the application
       # object handle the contents as it is best positioned to do so.
       # Note also that we expect the return value to be the desired timeout to use
       # in the next iteration of the poll.
       if (disc_req.msg_type == discovery_pb2.TYPE_REGISTER):
-        self.logger.debug (f"DiscoveryMW::handle_request – Received a register request: do_read_or_write {disc_req.do_read_or_write}, from {disc_req.register_req.info.id}")
+        self.logger.debug ("DiscoveryMW::handle_request – Received a register request: do_read_or_write %s, from %s", disc_req.do_read_or_write, disc_req.register_req.info.id)
 
         if(self.upcall_obj.lookup == "DHT"):
           self.logger.debug ("DiscoveryMW::handle_request – Processing a DHT Register request")
@@ -281,19 +420,20 @@ class DiscoveryMW ():
 
             # Find what node to forward the request to based on the hash
             node, found_the_one = self.find_successor(entity_hash)
-            self.logger.debug (f"DiscoveryMW::handle_request – found_the_one={found_the_one}")
+            self.logger.debug ("DiscoveryMW::handle_request – found_the_one=%s", found_the_one)
 
             # Construct the message
             new_disc_req = self.create_register_req_to_next_dht_node(disc_req, found_the_one)
             buf2send = new_disc_req.SerializeToString ()
 
-            self.logger.debug (f"DiscoveryMW::handle_request – Forwarding the request from myself (node {self.upcall_obj.name}) to node: {node.node_info['id']}, do_read_or_write={new_disc_req.do_read_or_write}")
+            self.logger.debug ("DiscoveryMW::handle_request – Forwarding the request from myself (node %s) to node: %s, do_read_or_write=%s", self.upcall_obj.name, node.node_info['id'], new_disc_req.do_read_or_write)
 
             # Update the message in the frames
             framesRcvd[-1] = buf2send
 
             # Send the message to the node
             node.dealer_socket.send_multipart(framesRcvd)
+            self.request_load["TYPE_REGISTER:forwarded"] += 1
 
             timeout = None
         
@@ -318,6 +458,15 @@ class DiscoveryMW ():
         self.logger.debug ("DiscoveryMW::handle_request – sending the LOOKUP ALL PUBLISHERS request to be handled in the upcall object")
         timeout = self.upcall_obj.handle_lookup_pub_by_topics(disc_req.lookup_req, True, framesRcvd, disc_req.timestamp_sent)
 
+      elif (disc_req.msg_type == discovery_pb2.TYPE_DHT):
+        # ring maintenance request from another discovery node, handled entirely at the middleware level
+        self.logger.debug ("DiscoveryMW::handle_request – handling a DHT maintenance request")
+        timeout = self.handle_dht_request(disc_req, framesRcvd)
+
+      elif (disc_req.msg_type == discovery_pb2.TYPE_CLOCK):
+        # clock offset estimation of a publisher or subscriber, answered right away
+        timeout = self.respond_to_clock_request (framesRcvd, receive_ns)
+
       else: # anything else is unrecognizable by this object
         # raise an exception here
         raise ValueError ("Unrecognized response message")
@@ -355,8 +504,8 @@ class DiscoveryMW ():
     # Update the message in the frames
     framesRcvd[-1] = buf2send
 
-    # Send the message to the immediate successor in finger table
-    self.finger_table[0].dealer_socket.send_multipart(framesRcvd)
+    # Send the message to the next node of the ring walk (our successor unless we use replication)
+    self.ring_walk_next_hop(visited_nodes_set).send_multipart(framesRcvd)
     return
   
   ########################################
@@ -365,11 +514,14 @@ class DiscoveryMW ():
   # Propagate the lookup request further to 
   # collect data about registered entities
   ########################################
-  def forward_lookup_request_further(self, visited_nodes_set, already_added_sockets, topiclist, all, framesRcvd, timestamp_sent):
+  def forward_lookup_request_further(self, visited_nodes_set, already_added_sockets, topiclist, all, framesRcvd, timestamp_sent, requester=''):
     lookup_req = discovery_pb2.LookupPubByTopicReq ()
     lookup_req.topiclist[:] = topiclist
     lookup_req.visited_nodes[:] = list(visited_nodes_set)
     lookup_req.sockets_to_connect_to[:] = list(already_added_sockets)
+    if requester:
+      # the next nodes must know that a broker asks, or they answer with the brokers
+      lookup_req.requester = requester
 
     disc_req = discovery_pb2.DiscoveryReq ()
     if(all):
@@ -384,8 +536,8 @@ class DiscoveryMW ():
     # Update the message in the frames
     framesRcvd[-1] = buf2send
 
-    # Send the message to the immediate successor in finger table
-    self.finger_table[0].dealer_socket.send_multipart(framesRcvd)
+    # Send the message to the next node of the ring walk (our successor unless we use replication)
+    self.ring_walk_next_hop(visited_nodes_set).send_multipart(framesRcvd)
     return
 
 
@@ -415,9 +567,10 @@ class DiscoveryMW ():
     disc_req.do_read_or_write = found_the_one
     disc_req.timestamp_sent = rcvd_register_req.timestamp_sent # statistics
 
-    self.logger.debug(f"Original Message: {rcvd_register_req.register_req.info.id}, {rcvd_register_req.register_req.info.addr}, {rcvd_register_req.register_req.info.port}, {rcvd_register_req.register_req.role}, {rcvd_register_req.register_req.topiclist}, {rcvd_register_req.do_read_or_write}")
+    if self.logger.isEnabledFor (logging.DEBUG):
+      self.logger.debug("Original Message: %s, %s, %s, %s, %s, %s", rcvd_register_req.register_req.info.id, rcvd_register_req.register_req.info.addr, rcvd_register_req.register_req.info.port, rcvd_register_req.register_req.role, list (rcvd_register_req.register_req.topiclist), rcvd_register_req.do_read_or_write)
 
-    self.logger.debug(f"New Message: {disc_req.register_req.info.id}, {disc_req.register_req.info.addr}, {disc_req.register_req.info.port}, {disc_req.register_req.role}, {disc_req.register_req.topiclist}, {disc_req.do_read_or_write}")
+      self.logger.debug("New Message: %s, %s, %s, %s, %s, %s", disc_req.register_req.info.id, disc_req.register_req.info.addr, disc_req.register_req.info.port, disc_req.register_req.role, list (disc_req.register_req.topiclist), disc_req.do_read_or_write)
 
     return disc_req
 
@@ -435,45 +588,55 @@ class DiscoveryMW ():
     else: # broker, publisher
       string_to_hash = register_req.info.id + ":" + register_req.info.addr + ":" + str(register_req.info.port)
 
-    self.logger.info(f"compute_hash_for_registring_entity: string {string_to_hash}")
-    self.logger.info(f"compute_hash_for_registring_entity: hash {self.hash_func(string_to_hash)}")
-    return self.hash_func(string_to_hash)
-
-  #################
-  # hash value
-  #################
-  def hash_func (self, id):
-    # first get the digest from hashlib and then take the desired number of bytes from the
-    # lower end of the 256 bits hash. Big or little endian does not matter.
-    hash_digest = hashlib.sha256(bytes(id, "utf-8")).digest()  # this is how we get the digest or hash value
-    # figure out how many bytes to retrieve
-    num_bytes = int(48/8)  # otherwise we get float which we cannot use below
-    hash_val = int.from_bytes (hash_digest[:num_bytes], "big")  # take lower N number of bytes
+    hash_val = hash_func(string_to_hash)
+    self.logger.debug("compute_hash_for_registring_entity: string %s, hash %d", string_to_hash, hash_val)
     return hash_val
-  
+
   #################
   # find_successor
   #
   # Returns finger table entry to query next and True if that node is the one that is responsible for the hash and false otherwise
   #################
   def find_successor(self, hash_searched):
-    self.logger.info(f"My Hash: {self.my_dht_hash}, {type(self.my_dht_hash)}")
-    self.logger.info(f"Searched Hash: {hash_searched}, {type(hash_searched)}")
-    self.logger.info(f"Successor Hash: {self.finger_table[0].hash}, {type(self.my_dht_hash)}")
+    if self.my_tokens:
+      return self.find_successor_virtual(hash_searched)
+
+    # lazy formatting, this is called for every hop of every request
+    self.logger.debug("My Hash: %s, Searched Hash: %s, Successor Hash: %s", self.my_dht_hash, hash_searched, self.finger_table[0].hash)
 
     successor_in_finger_table = self.finger_table[0]
-    if(hash_searched > self.my_dht_hash and hash_searched <= successor_in_finger_table.hash):
-        self.logger.info (f"find_successor: FOUND THE ONE")
+    if(successor_in_finger_table.hash == self.my_dht_hash):
+        # we are alone in the ring, so we are responsible for every hash
+        return successor_in_finger_table, True
+    elif(hash_searched > self.my_dht_hash and hash_searched <= successor_in_finger_table.hash):
+        self.logger.debug ("find_successor: FOUND THE ONE")
         return successor_in_finger_table, True
     elif(successor_in_finger_table.hash < self.my_dht_hash and (hash_searched > self.my_dht_hash or hash_searched < successor_in_finger_table.hash)):
-        self.logger.info (f"find_successor: FOUND THE ONE")
+        self.logger.debug ("find_successor: FOUND THE ONE")
         return successor_in_finger_table, True
     else:
-        self.logger.info (f"find_successor: MAKING REQUEST TO ANOTHER ONE")
+        self.logger.debug ("find_successor: MAKING REQUEST TO ANOTHER ONE")
         n_dot = self.find_closest_preceding_node(hash_searched)
         return n_dot, False
     
 
+  #################
+  # find_successor_virtual
+  #
+  # Same as above when we own several tokens: we are done if the hash lies between
+  # our token closest to it and the next token. Otherwise we go to the closest
+  # token preceding the hash that we know of.
+  #################
+  def find_successor_virtual(self, hash_searched):
+    # our token closest preceding the hash (index -1 wraps around to our last token)
+    my_token = self.my_tokens[bisect.bisect_left(self.my_tokens, hash_searched) - 1]
+    successor_entry = self.token_successor[my_token]
+    if (successor_entry.hash == hash_searched) or self.in_open_interval(hash_searched, my_token, successor_entry.hash):
+      return successor_entry, True
+
+    # closest preceding token of another node, with the same wrap around
+    return self.routing_entries[bisect.bisect_left(self.routing_hashes, hash_searched) - 1], False
+
   #################
   # find_closest_preceding_node
   #
@@ -490,6 +653,595 @@ class DiscoveryMW ():
     raise ValueError ("Reached the point we should not have reached – no appropriate node was found in the finger table")
     
   
+  ########################################
+  # compute_deadline
+  #
+  # Absolute time by which the application expects the poll to
+  # time out, None if it does not want a timeout
+  ########################################
+  def compute_deadline (self, timeout):
+    if timeout is None:
+      return None
+    return time.monotonic () + timeout/1000
+
+  ########################################
+  # time_until_next_wakeup
+  #
+  # Poll timeout (in ms) when ring maintenance is on: whichever comes first
+  # of the next maintenance round and the application deadline
+  ########################################
+  def time_until_next_wakeup (self, deadline):
+    wakeup = self.next_maintenance_time
+    if deadline is not None:
+      wakeup = min (wakeup, deadline)
+    return max (0, int ((wakeup - time.monotonic ()) * 1000))
+
+
+  ########################################
+  # get_dealer_socket
+  #
+  # Returns the DEALER socket connected to the given node,
+  # creating it the first time we need to talk to that node
+  ########################################
+  def get_dealer_socket (self, node_info):
+    node_id = node_info['id']
+    if node_id in self.dealer_sockets:
+      return self.dealer_sockets[node_id]
+
+    # Create Socket
+    dealer_socket = create_socket (self.context, zmq.DEALER, self.loop_metrics, "dealer")
+
+    # Set identity of the socket
+    dealer_uuid = bytes (uuid.uuid4 ().hex, 'utf-8')
+    dealer_socket.setsockopt (zmq.IDENTITY, dealer_uuid)
+
+    # Connect the socket to the address of the corresponding node
+    dealer_connect_str = "tcp://" + node_info['IP'] + ":" + str (node_info['port'])
+    dealer_socket.connect (dealer_connect_str)
+
+    # register the dealer socket with poller
+    self.poller.register (dealer_socket, zmq.POLLIN)
+    self.dealer_sockets[node_id] = dealer_socket
+    return dealer_socket
+
+  ########################################
+  # release_dealer_socket
+  #
+  # Close the socket to a node once nothing refers to it anymore
+  ########################################
+  def release_dealer_socket (self, node_id):
+    if node_id not in self.dealer_sockets:
+      return
+    if any (entry.node_info['id'] == node_id for entry in self.finger_table):
+      return
+    if self.predecessor is not None and self.predecessor['id'] == node_id:
+      return
+    if any (node['id'] == node_id for node in self.successor_list):
+      return
+    if any (pending['node']['id'] == node_id for pending in self.pending_dht_requests.values ()):
+      return
+
+    self.logger.debug (f"DiscoveryMW::release_dealer_socket - closing socket to {node_id}")
+    dealer_socket = self.dealer_sockets.pop (node_id)
+    self.poller.unregister (dealer_socket)
+    dealer_socket.close (linger=0)
+
+  ########################################
+  # set_finger
+  #
+  # Point the i-th finger to the given node
+  ########################################
+  def set_finger (self, i, node_info):
+    old_id = self.finger_table[i].node_info['id']
+    if old_id == node_info['id']:
+      return
+
+    self.logger.debug (f"DiscoveryMW::set_finger - finger {i}: {old_id} -> {node_info['id']}")
+    entry = FingerTableEntry (node_info['hash'], node_info)
+    entry.dealer_socket = self.get_dealer_socket (node_info)
+    self.finger_table[i] = entry
+    self.release_dealer_socket (old_id)
+
+  ########################################
+  # node_to_proto / proto_to_node
+  #
+  # Convert between the node info dictionaries (as in dht.json)
+  # and the DhtNodeInfo message
+  ########################################
+  def node_to_proto (self, node_info, node_proto):
+    node_proto.id = node_info['id']
+    node_proto.hash = node_info['hash']
+    node_proto.addr = node_info['IP']
+    node_proto.port = node_info['port']
+
+  def proto_to_node (self, node_proto):
+    return {
+      'id': node_proto.id,
+      'hash': node_proto.hash,
+      'IP': node_proto.addr,
+      'port': node_proto.port,
+      'host': ''
+    }
+
+  ########################################
+  # in_open_interval
+  #
+  # True if x lies in the open interval (a, b) going clockwise around
+  # the ring. When a == b the interval is the whole ring except a.
+  ########################################
+  def in_open_interval (self, x, a, b):
+    if a < b:
+      return a < x < b
+    elif a > b:
+      return x > a or x < b
+    else:
+      return x != a
+
+
+  ########################################
+  # send_dht_request
+  #
+  # Send a ring maintenance request that we originate ourselves. We remember
+  # it under its request id so that the response (or its absence) can be
+  # handled in the maintenance code.
+  ########################################
+  def send_dht_request (self, node_info, op, purpose, key=None, new_predecessor=None, new_successor=None, records=None, **details):
+    request_id = self.next_dht_request_id
+    self.next_dht_request_id += 1
+
+    dht_req = discovery_pb2.DhtReq ()  # allocate
+    dht_req.op = op
+    dht_req.request_id = request_id
+    self.node_to_proto (self.my_dht_node, dht_req.sender)
+    if key is not None:
+      dht_req.key = key
+    if new_predecessor is not None:
+      self.node_to_proto (new_predecessor, dht_req.new_predecessor)
+    if new_successor is not None:
+      self.node_to_proto (new_successor, dht_req.new_successor)
+    if records is not None:
+      dht_req.records = json.dumps (records)
+
+    disc_req = discovery_pb2.DiscoveryReq ()
+    disc_req.msg_type = discovery_pb2.TYPE_DHT
+    disc_req.dht_req.CopyFrom (dht_req)
+    buf2send = disc_req.SerializeToString ()
+
+    self.pending_dht_requests[request_id] = dict (purpose=purpose, node=node_info, sent_at=time.monotonic (), **details)
+
+    # the empty delimiter frame makes the message look like a REQ message to the ROUTER on the other side
+    self.logger.debug ("DiscoveryMW::send_dht_request - %s request %s to %s", purpose, request_id, node_info['id'])
+    self.get_dealer_socket (node_info).send_multipart ([b'', buf2send])
+    return request_id
+
+  ########################################
+  # has_pending_dht_request
+  ########################################
+  def has_pending_dht_request (self, purpose, **details):
+    for pending in self.pending_dht_requests.values ():
+      if pending['purpose'] == purpose and all (pending.get (k) == v for k, v in details.items ()):
+        return True
+    return False
+
+  ########################################
+  # handle_dht_request
+  #
+  # Handle a ring maintenance request received from another discovery node
+  ########################################
+  def handle_dht_request (self, disc_req, framesRcvd):
+    dht_req = disc_req.dht_req
+    sender = self.proto_to_node (dht_req.sender)
+    self.logger.debug ("DiscoveryMW::handle_dht_request - op %s from %s", dht_req.op, sender['id'])
+
+    if (dht_req.op == discovery_pb2.DHT_OP_FIND_SUCCESSOR):
+      node, found_the_one = self.find_successor (dht_req.key)
+      if found_the_one:
+        self.respond_to_dht_request (framesRcvd, dht_req, node=node.node_info, hops=dht_req.hops)
+      else:
+        # Forward the request towards the node responsible for the key. The response
+        # retraces the same path back to the requester.
+        dht_req.hops += 1
+        framesRcvd[-1] = disc_req.SerializeToString ()
+        node.dealer_socket.send_multipart (framesRcvd)
+
+    elif (dht_req.op == discovery_pb2.DHT_OP_GET_PREDECESSOR):
+      self.respond_to_dht_request (framesRcvd, dht_req, node=self.predecessor, successors=self.successor_list)
+
+    elif (dht_req.op == discovery_pb2.DHT_OP_NOTIFY):
+      # The sender thinks it might be our predecessor
+      if (sender['id'] != self.name) and (self.predecessor is None or self.in_open_interval (sender['hash'], self.predecessor['hash'], self.my_dht_hash)):
+        self.logger.info (f"DiscoveryMW::handle_dht_request - new predecessor {sender['id']}")
+        old_predecessor = self.predecessor
+        self.predecessor = sender
+        self.get_dealer_socket (sender)
+        if old_predecessor is not None:
+          self.release_dealer_socket (old_predecessor['id'])
+
+      self.respond_to_dht_request (framesRcvd, dht_req)
+
+      if self.predecessor is not None and self.predecessor['id'] == sender['id']:
+        # Replicas of keys in (predecessor, us] are ours now (e.g., our old predecessor failed)
+        self.upcall_obj.promote_dht_replicas (sender['hash'], self.my_dht_hash)
+
+        # Anything we store that is no longer in (predecessor, us] belongs to the predecessor now
+        records = self.upcall_obj.hand_off_dht_records (sender['hash'], self.my_dht_hash)
+        if records:
+          self.logger.info (f"DiscoveryMW::handle_dht_request - handing off {len (records)} records to {sender['id']}")
+          self.send_dht_request (sender, discovery_pb2.DHT_OP_TRANSFER_KEYS, 'transfer', records=records)
+
+    elif (dht_req.op == discovery_pb2.DHT_OP_PING):
+      self.respond_to_dht_request (framesRcvd, dht_req)
+
+    elif (dht_req.op == discovery_pb2.DHT_OP_TRANSFER_KEYS):
+      self.upcall_obj.take_over_dht_records (json.loads (dht_req.records))
+      self.respond_to_dht_request (framesRcvd, dht_req)
+
+    elif (dht_req.op == discovery_pb2.DHT_OP_REPLICATE):
+      self.upcall_obj.store_dht_replicas (json.loads (dht_req.records))
+      self.respond_to_dht_request (framesRcvd, dht_req)
+
+    elif (dht_req.op == discovery_pb2.DHT_OP_LEAVE):
+      self.logger.info (f"DiscoveryMW::handle_dht_request - {sender['id']} is leaving the ring")
+      if dht_req.HasField ("new_predecessor") and self.predecessor is not None and self.predecessor['id'] == sender['id']:
+        new_predecessor = self.proto_to_node (dht_req.new_predecessor)
+        self.predecessor = None if new_predecessor['id'] == self.name else new_predecessor
+
+      if dht_req.HasField ("new_successor") and self.finger_table[0].node_info['id'] == sender['id']:
+        new_successor = self.proto_to_node (dht_req.new_successor)
+        if new_successor['id'] == self.name:
+          self.successor_list = []
+        else:
+          self.successor_list = [new_successor] + [node for node in self.successor_list if node['id'] not in (sender['id'], new_successor['id'])]
+        self.set_finger (0, new_successor if new_successor['id'] != self.name else self.my_dht_node)
+
+      if dht_req.HasField ("records"):
+        self.upcall_obj.take_over_dht_records (json.loads (dht_req.records))
+
+      self.respond_to_dht_request (framesRcvd, dht_req)
+
+      # Whatever still points to the leaving node is treated as if it had failed
+      self.handle_failed_node (sender)
+
+    else:
+      raise ValueError ("DiscoveryMW::handle_dht_request - unknown DHT operation")
+
+    return None
+
+  ########################################
+  # respond_to_dht_request
+  ########################################
+  def respond_to_dht_request (self, framesRcvd, dht_req, node=None, successors=None, hops=0):
+    dht_resp = discovery_pb2.DhtResp ()  # allocate
+    dht_resp.op = dht_req.op
+    dht_resp.request_id = dht_req.request_id
+    dht_resp.hops = hops
+    if node is not None:
+      self.node_to_proto (node, dht_resp.node)
+    for successor in (successors or []):
+      self.node_to_proto (successor, dht_resp.successors.add ())
+
+    disc_resp = discovery_pb2.DiscoveryResp ()
+    disc_resp.msg_type = discovery_pb2.TYPE_DHT
+    disc_resp.dht_resp.CopyFrom (dht_resp)
+    buf2send = disc_resp.SerializeToString ()
+
+    framesRcvd[-1] = buf2send
+    self.router.send_multipart (framesRcvd)
+
+  ########################################
+  # respond_to_clock_request
+  #
+  # The times of our clock when the request came in and the response goes
+  # out, for the offset estimation of a publisher or subscriber (ClockSync.py)
+  ########################################
+  def respond_to_clock_request (self, framesRcvd, receive_ns):
+    disc_resp = discovery_pb2.DiscoveryResp ()
+    disc_resp.msg_type = discovery_pb2.TYPE_CLOCK
+    disc_resp.clock_resp.receive_ns = receive_ns
+    disc_resp.clock_resp.transmit_ns = time.time_ns ()
+    framesRcvd[-1] = disc_resp.SerializeToString ()
+    self.router.send_multipart (framesRcvd)
+    return None
+
+  ########################################
+  # handle_dht_response
+  #
+  # Handle the response to a maintenance request we originated
+  ########################################
+  def handle_dht_response (self, bytesRcvd):
+    disc_resp = discovery_pb2.DiscoveryResp ()
+    disc_resp.ParseFromString (bytesRcvd)
+    dht_resp = disc_resp.dht_resp
+
+    pending = self.pending_dht_requests.pop (dht_resp.request_id, None)
+    if pending is None:
+      # we already gave up on this request
+      self.logger.debug (f"DiscoveryMW::handle_dht_response - late response to request {dht_resp.request_id}")
+      return
+    purpose = pending['purpose']
+    self.logger.debug ("DiscoveryMW::handle_dht_response - %s response from %s, hops %d", purpose, pending['node']['id'], dht_resp.hops)
+
+    if purpose == 'join':
+      successor = self.proto_to_node (dht_resp.node)
+      if successor['id'] != self.name:
+        self.logger.info (f"DiscoveryMW::handle_dht_response - joined the ring, successor is {successor['id']}")
+        self.successor_list = [successor]
+        self.set_finger (0, successor)
+        self.joining = False
+        self.release_dealer_socket (pending['node']['id'])
+
+    elif purpose == 'fix_finger':
+      self.set_finger (pending['finger'], self.proto_to_node (dht_resp.node))
+
+    elif purpose == 'stabilize':
+      old_successor = pending['node']
+      successor = self.finger_table[0].node_info
+      if successor['id'] != old_successor['id']:
+        # our successor changed while the request was in flight
+        return
+
+      # Someone may have joined between us and our successor
+      if dht_resp.HasField ("node"):
+        x = self.proto_to_node (dht_resp.node)
+        if x['id'] != self.name and not self.recently_failed (x['id']) and self.in_open_interval (x['hash'], self.my_dht_hash, successor['hash']):
+          self.logger.info (f"DiscoveryMW::handle_dht_response - new successor {x['id']}")
+          successor = x
+
+      # our successor list is our successor followed by its successors
+      candidates = [successor, old_successor] + [self.proto_to_node (node) for node in dht_resp.successors]
+      successor_list = []
+      for node in candidates:
+        if node['id'] != self.name and not self.recently_failed (node['id']) and all (node['id'] != other['id'] for other in successor_list):
+          successor_list.append (node)
+      old_list = self.successor_list
+      self.successor_list = successor_list[:self.upcall_obj.dht_successor_list_size]
+      self.set_finger (0, successor)
+
+      # Nodes that just became one of our first k successors need a copy of our records
+      replication_factor = self.upcall_obj.dht_replication_factor
+      old_replica_ids = [node['id'] for node in old_list[:replication_factor]]
+      new_replicas = [node for node in self.successor_list[:replication_factor] if node['id'] not in old_replica_ids]
+      if new_replicas:
+        self.replicate_dht_records (self.upcall_obj.owned_dht_records (), new_replicas)
+
+      for node in old_list:
+        self.release_dealer_socket (node['id'])
+
+      self.send_dht_request (successor, discovery_pb2.DHT_OP_NOTIFY, 'notify')
+
+    # nothing else to do for the rest (check_predecessor, notify, transfer, leave),
+    # getting a response is all we wanted
+
+  ########################################
+  # replicate_dht_records
+  #
+  # Send copies of records we own to our first k successors (or just to
+  # the given nodes) so that they survive our failure and reads can be
+  # answered by any of the replicas
+  ########################################
+  def replicate_dht_records (self, records, replicas=None):
+    if not records:
+      return
+    if replicas is None:
+      replicas = self.successor_list[:self.upcall_obj.dht_replication_factor]
+
+    for node in replicas:
+      if node['id'] == self.name:
+        continue
+      self.logger.debug ("DiscoveryMW::replicate_dht_records - %d records to %s", len (records), node['id'])
+      self.send_dht_request (node, discovery_pb2.DHT_OP_REPLICATE, 'replicate', records=records)
+
+  ########################################
+  # ring_walk_next_hop
+  #
+  # Next node for the is ready and lookup requests that go around the ring.
+  # Each node also answers for the keys it replicates, i.e., those of its
+  # k predecessors, so we can skip k nodes at a time. If the node where the
+  # walk started is within reach we go there so that it sees the full circle.
+  #
+  # The walk follows the physical nodes of the ring (our successor list from
+  # the dht file or stabilize): with virtual nodes the finger table is sorted
+  # by token, so its first entry may be any node, us included.
+  ########################################
+  def ring_walk_next_hop (self, visited_nodes_set):
+    if not self.successor_list:
+      # alone in the ring
+      return self.get_dealer_socket (self.my_dht_node)
+
+    candidates = self.successor_list[:self.upcall_obj.dht_replication_factor + 1]
+    for node in candidates:
+      if node['id'] in visited_nodes_set:
+        return self.get_dealer_socket (node)
+    return self.get_dealer_socket (candidates[-1])
+
+  ########################################
+  # run_dht_maintenance_if_due
+  ########################################
+  def run_dht_maintenance_if_due (self):
+    now = time.monotonic ()
+    if now < self.next_maintenance_time:
+      return
+    self.next_maintenance_time = now + self.upcall_obj.dht_stabilize_interval
+
+    self.expire_dht_requests ()
+
+    if self.joining:
+      # keep trying until some node of the ring answers
+      if not self.has_pending_dht_request ('join'):
+        self.join_ring ()
+      return
+
+    self.stabilize ()
+    self.fix_fingers ()
+    self.check_predecessor ()
+
+  ########################################
+  # expire_dht_requests
+  #
+  # Requests that did not get a response in time tell us which nodes failed
+  ########################################
+  def expire_dht_requests (self):
+    now = time.monotonic ()
+    for request_id, pending in list (self.pending_dht_requests.items ()):
+      if now - pending['sent_at'] < self.upcall_obj.dht_failure_timeout:
+        continue
+
+      del self.pending_dht_requests[request_id]
+      purpose = pending['purpose']
+      self.logger.info (f"DiscoveryMW::expire_dht_requests - no response from {pending['node']['id']} to {purpose} request")
+
+      if purpose in ('stabilize', 'check_predecessor'):
+        self.handle_failed_node (pending['node'])
+      elif purpose == 'transfer':
+        # the records never made it, so we keep being responsible for them
+        self.upcall_obj.take_over_dht_records (pending['records'])
+      # fix_finger requests may have failed anywhere along the path, we simply retry
+      # them on the next round. A failed join is retried by run_dht_maintenance_if_due.
+
+      self.release_dealer_socket (pending['node']['id'])
+
+  ########################################
+  # join_ring
+  #
+  # Ask an existing node of the ring who our successor is
+  ########################################
+  def join_ring (self):
+    if self.bootstrap is not None:
+      addr, port = self.bootstrap.split (":")
+      bootstrap_node = {'id': self.bootstrap, 'hash': None, 'IP': addr, 'port': int (port), 'host': ''}
+    else:
+      bootstrap_node = self.dht_ring.random_node ()
+
+    self.logger.info (f"DiscoveryMW::join_ring - joining the ring through {bootstrap_node['id']}")
+    self.send_dht_request (bootstrap_node, discovery_pb2.DHT_OP_FIND_SUCCESSOR, 'join', key=self.my_dht_hash)
+
+  ########################################
+  # stabilize
+  #
+  # Ask our successor for its predecessor and successor list
+  ########################################
+  def stabilize (self):
+    if self.has_pending_dht_request ('stabilize'):
+      return
+
+    successor = self.finger_table[0].node_info
+    if successor['id'] == self.name:
+      # We are alone, but once somebody notifies us it is also our successor
+      if self.predecessor is not None:
+        self.successor_list = [self.predecessor]
+        self.set_finger (0, self.predecessor)
+      return
+
+    self.send_dht_request (successor, discovery_pb2.DHT_OP_GET_PREDECESSOR, 'stabilize')
+
+  ########################################
+  # fix_fingers
+  #
+  # Refresh the next few fingers (finger 0 is kept up to date by stabilize)
+  ########################################
+  def fix_fingers (self):
+    for _ in range (min (self.upcall_obj.dht_fingers_per_round, len (self.finger_table) - 1)):
+      i = self.next_finger_to_fix
+      self.next_finger_to_fix = i + 1 if i + 1 < len (self.finger_table) else 1
+      if self.has_pending_dht_request ('fix_finger', finger=i):
+        continue
+
+      target_hash = (self.my_dht_hash + 2 ** i) % self.dht_ring.address_space
+      node, found_the_one = self.find_successor (target_hash)
+      if found_the_one:
+        self.set_finger (i, node.node_info if node.node_info['id'] != self.name else self.my_dht_node)
+      else:
+        self.send_dht_request (node.node_info, discovery_pb2.DHT_OP_FIND_SUCCESSOR, 'fix_finger', key=target_hash, finger=i)
+
+  ########################################
+  # check_predecessor
+  ########################################
+  def check_predecessor (self):
+    if self.predecessor is None or self.has_pending_dht_request ('check_predecessor'):
+      return
+    self.send_dht_request (self.predecessor, discovery_pb2.DHT_OP_PING, 'check_predecessor')
+
+  ########################################
+  # handle_failed_node
+  #
+  # Remove a node that failed (or left) from our routing state
+  ########################################
+  def handle_failed_node (self, node_info):
+    failed_id = node_info['id']
+    if failed_id == self.name:
+      return
+
+    self.logger.info (f"DiscoveryMW::handle_failed_node - removing {failed_id} from the routing state")
+    self.failed_nodes[failed_id] = time.monotonic ()
+    self.successor_list = [node for node in self.successor_list if node['id'] != failed_id]
+    if self.predecessor is not None and self.predecessor['id'] == failed_id:
+      self.predecessor = None
+
+    # Our successor failed, so the next live node in the successor list takes over
+    if self.finger_table[0].node_info['id'] == failed_id:
+      if self.successor_list:
+        new_successor = self.successor_list[0]
+      elif self.predecessor is not None:
+        new_successor = self.predecessor
+        self.successor_list = [new_successor]
+      else:
+        new_successor = self.my_dht_node
+      self.set_finger (0, new_successor)
+
+    # Other fingers fall back to our successor until fix_fingers repairs them
+    for i in range (1, len (self.finger_table)):
+      if self.finger_table[i].node_info['id'] == failed_id:
+        self.set_finger (i, self.finger_table[0].node_info)
+
+    self.release_dealer_socket (failed_id)
+
+  ########################################
+  # recently_failed
+  #
+  # Other nodes may still report a node we found failed until they
+  # notice it themselves, so we ignore it for a while
+  ########################################
+  def recently_failed (self, node_id):
+    failed_at = self.failed_nodes.get (node_id)
+    if failed_at is None:
+      return False
+    if time.monotonic () - failed_at > 2 * self.upcall_obj.dht_failure_timeout:
+      del self.failed_nodes[node_id]
+      return False
+    return True
+
+  ########################################
+  # leave_ring
+  #
+  # Leave the ring gracefully: our successor takes over our records and
+  # our neighbours are told about each other
+  ########################################
+  def leave_ring (self):
+    successor = self.finger_table[0].node_info
+    if self.joining or successor['id'] == self.name:
+      return
+
+    self.logger.info ("DiscoveryMW::leave_ring - leaving the ring")
+    records = self.upcall_obj.hand_off_dht_records (None, None)
+    if self.predecessor is not None and self.predecessor['id'] == successor['id']:
+      # two node ring, the other node ends up alone
+      self.send_dht_request (successor, discovery_pb2.DHT_OP_LEAVE, 'leave', new_predecessor=successor, new_successor=successor, records=records)
+    else:
+      self.send_dht_request (successor, discovery_pb2.DHT_OP_LEAVE, 'leave', new_predecessor=self.predecessor, records=records)
+      if self.predecessor is not None:
+        self.send_dht_request (self.predecessor, discovery_pb2.DHT_OP_LEAVE, 'leave', new_successor=successor)
+
+    # Wait a little for the acknowledgements so that the messages are not lost when we exit
+    deadline = time.monotonic () + self.upcall_obj.dht_failure_timeout
+    while self.has_pending_dht_request ('leave') and time.monotonic () < deadline:
+      events = dict (self.poller.poll (timeout=100))
+      for dealer_socket in list (self.dealer_sockets.values ()):
+        if dealer_socket in events:
+          message = dealer_socket.recv_multipart ()
+          if len (message) == 2 and message[0] == b'':
+            self.handle_dht_response (message[-1])
+
+
   ########################################
   # respond_to_register_request
   #
@@ -522,7 +1274,7 @@ class DiscoveryMW ():
       # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
       # a real string
       buf2send = disc_resp.SerializeToString ()
-      self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
+      self.logger.debug ("Stringified serialized buf = %s", buf2send)
 
       # now send this to the service that sent the request
       self.logger.debug ("DiscoveryMW::respond_to_register_request - send isready stringified buffer to service that sent the request")
@@ -563,7 +1315,7 @@ class DiscoveryMW ():
       # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
       # a real string
       buf2send = disc_resp.SerializeToString ()
-      self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
+      self.logger.debug ("Stringified serialized buf = %s", buf2send)
 
       # Update the message in the frames
       framesRcvd[-1] = buf2send
@@ -604,7 +1356,7 @@ class DiscoveryMW ():
       # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
       # a real string
       buf2send = disc_resp.SerializeToString ()
-      self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
+      self.logger.debug ("Stringified serialized buf = %s", buf2send)
 
       # Update the message in the frames
       framesRcvd[-1] = buf2send
@@ -713,6 +1465,78 @@ class DiscoveryMW ():
     self.sync_pub_socket.send (send_str)
     return
   
+  ########################################
+  # new_zk_event_generation
+  #
+  # Called from the kazoo threads when a watch fires. Events of the same
+  # kind are full snapshots (e.g., all the children of /brokers), so an
+  # older one that shows up late must not undo a newer one
+  ########################################
+  def new_zk_event_generation (self, kind):
+    with self.zk_event_lock:
+      self.zk_event_generation[kind] += 1
+      return self.zk_event_generation[kind]
+
+  ########################################
+  # post_zk_event
+  #
+  # Called from the kazoo threads, hands the event to the event loop
+  ########################################
+  def post_zk_event (self, kind, payload, generation=None):
+    if generation is None:
+      generation = self.new_zk_event_generation (kind)
+    event = {'kind': kind, 'generation': generation, 'payload': payload}
+    with self.zk_event_lock:
+      self.zk_event_sender.send (json.dumps (event).encode ('utf-8'))
+    return
+
+  ########################################
+  # handle_zk_events
+  #
+  # Take all the events queued up so far and keep only the latest of each
+  # kind, so that a burst of watch events results in one upcall per kind
+  ########################################
+  def handle_zk_events (self):
+    latest = {}
+    num_events = 0
+    while True:
+      try:
+        bytesRcvd = self.zk_event_pair.recv (zmq.NOBLOCK)
+      except zmq.Again:
+        break
+      num_events += 1
+      event = json.loads (bytesRcvd.decode ('utf-8'))
+      if event['kind'] not in latest or event['generation'] > latest[event['kind']]['generation']:
+        latest[event['kind']] = event
+
+    self.logger.info ("DiscoveryMW::handle_zk_events - %d events, handling %s", num_events, list (latest))
+    for kind, event in latest.items ():
+      if event['generation'] <= self.zk_applied_generation.get (kind, 0):
+        continue
+      self.zk_applied_generation[kind] = event['generation']
+      self.upcall_obj.handle_zk_event (kind, event['payload'])
+    return
+
+  ########################################
+  # publish_unsub_updates
+  #
+  # All the publishers and brokers that died in one message
+  ########################################
+  def publish_unsub_updates(self, unsub_update_bodies):
+    if len(unsub_update_bodies) > 0:
+      self.publish_unsub_update(unsub_update_bodies)
+    return
+
+  ########################################
+  # publish_sub_updates
+  #
+  # All the new brokers in one message
+  ########################################
+  def publish_sub_updates(self, sub_update_bodies):
+    if len(sub_update_bodies) > 0:
+      self.publish_sub_update(sub_update_bodies)
+    return
+
   ########################################
   # handle_state_sync_request
   # 
@@ -0,0 +1,803 @@
+###############################################
+#
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose: In-process stand-in for ZooKeeper and the kazoo client
+#
+# Created: Spring 2023
+#
+###############################################
+
+# Everything that runs in ZooKeeper mode talks to an ensemble through a kazoo
+# client. To run elections and failovers without an ensemble (and without its
+# noise) this module keeps the znode tree in memory and provides a client with
+# the subset of the kazoo API used in this code base:
+#
+#    start/stop/close, add_listener/remove_listener
+#    create, delete, exists, get, get_children, set, ensure_path
+#    the *_async variants (with get() and rawlink() on the result)
+#    transaction (create, delete, set_data, check)
+#    ChildrenWatch, DataWatch
+#
+# along with ephemeral and sequential nodes, one-shot watches and sessions.
+#
+# Every client has a connection thread that executes its requests in order,
+# half a round trip after they were sent, and returns the result another half
+# later. Watch notifications also take half a round trip. The round trip
+# (latency, jitter) is set on the ensemble, so that results do not depend on
+# the machine and the network at hand. As with kazoo, watch functions and
+# rawlink callbacks run in a separate callback thread of the client and may
+# make synchronous calls.
+#
+# Sessions end in one of three ways:
+#
+#    stop ()                  the client closes its session, its ephemeral
+#                             nodes go away right away
+#    crash ()                 the process of the client died, the ensemble
+#                             notices after the session timeout
+#    ensemble.expire_session  the session expires but the client lives on
+#                             (e.g. after a network partition). It is told
+#                             LOST, then gets a new session (CONNECTED) on
+#                             which ChildrenWatch/DataWatch re-register
+#
+# The clients of one process share an ensemble by name:
+#
+#    zk_client = zookeeper_client ("inmemory://bench")    # in-memory
+#    zk_client = zookeeper_client ("localhost:2181")      # kazoo
+
+import time
+import heapq
+import random
+import logging
+import threading
+import functools
+import collections
+
+from kazoo.client import KazooClient
+from kazoo.exceptions import (NoNodeError, NodeExistsError, BadVersionError, NotEmptyError,
+                              RolledBackError, RuntimeInconsistency, ConnectionClosedError,
+                              BadArgumentsError)
+from kazoo.protocol.states import ZnodeStat, WatchedEvent, EventType, KeeperState, KazooState
+
+
+########################################
+# zookeeper_client
+#
+# An in-memory client for hosts of the form inmemory://<name>, a kazoo
+# client otherwise
+########################################
+def zookeeper_client (hosts, **kwargs):
+  if hosts.startswith ("inmemory"):
+    return InMemoryKazooClient (hosts=hosts, **kwargs)
+  return KazooClient (hosts=hosts, **kwargs)
+
+
+##################################
+#       Znode class
+##################################
+class Znode ():
+
+  def __init__ (self, data, zxid, ephemeral_owner=0):
+    self.data = data
+    self.version = 0
+    self.cversion = 0
+    self.czxid = zxid
+    self.mzxid = zxid
+    self.pzxid = zxid
+    self.ctime = int (time.time () * 1000)
+    self.mtime = self.ctime
+    self.ephemeral_owner = ephemeral_owner # session id, 0 for persistent nodes
+    self.children = set ()
+
+  def stat (self):
+    return ZnodeStat (self.czxid, self.mzxid, self.ctime, self.mtime, self.version, self.cversion, 0,
+                      self.ephemeral_owner, len (self.data), len (self.children), self.pzxid)
+
+
+##################################
+#       InMemoryEnsemble class
+##################################
+class InMemoryEnsemble ():
+
+  _named = {} # name -> ensemble shared by the clients of the process
+  _named_lock = threading.Lock ()
+
+  ########################################
+  # named
+  ########################################
+  @classmethod
+  def named (cls, name):
+    with cls._named_lock:
+      if name not in cls._named:
+        cls._named[name] = InMemoryEnsemble ()
+      return cls._named[name]
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, latency=0.0, jitter=0.0, seed=None):
+    self.latency = latency # round trip between a client and the ensemble in seconds
+    self.jitter = jitter # up to this many seconds are added to a round trip at random
+    self.rng = random.Random (seed)
+    self.lock = threading.RLock ()
+    self.zxid = 0
+    self.nodes = {"/": Znode (b"", 0)}
+    self.next_session_id = 1
+    self.sessions = {} # session id -> client
+    self.expiry_timers = {} # session id -> timer of a crashed client
+    self.data_watches = collections.defaultdict (list) # path -> [(client, watch)] of exists/get
+    self.child_watches = collections.defaultdict (list) # path -> [(client, watch)] of get_children
+
+  ########################################
+  # reset, an empty tree and no sessions
+  ########################################
+  def reset (self):
+    with self.lock:
+      for timer in self.expiry_timers.values ():
+        timer.cancel ()
+      self.__init__ (self.latency, self.jitter)
+
+  ########################################
+  # one way delay of a message
+  ########################################
+  def one_way_delay (self):
+    jitter = self.rng.uniform (0, self.jitter) if self.jitter > 0 else 0.0
+    return (self.latency + jitter) / 2
+
+  ########################################
+  # sessions
+  ########################################
+  def open_session (self, client):
+    with self.lock:
+      session_id = self.next_session_id
+      self.next_session_id += 1
+      self.sessions[session_id] = client
+      return session_id
+
+  def close_session (self, session_id):
+    with self.lock:
+      if self.sessions.pop (session_id, None) == None:
+        return
+      timer = self.expiry_timers.pop (session_id, None)
+      if timer != None:
+        timer.cancel ()
+
+      # the watches of the session go away with it, its ephemeral nodes are deleted
+      for watches in list (self.data_watches.values ()) + list (self.child_watches.values ()):
+        watches[:] = [(client, watch) for client, watch in watches if client.session_id != session_id]
+      ephemerals = [path for path, node in self.nodes.items () if node.ephemeral_owner == session_id]
+      for path in sorted (ephemerals, reverse=True):
+        if path in self.nodes:
+          self.delete (path, -1)
+
+  ########################################
+  # expire_session_after, the client is gone without closing its session
+  ########################################
+  def expire_session_after (self, session_id, timeout):
+    with self.lock:
+      timer = threading.Timer (timeout, self.close_session, args=(session_id,))
+      timer.daemon = True
+      self.expiry_timers[session_id] = timer
+      timer.start ()
+
+  ########################################
+  # expire_session, the client lives on and gets a new session
+  ########################################
+  def expire_session (self, client):
+    session_id = client.session_id
+    self.close_session (session_id)
+    client.session_expired (session_id)
+
+  ########################################
+  # watches
+  ########################################
+  def add_watch (self, watches, path, client, watch):
+    if watch != None:
+      watches[path].append ((client, watch))
+
+  def trigger (self, watches, path, event_type):
+    for client, watch in watches.pop (path, []):
+      client.deliver_watch (watch, WatchedEvent (event_type, KeeperState.CONNECTED, path))
+
+  ########################################
+  # tree operations, called with the lock held from the connection
+  # thread of a client. Return the result or raise the kazoo exception
+  ########################################
+  def parent_of (self, path):
+    return path[:path.rfind ("/")] or "/"
+
+  def check_path (self, path):
+    if not path.startswith ("/") or (path != "/" and path.endswith ("/")):
+      raise BadArgumentsError ("bad path " + path)
+
+  def create (self, path, value, ephemeral_owner, sequence, makepath):
+    self.check_path (path)
+    parent_path = self.parent_of (path)
+    if parent_path not in self.nodes:
+      if not makepath:
+        raise NoNodeError ()
+      self.create (parent_path, b"", 0, False, True)
+    parent = self.nodes[parent_path]
+    if parent.ephemeral_owner != 0:
+      raise NoNodeError () # ephemeral nodes have no children
+    if sequence:
+      path = path + "%010d" % parent.cversion
+    if path in self.nodes:
+      raise NodeExistsError ()
+
+    self.zxid += 1
+    self.nodes[path] = Znode (value, self.zxid, ephemeral_owner)
+    parent.children.add (path[path.rfind ("/") + 1:])
+    parent.cversion += 1
+    parent.pzxid = self.zxid
+
+    self.trigger (self.data_watches, path, EventType.CREATED)
+    self.trigger (self.child_watches, parent_path, EventType.CHILD)
+    return path
+
+  def delete (self, path, version, recursive=False):
+    if path not in self.nodes:
+      raise NoNodeError ()
+    node = self.nodes[path]
+    if version != -1 and node.version != version:
+      raise BadVersionError ()
+    if len (node.children) > 0:
+      if not recursive:
+        raise NotEmptyError ()
+      for child in list (node.children):
+        self.delete (path.rstrip ("/") + "/" + child, -1, True)
+
+    self.zxid += 1
+    del self.nodes[path]
+    parent_path = self.parent_of (path)
+    parent = self.nodes[parent_path]
+    parent.children.discard (path[path.rfind ("/") + 1:])
+    parent.cversion += 1
+    parent.pzxid = self.zxid
+
+    self.trigger (self.data_watches, path, EventType.DELETED)
+    self.trigger (self.child_watches, path, EventType.DELETED)
+    self.trigger (self.child_watches, parent_path, EventType.CHILD)
+    return True
+
+  def set (self, path, value, version):
+    if path not in self.nodes:
+      raise NoNodeError ()
+    node = self.nodes[path]
+    if version != -1 and node.version != version:
+      raise BadVersionError ()
+
+    self.zxid += 1
+    node.data = value
+    node.version += 1
+    node.mzxid = self.zxid
+    node.mtime = int (time.time () * 1000)
+
+    self.trigger (self.data_watches, path, EventType.CHANGED)
+    return node.stat ()
+
+  def exists (self, path, client, watch):
+    self.add_watch (self.data_watches, path, client, watch)
+    return self.nodes[path].stat () if path in self.nodes else None
+
+  def get (self, path, client, watch):
+    if path not in self.nodes:
+      raise NoNodeError ()
+    self.add_watch (self.data_watches, path, client, watch)
+    return (self.nodes[path].data, self.nodes[path].stat ())
+
+  def get_children (self, path, client, watch):
+    if path not in self.nodes:
+      raise NoNodeError ()
+    self.add_watch (self.child_watches, path, client, watch)
+    return sorted (self.nodes[path].children)
+
+  ########################################
+  # multi
+  #
+  # All or nothing: on the first failure the tree is restored and the
+  # results are RolledBackError before the failed operation, its error,
+  # RuntimeInconsistency after it
+  ########################################
+  def multi (self, operations, session_id):
+    nodes = {path: self.copy_node (node) for path, node in self.nodes.items ()}
+    zxid = self.zxid
+    data_watches = {path: list (watches) for path, watches in self.data_watches.items ()}
+    child_watches = {path: list (watches) for path, watches in self.child_watches.items ()}
+
+    # watches fire only once the whole transaction went through
+    fired = []
+    real_trigger = self.trigger
+    self.trigger = lambda watches, path, event_type: fired.append ((watches, path, event_type))
+
+    results = []
+    try:
+      for op, args in operations:
+        try:
+          if op == "create":
+            path, value, ephemeral, sequence = args
+            results.append (self.create (path, value, session_id if ephemeral else 0, sequence, False))
+          elif op == "delete":
+            results.append (self.delete (*args))
+          elif op == "set_data":
+            results.append (self.set (*args))
+          elif op == "check":
+            path, version = args
+            if path not in self.nodes:
+              raise NoNodeError ()
+            if self.nodes[path].version != version:
+              raise BadVersionError ()
+            results.append (True)
+        except Exception as e:
+          self.nodes = nodes
+          self.zxid = zxid
+          self.data_watches = collections.defaultdict (list, data_watches)
+          self.child_watches = collections.defaultdict (list, child_watches)
+          failed = len (results)
+          return [RolledBackError ()] * failed + [e] + [RuntimeInconsistency ()] * (len (operations) - failed - 1)
+    finally:
+      self.trigger = real_trigger
+
+    for watches, path, event_type in fired:
+      self.trigger (watches, path, event_type)
+    return results
+
+  def copy_node (self, node):
+    copy = Znode.__new__ (Znode)
+    copy.__dict__.update (node.__dict__)
+    copy.children = set (node.children)
+    return copy
+
+
+##################################
+# Result of an asynchronous call, the part of kazoo's IAsyncResult we use
+##################################
+class InMemoryAsyncResult ():
+
+  def __init__ (self, client):
+    self.client = client
+    self.event = threading.Event ()
+    self.value = None
+    self.exception = None
+    self.callbacks = []
+    self.lock = threading.Lock ()
+
+  def ready (self):
+    return self.event.is_set ()
+
+  def successful (self):
+    return self.ready () and self.exception == None
+
+  def set (self, value=None):
+    self.value = value
+    self.done ()
+
+  def set_exception (self, exception):
+    self.exception = exception
+    self.done ()
+
+  def done (self):
+    with self.lock:
+      if self.event.is_set ():
+        return
+      self.event.set ()
+      callbacks, self.callbacks = self.callbacks, []
+    self.client.pending.discard (self)
+    for callback in callbacks:
+      self.client.run_callback (callback, self)
+
+  def get (self, block=True, timeout=None):
+    if not self.event.wait (timeout if block else 0):
+      raise TimeoutError ("no result after {} s".format (timeout))
+    if self.exception != None:
+      raise self.exception
+    return self.value
+
+  def rawlink (self, callback):
+    with self.lock:
+      if not self.event.is_set ():
+        self.callbacks.append (callback)
+        return
+    self.client.run_callback (callback, self)
+
+  def unlink (self, callback):
+    with self.lock:
+      if callback in self.callbacks:
+        self.callbacks.remove (callback)
+
+
+##################################
+# Multi-op transaction
+##################################
+class InMemoryTransaction ():
+
+  def __init__ (self, client):
+    self.client = client
+    self.operations = []
+    self.committed = False
+
+  def create (self, path, value=b"", acl=None, ephemeral=False, sequence=False):
+    self.operations.append (("create", (path, value, ephemeral, sequence)))
+
+  def delete (self, path, version=-1):
+    self.operations.append (("delete", (path, version)))
+
+  def set_data (self, path, value, version=-1):
+    self.operations.append (("set_data", (path, value, version)))
+
+  def check (self, path, version):
+    self.operations.append (("check", (path, version)))
+
+  def commit_async (self):
+    self.committed = True
+    session_id = self.client.session_id
+    return self.client.submit ("Transaction", lambda ensemble: ensemble.multi (self.operations, session_id))
+
+  def commit (self):
+    return self.commit_async ().get ()
+
+
+##################################
+#       InMemoryKazooClient class
+##################################
+class InMemoryKazooClient ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, hosts="inmemory", timeout=10.0, ensemble=None, **kwargs):
+    self.ensemble = ensemble if ensemble != None else InMemoryEnsemble.named (hosts)
+    self.timeout = timeout # session timeout in seconds
+    self.session_id = None
+    self.state = KazooState.LOST
+    self.connected = False
+    self.listeners = []
+    self.ops = collections.Counter () # request type -> count, as kazoo names them
+    self.logger = logging.getLogger ("InMemoryKazooClient")
+
+    # requests and notifications that are on their way, executed by the connection thread
+    self.in_flight = [] # heap of (due time, sequence, function)
+    self.in_flight_cv = threading.Condition ()
+    self.sequence = 0
+    self.last_due = 0.0 # requests of a session are executed in order
+    self.pending = set () # results of the requests not answered yet
+
+    # watch functions and completion callbacks
+    self.callbacks = collections.deque ()
+    self.callbacks_cv = threading.Condition ()
+    self.threads = []
+
+  ########################################
+  # start/stop/close
+  ########################################
+  def start (self, timeout=None):
+    if self.connected:
+      return
+    self.connected = True
+    self.threads = [threading.Thread (target=self.connection_loop, daemon=True),
+                    threading.Thread (target=self.callback_loop, daemon=True)]
+    for thread in self.threads:
+      thread.start ()
+    self.session_id = self.ensemble.open_session (self)
+    self.change_state (KazooState.CONNECTED)
+
+  def stop (self):
+    if not self.connected:
+      return
+    self.ensemble.close_session (self.session_id)
+    self.change_state (KazooState.LOST)
+    self.shut_down ()
+
+  def close (self):
+    pass
+
+  ########################################
+  # crash, our process died: the session expires after its timeout
+  ########################################
+  def crash (self):
+    if not self.connected:
+      return
+    self.ensemble.expire_session_after (self.session_id, self.timeout)
+    self.shut_down ()
+
+  def shut_down (self):
+    with self.in_flight_cv:
+      self.connected = False
+      self.in_flight = []
+      self.in_flight_cv.notify_all ()
+      pending = list (self.pending)
+
+    # like kazoo, fail the requests still on their way, a watch function
+    # waiting for one of them would otherwise block the callback thread
+    for result in pending:
+      result.set_exception (ConnectionClosedError ("Connection has been closed"))
+
+    with self.callbacks_cv:
+      self.callbacks_cv.notify_all ()
+    for thread in self.threads:
+      if thread is not threading.current_thread ():
+        thread.join ()
+    self.threads = []
+
+  ########################################
+  # session_expired, called by the ensemble. We get a new session
+  ########################################
+  def session_expired (self, session_id):
+    if not self.connected or self.session_id != session_id:
+      return
+    self.change_state (KazooState.LOST)
+    self.session_id = self.ensemble.open_session (self)
+    self.change_state (KazooState.CONNECTED)
+
+  ########################################
+  # listeners
+  ########################################
+  def add_listener (self, listener):
+    self.listeners.append (listener)
+
+  def remove_listener (self, listener):
+    if listener in self.listeners:
+      self.listeners.remove (listener)
+
+  def change_state (self, state):
+    self.state = state
+    for listener in list (self.listeners):
+      listener (state)
+
+  ########################################
+  # connection thread
+  ########################################
+  def schedule (self, delay, function):
+    with self.in_flight_cv:
+      due = max (time.monotonic () + delay, self.last_due)
+      self.last_due = due
+      self.sequence += 1
+      heapq.heappush (self.in_flight, (due, self.sequence, function))
+      self.in_flight_cv.notify ()
+
+  def connection_loop (self):
+    while True:
+      with self.in_flight_cv:
+        while self.connected and (len (self.in_flight) == 0 or self.in_flight[0][0] > time.monotonic ()):
+          self.in_flight_cv.wait (None if len (self.in_flight) == 0 else self.in_flight[0][0] - time.monotonic ())
+        if not self.connected:
+          return
+        _, _, function = heapq.heappop (self.in_flight)
+      function ()
+
+  ########################################
+  # callback thread
+  ########################################
+  def run_callback (self, callback, *args):
+    with self.callbacks_cv:
+      self.callbacks.append ((callback, args))
+      self.callbacks_cv.notify ()
+
+  def callback_loop (self):
+    while True:
+      with self.callbacks_cv:
+        while self.connected and len (self.callbacks) == 0:
+          self.callbacks_cv.wait ()
+        if not self.connected:
+          return
+        callback, args = self.callbacks.popleft ()
+      try:
+        callback (*args)
+      except Exception as e:
+        self.logger.exception ("InMemoryKazooClient::callback_loop - {}".format (e))
+
+  # the ensemble notifies us of a watch, it takes half a round trip to get here
+  def deliver_watch (self, watch, event):
+    self.schedule (self.ensemble.one_way_delay (), lambda: self.run_callback (watch, event))
+
+  ########################################
+  # submit a request, executed by the ensemble half a round trip later
+  # and the result back here after another half
+  ########################################
+  def submit (self, request_type, operation):
+    self.ops[request_type] += 1
+    result = InMemoryAsyncResult (self)
+    with self.in_flight_cv:
+      closed = not self.connected
+      if not closed:
+        self.pending.add (result)
+    if closed:
+      result.set_exception (ConnectionClosedError ("Connection has been closed"))
+      return result
+
+    def execute ():
+      try:
+        with self.ensemble.lock:
+          value = operation (self.ensemble)
+        self.schedule (self.ensemble.one_way_delay (), lambda: result.set (value))
+      except Exception as e:
+        self.schedule (self.ensemble.one_way_delay (), lambda error=e: result.set_exception (error))
+
+    self.schedule (self.ensemble.one_way_delay (), execute)
+    return result
+
+  ########################################
+  # the kazoo API
+  ########################################
+  def create_async (self, path, value=b"", acl=None, ephemeral=False, sequence=False, makepath=False, include_data=False):
+    owner = self.session_id if ephemeral else 0
+    return self.submit ("Create", lambda ensemble: ensemble.create (path, value, owner, sequence, makepath))
+
+  def create (self, path, value=b"", acl=None, ephemeral=False, sequence=False, makepath=False, include_data=False):
+    return self.create_async (path, value, acl, ephemeral, sequence, makepath).get ()
+
+  def delete_async (self, path, version=-1):
+    return self.submit ("Delete", lambda ensemble: ensemble.delete (path, version))
+
+  def delete (self, path, version=-1, recursive=False):
+    if recursive:
+      return self.submit ("Delete", lambda ensemble: ensemble.delete (path, version, True)).get ()
+    return self.delete_async (path, version).get ()
+
+  def exists_async (self, path, watch=None):
+    return self.submit ("Exists", lambda ensemble: ensemble.exists (path, self, watch))
+
+  def exists (self, path, watch=None):
+    return self.exists_async (path, watch).get ()
+
+  def get_async (self, path, watch=None):
+    return self.submit ("GetData", lambda ensemble: ensemble.get (path, self, watch))
+
+  def get (self, path, watch=None):
+    return self.get_async (path, watch).get ()
+
+  def get_children_async (self, path, watch=None, include_data=False):
+    return self.submit ("GetChildren", lambda ensemble: ensemble.get_children (path, self, watch))
+
+  def get_children (self, path, watch=None, include_data=False):
+    return self.get_children_async (path, watch).get ()
+
+  def set_async (self, path, value, version=-1):
+    return self.submit ("SetData", lambda ensemble: ensemble.set (path, value, version))
+
+  def set (self, path, value, version=-1):
+    return self.set_async (path, value, version).get ()
+
+  def ensure_path_async (self, path, acl=None):
+    def ensure (ensemble):
+      if path not in ensemble.nodes:
+        ensemble.create (path, b"", 0, False, True)
+      return True
+    return self.submit ("Create", ensure)
+
+  def ensure_path (self, path, acl=None):
+    return self.ensure_path_async (path).get ()
+
+  def transaction (self):
+    return InMemoryTransaction (self)
+
+  def ChildrenWatch (self, path, func=None, allow_session_lost=True, send_event=False):
+    return InMemoryChildrenWatch (self, path, func)
+
+  def DataWatch (self, path, func=None, *args, **kwargs):
+    return InMemoryDataWatch (self, path, func)
+
+
+########################################
+# ignore_closed
+#
+# A watch that fires or re-reads while the client is stopped (or its
+# process crashed) gets ConnectionClosedError; like the kazoo recipes we
+# let the watch end there quietly
+########################################
+def ignore_closed (func):
+  @functools.wraps (func)
+  def wrapper (*args, **kwargs):
+    try:
+      return func (*args, **kwargs)
+    except ConnectionClosedError:
+      pass
+  return wrapper
+
+
+##################################
+# ChildrenWatch, calls func (children) now and on every change
+##################################
+class InMemoryChildrenWatch ():
+
+  def __init__ (self, client, path, func=None):
+    self.client = client
+    self.path = path
+    self.func = None
+    self.stopped = False
+    self.watch_established = False
+    self.prior_children = None
+    self.run_lock = threading.Lock ()
+    client.add_listener (self.session_watcher)
+    if func != None:
+      self (func)
+
+  def __call__ (self, func):
+    self.func = func
+    self.get_children ()
+    return func
+
+  @ignore_closed
+  def get_children (self, event=None):
+    with self.run_lock:
+      if self.stopped or not self.client.connected:
+        return
+      try:
+        children = self.client.get_children (self.path, self.watcher)
+      except NoNodeError:
+        self.stopped = True
+        return
+
+      # after a new session, only call again if something changed
+      if not self.watch_established:
+        self.watch_established = True
+        if self.prior_children != None and self.prior_children == children:
+          return
+      self.prior_children = children
+
+      if self.func (children) is False:
+        self.stopped = True
+        self.client.remove_listener (self.session_watcher)
+
+  def watcher (self, event):
+    self.get_children (event)
+
+  def session_watcher (self, state):
+    if state == KazooState.LOST:
+      self.watch_established = False
+    elif state == KazooState.CONNECTED and self.func != None and not self.watch_established and not self.stopped:
+      self.client.run_callback (self.get_children)
+
+
+##################################
+# DataWatch, calls func (data, stat) now and on every change
+##################################
+class InMemoryDataWatch ():
+
+  def __init__ (self, client, path, func=None):
+    self.client = client
+    self.path = path
+    self.func = None
+    self.stopped = False
+    self.version = None
+    self.ever_called = False
+    self.run_lock = threading.Lock ()
+    client.add_listener (self.session_watcher)
+    if func != None:
+      self (func)
+
+  def __call__ (self, func):
+    self.func = func
+    self.get_data ()
+    return func
+
+  @ignore_closed
+  def get_data (self, event=None):
+    with self.run_lock:
+      if self.stopped or not self.client.connected:
+        return
+      initial_version = self.version
+      try:
+        data, stat = self.client.get (self.path, self.watcher)
+      except NoNodeError:
+        data = None
+        # watch for the node to show up
+        stat = self.client.exists (self.path, self.watcher)
+        if stat != None:
+          self.client.run_callback (self.get_data)
+          return
+
+      self.version = None if stat == None else stat.mzxid
+      if initial_version != self.version or not self.ever_called:
+        self.ever_called = True
+        if self.func (data, stat) is False:
+          self.stopped = True
+          self.client.remove_listener (self.session_watcher)
+
+  def watcher (self, event):
+    self.get_data (event)
+
+  def session_watcher (self, state):
+    if state == KazooState.CONNECTED and self.func != None and not self.stopped:
+      self.client.run_callback (self.get_data)
@@ -0,0 +1,99 @@
+###############################################
+#
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose: When an open-loop publisher publishes
+#
+# Created: Spring 2023
+#
+###############################################
+
+# Started with --load, a publisher is an open-loop load generator: the time
+# of every publication round is fixed in advance by a profile of the offered
+# rate (rounds per second), whatever happens to the rounds before it:
+#
+#    constant:R          R rounds per second, for the -i rounds of the publisher
+#    ramp:R0,R1,T        from R0 to R1 rounds per second over T seconds
+#    step:R0,dR,T,N      R0 rounds per second, dR more every T seconds, N steps
+#
+# Prefixed with poisson: (e.g., poisson:step:10,10,30,8) the rounds are the
+# arrivals of a Poisson process with that rate instead of evenly spaced.
+#
+# A round the publisher could not send on time is sent as soon as it can,
+# stamped with the time it was intended for, so the latency the subscribers
+# measure includes the time it waited (no coordinated omission).
+
+import random
+
+
+##################################
+#       LoadProfile class
+##################################
+class LoadProfile ():
+
+  ########################################
+  # constructor, spec as above
+  ########################################
+  def __init__ (self, spec, seed=None):
+    self.spec = spec
+    self.poisson = spec.startswith ("poisson:")
+    if self.poisson:
+      spec = spec[len ("poisson:"):]
+    self.random = random.Random (seed)
+
+    kind, _, params = spec.partition (":")
+    try:
+      params = [float (param) for param in params.split (",")]
+    except ValueError:
+      raise ValueError ("LoadProfile - bad parameters in {}".format (self.spec))
+
+    self.kind = kind
+    if kind == "constant" and len (params) == 1:
+      self.start_rate, = params
+      rates = [self.start_rate]
+      self.duration = None # as many rounds as the publisher is asked for
+    elif kind == "ramp" and len (params) == 3:
+      self.start_rate, self.end_rate, self.duration = params
+      rates = [self.start_rate, self.end_rate]
+    elif kind == "step" and len (params) == 4:
+      self.start_rate, self.step_rate, self.step_duration, num_steps = params
+      self.num_steps = int (num_steps)
+      self.duration = self.step_duration * self.num_steps
+      rates = [self.start_rate, self.start_rate + self.step_rate * (self.num_steps - 1)]
+    else:
+      raise ValueError ("LoadProfile - unknown profile {}, expected constant:R, ramp:R0,R1,T or step:R0,dR,T,N".format (self.spec))
+
+    # the rate only moves between its first and last value
+    if min (rates) <= 0 or (self.duration != None and self.duration <= 0):
+      raise ValueError ("LoadProfile - rates and durations of {} must be positive".format (self.spec))
+    self.max_rate = max (rates)
+
+  ########################################
+  # offered rate, elapsed seconds into the profile
+  ########################################
+  def rate (self, elapsed):
+    if self.kind == "ramp":
+      return self.start_rate + (self.end_rate - self.start_rate) * min (elapsed / self.duration, 1.0)
+    if self.kind == "step":
+      return self.start_rate + self.step_rate * min (int (elapsed // self.step_duration), self.num_steps - 1)
+    return self.start_rate
+
+  ########################################
+  # seconds into the profile of the round after the one at elapsed,
+  # None once the profile is over
+  ########################################
+  def next_round (self, elapsed):
+    if self.poisson:
+      # thinning: candidates at the highest rate, each kept with rate/max_rate
+      while True:
+        elapsed += self.random.expovariate (self.max_rate)
+        if self.duration != None and elapsed >= self.duration:
+          return None
+        if self.random.random () * self.max_rate <= self.rate (elapsed):
+          return elapsed
+
+    elapsed += 1.0 / self.rate (elapsed)
+    if self.duration != None and elapsed >= self.duration:
+      return None
+    return elapsed
@@ -0,0 +1,259 @@
+###############################################
+#
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose: What the middleware event loops tell about themselves
+#
+# Created: Spring 2023
+#
+###############################################
+
+# Started with --metrics_port, an entity keeps track of how its event loop
+# spends its time and serves it over HTTP (http://<host>:<port>/metrics) in
+# the Prometheus text format:
+#
+#    cs6381_handler_seconds           histogram of the time spent in each handler,
+#                                     i.e., from waking up from the poll to polling
+#                                     again (the handler is timeout when nothing came in)
+#    cs6381_poll_wait_seconds_total   time spent waiting in the poll
+#    cs6381_busy_seconds_total        time spent handling what woke us up
+#    cs6381_socket_bytes_total        bytes received and sent per socket
+#    cs6381_socket_messages_total     frames received and sent per socket
+#    cs6381_messages_dropped_total    publications we did not pass on, per reason
+#    cs6381_queue_depth               current length of the queues of the entity
+#
+# The event loop tells us when it goes into and comes back from the poll,
+# so the time of a handler includes whatever it does before the next poll.
+# Bytes are counted by the sockets themselves, which are created from a
+# subclass of the ZMQ socket when the metrics are on. Without --metrics_port
+# the middleware gets plain sockets and skips the two calls per iteration.
+#
+# The counters are only updated by the event loop thread; the HTTP server
+# thread only reads them, so a scrape may be off by the iteration under way.
+
+import time
+import bisect
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import zmq
+
+# upper bounds of the histogram buckets in seconds, from 10 us to 10 s
+BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+##################################
+# a ZMQ socket that counts what goes through it
+##################################
+class CountingSocket (zmq.Socket):
+
+  # zmq.Socket takes unknown attributes for socket options, so they are declared here
+  loop_metrics = None
+  metrics_name = None
+
+  # send_multipart and send_string go through send, one frame at a time
+  def send (self, data, *args, **kwargs):
+    result = super ().send (data, *args, **kwargs)
+    self.loop_metrics.sent (self.metrics_name, len (data))
+    return result
+
+  # recv_multipart goes through recv
+  def recv (self, *args, **kwargs):
+    data = super ().recv (*args, **kwargs)
+    self.loop_metrics.received (self.metrics_name, len (data))
+    return data
+
+
+########################################
+# create_socket
+#
+# A socket of the context, counting its bytes under name when there are
+# loop metrics
+########################################
+def create_socket (context, socket_type, loop_metrics, name):
+  if loop_metrics == None:
+    return context.socket (socket_type)
+
+  socket = context.socket (socket_type, socket_class=CountingSocket)
+  socket.loop_metrics = loop_metrics
+  socket.metrics_name = name
+  return socket
+
+
+##################################
+# histogram of the time spent in one handler
+##################################
+class Histogram ():
+
+  def __init__ (self):
+    self.counts = [0] * (len (BUCKETS) + 1) # the last one is +Inf
+    self.sum = 0.0
+    self.count = 0
+
+  def observe (self, seconds):
+    self.counts[bisect.bisect_left (BUCKETS, seconds)] += 1
+    self.sum += seconds
+    self.count += 1
+
+
+##################################
+#       LoopMetrics class
+##################################
+class LoopMetrics ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, logger, entity, dispatch_order, other="other"):
+    self.logger = logger
+    self.entity = entity # name of the publisher, subscriber, broker or discovery node
+    self.dispatch_order = dispatch_order # handlers in the order the event loop checks their sockets
+    self.other = other # handler of the sockets nobody watches
+    self.watched = {} # handler -> socket
+    self.handlers = {} # handler -> Histogram
+    self.poll_wait = 0.0
+    self.busy = 0.0
+    self.iterations = 0
+    self.bytes = collections.Counter () # (socket, "in"/"out") -> bytes
+    self.messages = collections.Counter () # (socket, "in"/"out") -> frames
+    self.dropped = collections.Counter () # reason -> publications
+    self.queues = {} # queue -> function returning its length
+    self.poll_start = None
+    self.woke_up = None # when the last poll returned
+    self.handler = None # handler of what woke us up
+    self.server = None
+
+  ########################################
+  # watch a socket of the poller, the event loop handles it with handler
+  ########################################
+  def watch (self, socket, handler):
+    self.watched[handler] = socket
+
+  ########################################
+  # a queue whose length we report, length is called at every scrape
+  ########################################
+  def queue (self, name, length):
+    self.queues[name] = length
+
+  ########################################
+  # called by the event loop right before and after the poll
+  ########################################
+  def before_poll (self):
+    now = time.perf_counter ()
+    if self.woke_up != None:
+      elapsed = now - self.woke_up
+      self.busy += elapsed
+      histogram = self.handlers.get (self.handler)
+      if histogram == None:
+        histogram = self.handlers[self.handler] = Histogram ()
+      histogram.observe (elapsed)
+    self.poll_start = now
+
+  def after_poll (self, events):
+    now = time.perf_counter ()
+    self.poll_wait += now - self.poll_start
+    self.woke_up = now
+    self.iterations += 1
+
+    # the event loops handle the first ready socket in their dispatch order
+    if not events:
+      self.handler = "timeout"
+      return
+    for handler in self.dispatch_order:
+      socket = self.watched.get (handler)
+      if socket != None and socket in events:
+        self.handler = handler
+        return
+    self.handler = self.other
+
+  ########################################
+  # counted by the sockets and the handlers
+  ########################################
+  def received (self, socket, num_bytes):
+    self.bytes[(socket, "in")] += num_bytes
+    self.messages[(socket, "in")] += 1
+
+  def sent (self, socket, num_bytes):
+    self.bytes[(socket, "out")] += num_bytes
+    self.messages[(socket, "out")] += 1
+
+  def drop (self, reason):
+    self.dropped[reason] += 1
+
+  ########################################
+  # the Prometheus text format. Runs in the thread of the HTTP server, so
+  # it iterates over copies: the event loop may add keys meanwhile
+  ########################################
+  def render (self):
+    entity = 'entity="{}"'.format (self.entity)
+    lines = []
+
+    lines.append ("# HELP cs6381_handler_seconds Time from waking up from the poll to polling again, by handler")
+    lines.append ("# TYPE cs6381_handler_seconds histogram")
+    for handler, histogram in list (self.handlers.items ()):
+      labels = '{},handler="{}"'.format (entity, handler)
+      cumulative = 0
+      for bound, count in zip (BUCKETS + ("+Inf",), list (histogram.counts)):
+        cumulative += count
+        lines.append ('cs6381_handler_seconds_bucket{{{},le="{}"}} {}'.format (labels, bound, cumulative))
+      lines.append ("cs6381_handler_seconds_sum{{{}}} {}".format (labels, histogram.sum))
+      lines.append ("cs6381_handler_seconds_count{{{}}} {}".format (labels, histogram.count))
+
+    lines.append ("# HELP cs6381_poll_wait_seconds_total Time spent waiting in the poll")
+    lines.append ("# TYPE cs6381_poll_wait_seconds_total counter")
+    lines.append ("cs6381_poll_wait_seconds_total{{{}}} {}".format (entity, self.poll_wait))
+    lines.append ("# HELP cs6381_busy_seconds_total Time spent handling what woke up the event loop")
+    lines.append ("# TYPE cs6381_busy_seconds_total counter")
+    lines.append ("cs6381_busy_seconds_total{{{}}} {}".format (entity, self.busy))
+    lines.append ("# HELP cs6381_loop_iterations_total Times the event loop woke up from the poll")
+    lines.append ("# TYPE cs6381_loop_iterations_total counter")
+    lines.append ("cs6381_loop_iterations_total{{{}}} {}".format (entity, self.iterations))
+
+    lines.append ("# HELP cs6381_socket_bytes_total Bytes received and sent per socket")
+    lines.append ("# TYPE cs6381_socket_bytes_total counter")
+    for (socket, direction), num_bytes in sorted (list (self.bytes.items ())):
+      lines.append ('cs6381_socket_bytes_total{{{},socket="{}",direction="{}"}} {}'.format (entity, socket, direction, num_bytes))
+    lines.append ("# HELP cs6381_socket_messages_total Frames received and sent per socket")
+    lines.append ("# TYPE cs6381_socket_messages_total counter")
+    for (socket, direction), num_messages in sorted (list (self.messages.items ())):
+      lines.append ('cs6381_socket_messages_total{{{},socket="{}",direction="{}"}} {}'.format (entity, socket, direction, num_messages))
+
+    lines.append ("# HELP cs6381_messages_dropped_total Publications not passed on, by reason")
+    lines.append ("# TYPE cs6381_messages_dropped_total counter")
+    for reason, count in sorted (list (self.dropped.items ())):
+      lines.append ('cs6381_messages_dropped_total{{{},reason="{}"}} {}'.format (entity, reason, count))
+
+    lines.append ("# HELP cs6381_queue_depth Current length of a queue of the entity")
+    lines.append ("# TYPE cs6381_queue_depth gauge")
+    for name, length in list (self.queues.items ()):
+      lines.append ('cs6381_queue_depth{{{},queue="{}"}} {}'.format (entity, name, length ()))
+
+    return "\n".join (lines) + "\n"
+
+  ########################################
+  # serve the metrics on http://<any>:port/metrics
+  ########################################
+  def serve (self, port):
+    loop_metrics = self
+
+    class Handler (BaseHTTPRequestHandler):
+      def do_GET (self):
+        if self.path.split ("?")[0] not in ("/", "/metrics"):
+          self.send_error (404)
+          return
+        body = loop_metrics.render ().encode ("utf-8")
+        self.send_response (200)
+        self.send_header ("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header ("Content-Length", str (len (body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+      def log_message (self, format, *args):
+        pass # scrapes would flood the log
+
+    self.server = ThreadingHTTPServer (("", port), Handler)
+    self.server.daemon_threads = True
+    threading.Thread (target=self.server.serve_forever, name="LoopMetrics", daemon=True).start ()
+    self.logger.info ("LoopMetrics::serve - metrics of {} on http://localhost:{}/metrics".format (self.entity, self.server.server_address[1]))
@@ -0,0 +1,355 @@
+###############################################
+#
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose: Where the publishers and subscribers store their measurements
+#
+# Created: Spring 2023
+#
+###############################################
+
+# The applications hand every measurement (a row of one of the tables below)
+# to a MetricsSink, which only puts it in a bounded queue, so recording never
+# blocks the event loop. A writer thread takes the rows off the queue in
+# batches (BatchSize rows or FlushInterval seconds, whichever comes first) and
+# writes each batch to the backend chosen in the [Metrics] section of
+# config.ini:
+#
+#    SQLite   a local database file in WAL mode (Path), several processes
+#             on the same host can share it
+#    CSV      append-only files, one per table and process, in the Path directory
+#    Parquet  one columnar file per batch, per table, in the Path directory (needs pyarrow)
+#    MySQL    the tables of SQL_scripts.sql on a MySQL server (needs mysql-connector)
+#    None     measurements are dropped
+#
+# Every batch is committed (or flushed and synced) as soon as it is written,
+# so when a process is killed we lose at most the rows of the last
+# FlushInterval. A batch the backend fails to take is kept and tried again
+# with the next one. If the queue is full, rows are dropped and counted
+# rather than making the application wait.
+
+import os
+import sys
+import time
+import csv
+import queue
+import atexit
+import signal
+import threading
+
+# table -> (column, SQL type) in the order of the rows the applications record
+TABLES = {
+  'latencies': [
+    ('latency_sec', 'REAL'),
+    ('frequency', 'INTEGER'),
+    ('num_topics', 'INTEGER'),
+    ('pub_num', 'INTEGER'),
+    ('sub_num', 'INTEGER'),
+    ('dissemination', 'TEXT'),
+    ('pub_id', 'TEXT'),
+    ('sub_id', 'TEXT'),
+    ('experiment_name', 'TEXT'),
+    ('received_at', 'REAL'),
+    ('offered_rate', 'REAL'),
+    ('clock_offset', 'REAL'),
+    ('clock_error', 'REAL'),
+  ],
+  'dht_latencies': [
+    ('type_of_request', 'TEXT'),
+    ('latency_sec', 'REAL'),
+    ('lookup_strategy', 'TEXT'),
+    ('pub_num', 'INTEGER'),
+    ('sub_num', 'INTEGER'),
+    ('dht_num', 'INTEGER'),
+    ('entity_id', 'TEXT'),
+  ],
+}
+
+
+##################################
+# SQLite backend
+##################################
+class SqliteBackend ():
+
+  def __init__ (self, path):
+    self.path = path
+    self.connection = None
+
+  # called in the writer thread, sqlite connections stay in their thread
+  def open (self):
+    import sqlite3
+    self.connection = sqlite3.connect (self.path, timeout=30)
+    self.connection.execute ("PRAGMA journal_mode=WAL")
+    self.connection.execute ("PRAGMA synchronous=NORMAL")
+    for table, columns in TABLES.items ():
+      self.connection.execute ("CREATE TABLE IF NOT EXISTS {} (entry_id INTEGER PRIMARY KEY AUTOINCREMENT, {})".format (
+        table, ", ".join ("{} {}".format (column, sql_type) for column, sql_type in columns)))
+      # a database of an earlier run may lack the columns added since
+      existing = {row[1] for row in self.connection.execute ("PRAGMA table_info ({})".format (table))}
+      for column, sql_type in columns:
+        if column not in existing:
+          self.connection.execute ("ALTER TABLE {} ADD COLUMN {} {}".format (table, column, sql_type))
+    self.connection.commit ()
+
+  def write (self, table, rows):
+    columns = [column for column, _ in TABLES[table]]
+    self.connection.executemany ("INSERT INTO {} ({}) VALUES ({})".format (table, ", ".join (columns), ", ".join ("?" * len (columns))), rows)
+    self.connection.commit ()
+
+  def close (self):
+    if self.connection != None:
+      self.connection.close ()
+      self.connection = None
+
+
+##################################
+# CSV backend, append-only files
+##################################
+class CsvBackend ():
+
+  def __init__ (self, directory, name):
+    self.directory = directory
+    self.name = name
+    self.files = {} # table -> open file
+
+  def open (self):
+    os.makedirs (self.directory, exist_ok=True)
+
+  def write (self, table, rows):
+    if table not in self.files:
+      path = os.path.join (self.directory, "{}-{}-{}.csv".format (table, self.name, os.getpid ()))
+      self.files[table] = open (path, "a", newline="")
+      if self.files[table].tell () == 0:
+        csv.writer (self.files[table]).writerow ([column for column, _ in TABLES[table]])
+    out = self.files[table]
+    csv.writer (out).writerows (rows)
+    out.flush ()
+    os.fsync (out.fileno ())
+
+  def close (self):
+    for out in self.files.values ():
+      out.close ()
+    self.files = {}
+
+
+##################################
+# Parquet backend, one columnar file per batch
+##################################
+class ParquetBackend ():
+
+  def __init__ (self, directory, name):
+    self.directory = directory
+    self.name = name
+    self.num_batches = 0
+    self.pyarrow = None
+    self.parquet = None
+
+  def open (self):
+    import pyarrow
+    import pyarrow.parquet
+    self.pyarrow = pyarrow
+    self.parquet = pyarrow.parquet
+    for table in TABLES:
+      os.makedirs (os.path.join (self.directory, table), exist_ok=True)
+
+  def write (self, table, rows):
+    columns = [column for column, _ in TABLES[table]]
+    arrow_table = self.pyarrow.table ({column: [row[i] for row in rows] for i, column in enumerate (columns)})
+    path = os.path.join (self.directory, table, "{}-{}-{:06d}.parquet".format (self.name, os.getpid (), self.num_batches))
+    # readers never see a half written file
+    self.parquet.write_table (arrow_table, path + ".tmp")
+    os.replace (path + ".tmp", path)
+    self.num_batches += 1
+
+  def close (self):
+    pass
+
+
+##################################
+# MySQL backend, the tables of SQL_scripts.sql
+##################################
+class MysqlBackend ():
+
+  def __init__ (self, host, database, user, password):
+    self.host = host
+    self.database = database
+    self.user = user
+    self.password = password
+    self.connection = None
+
+  def open (self):
+    import mysql.connector
+    self.connector = mysql.connector
+
+  def write (self, table, rows):
+    # (re)connect lazily, the server may have been away for the last batch
+    if self.connection == None or not self.connection.is_connected ():
+      self.connection = self.connector.connect (host=self.host, database=self.database, user=self.user, password=self.password)
+    columns = [column for column, _ in TABLES[table]]
+    cursor = self.connection.cursor ()
+    try:
+      cursor.executemany ("INSERT INTO {} ({}) VALUES ({})".format (table, ", ".join (columns), ", ".join (["%s"] * len (columns))), rows)
+      self.connection.commit ()
+    finally:
+      cursor.close ()
+
+  def close (self):
+    if self.connection != None and self.connection.is_connected ():
+      self.connection.close ()
+    self.connection = None
+
+
+##################################
+#       MetricsSink class
+##################################
+class MetricsSink ():
+
+  STOP = object () # tells the writer thread to finish
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, logger, backend, queue_size=10000, batch_size=500, flush_interval=1.0):
+    self.logger = logger
+    self.backend = backend # None drops everything
+    self.queue = queue.Queue (maxsize=queue_size)
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.pending = {} # table -> rows the backend did not take yet
+    self.num_pending = 0
+    self.max_pending = queue_size
+    self.dropped = 0 # rows we had no room for
+    self.written = 0
+    self.closed = False
+    self.thread = None
+
+    if self.backend != None:
+      self.thread = threading.Thread (target=self.writer_loop, name="MetricsSink", daemon=True)
+      self.thread.start ()
+      atexit.register (self.close)
+
+  ########################################
+  # record a row of a table, never blocks
+  ########################################
+  def record (self, table, row):
+    if self.backend == None or self.closed:
+      return
+    try:
+      self.queue.put_nowait ((table, row))
+    except queue.Full:
+      self.dropped += 1
+
+  ########################################
+  # writer thread
+  ########################################
+  def writer_loop (self):
+    try:
+      self.backend.open ()
+    except Exception as e:
+      self.logger.error ("MetricsSink::writer_loop - cannot open {}: {}".format (type (self.backend).__name__, e))
+      self.backend = None
+      return
+
+    stopping = False
+    while not stopping:
+      # wait for the first row, then collect a batch for up to flush_interval
+      try:
+        item = self.queue.get (timeout=self.flush_interval)
+      except queue.Empty:
+        self.flush ()
+        continue
+
+      batch = []
+      deadline = time.time () + self.flush_interval
+      while True:
+        if item is self.STOP:
+          stopping = True
+          break
+        batch.append (item)
+        if len (batch) >= self.batch_size:
+          break
+        try:
+          item = self.queue.get (timeout=max (deadline - time.time (), 0))
+        except queue.Empty:
+          break
+
+      for table, row in batch:
+        self.pending.setdefault (table, []).append (row)
+      self.num_pending += len (batch)
+      self.flush ()
+
+    self.backend.close ()
+
+  ########################################
+  # write what is pending, keep it if the backend fails
+  ########################################
+  def flush (self):
+    for table in list (self.pending):
+      rows = self.pending[table]
+      try:
+        self.backend.write (table, rows)
+      except Exception as e:
+        self.logger.error ("MetricsSink::flush - writing {} rows of {} failed, trying again later: {}".format (len (rows), table, e))
+        continue
+      self.written += len (rows)
+      self.num_pending -= len (rows)
+      del self.pending[table]
+
+    # the backend has been away for too long, make room
+    while self.num_pending > self.max_pending:
+      table = next (iter (self.pending))
+      excess = min (self.num_pending - self.max_pending, len (self.pending[table]))
+      del self.pending[table][:excess]
+      self.num_pending -= excess
+      self.dropped += excess
+      if len (self.pending[table]) == 0:
+        del self.pending[table]
+
+  ########################################
+  # close, write whatever is queued
+  ########################################
+  def close (self, timeout=10.0):
+    if self.closed or self.thread == None:
+      return
+    self.closed = True
+    try:
+      self.queue.put (self.STOP, timeout=timeout)
+    except queue.Full:
+      pass
+    self.thread.join (timeout)
+    self.logger.info ("MetricsSink::close - {} rows written, {} dropped, {} not written".format (self.written, self.dropped, self.num_pending))
+
+
+########################################
+# create_metrics_sink
+#
+# The sink configured in the [Metrics] section of config.ini; name tells
+# apart the files of the processes sharing a directory
+########################################
+def create_metrics_sink (config, logger, name):
+  section = config['Metrics'] if config.has_section ('Metrics') else {}
+  kind = section.get ('Sink', 'None')
+  path = section.get ('Path', None)
+
+  if kind == 'SQLite':
+    backend = SqliteBackend (path if path else 'metrics.db')
+  elif kind == 'CSV':
+    backend = CsvBackend (path if path else 'metrics', name)
+  elif kind == 'Parquet':
+    backend = ParquetBackend (path if path else 'metrics', name)
+  elif kind == 'MySQL':
+    backend = MysqlBackend (section.get ('Host', 'localhost'), section.get ('Database', 'distributed_hw1'), section.get ('User', 'root'), section.get ('Password', ''))
+  elif kind == 'None':
+    backend = None
+  else:
+    raise ValueError ("Unknown metrics sink {}".format (kind))
+
+  # a plain kill (SIGTERM) should still write what is queued
+  if backend != None and threading.current_thread () is threading.main_thread () and signal.getsignal (signal.SIGTERM) == signal.SIG_DFL:
+    signal.signal (signal.SIGTERM, lambda signum, frame: sys.exit (128 + signum))
+
+  return MetricsSink (logger, backend,
+                      queue_size=int (section.get ('QueueSize', 10000)),
+                      batch_size=int (section.get ('BatchSize', 500)),
+                      flush_interval=float (section.get ('FlushInterval', 1.0)))
@@ -29,11 +29,14 @@ import sys    # for syspath and system exception
 import time   # for sleep
 import logging # for logging. Use it in place of print statements.
 import zmq  # ZMQ sockets
-import json # for reading the dht.json file
-import random # for choosing a random DHT node to contact
 
 # import serialization logic
 from CS6381_MW import discovery_pb2
+from CS6381_MW.DhtRing import DhtRing
+from CS6381_MW.DiscoveryLeaderResolver import DiscoveryLeaderResolver
+from CS6381_MW.LoopMetrics import LoopMetrics, create_socket
+from CS6381_MW.AsyncLogging import LogSampler
+from CS6381_MW.ClockSync import ClockSync
 #from CS6381_MW import topic_pb2  # you will need this eventually
 
 # import any other packages you need.
@@ -57,6 +60,10 @@ class PublisherMW ():
     self.handle_events = True # in general we keep going thru the event loop
     self.dht_json_path = None
     self.dht_num = None
+    self.leader_resolver = None # follows the discovery leader
+    self.loop_metrics = None # how the event loop spends its time, with --metrics_port
+    self.log_sampler = LogSampler () # which of the rounds we log, 1 in --log_every per topic
+    self.clock = ClockSync (logger) # our clock, synchronized with the discovery service with --clock_sync
 
   ########################################
   # configure/initialize
@@ -71,6 +78,7 @@ class PublisherMW ():
       # First retrieve our advertised IP addr and the publication port num
       self.port = args.port
       self.addr = args.addr
+      self.log_sampler = LogSampler (args.log_every)
 
       # path to the DHT.json file
       self.dht_json_path = args.dht_json_path
@@ -79,6 +87,15 @@ class PublisherMW ():
       self.logger.debug ("PublisherMW::configure - obtain ZMQ context")
       context = zmq.Context ()  # returns a singleton object
 
+      # estimate the offset of our clock from the one of the discovery service if asked to
+      if args.clock_sync:
+        self.clock.start (context, args.clock_sync)
+
+      # keep track of the event loop if asked to
+      if args.metrics_port:
+        self.loop_metrics = LoopMetrics (self.logger, args.name, ["handle_reply", "handle_discovery_leader_change"])
+        self.loop_metrics.serve (args.metrics_port)
+
       # get the ZMQ poller object
       self.logger.debug ("PublisherMW::configure - obtain the poller")
       self.poller = zmq.Poller ()
@@ -87,14 +104,16 @@ class PublisherMW ():
       # REQ is needed because we are the client of the Discovery service
       # PUB is needed because we publish topic data
       self.logger.debug ("PublisherMW::configure - obtain REQ and PUB sockets")
-      self.req = context.socket (zmq.REQ)
-      self.pub = context.socket (zmq.PUB)
+      self.req = create_socket (context, zmq.REQ, self.loop_metrics, "req")
+      self.pub = create_socket (context, zmq.PUB, self.loop_metrics, "pub")
 
       # Since are using the event loop approach, register the REQ socket for incoming events
       # Note that nothing ever will be received on the PUB socket and so it does not make
       # any sense to register it with the poller for an incoming message.
       self.logger.debug ("PublisherMW::configure - register the REQ socket for incoming replies")
       self.poller.register (self.req, zmq.POLLIN)
+      if self.loop_metrics != None:
+        self.loop_metrics.watch (self.req, "handle_reply")
       
       # Now connect ourselves to the discovery service. Recall that the IP/port were
       # supplied in our argument parsing. Best practices of ZQM suggest that the
@@ -104,20 +123,19 @@ class PublisherMW ():
       # if we are using DHT lookup, we are connecting to a random node in DHT file
       # otherwise, we are connecting to the discovery service specified in the parameters
       if (self.upcall_obj.lookup == "DHT"):
-        f = open(self.dht_json_path)
-        dht_file = json.load(f) # get dht.hson as a dictionary
-        dht_nodes_number = len(dht_file['dht'])
-        self.dht_num = dht_nodes_number
-        random_index = random.randint(0, dht_nodes_number-1)
-        randomly_chosen_dht = dht_file['dht'][random_index]
+        dht_ring = DhtRing.load(self.dht_json_path) # uses the binary ring descriptor when it is up to date
+        self.dht_num = len(dht_ring)
+        randomly_chosen_dht = dht_ring.random_node()
         self.logger.debug (f"PublisherMW::configure - connect to DHT Discovery service: {randomly_chosen_dht}")
         connect_str = "tcp://" + randomly_chosen_dht['IP'] + ":" + str(randomly_chosen_dht['port'])
         self.req.connect (connect_str)
+        self.clock.set_server (connect_str)
       
       elif (self.upcall_obj.lookup == "Centralized"):
         connect_str = "tcp://" + args.discovery
         # connect to discovery
         self.req.connect (connect_str)
+        self.clock.set_server (connect_str)
       
       # No additional setup needed for Publisher in case of ZookeeperLookup
       
@@ -149,7 +167,11 @@ class PublisherMW ():
       while self.handle_events:  # it starts with a True value
         # poll for events. We give it an infinite timeout.
         # The return value is a socket to event mask mapping
+        if self.loop_metrics != None:
+          self.loop_metrics.before_poll ()
         events = dict (self.poller.poll (timeout=timeout))
+        if self.loop_metrics != None:
+          self.loop_metrics.after_poll (events)
 
         # Unlike the previous starter code, here we are never returning from
         # the event loop but handle everything in the same locus of control
@@ -169,6 +191,10 @@ class PublisherMW ():
 
           # handle the incoming reply from remote entity and return the result
           timeout = self.handle_reply ()
+
+        elif self.leader_resolver != None and self.leader_resolver.socket in events:
+          # The discovery leader changed, keep the timeout we had
+          self.handle_discovery_leader_change ()
           
         else:
           raise Exception ("Unknown event after poll")
@@ -270,7 +296,7 @@ class PublisherMW ():
       # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
       # a real string
       buf2send = disc_req.SerializeToString ()
-      self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
+      self.logger.debug ("Stringified serialized buf = %s", buf2send)
 
       # now send this to our discovery service
       self.logger.debug ("PublisherMW::register - send stringified buffer to Discovery service")
@@ -321,7 +347,7 @@ class PublisherMW ():
       # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
       # a real string
       buf2send = disc_req.SerializeToString ()
-      self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
+      self.logger.debug ("Stringified serialized buf = %s", buf2send)
 
       # now send this to our discovery service
       self.logger.debug ("PublisherMW::is_ready - send stringified buffer to Discovery service")
@@ -345,14 +371,19 @@ class PublisherMW ():
   #
   # This part is left as an exercise.
   #################################################################
-  def disseminate (self, id, topic, data):
+  def disseminate (self, id, topic, data, epoch=0, seq=0):
     try:
       self.logger.debug ("PublisherMW::disseminate")
 
       # Now use the protobuf logic to encode the info and send it.  But for now
       # we are simply sending the string to make sure dissemination is working.
-      send_str = topic + ":" + str(data)
-      self.logger.debug ("PublisherMW::disseminate - {}".format (send_str))
+      #
+      # Right after the topic comes our ownership epoch of the topic (the
+      # sequence number of our node in the ownership election), our sequence
+      # number of the publication and our id, so that subscribers can tell
+      # the newest publication from replays, copies and former owners
+      send_str = topic + ":" + str(epoch) + ":" + str(seq) + ":" + id + ":" + str(data)
+      self.logger.debug ("PublisherMW::disseminate - %s", send_str)
 
       # send the info as bytes. See how we are providing an encoding of utf-8
       self.pub.send (bytes(send_str, "utf-8"))
@@ -380,6 +411,51 @@ class PublisherMW ():
     ''' disable event loop '''
     self.handle_events = False
 
+  ########################################
+  # watch_discovery_leader
+  #
+  # Follow the discovery leader through ZooKeeper, or the static endpoints
+  # (Leaders in the [Discovery] section of config.ini) without it
+  ########################################
+  def watch_discovery_leader(self, zk_client, static_leaders):
+    self.leader_resolver = DiscoveryLeaderResolver(self.logger, zmq.Context.instance(), DiscoveryLeaderResolver.parse_static_leaders(static_leaders))
+    self.poller.register(self.leader_resolver.socket, zmq.POLLIN)
+    if self.loop_metrics != None:
+      self.loop_metrics.watch (self.leader_resolver.socket, "handle_discovery_leader_change")
+    self.leader_resolver.start(zk_client)
+    return
+
+
+  ########################################
+  # wait_for_discovery_leader
+  #
+  # Block until there is a discovery leader and connect to it
+  ########################################
+  def wait_for_discovery_leader(self):
+    self.leader_resolver.wait_for_leader()
+    self.handle_discovery_leader_change()
+    return
+
+
+  ########################################
+  # handle_discovery_leader_change
+  #
+  # Called from the event loop when the discovery leader may have changed
+  ########################################
+  def handle_discovery_leader_change(self):
+    change = self.leader_resolver.handle_event()
+    if change == None:
+      return
+
+    old, new = change
+    self.logger.info("PublisherMW::handle_discovery_leader_change - from {} to {}".format(old, new))
+    if(old != None):
+      self.disconnect_from_old_discovery_leader(old['addr'], old['port'])
+    if(new != None):
+      self.connect_to_discovery_leader(new['addr'], new['port'])
+    return
+
+
   ########################################
   # connect_to_discovery_leader
   #
@@ -388,6 +464,7 @@ class PublisherMW ():
   def connect_to_discovery_leader(self, disc_addr, disc_port):
     # Connect the req socket
     self.req.connect('tcp://' + disc_addr + ':' + str(disc_port))
+    self.clock.set_server('tcp://' + disc_addr + ':' + str(disc_port))
     return
   
   ########################################
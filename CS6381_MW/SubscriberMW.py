@@ -38,14 +38,21 @@ import os     # for OS functions
 import sys    # for syspath and system exception
 import time   # for sleep
 import logging # for logging. Use it in place of print statements.
+import threading # the ZooKeeper watches run in the kazoo threads
+import collections
 import zmq  # ZMQ sockets
 import json # for reading the dht.json file
-import random # for choosing a random DHT node to contact
 
 import ast # for working with subsrption data (converting it back to dictionary)
 
 # import serialization logic
 from CS6381_MW import discovery_pb2
+from CS6381_MW.DhtRing import DhtRing
+from CS6381_MW.DiscoveryLeaderResolver import DiscoveryLeaderResolver
+from CS6381_MW.LoopMetrics import LoopMetrics, create_socket
+from CS6381_MW.TraceFile import TraceWriter
+from CS6381_MW.AsyncLogging import LogSampler
+from CS6381_MW.ClockSync import ClockSync
 #from CS6381_MW import topic_pb2  # you will need this eventually
 
 ##################################
@@ -69,11 +76,28 @@ class SubscriberMW ():
 
     # Zookeeper-related fields
     self.disc_sub_socket = None # Socket for subscribing to updates from discovery
+    self.leader_resolver = None # follows the discovery leader
+    self.zk_event_pair = None # PAIR socket on which the event loop receives the ZooKeeper watch events
+    self.zk_event_sender = None # its peer, written to from the kazoo threads
+    self.zk_event_lock = threading.Lock () # kazoo runs watches and async completions in different threads
+    self.zk_event_generation = collections.Counter () # kind of event -> generation of the latest one posted
+    self.zk_applied_generation = {} # kind of event -> generation of the latest one handled
+    self.loop_metrics = None # how the event loop spends its time, with --metrics_port
+    self.trace = None # where the publications we receive are written, with --trace
+    self.log_sampler = LogSampler () # which of the messages we log, 1 in --log_every per topic
+    self.clock = ClockSync (logger) # our clock, synchronized with the discovery service with --clock_sync
     # self.discovery_leader_addr = None 
     # self.discovery_leader_port = None
     # self.discovery_leader_sync_port = None
     self.ipports_connected_to = set()
 
+    # Ownership-related fields
+    self.topic_epoch = {} # topic -> highest ownership epoch seen on it
+    self.publication_seqs = {} # topic -> {publisher id -> sequence number of its newest publication}
+
+    # Autoscaling-related fields
+    self.excluded_ipports = set() # broker instances serving other subscribers, never connect to them
+
   ########################################
   # configure/initialize
   ########################################
@@ -86,11 +110,25 @@ class SubscriberMW ():
 
       self.port = args.port
       self.dht_json_path = args.dht_json_path
+      self.log_sampler = LogSampler (args.log_every)
       
       # Next get the ZMQ context
       self.logger.debug ("SubscriberMW::configure - obtain ZMQ context")
       context = zmq.Context ()  # returns a singleton object
 
+      # estimate the offset of our clock from the one of the discovery service if asked to
+      if args.clock_sync:
+        self.clock.start (context, args.clock_sync)
+
+      # keep track of the event loop if asked to
+      if args.metrics_port:
+        self.loop_metrics = LoopMetrics (self.logger, args.name, ["handle_bytes_on_req_socket", "handle_discovery_leader_change", "handle_zk_events", "handle_sync_update_from_disc_leader", "handle_bytes_on_sub_socket"])
+        self.loop_metrics.serve (args.metrics_port)
+
+      # and trace the publications we receive if asked to
+      if args.trace:
+        self.trace = TraceWriter (self.logger, args.trace)
+
       # get the ZMQ poller object
       self.logger.debug ("SubscriberMW::configure - obtain the poller")
       self.poller = zmq.Poller ()
@@ -99,12 +137,15 @@ class SubscriberMW ():
       # REQ is needed because we are the client of the Discovery service
       # PUB is needed because we publish topic data
       self.logger.debug ("SubscriberMW::configure - obtain REQ and PUB sockets")
-      self.req = context.socket (zmq.REQ)
-      self.sub = context.socket (zmq.SUB)
+      self.req = create_socket (context, zmq.REQ, self.loop_metrics, "req")
+      self.sub = create_socket (context, zmq.SUB, self.loop_metrics, "sub")
 
       self.logger.debug ("SubscriberMW::configure - register the REQ and SUB socket for incoming data (responses from discovery service and the data we subscribed to)")
       self.poller.register (self.req, zmq.POLLIN)
       self.poller.register (self.sub, zmq.POLLIN)
+      if self.loop_metrics != None:
+        self.loop_metrics.watch (self.req, "handle_bytes_on_req_socket")
+        self.loop_metrics.watch (self.sub, "handle_bytes_on_sub_socket")
       
       # Now connect ourselves to the discovery service. Recall that the IP/port were
       # supplied in our argument parsing. Best practices of ZQM suggest that the
@@ -114,27 +155,28 @@ class SubscriberMW ():
       # if we are using DHT lookup, we are connecting to a random node in DHT file
       # otherwise, we are connecting to the discovery service specified in the parameters
       if (self.upcall_obj.lookup == "DHT"):
-        f = open(self.dht_json_path)
-        dht_file = json.load(f) # get dht.hson as a dictionary
-        dht_nodes_number = len(dht_file['dht'])
-        self.dht_num = dht_nodes_number
-        random_index = random.randint(0, dht_nodes_number-1)
-        randomly_chosen_dht = dht_file['dht'][random_index]
+        dht_ring = DhtRing.load(self.dht_json_path) # uses the binary ring descriptor when it is up to date
+        self.dht_num = len(dht_ring)
+        randomly_chosen_dht = dht_ring.random_node()
         self.logger.debug (f"SubscriberMW::configure - connect to DHT Discovery service: {randomly_chosen_dht}")
         connect_str = "tcp://" + randomly_chosen_dht['IP'] + ":" + str(randomly_chosen_dht['port'])
         # connect to discovery
         self.req.connect (connect_str)
+        self.clock.set_server (connect_str)
       
       elif (self.upcall_obj.lookup == "Centralized"):
         connect_str = "tcp://" + args.discovery
         # connect to discovery
         self.req.connect (connect_str)
+        self.clock.set_server (connect_str)
       
       elif (self.upcall_obj.lookup == "ZooKeeper"):
         # Set up a SUB socket to later connect to a discovery
-        self.disc_sub_socket = context.socket (zmq.SUB)
+        self.disc_sub_socket = create_socket (context, zmq.SUB, self.loop_metrics, "disc_sub")
         # Add the sub socket to the poller
         self.poller.register (self.disc_sub_socket, zmq.POLLIN)
+        if self.loop_metrics != None:
+          self.loop_metrics.watch (self.disc_sub_socket, "handle_sync_update_from_disc_leader")
         
         # Make the subscriber listen for topics sub and unsub
         # sub is for used for notifying subs of new entities they need to subscribe to
@@ -163,7 +205,11 @@ class SubscriberMW ():
       while self.handle_events:  # it starts with a True value
         # poll for events. We give it an infinite timeout.
         # The return value is a socket to event mask mapping
+        if self.loop_metrics != None:
+          self.loop_metrics.before_poll ()
         events = dict (self.poller.poll (timeout=timeout))
+        if self.loop_metrics != None:
+          self.loop_metrics.after_poll (events)
         
         # check if a timeout has occurred. We know this is the case when
         # the event mask is empty
@@ -178,9 +224,17 @@ class SubscriberMW ():
           # handle the incoming reply from remote entity and return the result
           timeout = self.handle_bytes_on_req_socket()
 
+        elif self.leader_resolver != None and self.leader_resolver.socket in events:
+          # The discovery leader changed, keep the timeout we had
+          self.handle_discovery_leader_change()
+
+        elif self.zk_event_pair != None and self.zk_event_pair in events:
+          # A ZooKeeper watch fired, keep the timeout we had
+          self.handle_zk_events ()
+
         elif self.disc_sub_socket in events:
-          # Received an update from the discovery leader
-          timeout = self.handle_sync_update_from_disc_leader()
+          # Received an update from the discovery leader, keep the timeout we had
+          self.handle_sync_update_from_disc_leader()
 
         elif self.sub in events:
           timeout = self.handle_bytes_on_sub_socket()
@@ -236,12 +290,23 @@ class SubscriberMW ():
   def handle_bytes_on_sub_socket(self):
     self.logger.debug ("SubscriberMW::handle_bytes_on_sub_socket")
     data_in_bytes = self.sub.recv()
+    if self.trace != None:
+      self.trace.write (data_in_bytes)
     data_string = data_in_bytes.decode()
     
-    # Get the message and topic
-    beginning_of_payload = (data_string.find(':') + 1)
-    topic = data_string[:(beginning_of_payload-1)]
-    string_received = data_string[beginning_of_payload:]
+    # Get the topic, the ownership epoch, sequence number and id of the publisher, and the message
+    topic, epoch, seq, pubid, string_received = data_string.split(':', 4)
+    log_this = self.log_sampler.sample (topic) # 1 in --log_every messages of a topic is logged
+
+    # Drop what is not newer than what we have: the last value a broker taking
+    # over replays, the copies while a topic moves to another broker group, and
+    # whatever a publisher that lost the ownership of the topic still sends
+    if (not self.is_newest_publication(topic, int(epoch), pubid, int(seq))):
+      if log_this:
+        self.logger.info("IGNORE A MSG: publication %s of %s (epoch %s) on topic %s is not new", seq, pubid, epoch, topic, extra={"topic": topic})
+      if self.loop_metrics != None:
+        self.loop_metrics.drop ("not_newest")
+      return self.upcall_obj.timeout # publishers are still at it, wait for the next one
 
     # Get the array of messages
     array_of_messages = ast.literal_eval(string_received)
@@ -259,12 +324,16 @@ class SubscriberMW ():
       timeout = self.upcall_obj.handle_receipt_of_subscription_data(wanted_messages)
 
       # log
-      self.logger.info(f"PROCESS A MSG: Rcvd {num_of_messages_delivered} msgs on topic {topic}, wanted {num_of_messages_wanted}")
+      if log_this:
+        self.logger.info("PROCESS A MSG: Rcvd %d msgs on topic %s, wanted %d", num_of_messages_delivered, topic, num_of_messages_wanted, extra={"topic": topic})
 
     else:
       # log ignore
-      self.logger.info(f"IGNORE A MSG: Rcvd {num_of_messages_delivered} msgs on topic {topic}, wanted {num_of_messages_wanted}")
-      timeout = None
+      if log_this:
+        self.logger.info("IGNORE A MSG: Rcvd %d msgs on topic %s, wanted %d", num_of_messages_delivered, topic, num_of_messages_wanted, extra={"topic": topic})
+      if self.loop_metrics != None:
+        self.loop_metrics.drop ("short_history")
+      timeout = self.upcall_obj.timeout
 
     return timeout
             
@@ -319,7 +388,7 @@ class SubscriberMW ():
       # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
       # a real string
       buf2send = disc_req.SerializeToString ()
-      self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
+      self.logger.debug ("Stringified serialized buf = %s", buf2send)
 
       # now send this to our discovery service
       self.logger.debug ("SubscriberMW::register - send stringified buffer to Discovery service")
@@ -370,7 +439,7 @@ class SubscriberMW ():
       # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
       # a real string
       buf2send = disc_req.SerializeToString ()
-      self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
+      self.logger.debug ("Stringified serialized buf = %s", buf2send)
 
       # now send this to our discovery service
       self.logger.debug ("SubscriberMW::is_ready - send stringified buffer to Discovery service")
@@ -413,7 +482,7 @@ class SubscriberMW ():
       # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
       # a real string
       buf2send = disc_req.SerializeToString ()
-      self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
+      self.logger.debug ("Stringified serialized buf = %s", buf2send)
 
       # now send this to our discovery service
       self.logger.debug ("SubscriberMW::lookup - send stringified buffer to Discovery service")
@@ -437,6 +506,9 @@ class SubscriberMW ():
 
       # connect to every publisher we are interested in
       for ipport in addressesToConnectTo:
+        # we may be connected already, e.g., to a hot standby broker that became the leader
+        if (ipport in self.ipports_connected_to or ipport in self.excluded_ipports):
+          continue
         self.sub.connect ("tcp://" + ipport)
         self.ipports_connected_to.add(ipport)
 
@@ -465,6 +537,30 @@ class SubscriberMW ():
       raise e   
 
 
+  ########################################
+  # is_newest_publication
+  #
+  # Ownership of a topic only moves to publishers with a higher epoch, so
+  # once we have seen an epoch, the lower ones are former owners. Within an
+  # epoch, every publisher numbers its publications of the topic
+  ########################################
+  def is_newest_publication (self, topic, epoch, pubid, seq):
+    current_epoch = self.topic_epoch.get (topic, -1)
+    if (epoch < current_epoch):
+      return False
+
+    if (epoch > current_epoch):
+      # a new owner, the numbers of the former ones do not matter anymore
+      self.topic_epoch[topic] = epoch
+      self.publication_seqs[topic] = {}
+
+    seqs = self.publication_seqs[topic]
+    if (seq <= seqs.get (pubid, 0)):
+      return False
+    seqs[pubid] = seq
+    return True
+
+
   ########################################
   # set upcall handle
   #
@@ -486,6 +582,122 @@ class SubscriberMW ():
     self.handle_events = False
 
 
+  ########################################
+  # watch_discovery_leader
+  #
+  # Follow the discovery leader through ZooKeeper, or the static endpoints
+  # (Leaders in the [Discovery] section of config.ini) without it
+  ########################################
+  def watch_discovery_leader(self, zk_client, static_leaders):
+    self.leader_resolver = DiscoveryLeaderResolver(self.logger, zmq.Context.instance(), DiscoveryLeaderResolver.parse_static_leaders(static_leaders))
+    self.poller.register(self.leader_resolver.socket, zmq.POLLIN)
+    if self.loop_metrics != None:
+      self.loop_metrics.watch (self.leader_resolver.socket, "handle_discovery_leader_change")
+    self.leader_resolver.start(zk_client)
+    return
+
+
+  ########################################
+  # watch_zk_events
+  #
+  # ZooKeeper watch events get to the event loop through an inproc pipe,
+  # so that only the thread of the event loop uses our sockets and state
+  ########################################
+  def watch_zk_events(self):
+    context = zmq.Context.instance()
+    pipe = "inproc://zk-events-" + str (id (self))
+    self.zk_event_pair = context.socket (zmq.PAIR)
+    self.zk_event_pair.bind (pipe)
+    self.zk_event_sender = context.socket (zmq.PAIR)
+    self.zk_event_sender.connect (pipe)
+    self.poller.register (self.zk_event_pair, zmq.POLLIN)
+    if self.loop_metrics != None:
+      self.loop_metrics.watch (self.zk_event_pair, "handle_zk_events")
+    return
+
+
+  ########################################
+  # new_zk_event_generation
+  #
+  # Called from the kazoo threads when a watch fires. Events of the same
+  # kind are full snapshots, so an older one that shows up late (its reads
+  # took longer) must not undo a newer one
+  ########################################
+  def new_zk_event_generation(self, kind):
+    with self.zk_event_lock:
+      self.zk_event_generation[kind] += 1
+      return self.zk_event_generation[kind]
+
+
+  ########################################
+  # post_zk_event
+  #
+  # Called from the kazoo threads, hands the event to the event loop
+  ########################################
+  def post_zk_event(self, kind, payload, generation=None):
+    if generation is None:
+      generation = self.new_zk_event_generation (kind)
+    event = {'kind': kind, 'generation': generation, 'payload': payload}
+    with self.zk_event_lock:
+      self.zk_event_sender.send (json.dumps (event).encode ('utf-8'))
+    return
+
+
+  ########################################
+  # handle_zk_events
+  #
+  # Take all the events queued up so far and make one upcall per kind
+  # with the latest of them
+  ########################################
+  def handle_zk_events(self):
+    latest = {}
+    while True:
+      try:
+        bytesRcvd = self.zk_event_pair.recv (zmq.NOBLOCK)
+      except zmq.Again:
+        break
+      event = json.loads (bytesRcvd.decode ('utf-8'))
+      if event['kind'] not in latest or event['generation'] > latest[event['kind']]['generation']:
+        latest[event['kind']] = event
+
+    for kind, event in latest.items ():
+      if event['generation'] <= self.zk_applied_generation.get (kind, 0):
+        continue
+      self.zk_applied_generation[kind] = event['generation']
+      self.upcall_obj.handle_zk_event (kind, event['payload'])
+    return
+
+
+  ########################################
+  # wait_for_discovery_leader
+  #
+  # Block until there is a discovery leader and connect to it
+  ########################################
+  def wait_for_discovery_leader(self):
+    self.leader_resolver.wait_for_leader()
+    self.handle_discovery_leader_change()
+    return
+
+
+  ########################################
+  # handle_discovery_leader_change
+  #
+  # Called from the event loop when the discovery leader may have changed
+  ########################################
+  def handle_discovery_leader_change(self):
+    change = self.leader_resolver.handle_event()
+    if change == None:
+      return
+
+    old, new = change
+    self.logger.info("SubscriberMW::handle_discovery_leader_change - from {} to {}".format(old, new))
+    if(old != None):
+      self.disconnect_from_old_discovery_leader(old['addr'], old['port'], old['sub_port'])
+    if(new != None):
+      self.connect_to_discovery_leader(new['addr'], new['port'], new['sub_port'])
+    return
+
+
   ########################################
   # connect_to_discovery_leader
   #
@@ -494,6 +706,7 @@ class SubscriberMW ():
   def connect_to_discovery_leader(self, disc_addr, disc_port, disc_sync_port):
     # Connect the req socket
     self.req.connect('tcp://' + disc_addr + ':' + str(disc_port))
+    self.clock.set_server('tcp://' + disc_addr + ':' + str(disc_port))
 
     # Subscribe for updates
     self.disc_sub_socket.connect('tcp://' + disc_addr + ':' + str(disc_sync_port))
@@ -527,8 +740,19 @@ class SubscriberMW ():
     beginning_of_payload = (bytesRcvd.find(':') + 1)
     update_type = bytesRcvd[:(beginning_of_payload-1)]
     string_received = bytesRcvd[beginning_of_payload:]
-    data_dict = json.loads(string_received)
+    data = json.loads(string_received)
+
+    # after a burst of ZooKeeper events the discovery leader sends all the changes in one message
+    for data_dict in (data if isinstance(data, list) else [data]):
+      self.apply_sync_update(update_type, data_dict)
+
+    return None
 
+
+  ########################################
+  # apply_sync_update
+  ########################################
+  def apply_sync_update(self, update_type, data_dict):
     ipport = data_dict['addr'] + ':' + str(data_dict['port'])
 
     # New broker or pub has joined
@@ -554,12 +778,20 @@ class SubscriberMW ():
     elif(update_type == 'unsub'):
       self.logger.info("Processing a UNSUB update")
       # unsubscribe if we were subscribed
-      if (ipport in self.ipports_connected_to):
-        self.sub.disconnect('tcp://' + ipport)
-        self.ipports_connected_to.remove(ipport)
-        self.logger.info(f"Disconnected from {ipport}")
+      self.disconnect_from_publisher(ipport)
 
     return None
+
+
+  ########################################
+  # disconnect_from_publisher
+  ########################################
+  def disconnect_from_publisher(self, ipport):
+    if (ipport in self.ipports_connected_to):
+      self.sub.disconnect('tcp://' + ipport)
+      self.ipports_connected_to.remove(ipport)
+      self.logger.info(f"Disconnected from {ipport}")
+    return
   
 
   ########################################
@@ -0,0 +1,128 @@
+###############################################
+#
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose: Load-adaptive assignment of topics to broker groups
+#
+# Created: Spring 2023
+#
+###############################################
+
+# The brokers report how many messages and bytes per second they forward on
+# every topic. From these reports the discovery leader computes a new topic ->
+# broker group mapping by bin packing the topic loads onto the groups. To keep
+# topics from bouncing between groups (every move costs an overlap period during
+# which two brokers carry the topic) there are two levels of hysteresis:
+#
+#   - nothing is recomputed while the most loaded group carries less than
+#     threshold times the average group load
+#   - a new mapping is only proposed if it lowers the load of the most loaded
+#     group by at least min_improvement (a fraction)
+#
+# The packing itself is "sticky": topics are placed from the heaviest to the
+# lightest and a topic stays in its current group as long as that group does
+# not go above the target load, otherwise it goes to the least loaded group.
+
+##################################
+#       TopicRebalancer class
+##################################
+class TopicRebalancer ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, threshold=1.25, min_improvement=0.1, byte_weight=1.0):
+    self.threshold = threshold # max/average group load above which we rebalance
+    self.min_improvement = min_improvement # required relative drop of the max group load
+    self.byte_weight = byte_weight # cost of a KB/s relative to one message/s
+
+  ########################################
+  # topic_loads
+  #
+  # reports: group -> {topic: {'msgs': per sec, 'bytes': per sec}}
+  # During an overlap period two groups report the same topic, we take the larger
+  ########################################
+  def topic_loads (self, reports):
+    loads = {}
+    for report in reports.values ():
+      for topic, rates in report.items ():
+        cost = rates.get ('msgs', 0) + self.byte_weight * rates.get ('bytes', 0) / 1024
+        loads[topic] = max (loads.get (topic, 0), cost)
+    return loads
+
+  ########################################
+  # group_loads
+  ########################################
+  def group_loads (self, mapping, loads):
+    return {group: sum (loads.get (topic, 0) for topic in topics) for group, topics in mapping.items ()}
+
+  ########################################
+  # imbalance
+  #
+  # load of the most loaded group over the average group load (1.0 is perfect)
+  ########################################
+  def imbalance (self, mapping, loads):
+    group_loads = self.group_loads (mapping, loads)
+    total = sum (group_loads.values ())
+    if total == 0 or len (group_loads) == 0:
+      return 1.0
+    return max (group_loads.values ()) / (total / len (group_loads))
+
+  ########################################
+  # pack
+  #
+  # Sticky greedy bin packing of the topics onto the groups of the mapping
+  ########################################
+  def pack (self, mapping, loads):
+    groups = sorted (mapping)
+    home = {topic: group for group, topics in mapping.items () for topic in topics}
+    total = sum (loads.get (topic, 0) for topic in home)
+    heaviest = max ((loads.get (topic, 0) for topic in home), default=0)
+
+    # a group may go up to the target load, but a single topic cannot be split
+    target = max (total / len (groups), heaviest)
+
+    new_mapping = {group: [] for group in groups}
+    group_load = {group: 0 for group in groups}
+    for topic in sorted (home, key=lambda topic: (-loads.get (topic, 0), topic)):
+      load = loads.get (topic, 0)
+      group = home[topic]
+      if group_load[group] + load > target:
+        group = min (groups, key=lambda candidate: (group_load[candidate], candidate != home[topic], candidate))
+      new_mapping[group].append (topic)
+      group_load[group] += load
+
+    return new_mapping
+
+  ########################################
+  # rebalance
+  #
+  # Returns the new mapping, or None if the current one should be kept
+  ########################################
+  def rebalance (self, mapping, reports):
+    loads = self.topic_loads (reports)
+    if self.imbalance (mapping, loads) <= self.threshold:
+      return None
+
+    new_mapping = self.pack (mapping, loads)
+    current_max = max (self.group_loads (mapping, loads).values ())
+    new_max = max (self.group_loads (new_mapping, loads).values ())
+    if new_max > current_max * (1 - self.min_improvement):
+      return None
+
+    return new_mapping
+
+  ########################################
+  # moved_topics
+  #
+  # topic -> (old group, new group) for the topics that change group
+  ########################################
+  def moved_topics (self, old_mapping, new_mapping):
+    old_home = {topic: group for group, topics in old_mapping.items () for topic in topics}
+    moved = {}
+    for group, topics in new_mapping.items ():
+      for topic in topics:
+        if old_home.get (topic) != group:
+          moved[topic] = (old_home.get (topic), group)
+    return moved
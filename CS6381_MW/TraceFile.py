@@ -0,0 +1,150 @@
+###############################################
+#
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose: Traces of the publications a subscriber or broker received
+#
+# Created: Spring 2023
+#
+###############################################
+
+# Started with --trace <file>, a subscriber or broker writes every publication
+# it receives, as it came off the wire, with the time it came in. A publisher
+# started with --replay <file> publishes the same topics with the same data
+# at the same moments (or N times faster, or as fast as it can), so brokers
+# and subscribers can be benchmarked under the bursts of a real run.
+#
+# The file is binary:
+#
+#    header   b"CS6381TR", version (1 byte), time of the start (8 bytes, ns
+#             since the epoch)
+#    records  ns since the start (8 bytes), length (4 bytes), the message
+#
+# integers little endian. The offsets come from the monotonic clock, so a
+# step of the wall clock during the trace does not show up in them; the wall
+# clock only dates the start. A file name ending in .gz is gzip compressed. The
+# trace is buffered and flushed every flush_interval seconds, so a killed
+# process loses at most the records of the last one.
+
+import sys
+import gzip
+import time
+import atexit
+import signal
+import struct
+import threading
+
+MAGIC = b"CS6381TR"
+VERSION = 1
+HEADER = struct.Struct ("<BQ")
+RECORD = struct.Struct ("<QI")
+
+
+########################################
+# open a trace file, compressed if its name says so
+########################################
+def open_trace (path, mode):
+  if path.endswith (".gz"):
+    return gzip.open (path, mode)
+  return open (path, mode)
+
+
+##################################
+#       TraceWriter class
+##################################
+class TraceWriter ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, logger, path, flush_interval=1.0):
+    self.logger = logger
+    self.path = path
+    self.flush_interval = flush_interval
+    self.file = open_trace (path, "wb")
+    self.start = time.time_ns ()
+    self.start_monotonic = time.monotonic_ns () # the offsets of the records count from here
+    self.file.write (MAGIC + HEADER.pack (VERSION, self.start))
+    self.last_flush = time.monotonic ()
+    self.num_records = 0
+    self.num_bytes = 0
+    atexit.register (self.close)
+
+    # a plain kill (SIGTERM) should still flush the trace
+    if threading.current_thread () is threading.main_thread () and signal.getsignal (signal.SIGTERM) == signal.SIG_DFL:
+      signal.signal (signal.SIGTERM, lambda signum, frame: sys.exit (128 + signum))
+
+    self.logger.info ("TraceWriter - tracing the publications received to {}".format (path))
+
+  ########################################
+  # write a message received just now
+  ########################################
+  def write (self, message):
+    if self.file == None:
+      return
+    self.file.write (RECORD.pack (time.monotonic_ns () - self.start_monotonic, len (message)))
+    self.file.write (message)
+    self.num_records += 1
+    self.num_bytes += len (message)
+
+    now = time.monotonic ()
+    if now - self.last_flush >= self.flush_interval:
+      self.file.flush ()
+      self.last_flush = now
+
+  ########################################
+  # close
+  ########################################
+  def close (self):
+    if self.file == None:
+      return
+    self.file.close ()
+    self.file = None
+    self.logger.info ("TraceWriter::close - {} publications ({} bytes) written to {}".format (self.num_records, self.num_bytes, self.path))
+
+
+##################################
+#       TraceReader class
+##################################
+class TraceReader ():
+
+  ########################################
+  # constructor, reads the header
+  ########################################
+  def __init__ (self, path):
+    self.path = path
+    with open_trace (path, "rb") as f:
+      self.start = self.read_header (f)
+
+  def read_header (self, f):
+    header = f.read (len (MAGIC) + HEADER.size)
+    if len (header) < len (MAGIC) + HEADER.size or header[:len (MAGIC)] != MAGIC:
+      raise ValueError ("TraceReader - {} is not a trace file".format (self.path))
+    version, start = HEADER.unpack (header[len (MAGIC):])
+    if version != VERSION:
+      raise ValueError ("TraceReader - {} has version {} of the format, we read {}".format (self.path, version, VERSION))
+    return start
+
+  ########################################
+  # the records, (seconds since the start, message), read as we go. A record
+  # cut short by a killed writer ends the trace
+  ########################################
+  def records (self):
+    with open_trace (self.path, "rb") as f:
+      self.read_header (f)
+      while True:
+        try:
+          header = f.read (RECORD.size)
+          if len (header) < RECORD.size:
+            return
+          offset, length = RECORD.unpack (header)
+          message = f.read (length)
+        except EOFError:
+          return # a gzip stream without its end
+        if len (message) < length:
+          return
+        yield offset / 1e9, message
+
+  def __iter__ (self):
+    return self.records ()
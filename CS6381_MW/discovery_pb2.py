@@ -13,19 +13,21 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0f\x64iscovery.proto\"r\n\x0eRegistrantInfo\x12\n\n\x02id\x18\x01 \x01(\t\x12\x11\n\x04\x61\x64\x64r\x18\x02 \x01(\tH\x00\x88\x01\x01\x12\x11\n\x04port\x18\x03 \x01(\rH\x01\x88\x01\x01\x12\x12\n\x05group\x18\x04 \x01(\tH\x02\x88\x01\x01\x42\x07\n\x05_addrB\x07\n\x05_portB\x08\n\x06_group\"T\n\x0bRegisterReq\x12\x13\n\x04role\x18\x01 \x01(\x0e\x32\x05.Role\x12\x1d\n\x04info\x18\x02 \x01(\x0b\x32\x0f.RegistrantInfo\x12\x11\n\ttopiclist\x18\x03 \x03(\t\"G\n\x0cRegisterResp\x12\x17\n\x06status\x18\x01 \x01(\x0e\x32\x07.Status\x12\x13\n\x06reason\x18\x02 \x01(\tH\x00\x88\x01\x01\x42\t\n\x07_reason\"x\n\x11\x44htIsReadyPayload\x12\x15\n\rvisited_nodes\x18\x01 \x03(\t\x12\x17\n\x0fregistered_subs\x18\x02 \x03(\t\x12\x17\n\x0fregistered_pubs\x18\x03 \x03(\t\x12\x1a\n\x12registered_brokers\x18\x04 \x03(\t\"J\n\nIsReadyReq\x12,\n\x0b\x64ht_payload\x18\x01 \x01(\x0b\x32\x12.DhtIsReadyPayloadH\x00\x88\x01\x01\x42\x0e\n\x0c_dht_payload\"\x1d\n\x0bIsReadyResp\x12\x0e\n\x06status\x18\x01 \x01(\x08\"\x84\x01\n\x13LookupPubByTopicReq\x12\x11\n\ttopiclist\x18\x01 \x03(\t\x12\x15\n\rvisited_nodes\x18\x02 \x03(\t\x12\x1d\n\x15sockets_to_connect_to\x18\x03 \x03(\t\x12\x16\n\trequester\x18\x04 \x01(\tH\x00\x88\x01\x01\x42\x0c\n\n_requester\"r\n\x14LookupPubByTopicResp\x12\x1c\n\x14\x61\x64\x64ressesToConnectTo\x18\x01 \x03(\t\x12\"\n\x15\x62rokers_to_connect_to\x18\x02 \x01(\tH\x00\x88\x01\x01\x42\x18\n\x16_brokers_to_connect_to\"\x90\x02\n\x0c\x44iscoveryReq\x12\x1b\n\x08msg_type\x18\x01 \x01(\x0e\x32\t.MsgTypes\x12$\n\x0cregister_req\x18\x02 \x01(\x0b\x32\x0c.RegisterReqH\x00\x12\"\n\x0bisready_req\x18\x03 \x01(\x0b\x32\x0b.IsReadyReqH\x00\x12*\n\nlookup_req\x18\x04 \x01(\x0b\x32\x14.LookupPubByTopicReqH\x00\x12\x1d\n\x10\x64o_read_or_write\x18\x06 \x01(\x08H\x01\x88\x01\x01\x12\x1b\n\x0etimestamp_sent\x18\x07 \x01(\tH\x02\x88\x01\x01\x42\t\n\x07\x43ontentB\x13\n\x11_do_read_or_writeB\x11\n\x0f_timestamp_sent\"\xe3\x01\n\rDiscoveryResp\x12\x1b\n\x08msg_type\x18\x01 \x01(\x0e\x32\t.MsgTypes\x12&\n\rregister_resp\x18\x02 \x01(\x0b\x32\r.RegisterRespH\x00\x12$\n\x0cisready_resp\x18\x03 \x01(\x0b\x32\x0c.IsReadyRespH\x00\x12,\n\x0blookup_resp\x18\x04 \x01(\x0b\x32\x15.LookupPubByTopicRespH\x00\x12\x1b\n\x0etimestamp_sent\x18\x07 \x01(\tH\x01\x88\x01\x01\x42\t\n\x07\x43ontentB\x11\n\x0f_timestamp_sent*P\n\x04Role\x12\x10\n\x0cROLE_UNKNOWN\x10\x00\x12\x12\n\x0eROLE_PUBLISHER\x10\x01\x12\x13\n\x0fROLE_SUBSCRIBER\x10\x02\x12\r\n\tROLE_BOTH\x10\x03*\\\n\x06Status\x12\x12\n\x0eSTATUS_UNKNOWN\x10\x00\x12\x12\n\x0eSTATUS_SUCCESS\x10\x01\x12\x12\n\x0eSTATUS_FAILURE\x10\x02\x12\x16\n\x12STATUS_CHECK_AGAIN\x10\x03*\x87\x01\n\x08MsgTypes\x12\x10\n\x0cTYPE_UNKNOWN\x10\x00\x12\x11\n\rTYPE_REGISTER\x10\x01\x12\x10\n\x0cTYPE_ISREADY\x10\x02\x12\x1c\n\x18TYPE_LOOKUP_PUB_BY_TOPIC\x10\x03\x12\x18\n\x14TYPE_LOOKUP_ALL_PUBS\x10\x04\x12\x0c\n\x08TYPE_DHT\x10\x05\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0f\x64iscovery.proto\"r\n\x0eRegistrantInfo\x12\n\n\x02id\x18\x01 \x01(\t\x12\x11\n\x04\x61\x64\x64r\x18\x02 \x01(\tH\x00\x88\x01\x01\x12\x11\n\x04port\x18\x03 \x01(\rH\x01\x88\x01\x01\x12\x12\n\x05group\x18\x04 \x01(\tH\x02\x88\x01\x01\x42\x07\n\x05_addrB\x07\n\x05_portB\x08\n\x06_group\"T\n\x0bRegisterReq\x12\x13\n\x04role\x18\x01 \x01(\x0e\x32\x05.Role\x12\x1d\n\x04info\x18\x02 \x01(\x0b\x32\x0f.RegistrantInfo\x12\x11\n\ttopiclist\x18\x03 \x03(\t\"G\n\x0cRegisterResp\x12\x17\n\x06status\x18\x01 \x01(\x0e\x32\x07.Status\x12\x13\n\x06reason\x18\x02 \x01(\tH\x00\x88\x01\x01\x42\t\n\x07_reason\"x\n\x11\x44htIsReadyPayload\x12\x15\n\rvisited_nodes\x18\x01 \x03(\t\x12\x17\n\x0fregistered_subs\x18\x02 \x03(\t\x12\x17\n\x0fregistered_pubs\x18\x03 \x03(\t\x12\x1a\n\x12registered_brokers\x18\x04 \x03(\t\"J\n\nIsReadyReq\x12,\n\x0b\x64ht_payload\x18\x01 \x01(\x0b\x32\x12.DhtIsReadyPayloadH\x00\x88\x01\x01\x42\x0e\n\x0c_dht_payload\"\x1d\n\x0bIsReadyResp\x12\x0e\n\x06status\x18\x01 \x01(\x08\"\x84\x01\n\x13LookupPubByTopicReq\x12\x11\n\ttopiclist\x18\x01 \x03(\t\x12\x15\n\rvisited_nodes\x18\x02 \x03(\t\x12\x1d\n\x15sockets_to_connect_to\x18\x03 \x03(\t\x12\x16\n\trequester\x18\x04 \x01(\tH\x00\x88\x01\x01\x42\x0c\n\n_requester\"r\n\x14LookupPubByTopicResp\x12\x1c\n\x14\x61\x64\x64ressesToConnectTo\x18\x01 \x03(\t\x12\"\n\x15\x62rokers_to_connect_to\x18\x02 \x01(\tH\x00\x88\x01\x01\x42\x18\n\x16_brokers_to_connect_to\"C\n\x0b\x44htNodeInfo\x12\n\n\x02id\x18\x01 \x01(\t\x12\x0c\n\x04hash\x18\x02 \x01(\x04\x12\x0c\n\x04\x61\x64\x64r\x18\x03 \x01(\t\x12\x0c\n\x04port\x18\x04 \x01(\r\"\x94\x02\n\x06\x44htReq\x12\x12\n\x02op\x18\x01 \x01(\x0e\x32\x06.DhtOp\x12\x12\n\nrequest_id\x18\x02 \x01(\x04\x12\x1c\n\x06sender\x18\x03 \x01(\x0b\x32\x0c.DhtNodeInfo\x12\x10\n\x03key\x18\x04 \x01(\x04H\x00\x88\x01\x01\x12*\n\x0fnew_predecessor\x18\x05 \x01(\x0b\x32\x0c.DhtNodeInfoH\x01\x88\x01\x01\x12(\n\rnew_successor\x18\x06 \x01(\x0b\x32\x0c.DhtNodeInfoH\x02\x88\x01\x01\x12\x14\n\x07records\x18\x07 \x01(\tH\x03\x88\x01\x01\x12\x0c\n\x04hops\x18\x08 \x01(\rB\x06\n\x04_keyB\x12\n\x10_new_predecessorB\x10\n\x0e_new_successorB\n\n\x08_records\"\x8b\x01\n\x07\x44htResp\x12\x12\n\x02op\x18\x01 \x01(\x0e\x32\x06.DhtOp\x12\x12\n\nrequest_id\x18\x02 \x01(\x04\x12\x1f\n\x04node\x18\x03 \x01(\x0b\x32\x0c.DhtNodeInfoH\x00\x88\x01\x01\x12 \n\nsuccessors\x18\x04 \x03(\x0b\x32\x0c.DhtNodeInfo\x12\x0c\n\x04hops\x18\x05 \x01(\rB\x07\n\x05_node\"\n\n\x08\x43lockReq\"4\n\tClockResp\x12\x12\n\nreceive_ns\x18\x01 \x01(\x06\x12\x13\n\x0btransmit_ns\x18\x02 \x01(\x06\"\xcc\x02\n\x0c\x44iscoveryReq\x12\x1b\n\x08msg_type\x18\x01 \x01(\x0e\x32\t.MsgTypes\x12$\n\x0cregister_req\x18\x02 \x01(\x0b\x32\x0c.RegisterReqH\x00\x12\"\n\x0bisready_req\x18\x03 \x01(\x0b\x32\x0b.IsReadyReqH\x00\x12*\n\nlookup_req\x18\x04 \x01(\x0b\x32\x14.LookupPubByTopicReqH\x00\x12\x1a\n\x07\x64ht_req\x18\x05 \x01(\x0b\x32\x07.DhtReqH\x00\x12\x1e\n\tclock_req\x18\x08 \x01(\x0b\x32\t.ClockReqH\x00\x12\x1d\n\x10\x64o_read_or_write\x18\x06 \x01(\x08H\x01\x88\x01\x01\x12\x1b\n\x0etimestamp_sent\x18\x07 \x01(\tH\x02\x88\x01\x01\x42\t\n\x07\x43ontentB\x13\n\x11_do_read_or_writeB\x11\n\x0f_timestamp_sent\"\xa3\x02\n\rDiscoveryResp\x12\x1b\n\x08msg_type\x18\x01 \x01(\x0e\x32\t.MsgTypes\x12&\n\rregister_resp\x18\x02 \x01(\x0b\x32\r.RegisterRespH\x00\x12$\n\x0cisready_resp\x18\x03 \x01(\x0b\x32\x0c.IsReadyRespH\x00\x12,\n\x0blookup_resp\x18\x04 \x01(\x0b\x32\x15.LookupPubByTopicRespH\x00\x12\x1c\n\x08\x64ht_resp\x18\x05 \x01(\x0b\x32\x08.DhtRespH\x00\x12 \n\nclock_resp\x18\x08 \x01(\x0b\x32\n.ClockRespH\x00\x12\x1b\n\x0etimestamp_sent\x18\x07 \x01(\tH\x01\x88\x01\x01\x42\t\n\x07\x43ontentB\x11\n\x0f_timestamp_sent*P\n\x04Role\x12\x10\n\x0cROLE_UNKNOWN\x10\x00\x12\x12\n\x0eROLE_PUBLISHER\x10\x01\x12\x13\n\x0fROLE_SUBSCRIBER\x10\x02\x12\r\n\tROLE_BOTH\x10\x03*\\\n\x06Status\x12\x12\n\x0eSTATUS_UNKNOWN\x10\x00\x12\x12\n\x0eSTATUS_SUCCESS\x10\x01\x12\x12\n\x0eSTATUS_FAILURE\x10\x02\x12\x16\n\x12STATUS_CHECK_AGAIN\x10\x03*\x97\x01\n\x08MsgTypes\x12\x10\n\x0cTYPE_UNKNOWN\x10\x00\x12\x11\n\rTYPE_REGISTER\x10\x01\x12\x10\n\x0cTYPE_ISREADY\x10\x02\x12\x1c\n\x18TYPE_LOOKUP_PUB_BY_TOPIC\x10\x03\x12\x18\n\x14TYPE_LOOKUP_ALL_PUBS\x10\x04\x12\x0c\n\x08TYPE_DHT\x10\x05\x12\x0e\n\nTYPE_CLOCK\x10\x06*\xb8\x01\n\x05\x44htOp\x12\x12\n\x0e\x44HT_OP_UNKNOWN\x10\x00\x12\x19\n\x15\x44HT_OP_FIND_SUCCESSOR\x10\x01\x12\x1a\n\x16\x44HT_OP_GET_PREDECESSOR\x10\x02\x12\x11\n\rDHT_OP_NOTIFY\x10\x03\x12\x0f\n\x0b\x44HT_OP_PING\x10\x04\x12\x18\n\x14\x44HT_OP_TRANSFER_KEYS\x10\x05\x12\x10\n\x0c\x44HT_OP_LEAVE\x10\x06\x12\x14\n\x10\x44HT_OP_REPLICATE\x10\x07\x62\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'discovery_pb2', globals())
 if _descriptor._USE_C_DESCRIPTORS == False:
 
   DESCRIPTOR._options = None
-  _ROLE._serialized_start=1279
-  _ROLE._serialized_end=1359
-  _STATUS._serialized_start=1361
-  _STATUS._serialized_end=1453
-  _MSGTYPES._serialized_start=1456
-  _MSGTYPES._serialized_end=1591
+  _ROLE._serialized_start=1959
+  _ROLE._serialized_end=2039
+  _STATUS._serialized_start=2041
+  _STATUS._serialized_end=2133
+  _MSGTYPES._serialized_start=2136
+  _MSGTYPES._serialized_end=2287
+  _DHTOP._serialized_start=2290
+  _DHTOP._serialized_end=2474
   _REGISTRANTINFO._serialized_start=19
   _REGISTRANTINFO._serialized_end=133
   _REGISTERREQ._serialized_start=135
@@ -42,8 +44,18 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   _LOOKUPPUBBYTOPICREQ._serialized_end=656
   _LOOKUPPUBBYTOPICRESP._serialized_start=658
   _LOOKUPPUBBYTOPICRESP._serialized_end=772
-  _DISCOVERYREQ._serialized_start=775
-  _DISCOVERYREQ._serialized_end=1047
-  _DISCOVERYRESP._serialized_start=1050
-  _DISCOVERYRESP._serialized_end=1277
+  _DHTNODEINFO._serialized_start=774
+  _DHTNODEINFO._serialized_end=841
+  _DHTREQ._serialized_start=844
+  _DHTREQ._serialized_end=1120
+  _DHTRESP._serialized_start=1123
+  _DHTRESP._serialized_end=1262
+  _CLOCKREQ._serialized_start=1264
+  _CLOCKREQ._serialized_end=1274
+  _CLOCKRESP._serialized_start=1276
+  _CLOCKRESP._serialized_end=1328
+  _DISCOVERYREQ._serialized_start=1331
+  _DISCOVERYREQ._serialized_end=1663
+  _DISCOVERYRESP._serialized_start=1666
+  _DISCOVERYRESP._serialized_end=1957
 # @@protoc_insertion_point(module_scope)
@@ -0,0 +1,533 @@
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose:
+#
+# In-process simulator of the DHT ring of discovery nodes.
+#
+# Checking how requests are routed on the ring otherwise needs the Mininet
+# scripts (mnexperiment_*dht*.sh) and a process per discovery node. Here we
+# instead create one DiscoveryMW object per discovery node in a single process
+# and use its own finger table and find_successor logic to route simulated
+# register and lookup requests. Nothing goes over the network: the ZMQ context
+# and poller of the middleware objects are replaced by in-process stand-ins and
+# the time a message takes between two nodes comes from a pluggable transport
+# model (instant, uniform, lognormal or host-aware latency).
+#
+# Register requests are routed to the node responsible for the hash of the
+# registering entity, which stores it. Lookups route to the node responsible for
+# a previously registered entity and check that it still has it (this is the
+# per-key lookup of a DHT; the is ready and lookup requests of our system walk the
+# entire ring instead and are not simulated here).
+#
+# Churn can be injected: discovery nodes fail and new ones join at a given rate.
+# Nodes learn about changes in the ring the way the maintenance protocol would
+# let them: a node that forwards to a failed node waits for the failure timeout
+# and then removes it from its routing state (DiscoveryMW.handle_failed_node), and
+# every node rebuilds its finger table from the current ring every refresh interval
+# (what fix_fingers achieves over time). Each operation is routed in one go at its
+# arrival time, the churn events happen in between operations.
+#
+# The same seed always gives the same results. At the end we report the hop count
+# distribution, latency, message counts and the load on the discovery nodes.
+#
+# Example:
+#
+#    python3 dht_simulator.py -N 10000 -o 1000000 -t lognormal:1,0.5 -c 5 -r 30
+
+import os
+import sys
+import time
+import math
+import random # random number generation
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+import collections
+
+# we reuse the middleware of the discovery nodes which lives in the parent directory
+sys.path.append (os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from CS6381_MW.DiscoveryMW import DiscoveryMW
+from CS6381_MW.DhtRing import DhtRing, hash_func
+
+
+##########################
+#
+# Transports
+#
+# A transport decides how long (in seconds) a message from one discovery
+# node to another takes. Anything with a delay (src, dst, rng) method will do.
+#
+##########################
+class InstantTransport ():
+  def delay (self, src, dst, rng):
+    return 0.0
+
+  def __str__ (self):
+    return "instant"
+
+
+class UniformTransport ():
+  def __init__ (self, low_ms, high_ms):
+    self.low = low_ms / 1000
+    self.high = high_ms / 1000
+
+  def delay (self, src, dst, rng):
+    return rng.uniform (self.low, self.high)
+
+  def __str__ (self):
+    return "uniform [{:g}, {:g}] ms".format (self.low * 1000, self.high * 1000)
+
+
+class LogNormalTransport ():
+  def __init__ (self, median_ms, sigma):
+    self.mu = math.log (median_ms / 1000)
+    self.sigma = sigma
+
+  def delay (self, src, dst, rng):
+    return rng.lognormvariate (self.mu, self.sigma)
+
+  def __str__ (self):
+    return "lognormal median {:g} ms, sigma {:g}".format (math.exp (self.mu) * 1000, self.sigma)
+
+
+class HostTransport ():
+  # nodes on the same (Mininet) host talk faster than nodes on different hosts
+  def __init__ (self, local_ms, remote_ms):
+    self.local = local_ms / 1000
+    self.remote = remote_ms / 1000
+
+  def delay (self, src, dst, rng):
+    if src is not None and src.get ('host') == dst.get ('host'):
+      return self.local
+    return self.remote
+
+  def __str__ (self):
+    return "host-aware local {:g} ms, remote {:g} ms".format (self.local * 1000, self.remote * 1000)
+
+
+#################
+# make_transport
+#
+# instant | uniform:low,high | lognormal:median,sigma | host:local,remote (ms)
+#################
+def make_transport (spec):
+  name, _, params = spec.partition (":")
+  values = [float (v) for v in params.split (",")] if params else []
+  if name == "instant":
+    return InstantTransport ()
+  elif name == "uniform":
+    return UniformTransport (*values)
+  elif name == "lognormal":
+    return LogNormalTransport (*values)
+  elif name == "host":
+    return HostTransport (*values)
+  raise ValueError ("Unknown transport: {}".format (spec))
+
+
+##########################
+#
+# In-process stand-ins for the ZMQ objects used by DiscoveryMW
+# when it changes its routing state
+#
+##########################
+class SimSocket ():
+  def setsockopt (self, option, value):
+    pass
+
+  def connect (self, endpoint):
+    pass
+
+  def send_multipart (self, frames):
+    pass
+
+  def close (self, linger=None):
+    pass
+
+
+class SimContext ():
+  def socket (self, socket_type):
+    return SimSocket ()
+
+
+class SimPoller ():
+  def register (self, socket, flags=None):
+    pass
+
+  def unregister (self, socket):
+    pass
+
+
+##########################
+#
+# What DiscoveryMW expects from its application object
+#
+##########################
+class SimUpcall ():
+  def __init__ (self, args):
+    self.lookup = "DHT"
+    self.dht_maintenance = False
+    self.dht_virtual_nodes = args.virtual_nodes
+    self.dht_successor_list_size = args.successor_list_size
+    self.dht_failure_timeout = args.failure_timeout / 1000
+    self.dht_replication_factor = 0
+
+
+##########################
+#
+# DhtSimulator class
+#
+##########################
+class DhtSimulator ():
+
+  #################
+  # constructor
+  #################
+  def __init__ (self, logger):
+    self.logger = logger # The logger
+    self.mw_logger = logging.getLogger ("DhtSimulator.MW") # the middleware objects log here (silenced)
+    self.rng = None # all randomness comes from here so that a seed gives the same run
+    self.ring = None # the current ring (changes with churn)
+    self.upcall = None
+    self.transport = None
+    self.nodes = {} # node id -> (DiscoveryMW, time its finger table was built); built when first used
+    self.next_node_num = 0 # for naming joining nodes
+    self.now = 0.0 # simulated time in seconds
+
+    # statistics
+    self.hops = collections.Counter () # hops -> num of operations
+    self.latencies = [] # per operation, seconds
+    self.node_load = collections.Counter () # node id -> requests received
+    self.stored = {} # key -> id of the node that stored it
+    self.stats = collections.Counter ()
+
+  #################
+  # configuration
+  #################
+  def configure (self, args):
+    self.logger.debug ("DhtSimulator::configure")
+    self.args = args
+    self.rng = random.Random (args.seed)
+    self.upcall = SimUpcall (args)
+    self.transport = make_transport (args.transport)
+    self.mw_logger.setLevel (logging.CRITICAL)
+    self.mw_logger.propagate = False
+
+    if args.json_file:
+      self.ring = DhtRing.load (args.json_file, bits_hash=args.bits_hash, virtual_nodes=args.virtual_nodes)
+      self.next_node_num = len (self.ring)
+    else:
+      nodes = [self.make_node () for i in range (args.num_nodes)]
+      self.ring = DhtRing (nodes, bits_hash=args.bits_hash, virtual_nodes=args.virtual_nodes)
+
+    if args.churn_rate > 0 and self.ring.is_virtual ():
+      # failures are handled by rebuilding the routing state of the virtual nodes
+      self.logger.info ("DhtSimulator::configure - virtual nodes with churn: failed fingers are repaired by a refresh")
+
+  #################
+  # make a new discovery node the way exp_generator names and hashes them
+  #################
+  def make_node (self):
+    self.next_node_num += 1
+    id = "disc" + str (self.next_node_num)
+    host_num = self.rng.randint (1, self.args.num_hosts)
+    ip = "10.0." + str (host_num // 256) + "." + str (host_num % 256)
+    port = 5555
+    return {"id": id, "hash": hash_func (id + ":" + ip + ":" + str (port), self.args.bits_hash),
+            "IP": ip, "port": port, "host": "h" + str (host_num)}
+
+  #################
+  # middleware object of a node, (re)building its finger table from the
+  # current ring when it does not have one or it is older than the refresh interval
+  #################
+  def get_mw (self, node_id):
+    mw, built_at = self.nodes.get (node_id, (None, None))
+    if mw is not None and built_at != -math.inf and (self.args.refresh_interval <= 0 or self.now - built_at < self.args.refresh_interval):
+      return mw
+
+    if mw is None:
+      mw = DiscoveryMW (self.mw_logger)
+      mw.name = node_id
+      mw.context = SimContext ()
+      mw.poller = SimPoller ()
+      mw.set_upcall_handle (self.upcall)
+      self.stats["finger tables built"] += 1
+    else:
+      self.stats["finger tables refreshed"] += 1
+    mw.dealer_sockets = {}
+    mw.set_up_finger_table (self.ring)
+    self.nodes[node_id] = (mw, self.now)
+    return mw
+
+  #################
+  # route a request for key starting at the given node
+  #
+  # Returns the id of the node that handled it (None if it could not be
+  # routed) after updating the statistics
+  #################
+  def route (self, key, start_id):
+    delay = self.transport.delay (None, self.ring.find_node (start_id), self.rng) # client to first node
+    hops = 0
+    timeouts = 0
+    current_id = start_id
+    self.node_load[current_id] += 1
+
+    while True:
+      mw = self.get_mw (current_id)
+      entry, found_the_one = mw.find_successor (key)
+      next_node = entry.node_info
+
+      if self.ring.find_node (next_node['id']) is not next_node:
+        # the next node failed, we only find out after the timeout
+        timeouts += 1
+        delay += self.upcall.dht_failure_timeout
+        if mw.my_tokens or timeouts > 3:
+          self.nodes[current_id] = (mw, -math.inf) # rebuild from the current ring
+        else:
+          mw.handle_failed_node (next_node)
+        if timeouts > 2 * self.args.bits_hash:
+          self.stats["unroutable requests"] += 1
+          return None
+        continue
+
+      # forward the request (the reply retraces the same path)
+      delay += self.transport.delay (self.ring.find_node (current_id), next_node, self.rng)
+      hops += 1
+      self.node_load[next_node['id']] += 1
+      if found_the_one:
+        break
+      current_id = next_node['id']
+      if hops > 4 * self.args.bits_hash:
+        self.stats["unroutable requests"] += 1
+        return None
+
+    self.hops[hops] += 1
+    self.latencies.append (2 * delay)
+    self.stats["request messages"] += hops + 1
+    self.stats["reply messages"] += hops + 1
+    self.stats["timeouts"] += timeouts
+    return next_node['id']
+
+  #################
+  # one register or lookup operation
+  #################
+  def run_operation (self, op_num):
+    start_id = self.rng.choice (self.ring.nodes)['id']  # like the clients, pick a random discovery node
+
+    if self.stored and self.rng.random () < self.args.lookup_fraction:
+      # lookup of an entity that registered earlier
+      key = self.rng.choice (self.stored_keys)
+      owner_id = self.route (key, start_id)
+      self.stats["lookups"] += 1
+      if owner_id is not None and self.stored.get (key) == owner_id:
+        self.stats["lookup hits"] += 1
+    else:
+      id = "pub" + str (op_num)
+      key = hash_func (id + ":10.0.0." + str (op_num % 250 + 1) + ":" + str (7777 - op_num % 100), self.args.bits_hash)
+      owner_id = self.route (key, start_id)
+      self.stats["registers"] += 1
+      if owner_id is not None:
+        if key not in self.stored:
+          self.stored_keys.append (key)
+        self.stored[key] = owner_id
+        if owner_id != self.ring.successor (key)['id']:
+          self.stats["misrouted registers"] += 1
+
+  #################
+  # one churn event: a node fails or a new one joins
+  #################
+  def churn (self):
+    if self.rng.random () < self.args.join_fraction or len (self.ring) < 2:
+      node = self.make_node ()
+      while self.ring.successor (node['hash'])['hash'] == node['hash']:  # hash collision, try another one
+        node = self.make_node ()
+      self.ring.add_node (node)
+      self.stats["joins"] += 1
+    else:
+      node = self.rng.choice (self.ring.nodes)
+      self.ring.remove_node (node['id'])
+      self.nodes.pop (node['id'], None)
+      self.stats["failures"] += 1
+
+  #################
+  # percentile of a sorted list
+  #################
+  def percentile (self, values, p):
+    if not values:
+      return 0
+    return values[min (len (values) - 1, int (p / 100 * len (values)))]
+
+  #################
+  # report
+  #################
+  def report (self, wall_time):
+    args = self.args
+    self.logger.info ("**********************************")
+    self.logger.info ("DhtSimulator::report")
+    self.logger.info ("------------------------------")
+    self.logger.info ("Nodes at start/end: {}/{} ({} tokens), transport: {}".format (args.num_nodes if not args.json_file else "-", len (self.ring), len (self.ring.token_hashes), self.transport))
+    self.logger.info ("Operations: {} registers, {} lookups in {:.1f} simulated s, {:.1f} s wall ({:.0f} ops/s)".format (
+      self.stats["registers"], self.stats["lookups"], self.now, wall_time, args.num_ops / max (wall_time, 1e-9)))
+    if args.churn_rate > 0:
+      self.logger.info ("Churn: {} joins, {} failures, {} finger table refreshes".format (self.stats["joins"], self.stats["failures"], self.stats["finger tables refreshed"]))
+      self.logger.info ("Misrouted registers: {}, unroutable requests: {}, lookup hits: {:.2%}".format (
+        self.stats["misrouted registers"], self.stats["unroutable requests"], self.stats["lookup hits"] / max (1, self.stats["lookups"])))
+
+    # hop count distribution
+    total = sum (self.hops.values ())
+    cumulative = 0
+    self.logger.info ("Hop count distribution:")
+    percentiles = {}
+    for hops in sorted (self.hops):
+      count = self.hops[hops]
+      for p in (50, 90, 99):
+        if p not in percentiles and cumulative + count >= p / 100 * total:
+          percentiles[p] = hops
+      cumulative += count
+      self.logger.info ("     {:3d} hops: {:10d} ({:6.2%})".format (hops, count, count / max (1, total)))
+    mean_hops = sum (hops * count for hops, count in self.hops.items ()) / max (1, total)
+    self.logger.info ("Hops mean {:.2f}, p50 {}, p90 {}, p99 {}, max {} (log2 N = {:.1f})".format (
+      mean_hops, percentiles.get (50), percentiles.get (90), percentiles.get (99), max (self.hops) if self.hops else 0, math.log2 (max (2, len (self.ring)))))
+
+    # latency
+    latencies = sorted (self.latencies)
+    self.logger.info ("Latency (ms) p50 {:.3f}, p90 {:.3f}, p99 {:.3f}, max {:.3f}".format (
+      *[self.percentile (latencies, p) * 1000 for p in (50, 90, 99)], (latencies[-1] if latencies else 0) * 1000))
+
+    # messages
+    self.logger.info ("Messages: {} requests, {} replies, {} timeouts, {:.2f} messages per operation".format (
+      self.stats["request messages"], self.stats["reply messages"], self.stats["timeouts"],
+      (self.stats["request messages"] + self.stats["reply messages"]) / max (1, total)))
+
+    # load on the nodes (requests received, including forwarding)
+    loads = sorted (self.node_load.get (node['id'], 0) for node in self.ring.nodes)
+    mean_load = sum (loads) / max (1, len (loads))
+    self.logger.info ("Requests per node: mean {:.1f}, p50 {}, p99 {}, max {} (max/mean {:.2f})".format (
+      mean_load, self.percentile (loads, 50), self.percentile (loads, 99), loads[-1] if loads else 0, (loads[-1] if loads else 0) / max (mean_load, 1e-9)))
+    records_per_node = collections.Counter (self.stored.values ())
+    records = sorted (records_per_node.get (node['id'], 0) for node in self.ring.nodes)
+    self.logger.info ("Records per node: p50 {}, p99 {}, max {}".format (self.percentile (records, 50), self.percentile (records, 99), records[-1] if records else 0))
+    shares = sorted (self.ring.key_shares ().values ())
+    self.logger.info ("Key share: min {:.4%}, max {:.4%} (max/min {:.1f})".format (shares[0], shares[-1], shares[-1] / max (shares[0], 1e-12)))
+    for node_id, load in self.node_load.most_common (5):
+      self.logger.info ("     busiest: {} with {} requests".format (node_id, load))
+    self.logger.info ("**********************************")
+
+  #################
+  # Driver program
+  #################
+  def driver (self):
+    self.logger.debug ("DhtSimulator::driver")
+    args = self.args
+    self.stored_keys = [] # keys in the order they were stored, to pick lookups from
+
+    next_churn = self.rng.expovariate (args.churn_rate) if args.churn_rate > 0 else math.inf
+    start = time.perf_counter ()
+    for op_num in range (args.num_ops):
+      # operations arrive as a Poisson process
+      self.now += self.rng.expovariate (args.op_rate)
+      while next_churn <= self.now:
+        self.churn ()
+        next_churn += self.rng.expovariate (args.churn_rate)
+
+      self.run_operation (op_num)
+
+      if args.num_ops >= 10 and (op_num + 1) % (args.num_ops // 10) == 0:
+        self.logger.info ("DhtSimulator::driver - {} operations done".format (op_num + 1))
+
+    self.report (time.perf_counter () - start)
+
+
+###################################
+#
+# Parse command line arguments
+#
+###################################
+def parseCmdLineArgs ():
+  # instantiate a ArgumentParser object
+  parser = argparse.ArgumentParser (description="In-process DHT ring simulator")
+
+  parser.add_argument ("-N", "--num_nodes", type=int, default=1000, help="Number of discovery nodes on the ring, default 1000 (ignored with -j)")
+
+  parser.add_argument ("-j", "--json_file", default=None, help="Use the ring of this dht file instead of generating one")
+
+  parser.add_argument ("-H", "--num_hosts", type=int, default=100, help="Number of hosts the generated nodes are spread over, default 100")
+
+  parser.add_argument ("-b", "--bits_hash", type=int, choices=[8,16,24,32,40,48,56,64], default=48, help="Number of bits of hash value, default 48")
+
+  parser.add_argument ("-V", "--virtual_nodes", type=int, default=1, help="Virtual nodes per discovery node, default 1")
+
+  parser.add_argument ("-o", "--num_ops", type=int, default=100000, help="Number of register/lookup operations, default 100000")
+
+  parser.add_argument ("-L", "--lookup_fraction", type=float, default=0.5, help="Fraction of operations that are lookups, default 0.5")
+
+  parser.add_argument ("-R", "--op_rate", type=float, default=10000, help="Operations per simulated second, default 10000")
+
+  parser.add_argument ("-t", "--transport", default="instant", help="instant | uniform:low,high | lognormal:median,sigma | host:local,remote (times in ms), default instant")
+
+  parser.add_argument ("-c", "--churn_rate", type=float, default=0, help="Churn events (failure or join) per simulated second, default 0")
+
+  parser.add_argument ("-J", "--join_fraction", type=float, default=0.5, help="Fraction of churn events that are joins, default 0.5")
+
+  parser.add_argument ("-r", "--refresh_interval", type=float, default=30, help="Seconds after which a node rebuilds its finger table from the current ring (0 = never), default 30")
+
+  parser.add_argument ("-f", "--failure_timeout", type=float, default=3000, help="Time in ms after which a request to a failed node is given up, default 3000")
+
+  parser.add_argument ("-s", "--successor_list_size", type=int, default=3, help="Successors each node keeps to route around failures, default 3")
+
+  parser.add_argument ("-S", "--seed", type=int, default=42, help="Random seed, default 42")
+
+  parser.add_argument ("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+
+  return parser.parse_args()
+
+
+###################################
+#
+# Main program
+#
+###################################
+def main ():
+  try:
+    # obtain a system wide logger and initialize it to debug level to begin with
+    logging.info ("Main - acquire a child logger and then log messages in the child")
+    logger = logging.getLogger ("DhtSimulator")
+
+    # first parse the arguments
+    logger.debug ("Main: parse command line arguments")
+    args = parseCmdLineArgs ()
+
+    # reset the log level to as specified
+    logger.debug ("Main: resetting log level to {}".format (args.loglevel))
+    logger.setLevel (args.loglevel)
+    logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
+
+    # Obtain the simulator object
+    logger.debug ("Main: obtain the DhtSimulator object")
+    sim_obj = DhtSimulator (logger)
+
+    # configure the object
+    logger.debug ("Main: configure the simulator object")
+    sim_obj.configure (args)
+
+    # now invoke the driver program
+    logger.debug ("Main: invoke the driver")
+    sim_obj.driver ()
+
+  except Exception as e:
+    logger.error ("Exception caught in main - {}".format (e))
+    return
+
+
+###################################
+#
+# Main entry point
+#
+###################################
+if __name__ == "__main__":
+
+  # set underlying default logging capabilities
+  logging.basicConfig (level=logging.DEBUG,
+                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+  main ()
@@ -18,18 +18,31 @@
 # Since our topic helper has 9 topics, we also have to make sure that the num of topics
 # published or subscribed are 5 or more so that there is some overlap.
 #
-# Note, our script generation logic will place these entities randomly across the nodes of
-# system. We make no effort to load balance or just use round robin allocation (which would
-# have been simpler). But this becomes too deterministic and sort of equally distributed
-# scenario.
+# By default, our script generation logic places these entities randomly across the nodes
+# of the system. With -m balanced every entity goes to the host with the least load so far,
+# and with -m binpack the entities are packed onto as few hosts as possible, each carrying
+# at most -c of load. The load of an entity is an estimate of the work it does: the
+# capacity of a discovery node, the topics times the frequency of a publisher and the
+# topics of a subscriber. Both place the heaviest entities first.
+#
+# In the same pass we write the Mininet script (-f) with its dht file (-j), and a script
+# that runs the same experiment on this machine (--local_script) with its own dht file
+# (--local_json), where every entity listens on 127.0.0.1 on a port of its own.
 
 import os
+import sys
+import heapq # for the least loaded host
 import random # random number generation
-import hashlib  # for the secure hash library
 import argparse # argument parsing
 import json # for JSON
 import logging # for logging. Use it in place of print statements.
 
+# the hashes, tokens and key shares come from the ring model of the middleware,
+# which lives in the parent directory, so that the dht file and the ring agree
+sys.path.append (os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from CS6381_MW.DhtRing import DhtRing, hash_func, token_hash
+
 ##########################
 #
 # ExperimentGenerator class.
@@ -52,11 +65,26 @@ class ExperimentGenerator ():
     self.pub_base_port = None  # same for this
     self.num_mn_nodes = None # num of nodes in mininet topo; will be derived
     self.bits_hash = None # number of bits in hash value (default 48)
+    self.virtual_nodes = None # positions on the ring per discovery node (scaled by capacity)
+    self.ring = None # the ring model, which tells how many tokens a node gets
+    self.weights = None # capacities to choose from for the discovery nodes
+    self.placement = None # random, balanced or binpack
+    self.host_capacity = None # load a host can carry with binpack
+    self.zookeeper = None # addr:port of ZooKeeper passed to every entity, if any
+    self.exp_name = None # experiment name passed to the publishers, if any
+    self.iters = None # iterations of every publisher, random if None
+    self.log_prefix = None # prefix of the log file names
     self.disc_dict = {} # dictionary of generated discovery DHT instances
     self.pub_dict = {} # dictionary of generated publisher instances
     self.sub_dict = {} # dictionary of generated subscriber instances
+    self.used_hashes = {"disc": set (), "pub": set (), "sub": set ()} # hash values (and tokens) given out per entity type
+    self.host_load = None # load placed so far on each host, index is the host number
+    self.next_port = {} # (prefix, host) -> port the next entity of that type on that host tries
+    self.num_local_ports = 0 # ports given out on this machine for the local script
     self.script_file = None  # for the experiment script
     self.json_file = None # for the database of DHT 
+    self.local_script_file = None # same experiment on this machine
+    self.local_json_file = None # and its database of DHT
     self.logger = logger # The logger
 
   #################
@@ -67,13 +95,24 @@ class ExperimentGenerator ():
     self.logger.debug ("ExperimentGenerator::configure")
 
     self.bits_hash = args.bits_hash
+    self.virtual_nodes = args.virtual_nodes
+    self.ring = DhtRing ([], self.bits_hash, self.virtual_nodes)
+    self.weights = [float (w) for w in args.weights.split (",")]
     self.num_disc_dht = args.num_disc_dht
     self.num_pub = args.num_pub
     self.num_sub = args.num_sub
     self.disc_base_port = args.disc_base_port
     self.pub_base_port = args.pub_base_port
+    self.placement = args.placement
+    self.host_capacity = args.host_capacity
+    self.zookeeper = args.zookeeper
+    self.exp_name = args.exp_name
+    self.iters = args.iters
+    self.log_prefix = args.log_prefix
     self.script_file = args.script_file
     self.json_file = args.json_file
+    self.local_script_file = args.local_script
+    self.local_json_file = args.local_json
     
     # Now let us parse the mininet topo and derive how many nodes
     # we have in mininet topology
@@ -90,6 +129,9 @@ class ExperimentGenerator ():
     else:
       raise ValueError ("Bad mininet topology")
 
+    # the placement adds up the load of all entity types, host 0 does not exist
+    self.host_load = [0] * (self.num_mn_nodes + 1)
+
     # Now let us initialize the dictionaries. Since the entities can be deployed
     # across any host of the mininet topology, the dictionary is keyed by
     # mininet host name. We assume montonically increasing host names.
@@ -106,12 +148,15 @@ class ExperimentGenerator ():
 
     self.logger.debug ("*******ExperimentGenerator::DUMP***********")
     self.logger.debug ("Num of bits in hash fn = {}".format (self.bits_hash))
+    self.logger.debug ("Virtual nodes per DHT instance = {}".format (self.virtual_nodes))
+    self.logger.debug ("Capacities of DHT instances = {}".format (self.weights))
     self.logger.debug ("Num DHT instances = {}".format (self.num_disc_dht))
     self.logger.debug ("Num pubs = {}".format (self.num_pub))
     self.logger.debug ("Num subs = {}".format (self.num_sub))
     self.logger.debug ("Base discovery port = {}".format (self.disc_base_port))
     self.logger.debug ("Base pub port = {}".format (self.pub_base_port))
     self.logger.debug ("Num Mininet nodes = {}".format (self.num_mn_nodes))
+    self.logger.debug ("Placement = {}".format (self.placement))
     self.logger.debug ("Discovery dictionary = {}".format (self.disc_dict))
     self.logger.debug ("Publisher dictionary = {}".format (self.pub_dict))
     self.logger.debug ("Subscriber dictionary = {}".format (self.sub_dict))
@@ -122,71 +167,99 @@ class ExperimentGenerator ():
   #################
   def hash_func (self, id):
     self.logger.debug ("ExperimentGenerator::hash_func")
+    return hash_func (id, self.bits_hash)
 
-    # first get the digest from hashlib and then take the desired number of bytes from the
-    # lower end of the 256 bits hash. Big or little endian does not matter.
-    hash_digest = hashlib.sha256 (bytes (id, "utf-8")).digest ()  # this is how we get the digest or hash value
-    # figure out how many bytes to retrieve
-    num_bytes = int(self.bits_hash/8)  # otherwise we get float which we cannot use below
-    hash_val = int.from_bytes (hash_digest[:num_bytes], "big")  # take lower N number of bytes
+  #################
+  # gen entities
+  #
+  # The entities of a type with the parameters they will run with and their load
+  #################
+  def gen_entities (self, prefix, num_entities):
+    self.logger.debug ("ExperimentGenerator::gen_entities")
 
-    return hash_val
+    entities = []
+    for i in range (num_entities):
+      # generate our id, index is monotonically increasing
+      entity = {"prefix": prefix, "id": prefix + str (i+1)}
+      if prefix == "disc":
+        entity["capacity"] = random.choice (self.weights)
+        entity["load"] = entity["capacity"]
+      elif prefix == "pub":
+        # generate interested in topics in the range of 5 to 9 because
+        # our topic helper currently has 9 topics in it.
+        entity["num_topics"] = random.randint (5, 9)
+        entity["frequency"] = random.choice ([0.25, 0.5, 0.75, 1, 2, 3, 4])
+        entity["iterations"] = self.iters if self.iters else random.choice ([1000, 2000, 3000])
+        entity["load"] = entity["num_topics"] * entity["frequency"]
+      elif prefix == "sub":
+        entity["num_topics"] = random.randint (5, 9)
+        entity["load"] = entity["num_topics"]
+      else:
+        raise ValueError ("gen_entities::unknown prefix: {}".format (prefix))
+      entities.append (entity)
+
+    return entities
 
   #################
-  # gen dictionary values
+  # place the entities on the hosts
   #
-  # called by the populate method
+  # Returns the host number of every entity, in the order of the entities
   #################
-  def gen_dict_values (self, prefix, index):
-    self.logger.debug ("ExperimentGenerator::gen_dict_values")
-
-    # here we generate the dictionary values.
-    # prefix, such as pub, sub or disc must be specified
-    # index should be monotonically increasing.
+  def place (self, entities):
+    self.logger.debug ("ExperimentGenerator::place")
+
+    # the heaviest first, ties in the order of generation
+    order = sorted (range (len (entities)), key=lambda idx: -entities[idx]["load"])
+    hosts = [None] * len (entities)
+
+    if self.placement == "random":
+      for idx in range (len (entities)):
+        hosts[idx] = random.randint (1, self.num_mn_nodes)
+        self.host_load[hosts[idx]] += entities[idx]["load"]
+
+    elif self.placement == "balanced":
+      # heap of (load so far, host number), the least loaded host is on top
+      heap = [(self.host_load[host_num], host_num) for host_num in range (1, self.num_mn_nodes + 1)]
+      heapq.heapify (heap)
+      for idx in order:
+        load, host_num = heapq.heappop (heap)
+        hosts[idx] = host_num
+        heapq.heappush (heap, (load + entities[idx]["load"], host_num))
+      for load, host_num in heap:
+        self.host_load[host_num] = load
+
+    elif self.placement == "binpack":
+      # first fit decreasing
+      for idx in order:
+        for host_num in range (1, self.num_mn_nodes + 1):
+          if self.host_load[host_num] + entities[idx]["load"] <= self.host_capacity:
+            break
+        else:
+          raise ValueError ("place::{} with load {} does not fit on any of the {} hosts of capacity {}".format (entities[idx]["id"], entities[idx]["load"], self.num_mn_nodes, self.host_capacity))
+        self.host_load[host_num] += entities[idx]["load"]
+        hosts[idx] = host_num
 
-    # generate our id
-    id = prefix + str (index)
+    else:
+      raise ValueError ("place::unknown placement: {}".format (self.placement))
 
-    # generate a host on which we will deploy this entity
-    mn_host_num = random.randint (1, self.num_mn_nodes)
-    host = "h" + str (mn_host_num)
-    ip = "10.0.0." + str(mn_host_num)
+    self.logger.info ("Placed {} entities of type {}, hosts in use {} of {}, max/min host load = {}/{}".format (len (entities), entities[0]["prefix"] if entities else "-", sum (1 for load in self.host_load[1:] if load > 0), self.num_mn_nodes, max (self.host_load[1:]), min (self.host_load[1:])))
 
-    # if there already is a service of that type running on that host
-    # then, we cannot reuse that port and so must generate the next
-    # port in the sequence
-    if prefix == "disc":
-      port = self.disc_base_port + len (self.disc_dict[host])
-    elif prefix == "pub":
-      port = self.pub_base_port - len (self.pub_dict[host])
-    else:
-      port = None
+    return hosts
 
-    # return the generated parameters
-    return id, host, ip, port
-  
   #################
   # check for collision
   #
   #################
-  def check4collision (self, hash_val, dictionary):
-    self.logger.debug ("ExperimentGenerator::check4collision")
+  def check4collision (self, hash_val, prefix):
+    # the set of hash values already given out to this type of entity
+    return hash_val in self.used_hashes[prefix]
 
-    # check the dictionary if the hash value already exists
-    for i in range (self.num_mn_nodes):
-      host_list = dictionary["h"+str (i+1)]
-      for nested_dict in host_list:
-        if nested_dict["hash"] == hash_val:
-          return True
-
-    return False # otherwise
-  
   #################
   # populate a given dict.
   #
   # Generic method
   #################
-  def populate_dict (self, prefix, num_entities):
+  def populate_dict (self, entity, host_num):
     self.logger.debug ("ExperimentGenerator::populate_dict")
 
     # populate the dictionary corresponding to the entity
@@ -197,10 +270,7 @@ class ExperimentGenerator ():
     # We can guarantee no duplicate because we will be
     # generating sequentially for each entity and
     # not randomly but must check for collision
-
-    # check if no prefix is passed
-    if not prefix:
-      raise ValueError ("populate_dict::prefix not supplied")
+    prefix = entity["prefix"]
 
     # Since we are making this a generic method (exploiting the fact that
     # all dictionaries look very similar), so we must set the handle to
@@ -213,41 +283,129 @@ class ExperimentGenerator ():
       target_dict = self.sub_dict
     else:
       raise ValueError ("populate_dict::unknown prefix: {}".format (prefix))
-      
-    for i in range (num_entities):
-      collision = True  # assume there is collision
-      while (collision):
-        # keep generating values until no collision
-        id, host, ip, port = self.gen_dict_values (prefix, index=i+1)
-        if port:
-          string = id + ":" + ip + ":" + str (port)  # will be the case for disc and pubs
-        else:
-          string = id + ":" + ip  # will be the case for subscribers
 
-        # now get the hash value for this string
-        hash_val = self.hash_func (string)
-        
-        # check if this hash value already exists anywhere in our dict
-        collision = self.check4collision (hash_val, target_dict)
-        if collision:
-          self.logger.debug ("ExperimentGenerator::populate_dict -- collision occurred for string {}".format (str))
+    if len (self.used_hashes[prefix]) >= 2 ** self.bits_hash:
+      raise ValueError ("populate_dict::no {} bit hash values left for {}".format (self.bits_hash, entity["id"]))
+
+    # If there already is a service of that type running on that host then, we
+    # cannot reuse that port and so must generate the next port in the sequence.
+    # Discovery ports count up from their base, publisher ports down. On a
+    # collision the next port is tried, subscribers (no port) try the next host.
+    for attempt in range (max (self.num_mn_nodes, 1000)):
+      host = "h" + str (host_num)
+      ip = "10.0.0." + str (host_num)
+      if prefix == "sub":
+        port = None
+        string = entity["id"] + ":" + ip  # will be the case for subscribers
+      else:
+        port = self.next_port.get ((prefix, host), self.disc_base_port if prefix == "disc" else self.pub_base_port)
+        self.next_port[(prefix, host)] = port + 1 if prefix == "disc" else port - 1
+        string = entity["id"] + ":" + ip + ":" + str (port)  # will be the case for disc and pubs
+
+      # now get the hash value for this string
+      hash_val = self.hash_func (string)
+
+      # check if this hash value already exists anywhere in our dict
+      if not self.check4collision (hash_val, prefix):
+        break
+      self.logger.debug ("ExperimentGenerator::populate_dict -- collision occurred for string {}".format (string))
+      if prefix == "sub":
+        host_num = host_num % self.num_mn_nodes + 1
+    else:
+      raise ValueError ("populate_dict::cannot find a collision free hash for {}, use more bits (-b)".format (entity["id"]))
+
+    # now that we know that the generated values do not cause collision
+    # insert it into our dictionary
+    self.used_hashes[prefix].add (hash_val)
+    nested_dict = {"id": entity["id"], "hash": hash_val, "IP": ip, "port": port}
+    for key in ("num_topics", "frequency", "iterations"):
+      if key in entity:
+        nested_dict[key] = entity[key]
+
+    # on this machine every entity that listens gets a port of its own
+    if port != None:
+      nested_dict["local_port"] = self.local_port ()
+      if prefix == "disc" and self.zookeeper:
+        nested_dict["local_sync_port"] = self.local_port ()
+    target_dict[host].append (nested_dict)
+
+    # discovery nodes may occupy several positions on the ring
+    if prefix == "disc":
+      self.gen_vnodes (nested_dict, entity["capacity"])
+
+  #################
+  # next free port on this machine, counting up from the discovery base port
+  #################
+  def local_port (self):
+    self.num_local_ports += 1
+    return self.disc_base_port + self.num_local_ports - 1
 
-      # now that we know that the generated values do not cause collision
-      # insert it into our dictionary
-      target_dict[host].append ({"id": id, "hash": hash_val, "IP": ip, "port": port})
+  #################
+  # generate virtual nodes
+  #
+  # A discovery node with capacity c gets round (c * virtual_nodes) positions
+  # (tokens) on the ring, the ones DhtRing would derive. The first one is its
+  # hash. We save them in the dht file so that every entity agrees on the ring.
+  #################
+  def gen_vnodes (self, nested_dict, capacity):
+    self.logger.debug ("ExperimentGenerator::gen_vnodes")
+
+    num_tokens = self.ring.num_tokens ({"capacity": capacity})
+    if num_tokens == 1 and capacity == 1:
+      return  # plain node, nothing to add to the dht file
+
+    # tokens must not collide either, a colliding one is skipped
+    nested_dict["capacity"] = capacity
+    nested_dict["vnodes"] = [nested_dict["hash"]]
+    suffix = 1
+    while len (nested_dict["vnodes"]) < num_tokens:
+      if len (self.used_hashes["disc"]) >= 2 ** self.bits_hash:
+        raise ValueError ("gen_vnodes::no {} bit hash values left for the tokens of {}".format (self.bits_hash, nested_dict["id"]))
+      token = token_hash (nested_dict, suffix, self.bits_hash)
+      suffix += 1
+      if not self.check4collision (token, "disc"):
+        self.used_hashes["disc"].add (token)
+        nested_dict["vnodes"].append (token)
+
+  #################
+  # report key shares
+  #
+  # Print the share of the hash space owned by each discovery node, as the
+  # ring of the dht file we write splits it (DhtRing.key_shares)
+  #################
+  def report_key_shares (self):
+    self.logger.debug ("ExperimentGenerator::report_key_shares")
+
+    nodes = [nested_dict for host_list in self.disc_dict.values () for nested_dict in host_list]
+    if not nodes:
+      return
+    shares = DhtRing (nodes, self.bits_hash).key_shares ()
+
+    for id, share in sorted (shares.items (), key=lambda item: -item[1]):
+      self.logger.info ("Key share of {} = {:.2%}".format (id, share))
+    self.logger.info ("Max/min key share = {:.2f}".format (max (shares.values ()) / min (shares.values ())))
 
   #######################
   # Generate the experiment script
   #
+  # With local, the commands run on this machine instead of the Mininet hosts,
+  # every entity on 127.0.0.1 with its local port and the local dht file.
+  #
   # Change/extend this code to suit your needs
   #######################
-  def gen_exp_script (self):
+  def gen_exp_script (self, script_file, json_file, local=False):
     self.logger.debug ("ExperimentGenerator::gen_exp_script")
 
+    # the hosts of Mininet run the commands, here the shell does
+    zookeeper = self.zookeeper
+    if local and zookeeper:
+      zookeeper = "localhost:" + zookeeper.split (":")[-1]
+    opts = (" -z " + zookeeper if zookeeper else "")
+
     # Here we are going to generate the command line to run each
     # entity in our system, which otherwise would have to be done
     #manually
-    with open (self.script_file, "w") as f:
+    with open (script_file, "w") as f:
 
       # Let us first generate all the commands to run the dictionary DHT nodes
       # I am thinking that because we now have multiple Discovery instances
@@ -259,13 +417,15 @@ class ExperimentGenerator ():
         host = "h" + str (i+1)
         host_list = self.disc_dict[host]
         for nested_dict in host_list:
-          cmdline = host + " python3 DiscoveryAppln.py " + \
+          cmdline = ("" if local else host + " ") + "python3 DiscoveryAppln.py " + \
             "-n " + nested_dict["id"]  + " " + \
-            "-j " + self.json_file + " " + \
-            "-p " + str(nested_dict["port"]) + " " + \
+            "-j " + json_file + " " + \
+            "-p " + str(nested_dict["local_port"] if local else nested_dict["port"]) + " " + \
             "-P " + str(self.num_pub) + " " + \
-            "-S " + str(self.num_sub) + " " + \
-            "> " + nested_dict["id"] + ".out 2>&1 &\n"
+            "-S " + str(self.num_sub) + \
+            opts + \
+            (" -s " + str(nested_dict["local_sync_port"]) if local and self.zookeeper else "") + " " + \
+            "> " + self.log_prefix + nested_dict["id"] + ".out 2>&1 &\n"
           f.write (cmdline)
 
       # Do similar things with publishers. Here I am suggesting that we pass
@@ -277,24 +437,21 @@ class ExperimentGenerator ():
         host = "h" + str (i+1)
         host_list = self.pub_dict[host]
         for nested_dict in host_list:
-          # generate intested in topics in the range of 5 to 9 because
-          # our topic helper currently has 9 topics in it.
-          num_topics = random.randint (5, 9)
-          frequency = random.choice ([0.25, 0.5, 0.75, 1, 2, 3, 4])
-          iterations = random.choice ([1000, 2000, 3000])
-
-          # build the command line
-          cmdline = host + " python3 PublisherAppln.py " + \
+          # build the command line; topics, frequency and iterations were
+          # chosen when the publisher was generated
+          cmdline = ("" if local else host + " ") + "python3 PublisherAppln.py " + \
             "-n " + nested_dict["id"]  + " " + \
             "-P " + str(self.num_pub) + " " + \
             "-S " + str(self.num_sub) + " " + \
-            "-j " + self.json_file + " " + \
-            "-a " + str(nested_dict["IP"]) + " " + \
-            "-p " + str(nested_dict["port"]) + " " + \
-            "-T " + str(num_topics) + " " + \
-            "-f " + str(frequency) + " " + \
-            "-i " + str(iterations) + " " + \
-            "> " + nested_dict["id"] + ".out 2>&1 &\n"
+            "-j " + json_file + " " + \
+            "-a " + ("127.0.0.1" if local else str(nested_dict["IP"])) + " " + \
+            "-p " + str(nested_dict["local_port"] if local else nested_dict["port"]) + " " + \
+            "-T " + str(nested_dict["num_topics"]) + " " + \
+            "-f " + str(nested_dict["frequency"]) + " " + \
+            "-i " + str(nested_dict["iterations"]) + \
+            opts + \
+            (" -en " + self.exp_name if self.exp_name else "") + " " + \
+            "> " + self.log_prefix + nested_dict["id"] + ".out 2>&1 &\n"
           f.write (cmdline)
 
       # Do similar things with subscribers. Here I am suggesting that we pass
@@ -306,29 +463,32 @@ class ExperimentGenerator ():
         host = "h" + str (i+1)
         host_list = self.sub_dict[host]
         for nested_dict in host_list:
-          # generate intested in topics in the range of 5 to 9 because
-          # our topic helper currently has 9 topics in it.
-          num_topics = random.randint (5, 9)
-
           # build the command line
-          cmdline = host + " python3 SubscriberAppln.py " + \
+          cmdline = ("" if local else host + " ") + "python3 SubscriberAppln.py " + \
             "-n " + nested_dict["id"]  + " " + \
             "-P " + str(self.num_pub) + " " + \
             "-S " + str(self.num_sub) + " " + \
-            "-j " + self.json_file + " " + \
-            "-T " + str(num_topics) + " " + \
-            "> " + nested_dict["id"] + ".out 2>&1 &\n"
+            "-j " + json_file + " " + \
+            "-T " + str(nested_dict["num_topics"]) + \
+            opts + " " + \
+            "> " + self.log_prefix + nested_dict["id"] + ".out 2>&1 &\n"
           f.write (cmdline)
 
-      
+      # the shell running the local script waits for its entities
+      if local:
+        f.write ("wait\n")
+
     f.close ()
           
   #######################
   # Generate the JSONified DB of DHT nodes
   #
+  # With local, the nodes are on 127.0.0.1 at their local ports. The hash values
+  # stay those of the Mininet names so both rings look the same.
+  #
   # Change/extend this code to suit your needs
   #######################
-  def jsonify_dht_db (self):
+  def jsonify_dht_db (self, json_file, local=False):
     self.logger.debug ("ExperimentGenerator::jsonify_dht_db")
 
     # first get an in-memory representation of our DHT DB, which is a
@@ -339,12 +499,18 @@ class ExperimentGenerator ():
       host = "h" + str (i+1)
       host_list = self.disc_dict[host]
       for nested_dict in host_list:
-        dht_db["dht"].append ({"id": nested_dict["id"], "hash": nested_dict["hash"], \
-                               "IP": nested_dict["IP"], "port": nested_dict["port"], "host": host})
+        node = {"id": nested_dict["id"], "hash": nested_dict["hash"], \
+                "IP": "127.0.0.1" if local else nested_dict["IP"], \
+                "port": nested_dict["local_port"] if local else nested_dict["port"], \
+                "host": "localhost" if local else host}
+        if "vnodes" in nested_dict:
+          node["capacity"] = nested_dict["capacity"]
+          node["vnodes"] = nested_dict["vnodes"]
+        dht_db["dht"].append (node)
     
     # Here we are going to generate a DB of all the DHT node details and
     # save it as a json file
-    with open (self.json_file, "w") as f:
+    with open (json_file, "w") as f:
       json.dump (dht_db, f)
       
     f.close ()
@@ -362,29 +528,35 @@ class ExperimentGenerator ():
     # First, seed the random number generator
     random.seed ()  
 
-    # Now generate the entries for our discovery dht nodes
-    self.populate_dict ("disc", self.num_disc_dht)
-
-    # Now generate the entries for our publishers
-    self.populate_dict ("pub", self.num_pub)
-
-    # Now generate the entries for our subscribers
-    self.populate_dict ("sub", self.num_sub)
+    # Generate the entities of each type, place them on the hosts and then
+    # make the entries for our discovery dht nodes, publishers and subscribers
+    for prefix, num in (("disc", self.num_disc_dht), ("pub", self.num_pub), ("sub", self.num_sub)):
+      entities = self.gen_entities (prefix, num)
+      for entity, host_num in zip (entities, self.place (entities)):
+        self.populate_dict (entity, host_num)
 
     self.dump ()
 
+    # How evenly is the hash space spread over the discovery nodes
+    self.report_key_shares ()
+
     # Now JSONify the DHT DB
-    self.jsonify_dht_db ()
+    self.jsonify_dht_db (self.json_file)
     
     # Now generate experiment script
-    self.gen_exp_script ()
+    self.gen_exp_script (self.script_file, self.json_file)
+
+    # and the same experiment on this machine
+    if self.local_script_file:
+      self.jsonify_dht_db (self.local_json_file, local=True)
+      self.gen_exp_script (self.local_script_file, self.local_json_file, local=True)
       
 ###################################
 #
 # Parse command line arguments
 #
 ###################################
-def parseCmdLineArgs ():
+def parseCmdLineArgs (defaults={}):
   # instantiate a ArgumentParser object
   parser = argparse.ArgumentParser (description="HashCollisionTest")
   
@@ -392,6 +564,10 @@ def parseCmdLineArgs ():
   #
   parser.add_argument ("-b", "--bits_hash", type=int, choices=[8,16,24,32,40,48,56,64], default=48, help="Number of bits of hash value to test for collision: allowable values between 6 and 64 in increments of 8 bytes, default 48")
 
+  parser.add_argument ("-V", "--virtual_nodes", type=int, default=1, help="Number of positions on the ring per Discovery DHT instance (virtual nodes), default 1")
+
+  parser.add_argument ("-w", "--weights", default="1", help="Comma separated capacities from which each Discovery DHT instance picks one at random; an instance gets round (capacity * virtual_nodes) positions, default 1")
+
   parser.add_argument ("-D", "--num_disc_dht", type=int, default=20, help="Number of Discovery DHT instances, default 20")
 
   parser.add_argument ("-P", "--num_pub", type=int, default=5, help="number of publishers, default 5")
@@ -408,8 +584,27 @@ def parseCmdLineArgs ():
 
   parser.add_argument ("-j", "--json_file", default="dht.json", help="JSON file with the database of all DHT nodes, default dht.json")
 
+  parser.add_argument ("-m", "--placement", choices=["random", "balanced", "binpack"], default="random", help="How entities are placed on the hosts: random, balanced (least loaded host first) or binpack (fewest hosts of capacity -c), default random")
+
+  parser.add_argument ("-c", "--host_capacity", type=float, default=50, help="Load a host can carry with binpack placement, default 50")
+
+  parser.add_argument ("--local_script", default=None, help="Also write a script running the same experiment on this machine, e.g., localexperiment.sh, default none")
+
+  parser.add_argument ("--local_json", default="dht_local.json", help="JSON file with the database of DHT nodes for the local script, default dht_local.json")
+
+  parser.add_argument ("-z", "--zookeeper", default=None, help="addr:port of ZooKeeper passed to every entity, default none")
+
+  parser.add_argument ("-e", "--exp_name", default=None, help="Experiment name passed to the publishers, default none")
+
+  parser.add_argument ("-i", "--iters", type=int, default=None, help="Iterations of every publisher, default a random choice of 1000, 2000 or 3000")
+
+  parser.add_argument ("--log_prefix", default="", help="Prefix of the output file of every entity, default none")
+
   parser.add_argument ("-l", "--loglevel", type=int, default=logging.DEBUG, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 10=logging.DEBUG")
   
+  # callers such as PA4_EXP/exp_generator.py change the defaults
+  parser.set_defaults (**defaults)
+
   return parser.parse_args()
 
 
@@ -418,7 +613,7 @@ def parseCmdLineArgs ():
 # Main program
 #
 ###################################
-def main ():
+def main (**defaults):
   try:
     # obtain a system wide logger and initialize it to debug level to begin with
     logging.info ("Main - acquire a child logger and then log messages in the child")
@@ -426,7 +621,7 @@ def main ():
     
     # first parse the arguments
     logger.debug ("Main: parse command line arguments")
-    args = parseCmdLineArgs ()
+    args = parseCmdLineArgs (defaults)
 
     # reset the log level to as specified
     logger.debug ("Main: resetting log level to {}".format (args.loglevel))
@@ -36,6 +36,7 @@ import time   # for sleep
 import argparse # for argument parsing
 import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
+from CS6381_MW.AsyncLogging import setup_logging # logs written by a listener thread
 
 # Import our topic selector. Feel free to use alternate way to
 # get your topics of interest
@@ -45,13 +46,14 @@ from topic_selector import TopicSelector
 from CS6381_MW.DiscoveryMW import DiscoveryMW
 # We also need the message formats to handle incoming responses.
 from CS6381_MW import discovery_pb2
+from CS6381_MW.TopicRebalancer import TopicRebalancer
 
 # import any other packages you need.
 from enum import Enum  # for an enumeration we are using to describe what state we are in
 
 # Objects to interact with Zookeeper
-from kazoo.client import KazooClient
-from kazoo.exceptions import NodeExistsError
+from CS6381_MW.InMemoryZooKeeper import zookeeper_client # kazoo client, or the in-memory stand-in for inmemory:// addresses
+from kazoo.exceptions import NodeExistsError, NoNodeError, BadVersionError
 import json
 
 
@@ -83,6 +85,7 @@ class DiscoveryAppln ():
     self.logger = logger  # internal logger for print statements
     self.expected_pub_num = 0    # number of publishers in the system
     self.expected_sub_num = 0    # number of subscribers in the system
+    self.expected_broker_num = 0 # number of brokers in the system, 0 for any one
     self.timeout = None
 
     self.registered_publishers = set() # set of strings, where each string is id of a publisher
@@ -94,6 +97,17 @@ class DiscoveryAppln ():
     self.registered_brokers = set() # set of strings, where each string is ip:port of a broker
     self.broker_id_to_ipport_mapping = {}
 
+    # DHT-related variables
+    self.dht_records = {} # "role:id" -> registration stored on this node, handed over when the ring changes
+    self.dht_replicas = {} # "role:id" -> copy of a registration owned by one of our predecessors
+    self.dht_maintenance = False # Dynamic membership (join/leave, stabilization) or the Static ring of the dht file
+    self.dht_stabilize_interval = 1.0 # seconds between rounds of ring maintenance
+    self.dht_fingers_per_round = 1 # number of fingers refreshed in each round
+    self.dht_successor_list_size = 3 # number of successors we keep track of
+    self.dht_failure_timeout = 3.0 # seconds without a response after which a node is considered failed
+    self.dht_replication_factor = 0 # number of successors holding a copy of each registration
+    self.dht_virtual_nodes = 1 # positions on the ring per node (scaled by the capacity of the node in the dht file)
+
     # Zookeeper-related variables
     self.zk_client = None
     self.zk_am_leader = False
@@ -106,6 +120,15 @@ class DiscoveryAppln ():
     }
     self.port = None
 
+    # Topic rebalancing variables
+    self.rebalance = False # with the Adaptive strategy the leader moves topics between broker groups
+    self.rebalancer = None
+    self.rebalance_interval = 30.0 # minimum seconds between two changes of the mapping
+    self.topic_mapping_version = None # version of /rebalance/mapping we last saw
+    self.broker_load_reports = {} # group -> {topic: {'msgs': per sec, 'bytes': per sec}}
+    self.watched_load_groups = set()
+    self.last_rebalance_time = 0
+
 
   ########################################
   # configure/initialize
@@ -127,16 +150,37 @@ class DiscoveryAppln ():
       self.dissemination = config["Dissemination"]["Strategy"]
       self.timeout = args.timeout * 1000 # timeout for receiving data when subscribed in ms
 
+      # DHT ring maintenance. Without a [DHT] section the ring is the static one from the dht file
+      if config.has_section ("DHT"):
+        self.dht_maintenance = (config["DHT"].get ("Maintenance", "Static") == "Dynamic")
+        self.dht_stabilize_interval = config["DHT"].getfloat ("StabilizeInterval", self.dht_stabilize_interval)
+        self.dht_fingers_per_round = config["DHT"].getint ("FingersPerRound", self.dht_fingers_per_round)
+        self.dht_successor_list_size = config["DHT"].getint ("SuccessorListSize", self.dht_successor_list_size)
+        self.dht_failure_timeout = config["DHT"].getfloat ("FailureTimeout", self.dht_failure_timeout)
+        self.dht_replication_factor = config["DHT"].getint ("ReplicationFactor", self.dht_replication_factor)
+        self.dht_virtual_nodes = config["DHT"].getint ("VirtualNodes", self.dht_virtual_nodes)
+        # ring walks skip to the (k+1)-th successor, so we need to know that many
+        self.dht_successor_list_size = max (self.dht_successor_list_size, self.dht_replication_factor + 1)
+
       self.group_to_topics_mapping = {
         'group1': config['GroupToTopicMapping']['group1'].split(','),
         'group2': config['GroupToTopicMapping']['group2'].split(','),
         'group3': config['GroupToTopicMapping']['group3'].split(',')
       }
+
+      # Load-adaptive topic to broker group mapping. Without a [Rebalance] section the mapping above is used as is
+      if config.has_section ("Rebalance"):
+        self.rebalance = (config["Rebalance"].get ("Strategy", "Static") == "Adaptive")
+        self.rebalance_interval = config["Rebalance"].getfloat ("RebalanceInterval", self.rebalance_interval)
+        self.rebalancer = TopicRebalancer (threshold=config["Rebalance"].getfloat ("ImbalanceThreshold", 1.25),
+                                           min_improvement=config["Rebalance"].getfloat ("MinImprovement", 0.1),
+                                           byte_weight=config["Rebalance"].getfloat ("ByteWeight", 1.0))
       
 
       self.name = args.name
       self.expected_pub_num = args.publishers    # number of publishers in the system
       self.expected_sub_num = args.subscribers    # number of subscribers in the system
+      self.expected_broker_num = args.brokers    # number of brokers in the system
 
       # Now setup up our underlying middleware object to which we delegate
       # everything
@@ -160,18 +204,19 @@ class DiscoveryAppln ():
       # if Zookeeper lookup is used, create /discovery/leader node
       if (self.lookup == 'ZooKeeper'):
         self.zookeeper_addr = args.zookeeper
-        self.zk_client = KazooClient(hosts=self.zookeeper_addr)
+        self.zk_client = zookeeper_client(self.zookeeper_addr)
         self.zk_client.start()
 
         # Conduct the election of a leader
         self.zk_am_leader = self.register_discovery_with_zookeeper()
         
+        # The watches below run in the threads of kazoo. They only hand the
+        # event over to the event loop of the middleware (see handle_zk_event)
+
         # Start a children watch on /discovery
         @self.zk_client.ChildrenWatch('/discovery')
         def watch_discovery_children(children):
-          if(len(children) == 0):
-            # if we get triggered, this means a discovery node has died, so we need to elect a new discovery leader and subscribe to it if we are not the leader
-            self.zk_am_leader = self.register_discovery_with_zookeeper()
+          self.mw_obj.post_zk_event('discovery', children)
           return
         
         # After selecting a leader, subscribe to /pubs, /brokers nodes with child watch
@@ -180,7 +225,7 @@ class DiscoveryAppln ():
         self.zk_client.ensure_path(pubs_path)
         @self.zk_client.ChildrenWatch(pubs_path)
         def watch_pubs_children(children):
-          self.process_pubs_child_trigger(children)
+          self.mw_obj.post_zk_event('pubs', children)
 
         # If using Broker dissemination, set up a watch for broker leader too
         if(self.dissemination == 'Broker'):
@@ -188,7 +233,10 @@ class DiscoveryAppln ():
           self.zk_client.ensure_path(brokers_path)
           @self.zk_client.ChildrenWatch(brokers_path)
           def watch_brokers_children(children):
-            self.process_brokers_child_trigger(children)
+            self.fetch_broker_leaders(children)
+
+          if(self.rebalance):
+            self.set_up_topic_rebalancing()
 
 
       self.logger.debug ("DiscoveryAppln::configure - configuration complete")
@@ -236,6 +284,71 @@ class DiscoveryAppln ():
       return False
       
 
+  ########################################
+  # handle_zk_event
+  #
+  # Upcall from the event loop of the middleware with the latest event of
+  # each kind that the ZooKeeper watches posted since the last upcall
+  ########################################
+  def handle_zk_event(self, kind, payload):
+    if(kind == 'discovery'):
+      if(len(payload) == 0):
+        # if we get triggered, this means a discovery node has died, so we need to elect a new discovery leader and subscribe to it if we are not the leader
+        self.zk_am_leader = self.register_discovery_with_zookeeper()
+
+    elif(kind == 'pubs'):
+      self.process_pubs_child_trigger(payload)
+
+    elif(kind == 'brokers'):
+      self.process_brokers_child_trigger(payload)
+
+    elif(kind == 'mapping'):
+      self.group_to_topics_mapping = payload['groups']
+      self.topic_mapping_version = payload['version']
+      self.logger.info(f"Topic mapping version {payload['version']}: {self.group_to_topics_mapping}")
+
+    elif(kind.startswith('load:')):
+      group = kind[len('load:'):]
+      if(payload == None):
+        self.broker_load_reports.pop(group, None)
+      else:
+        self.broker_load_reports[group] = payload
+        self.rebalance_topics_if_due()
+
+    return
+
+
+  ########################################
+  # fetch_broker_leaders
+  #
+  # Runs in the watch thread of kazoo. Reads the data of all the group
+  # leaders in parallel and posts them as one event once all reads are done
+  ########################################
+  def fetch_broker_leaders(self, children):
+    generation = self.mw_obj.new_zk_event_generation('brokers')
+    if(len(children) == 0):
+      self.mw_obj.post_zk_event('brokers', {}, generation)
+      return
+
+    # the completions all run in the completion thread of kazoo, one after the other
+    leaders = {}
+    done = []
+    def leader_fetched(group, async_result):
+      try:
+        data_bytes, _ = async_result.get()
+        leaders[group] = json.loads(data_bytes.decode('utf-8'))
+      except NoNodeError:
+        # gone already, the next watch event tells us
+        pass
+      done.append(group)
+      if(len(done) == len(children)):
+        self.mw_obj.post_zk_event('brokers', leaders, generation)
+
+    for child in children:
+      self.zk_client.get_async('/brokers/' + child).rawlink(lambda async_result, group=child: leader_fetched(group, async_result))
+    return
+
+
   ########################################
   # process_pubs_child_trigger
   #
@@ -260,19 +373,21 @@ class DiscoveryAppln ():
     # registered_publishers now contains the publishers that died
     # notify subscribers and brokers of the nodes they need to unsubscribe from
     self.logger.info(f'Died publishers: {registered_publishers}')
+    if(len(registered_publishers) == 0):
+      return
 
+    unsub_updates = []
     for died_publisher_name in registered_publishers:
       ipport = self.publisher_id_to_ipport_mapping[died_publisher_name]
       beginning_of_port = (ipport.find(':') + 1)
       ip = ipport[:(beginning_of_port-1)]
       port = ipport[beginning_of_port:]
 
-      # Send an update to subscribers and brokers about the publisher that died
-      unsub_update = {
+      # Tell subscribers and brokers about the publisher that died
+      unsub_updates.append({
         'addr': ip,
         'port': port
-      }
-      self.mw_obj.publish_unsub_update(unsub_update)
+      })
 
       # Remove the publisher from state
       self.registered_publishers.remove(died_publisher_name)
@@ -283,7 +398,8 @@ class DiscoveryAppln ():
     
     self.logger.info(f'New State: reg_pubs:{self.registered_publishers}, pub_ipport:{self.publisher_id_to_ipport_mapping}, topic_pubid:{self.topic_to_publishers_id_mapping}')
 
-    # Send an updated state to discovery replicas
+    # One message for all the publishers that died, then the updated state to discovery replicas
+    self.mw_obj.publish_unsub_updates(unsub_updates)
     self.mw_obj.publish_discovery_update()
 
     return
@@ -293,9 +409,10 @@ class DiscoveryAppln ():
   # process_brokers_child_trigger
   #
   # Function that is called whenever the 
-  # children of /brokers node change
+  # children of /brokers node change, with the
+  # data of the leader of every group
   ########################################
-  def process_brokers_child_trigger(self, current_children):
+  def process_brokers_child_trigger(self, current_leaders):
     new_broker_leaders = {
       'group1': None,
       'group2': None,
@@ -303,32 +420,127 @@ class DiscoveryAppln ():
     }
 
     # Each child is a leader within a group
-    for child in current_children:
-      # Get the info of the leader in the group
-      # Get data from the node
-      data_bytes, _ = self.zk_client.get('/brokers/' + child)
-      data_dict = json.loads(data_bytes.decode('utf-8'))
+    for brokers_group, data_dict in current_leaders.items():
       self.logger.info(f'Current broker leader: {data_dict}')
-
-      brokers_group = child
       new_broker_leaders[brokers_group] = data_dict
 
-    # Check if any of the leaders have changed, send appropriate sub and unsub notifications
-    self.check_if_group_leader_changed_and_send_notif('group1', new_broker_leaders)
-    self.check_if_group_leader_changed_and_send_notif('group2', new_broker_leaders)
-    self.check_if_group_leader_changed_and_send_notif('group3', new_broker_leaders)
+    # Check if any of the leaders have changed, collect the sub and unsub notifications
+    sub_updates = []
+    unsub_updates = []
+    for group_name in new_broker_leaders:
+      self.check_if_group_leader_changed_and_send_notif(group_name, new_broker_leaders, sub_updates, unsub_updates)
 
     # Update the state of broker leaders
     self.broker_leaders = new_broker_leaders
+
+    # Send all the changes at once
+    self.mw_obj.publish_unsub_updates(unsub_updates)
+    self.mw_obj.publish_sub_updates(sub_updates)
+    if(len(unsub_updates) > 0):
+      self.mw_obj.publish_discovery_update()
     
 
+  ########################################
+  # set_up_topic_rebalancing
+  #
+  # The topic to group mapping lives in /rebalance/mapping (the one from
+  # config.ini until the first rebalancing) and the brokers report their
+  # load per topic in /rebalance/load/<group>. Every discovery node follows
+  # both, only the leader changes the mapping. Like the other watches, these
+  # only post events, the event loop applies them (handle_zk_event)
+  ########################################
+  def set_up_topic_rebalancing(self):
+    # give the brokers time to report before the first rebalancing
+    self.last_rebalance_time = time.time()
+
+    mapping = {'version': 0, 'groups': self.group_to_topics_mapping}
+    try:
+      self.zk_client.create('/rebalance/mapping', value=json.dumps(mapping).encode('utf-8'), makepath=True)
+    except NodeExistsError:
+      # published by an earlier leader, possibly already rebalanced
+      pass
+
+    @self.zk_client.DataWatch('/rebalance/mapping')
+    def watch_topic_mapping(data, stat):
+      if(data != None):
+        self.mw_obj.post_zk_event('mapping', {'groups': json.loads(data.decode('utf-8'))['groups'], 'version': stat.version})
+      return
+
+    self.zk_client.ensure_path('/rebalance/load')
+    @self.zk_client.ChildrenWatch('/rebalance/load')
+    def watch_load_children(children):
+      # one data watch per group, it keeps watching after the node goes away.
+      # watched_load_groups is only touched by this watch
+      for group in children:
+        if(group not in self.watched_load_groups):
+          self.watched_load_groups.add(group)
+          self.set_up_watch_for_broker_load(group)
+      return
+
+    return
+
+
+  ########################################
+  # set_up_watch_for_broker_load
+  ########################################
+  def set_up_watch_for_broker_load(self, group):
+    @self.zk_client.DataWatch('/rebalance/load/' + group)
+    def watch_broker_load(data, stat):
+      self.mw_obj.post_zk_event('load:' + group, None if data == None else json.loads(data.decode('utf-8')))
+      return
+
+
+  ########################################
+  # rebalance_topics_if_due
+  #
+  # Called from the event loop on every load report. The leader computes a
+  # new mapping (see TopicRebalancer for the hysteresis) at most once per
+  # RebalanceInterval. The write does not block the event loop, the new
+  # mapping comes back through the watch on /rebalance/mapping
+  ########################################
+  def rebalance_topics_if_due(self):
+    if(not self.zk_am_leader or time.time() - self.last_rebalance_time < self.rebalance_interval):
+      return
+
+    # the mapping we change has not come through the watch yet
+    if(self.topic_mapping_version == None):
+      return
+
+    # A group without a broker reports no load, moving topics there would leave them unserved
+    if(set(self.broker_load_reports) != set(self.group_to_topics_mapping)):
+      return
+
+    new_mapping = self.rebalancer.rebalance(self.group_to_topics_mapping, self.broker_load_reports)
+    if(new_mapping == None):
+      return
+
+    moved = self.rebalancer.moved_topics(self.group_to_topics_mapping, new_mapping)
+    mapping = {'version': self.topic_mapping_version + 1, 'groups': new_mapping}
+
+    # an attempt counts as a rebalancing, so no second write goes out while this one is in flight
+    self.last_rebalance_time = time.time()
+
+    # runs in the completion thread of kazoo, it only logs
+    def mapping_written(async_result):
+      try:
+        async_result.get()
+        self.logger.info(f'DiscoveryAppln::rebalance_topics_if_due - moved topics {moved}, new mapping {new_mapping}')
+      except BadVersionError:
+        self.logger.info('DiscoveryAppln::rebalance_topics_if_due - the mapping changed in the meantime, not rebalanced')
+
+    # only if nobody changed it in the meantime
+    self.zk_client.set_async('/rebalance/mapping', json.dumps(mapping).encode('utf-8'), version=self.topic_mapping_version).rawlink(mapping_written)
+    return
+
+
   ########################################
   # check_if_group_leader_changed_and_send_notif
   # Also removes brokers from the local state if necessary
+  # The notifications go to sub_updates and unsub_updates
   ########################################
-  def check_if_group_leader_changed_and_send_notif(self, group_name, new_broker_leaders):
+  def check_if_group_leader_changed_and_send_notif(self, group_name, new_broker_leaders, sub_updates, unsub_updates):
     # Check if group_name leader changed
-    if(self.broker_leaders[group_name]==None):
+    if(self.broker_leaders.get(group_name)==None):
       if(new_broker_leaders[group_name] != None):
         # There was no broker, now there is one
         # Issue a sub update
@@ -336,9 +548,9 @@ class DiscoveryAppln ():
           'update_type': 'broker',
           'addr': new_broker_leaders[group_name]['addr'],
           'port': new_broker_leaders[group_name]['port'],
-          'topics': self.group_to_topics_mapping[group_name]
+          'topics': self.group_to_topics_mapping.get(group_name, [])
         }
-        self.mw_obj.publish_sub_update(sub_update)
+        sub_updates.append(sub_update)
 
     else:
       # There was a broker
@@ -352,12 +564,12 @@ class DiscoveryAppln ():
           'addr': self.broker_leaders[group_name]['addr'],
           'port': self.broker_leaders[group_name]['port']
         }
-        self.mw_obj.publish_unsub_update(unsub_update)
+        unsub_updates.append(unsub_update)
 
         # Remove from local state
         old_broker_name = self.broker_leaders[group_name]['name']
-        self.registered_brokers.remove(old_broker_name)
-        del self.broker_id_to_ipport_mapping[old_broker_name]
+        self.registered_brokers.discard(old_broker_name)
+        self.broker_id_to_ipport_mapping.pop(old_broker_name, None)
       
       else:
         # There was a broker and there is one right now
@@ -369,21 +581,21 @@ class DiscoveryAppln ():
             'addr': self.broker_leaders[group_name]['addr'],
             'port': self.broker_leaders[group_name]['port']
           }
-          self.mw_obj.publish_unsub_update(unsub_update)
+          unsub_updates.append(unsub_update)
 
           # Remove from local state
           old_broker_name = self.broker_leaders[group_name]['name']
-          self.registered_brokers.remove(old_broker_name)
-          del self.broker_id_to_ipport_mapping[old_broker_name]
+          self.registered_brokers.discard(old_broker_name)
+          self.broker_id_to_ipport_mapping.pop(old_broker_name, None)
           
           # Send a sub update for a new broker
           sub_update = {
             'update_type': 'broker',
             'addr': new_broker_leaders[group_name]['addr'],
             'port': new_broker_leaders[group_name]['port'],
-            'topics': self.group_to_topics_mapping[group_name]
+            'topics': self.group_to_topics_mapping.get(group_name, [])
           }
-          self.mw_obj.publish_sub_update(sub_update)
+          sub_updates.append(sub_update)
 
         else:
           # Same broker as before, don't do anything
@@ -421,7 +633,11 @@ class DiscoveryAppln ():
       # None or some large value, but if we want to send a request ourselves right away,
       # we set timeout is zero.
       #
-      self.mw_obj.event_loop (timeout=None)  # start the event loop
+      try:
+        self.mw_obj.event_loop (timeout=None)  # start the event loop
+      except KeyboardInterrupt:
+        # Ctrl-C, leave gracefully (with Dynamic DHT maintenance our records go to our successor)
+        self.stop_appln ()
       
       self.logger.debug ("DiscoveryAppln::driver completed")
       
@@ -466,6 +682,7 @@ class DiscoveryAppln ():
           
           # respond to the service that made the request
           self.mw_obj.respond_to_register_request(framesRcvd, True, "", timestamp_sent)
+          self.remember_dht_record(register_req)
 
           # Notify subscribers and brokers of a new publisher
           if (self.lookup == 'ZooKeeper'):
@@ -491,6 +708,7 @@ class DiscoveryAppln ():
           # Add subscriber to the list of subscribers
           self.registered_subscribers.add(registrant_id)
           self.mw_obj.respond_to_register_request(framesRcvd, True, "", timestamp_sent)
+          self.remember_dht_record(register_req)
 
       elif (register_req.role == discovery_pb2.ROLE_BOTH): 
         # BROKER sent a request to register
@@ -505,6 +723,7 @@ class DiscoveryAppln ():
           self.registered_brokers.add(registrant_id)
           self.broker_id_to_ipport_mapping[registrant_id] = ip_port_pair
           self.mw_obj.respond_to_register_request(framesRcvd, True, "", timestamp_sent)
+          self.remember_dht_record(register_req)
 
       else:
         # Request with unknown role has been received, abort
@@ -544,7 +763,7 @@ class DiscoveryAppln ():
         areSubscribersReady = (self.expected_sub_num == len(registered_subs_set))
         arePublishersReady = (self.expected_pub_num == len(registered_pubs_set))
 
-        areBrokersReady = (self.dissemination != 'Broker' or (self.dissemination == 'Broker' and len(registered_brokers_set) != 0))
+        areBrokersReady = (self.dissemination != 'Broker' or (self.dissemination == 'Broker' and len(registered_brokers_set) >= max(self.expected_broker_num, 1)))
 
         self.logger.debug("areBrokersReady = %s", str(areBrokersReady))
 
@@ -574,6 +793,11 @@ class DiscoveryAppln ():
         # Add registered publishers
         registered_brokers_set.update(self.registered_brokers)
 
+        # Add the registrations we hold copies of (the next node we go to skips the nodes that own them)
+        registered_pubs_set.update(self.dht_replica_ids(discovery_pb2.ROLE_PUBLISHER))
+        registered_subs_set.update(self.dht_replica_ids(discovery_pb2.ROLE_SUBSCRIBER))
+        registered_brokers_set.update(self.dht_replica_ids(discovery_pb2.ROLE_BOTH))
+
         # Send the is_ready request to the next node
         self.mw_obj.forward_isready_request_further(visited_nodes_set, registered_pubs_set, registered_subs_set, registered_brokers_set, framesRcvd, timestamp_sent)
 
@@ -587,7 +811,7 @@ class DiscoveryAppln ():
       areSubscribersReady = self.expected_sub_num == len(self.registered_subscribers)
       arePublishersReady = self.expected_pub_num == len(self.registered_publishers)
 
-      areBrokersReady = (self.dissemination != 'Broker' or (self.dissemination == 'Broker' and len(self.registered_brokers) != 0))
+      areBrokersReady = (self.dissemination != 'Broker' or (self.dissemination == 'Broker' and len(self.registered_brokers) >= max(self.expected_broker_num, 1)))
 
       self.logger.debug("areBrokersReady = %s", str(areBrokersReady))
 
@@ -655,6 +879,16 @@ class DiscoveryAppln ():
         self.mw_obj.respond_to_lookup_request(socketsToConnectTo, all, framesRcvd, timestamp_sent)
       
       elif (self.lookup == 'DHT'):
+        # Answer for the registrations we hold copies of as well
+        wants_brokers = (self.dissemination == 'Broker' and not all and lookup_req.requester != 'Broker')
+        for record in self.dht_replicas.values():
+          ip_port_pair = record['addr'] + ":" + str(record['port'])
+          if wants_brokers and record['role'] == discovery_pb2.ROLE_BOTH:
+            socketsToConnectTo.add(ip_port_pair)
+          elif (not wants_brokers) and record['role'] == discovery_pb2.ROLE_PUBLISHER:
+            if all or set(record['topiclist']) & set(lookup_req.topiclist):
+              socketsToConnectTo.add(ip_port_pair)
+
         # check if we visited all nodes
         visited_nodes_set = set(lookup_req.visited_nodes)
         already_added_sockets = set(lookup_req.sockets_to_connect_to)
@@ -666,7 +900,7 @@ class DiscoveryAppln ():
         else:
           # Haven't done the full circle, forward the request to the next node
           visited_nodes_set.add(self.name)
-          self.mw_obj.forward_lookup_request_further(visited_nodes_set, already_added_sockets, lookup_req.topiclist, all, framesRcvd, timestamp_sent)
+          self.mw_obj.forward_lookup_request_further(visited_nodes_set, already_added_sockets, lookup_req.topiclist, all, framesRcvd, timestamp_sent, lookup_req.requester)
       
       return None
 
@@ -688,8 +922,157 @@ class DiscoveryAppln ():
 
 
 
+  ########################################
+  # remember_dht_record
+  #
+  # Keep the registration together with its hash so that it can
+  # be handed over to another node when the ring changes
+  ########################################
+  def remember_dht_record(self, register_req):
+    if (self.lookup != 'DHT'):
+      return
+
+    record = {
+      'hash': self.mw_obj.compute_hash_for_registring_entity(register_req),
+      'role': register_req.role,
+      'id': register_req.info.id,
+      'addr': register_req.info.addr,
+      'port': register_req.info.port,
+      'topiclist': list(register_req.topiclist)
+    }
+    self.dht_records[str(record['role']) + ":" + record['id']] = record
+
+    # keep copies on our k successors
+    self.mw_obj.replicate_dht_records([record])
+
+  ########################################
+  # owned_dht_records
+  ########################################
+  def owned_dht_records(self):
+    return list(self.dht_records.values())
+
+  ########################################
+  # hand_off_dht_records
+  #
+  # Remove and return the records whose hash is not in (keep_from, keep_to]
+  # anymore. With keep_from=None all records are handed off (we are leaving).
+  ########################################
+  def hand_off_dht_records(self, keep_from, keep_to):
+    records = []
+    for key, record in list(self.dht_records.items()):
+      if keep_from is not None:
+        if record['hash'] == keep_to or self.mw_obj.in_open_interval(record['hash'], keep_from, keep_to):
+          continue
+
+      del self.dht_records[key]
+      records.append(record)
+
+      # The new owner is our predecessor, so we are one of its replicas
+      if keep_from is not None and self.dht_replication_factor > 0:
+        self.dht_replicas[key] = record
+
+      registrant_id = record['id']
+      if (record['role'] == discovery_pb2.ROLE_PUBLISHER):
+        self.registered_publishers.discard(registrant_id)
+        self.publisher_id_to_ipport_mapping.pop(registrant_id, None)
+        for topic in record['topiclist']:
+          pub_ids = self.topic_to_publishers_id_mapping.get(topic, [])
+          if registrant_id in pub_ids:
+            pub_ids.remove(registrant_id)
+          if not pub_ids:
+            self.topic_to_publishers_id_mapping.pop(topic, None)
+      elif (record['role'] == discovery_pb2.ROLE_SUBSCRIBER):
+        self.registered_subscribers.discard(registrant_id)
+      elif (record['role'] == discovery_pb2.ROLE_BOTH):
+        self.registered_brokers.discard(registrant_id)
+        self.broker_id_to_ipport_mapping.pop(registrant_id, None)
+
+    return records
+
+  ########################################
+  # take_over_dht_records
+  #
+  # Become responsible for records handed over by another node
+  ########################################
+  def take_over_dht_records(self, records):
+    self.logger.info (f"DiscoveryAppln::take_over_dht_records - taking over {len(records)} records")
+    for record in records:
+      registrant_id = record['id']
+      ip_port_pair = record['addr'] + ":" + str(record['port'])
+      key = str(record['role']) + ":" + registrant_id
+      self.dht_records[key] = record
+      self.dht_replicas.pop(key, None)
+
+      if (record['role'] == discovery_pb2.ROLE_PUBLISHER):
+        if registrant_id not in self.registered_publishers:
+          self.registered_publishers.add(registrant_id)
+          for topic in record['topiclist']:
+            self.topic_to_publishers_id_mapping.setdefault(topic, []).append(registrant_id)
+        self.publisher_id_to_ipport_mapping[registrant_id] = ip_port_pair
+      elif (record['role'] == discovery_pb2.ROLE_SUBSCRIBER):
+        self.registered_subscribers.add(registrant_id)
+      elif (record['role'] == discovery_pb2.ROLE_BOTH):
+        self.registered_brokers.add(registrant_id)
+        self.broker_id_to_ipport_mapping[registrant_id] = ip_port_pair
+
+    # we are the owner now, so our successors need the copies
+    self.mw_obj.replicate_dht_records(records)
+
+  ########################################
+  # store_dht_replicas
+  #
+  # Keep copies of registrations owned by one of our predecessors
+  ########################################
+  def store_dht_replicas(self, records):
+    for record in records:
+      key = str(record['role']) + ":" + record['id']
+      if key not in self.dht_records:
+        self.dht_replicas[key] = record
+
+  ########################################
+  # promote_dht_replicas
+  #
+  # Become the owner of the replicas whose hash is in (keep_from, keep_to],
+  # i.e., those of a predecessor that failed
+  ########################################
+  def promote_dht_replicas(self, keep_from, keep_to):
+    records = [record for record in self.dht_replicas.values()
+               if record['hash'] == keep_to or self.mw_obj.in_open_interval(record['hash'], keep_from, keep_to)]
+    if records:
+      self.take_over_dht_records(records)
+
+  ########################################
+  # dht_replica_ids
+  #
+  # ids of the replicated registrations with the given role
+  ########################################
+  def dht_replica_ids(self, role):
+    return [record['id'] for record in self.dht_replicas.values() if record['role'] == role]
+
+
+  ########################################
+  # report_dht_load
+  #
+  # Log the share of the hash space we own and the requests we handled
+  ########################################
+  def report_dht_load(self):
+    if (self.lookup != 'DHT'):
+      return
+
+    key_share = self.mw_obj.dht_ring.key_shares().get(self.name)
+    if key_share is not None:
+      self.logger.info ("DiscoveryAppln::report_dht_load - key share: {:.2%} of the hash space ({} tokens)".format (key_share, max(1, len(self.mw_obj.my_tokens))))
+    self.logger.info ("DiscoveryAppln::report_dht_load - records owned: {}, replicas: {}".format (len(self.dht_records), len(self.dht_replicas)))
+    for load_type, count in sorted(self.mw_obj.request_load.items()):
+      self.logger.info ("DiscoveryAppln::report_dht_load - requests {}: {}".format (load_type, count))
+
+
   def stop_appln(self):
     self.logger.info ("PublisherAppln::stop_appln - Stopping the application completed")
+    self.report_dht_load ()
+    if (self.lookup == 'DHT' and self.dht_maintenance):
+      # hand our records over to our successor before going away
+      self.mw_obj.leave_ring ()
     self.mw_obj.disable_event_loop ()
     return None
 
@@ -710,12 +1093,18 @@ class DiscoveryAppln ():
       self.logger.info ("     Dissemination: {}".format (self.dissemination))
       self.logger.info ("     Number of publishers in the system: {}".format (self.expected_pub_num))
       self.logger.info ("     Number of subscribers in the system: {}".format (self.expected_sub_num))
+      self.logger.info ("     Number of brokers in the system: {}".format (self.expected_broker_num))
       
       # print out finger table
       self.logger.info ("     Finger Table:")
       for idx, entry in enumerate(self.mw_obj.finger_table):
         self.logger.info(f"          {idx}: hash {entry.hash}, name {entry.node_info['id']}")
 
+      if (self.lookup == 'DHT'):
+        key_share = self.mw_obj.dht_ring.key_shares().get(self.name)
+        if key_share is not None:
+          self.logger.info ("     Key share: {:.2%}".format (key_share))
+
       self.logger.info ("**********************************")
       
     except Exception as e:
@@ -736,6 +1125,8 @@ def parseCmdLineArgs ():
 
   parser.add_argument("-S", "--subscribers", type=int, default=2, help="Number of subscribers")
 
+  parser.add_argument("-B", "--brokers", type=int, default=0, help="Number of brokers (one per group) with the Broker dissemination, default 0: any one")
+
   parser.add_argument ("-c", "--config", default="config.ini", help="configuration file (default: config.ini)")
 
   parser.add_argument ("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
@@ -760,8 +1151,17 @@ def parseCmdLineArgs ():
   # address of Zookeeper
   parser.add_argument("-z", "--zookeeper", default='localhost:2181', help="Address of the Zookeeper instance")
 
+  # existing DHT node used to join the ring when this node is not in the dht file
+  parser.add_argument("-b", "--bootstrap", default=None, help="addr:port of a DHT node to join the ring through (Dynamic DHT maintenance only). Default: a random node from the dht file")
+
   
 
+  parser.add_argument ("--metrics_port", type=int, default=0, help="Serve the event loop metrics in the Prometheus text format on this port (http://localhost:<port>/metrics), default 0: no metrics")
+
+  parser.add_argument ("--log_json", action="store_true", help="Write the logs as JSON lines, with the fields of every record, default: plain text")
+
+  parser.add_argument ("--log_every", type=int, default=100, help="Log 1 in N of the messages per topic, default 100")
+
   return parser.parse_args()
 
 
@@ -784,6 +1184,7 @@ def main ():
     # reset the log level to as specified
     logger.debug ("Main: resetting log level to {}".format (args.loglevel))
     logger.setLevel (args.loglevel)
+    setup_logging (level=logging.DEBUG, structured=args.log_json)
     logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
 
     # Obtain a Discover application
@@ -814,9 +1215,8 @@ def main ():
 ###################################
 if __name__ == "__main__":
 
-  # set underlying default logging capabilities
-  logging.basicConfig (level=logging.DEBUG,
-                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  # set underlying default logging capabilities, written off the event loop
+  setup_logging (level=logging.DEBUG)
 
 
   main ()
\ No newline at end of file
@@ -0,0 +1,335 @@
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose:
+#
+# Failover benchmark suite on the in-memory ZooKeeper stand-in.
+#
+# Runs the elections of the applications (their own code, no middleware,
+# no discovery) against CS6381_MW/InMemoryZooKeeper.py instead of a live
+# ensemble, so that the numbers only depend on the round trip we inject and
+# can be reproduced anywhere. For every scenario, number of members, round
+# trip and way of killing the leader it kills the leader a few times and
+# measures the time until a new leader takes over and the ZooKeeper requests
+# the surviving members make until things settle down.
+#
+# Scenarios:
+#
+#    publisher       publishers of one topic, ownership strength election
+#                    (PublisherAppln, each publisher watches its predecessor)
+#    publisher-herd  same with the old recipe, every publisher watches all
+#    broker          brokers of one group competing for /brokers/<group>
+#                    (BrokerAppln)
+#
+# Ways of killing the leader:
+#
+#    close   the leader closes its session, e.g., on a clean shutdown
+#    crash   the process of the leader dies, ZooKeeper notices after the
+#            session timeout (-T)
+#
+# Example (5 and 50 members, round trips of 0, 2 and 10 ms):
+#
+#    python3 failover_bench.py -s publisher,publisher-herd,broker -n 5,50 -L 0,2,10 -k both
+
+import os
+import sys
+import time
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+import collections
+
+# we reuse the applications which live in the parent directory
+sys.path.append (os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from CS6381_MW.InMemoryZooKeeper import InMemoryEnsemble, InMemoryKazooClient
+from PublisherAppln import PublisherAppln
+from BrokerAppln import BrokerAppln
+
+from ownership_election_bench import HerdPublisherAppln
+
+
+##################################
+#       FailoverBench class
+##################################
+class FailoverBench ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, logger):
+    self.logger = logger
+    self.scenarios = None    # list of scenarios to run
+    self.member_counts = None # list of number of members to try
+    self.latencies = None    # list of round trips in seconds
+    self.jitter = None       # random extra round trip in seconds
+    self.kills = None        # list of ways to kill the leader
+    self.failovers = None    # leaders killed per run
+    self.session_timeout = None # seconds until ZooKeeper notices a crash
+    self.quiet_period = None # seconds without requests after which a failover is over
+    self.timeout = None      # seconds to wait for a new leader
+    self.seed = None
+    self.app_logger = None   # logger handed to the application objects
+    self.results = []        # one row per run
+
+  ########################################
+  # configure
+  ########################################
+  def configure (self, args):
+    ''' Initialize the object '''
+
+    try:
+      self.logger.info ("FailoverBench::configure")
+
+      self.scenarios = args.scenarios.split (",")
+      self.member_counts = [int (count) for count in args.members.split (",")]
+      self.latencies = [float (latency) / 1000 for latency in args.latencies.split (",")]
+      self.jitter = args.jitter / 1000
+      self.kills = ["close", "crash"] if args.kill == "both" else [args.kill]
+      self.failovers = args.failovers
+      self.session_timeout = args.session_timeout
+      self.quiet_period = args.quiet_period
+      self.timeout = args.timeout
+      self.seed = args.seed
+
+      # the applications log every election change, keep them quiet unless debugging
+      self.app_logger = logging.getLogger ("FailoverBenchApps")
+      self.app_logger.setLevel (logging.DEBUG if args.loglevel == logging.DEBUG else logging.WARNING)
+
+      self.logger.info ("FailoverBench::configure - configuration complete")
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # start a member of the scenario with its own session
+  ########################################
+  def start_member (self, scenario, ensemble, i):
+    zk_client = InMemoryKazooClient (ensemble=ensemble, timeout=self.session_timeout)
+    zk_client.start ()
+
+    if (scenario == "broker"):
+      member = BrokerAppln (self.app_logger)
+      member.name = "broker{}".format (i)
+      member.group = "group1"
+      member.addr = "localhost"
+      member.port = 6000 + i
+      member.zk_client = zk_client
+      member.conduct_broker_leader_election ()
+    else:
+      member = HerdPublisherAppln (self.app_logger) if scenario == "publisher-herd" else PublisherAppln (self.app_logger)
+      member.name = "pub{}".format (i)
+      member.topiclist = ["weather"]
+      member.zk_client = zk_client
+      member.create_zookeeper_nodes ()
+
+    return member
+
+  ########################################
+  # is the member the leader
+  ########################################
+  def is_leader (self, scenario, member):
+    if (scenario == "broker"):
+      return member.zk_am_broker_leader
+    return member.am_leader_for_topic.get ("weather", False)
+
+  ########################################
+  # requests sent by the given members so far
+  ########################################
+  def count_ops (self, members):
+    total = collections.Counter ()
+    for member in members:
+      total.update (member.zk_client.ops)
+    return total
+
+  ########################################
+  # wait until the members stop sending requests
+  ########################################
+  def wait_until_quiet (self, members):
+    last = sum (self.count_ops (members).values ())
+    quiet_since = time.time ()
+    while (time.time () - quiet_since < self.quiet_period):
+      time.sleep (0.001)
+      now = sum (self.count_ops (members).values ())
+      if (now != last):
+        last = now
+        quiet_since = time.time ()
+
+  ########################################
+  # percentile of a sorted list
+  ########################################
+  def percentile (self, values, p):
+    if (len (values) == 0):
+      return 0.0
+    return values[min (len (values) - 1, int (p / 100 * len (values)))]
+
+  ########################################
+  # one run: start the members, kill leaders one after the other
+  ########################################
+  def run (self, scenario, num_members, latency, kill):
+    ''' Kill the leader failovers times, measure the takeovers '''
+
+    try:
+      self.logger.info ("FailoverBench::run - %s, %d members, round trip %.1f ms, %s", scenario, num_members, 1000 * latency, kill)
+
+      ensemble = InMemoryEnsemble (latency=latency, jitter=self.jitter, seed=self.seed)
+      members = [self.start_member (scenario, ensemble, i) for i in range (num_members)]
+      self.wait_until_quiet (members)
+
+      takeovers = []
+      ops_per_failover = []
+      for i in range (min (self.failovers, num_members - 1)):
+        leader = next ((member for member in members if self.is_leader (scenario, member)), None)
+        if (leader == None):
+          raise Exception ("no leader to kill")
+        members.remove (leader)
+
+        before = self.count_ops (members)
+        start = time.time ()
+        if (kill == "crash"):
+          leader.zk_client.crash ()
+        else:
+          leader.zk_client.stop ()
+
+        while (not any (self.is_leader (scenario, member) for member in members)):
+          if (time.time () - start > self.timeout):
+            raise Exception ("no new leader after {} s".format (self.timeout))
+          time.sleep (0.0002)
+        takeovers.append (time.time () - start)
+
+        self.wait_until_quiet (members)
+        ops = self.count_ops (members)
+        ops.subtract (before)
+        ops_per_failover.append (sum (ops.values ()))
+
+      for member in members:
+        member.zk_client.stop ()
+
+      values = sorted (takeovers)
+      self.results.append ({
+        "scenario": scenario,
+        "members": num_members,
+        "latency": 1000 * latency,
+        "kill": kill,
+        "failovers": len (values),
+        "p50": 1000 * self.percentile (values, 50),
+        "p95": 1000 * self.percentile (values, 95),
+        "max": 1000 * (values[-1] if values else 0.0),
+        "ops": sum (ops_per_failover) / max (len (ops_per_failover), 1),
+      })
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # report
+  ########################################
+  def report (self):
+    self.logger.info ("**********************************")
+    self.logger.info ("FailoverBench::report - time until a new leader takes over, session timeout %.2f s", self.session_timeout)
+    self.logger.info ("{:>15} {:>8} {:>8} {:>6} {:>9} {:>10} {:>10} {:>10} {:>9}".format ("scenario", "members", "rtt ms", "kill", "failovers", "p50 ms", "p95 ms", "max ms", "ops/fail"))
+    for row in self.results:
+      self.logger.info ("{:>15} {:>8} {:>8.1f} {:>6} {:>9} {:>10.2f} {:>10.2f} {:>10.2f} {:>9.1f}".format (row["scenario"], row["members"], row["latency"], row["kill"], row["failovers"], row["p50"], row["p95"], row["max"], row["ops"]))
+    self.logger.info ("**********************************")
+
+  ########################################
+  # driver
+  ########################################
+  def driver (self):
+    ''' Driver program '''
+
+    try:
+      self.logger.info ("FailoverBench::driver")
+      for scenario in self.scenarios:
+        for num_members in self.member_counts:
+          for latency in self.latencies:
+            for kill in self.kills:
+              self.run (scenario, num_members, latency, kill)
+      self.report ()
+
+    except Exception as e:
+      raise e
+
+
+###################################
+#
+# Parse command line arguments
+#
+###################################
+def parseCmdLineArgs ():
+  # instantiate a ArgumentParser object
+  parser = argparse.ArgumentParser (description="Failover benchmark suite on the in-memory ZooKeeper")
+
+  parser.add_argument ("-s", "--scenarios", default="publisher,publisher-herd,broker", help="Comma separated scenarios among publisher, publisher-herd and broker, default all")
+
+  parser.add_argument ("-n", "--members", default="5,50", help="Comma separated numbers of members competing for the leadership, default 5,50")
+
+  parser.add_argument ("-L", "--latencies", default="0,2,10", help="Comma separated round trips to ZooKeeper in ms, default 0,2,10")
+
+  parser.add_argument ("-J", "--jitter", type=float, default=0.0, help="Up to this many ms are added to each round trip at random, default 0")
+
+  parser.add_argument ("-k", "--kill", default="close", choices=["close", "crash", "both"], help="How the leader goes away, default close")
+
+  parser.add_argument ("-f", "--failovers", type=int, default=5, help="Leaders killed per run, default 5")
+
+  parser.add_argument ("-T", "--session_timeout", type=float, default=1.0, help="Session timeout in seconds, how long a crash goes unnoticed, default 1.0")
+
+  parser.add_argument ("-q", "--quiet_period", type=float, default=0.1, help="Seconds without requests after which a failover is over, default 0.1")
+
+  parser.add_argument ("-t", "--timeout", type=float, default=10, help="Seconds to wait for a new leader, default 10")
+
+  parser.add_argument ("-S", "--seed", type=int, default=42, help="Random seed of the jitter, default 42")
+
+  parser.add_argument ("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+
+  return parser.parse_args()
+
+
+###################################
+#
+# Main program
+#
+###################################
+def main ():
+  try:
+    # obtain a system wide logger and initialize it to debug level to begin with
+    logging.info ("Main - acquire a child logger and then log messages in the child")
+    logger = logging.getLogger ("FailoverBench")
+
+    # first parse the arguments
+    logger.debug ("Main: parse command line arguments")
+    args = parseCmdLineArgs ()
+
+    # reset the log level to as specified
+    logger.debug ("Main: resetting log level to {}".format (args.loglevel))
+    logger.setLevel (args.loglevel)
+    logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
+
+    # Obtain the benchmark object
+    logger.debug ("Main: obtain the FailoverBench object")
+    bench = FailoverBench (logger)
+
+    # configure the object
+    logger.debug ("Main: configure the FailoverBench object")
+    bench.configure (args)
+
+    # now invoke the driver program
+    logger.debug ("Main: invoke the FailoverBench driver")
+    bench.driver ()
+
+  except Exception as e:
+    logger.error ("Exception caught in main - {}".format (e))
+    return
+
+
+###################################
+#
+# Main entry point
+#
+###################################
+if __name__ == "__main__":
+
+  # set underlying default logging capabilities
+  logging.basicConfig (level=logging.DEBUG,
+                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+  main ()
@@ -0,0 +1,538 @@
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose:
+#
+# Microbenchmarks of the per-message paths of the middleware.
+#
+# Every case calls the real middleware (and application) code on realistic
+# payloads, with real ZMQ sockets over inproc:
+#
+#    publisher.disseminate/h<H>    PublisherMW.disseminate of a history of H publications
+#    subscriber.receive/h<H>       SubscriberMW.handle_bytes_on_sub_socket up to the
+#                                  SubscriberAppln upcall (split, literal_eval, dedupe, metrics)
+#    broker.forward/h<H>           BrokerMW.handle_bytes_on_sub_socket
+#    discovery.register            DiscoveryMW.handle_request of a publisher registration
+#    discovery.isready             DiscoveryMW.handle_request of an is ready request
+#    discovery.lookup/p<P>         DiscoveryMW.handle_request of a lookup, P publishers registered
+#    discovery.respond_register    DiscoveryMW.respond_to_register_request
+#    discovery.respond_isready     DiscoveryMW.respond_to_isready_request
+#    discovery.respond_lookup/p<P> DiscoveryMW.respond_to_lookup_request with P addresses
+#
+# The middleware logs as it does in a deployment (-L, INFO by default) into a
+# handler that drops the records, so formatting is measured and I/O is not.
+#
+# Each case runs -w warmup repetitions and then -r timed repetitions of -n
+# calls each, with the garbage collector off while timing (like timeit). We
+# report the median, minimum and spread of the time per call over the
+# repetitions. -C pins the process to one CPU.
+#
+# --save writes the results to a JSON baseline, --compare reads one and flags
+# every case whose best repetition got slower by more than --threshold; the
+# exit status is then 1, so that the comparison can run as a check. Noise on a
+# busy machine only ever adds time, so the minimum is what we compare, the
+# median shows how much noise there was. A baseline only means something on
+# the machine it was taken on.
+#
+# Example:
+#
+#    python3 hotpath_bench.py -H 1,5 -P 10,100 -C 2 --save hotpath_baseline.json
+#    python3 hotpath_bench.py -H 1,5 -P 10,100 -C 2 --compare hotpath_baseline.json
+
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import statistics
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+import zmq
+
+# we reuse the middleware and applications which live in the parent directory
+sys.path.append (os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.SubscriberMW import SubscriberMW
+from CS6381_MW.BrokerMW import BrokerMW
+from CS6381_MW.DiscoveryMW import DiscoveryMW
+from CS6381_MW.MetricsSink import MetricsSink
+from CS6381_MW import discovery_pb2
+from SubscriberAppln import SubscriberAppln
+from DiscoveryAppln import DiscoveryAppln
+from BrokerAppln import BrokerAppln
+from topic_selector import TopicSelector
+
+
+##################################
+#       HotPathBench class
+##################################
+class HotPathBench ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, logger):
+    self.logger = logger
+    self.history_depths = None # publications per message
+    self.pub_counts = None     # publishers registered with discovery
+    self.number = None         # calls per repetition
+    self.repeat = None         # timed repetitions
+    self.warmup = None         # untimed repetitions
+    self.cases = None          # only the cases starting with one of these, None for all
+    self.save_path = None
+    self.compare_path = None
+    self.threshold = None      # relative slowdown reported as a regression
+    self.mw_logger = None      # logger handed to the middleware
+    self.context = None
+    self.topics = TopicSelector ().interest (9)
+    self.results = {}          # case -> statistics
+
+  ########################################
+  # configure
+  ########################################
+  def configure (self, args):
+    ''' Initialize the object '''
+
+    try:
+      self.logger.info ("HotPathBench::configure")
+
+      self.history_depths = [int (depth) for depth in args.history.split (",")]
+      self.pub_counts = [int (count) for count in args.publishers.split (",")]
+      self.number = args.number
+      self.repeat = args.repeat
+      self.warmup = args.warmup
+      self.cases = args.cases.split (",") if args.cases else None
+      self.save_path = args.save
+      self.compare_path = args.compare
+      self.threshold = args.threshold
+
+      if args.cpu != None:
+        os.sched_setaffinity (0, {args.cpu})
+        self.logger.info ("HotPathBench::configure - pinned to CPU %d", args.cpu)
+
+      # log like a deployment, without the I/O
+      self.mw_logger = logging.getLogger ("HotPathBenchMW")
+      self.mw_logger.setLevel (args.mw_loglevel)
+      self.mw_logger.propagate = False
+      self.mw_logger.addHandler (logging.NullHandler ())
+
+      self.context = zmq.Context ()
+
+      self.logger.info ("HotPathBench::configure - configuration complete")
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # a pair of connected inproc sockets without high water marks
+  ########################################
+  def socket_pair (self, name):
+    reader = self.context.socket (zmq.PAIR)
+    reader.setsockopt (zmq.RCVHWM, 0)
+    reader.bind ("inproc://hotpath-" + name)
+    writer = self.context.socket (zmq.PAIR)
+    writer.setsockopt (zmq.SNDHWM, 0)
+    writer.connect ("inproc://hotpath-" + name)
+    return reader, writer
+
+  ########################################
+  # read whatever is queued on a socket
+  ########################################
+  def drain (self, socket):
+    while socket.poll (0):
+      socket.recv_multipart ()
+
+  ########################################
+  # a publication as built by PublisherAppln.disseminate_round
+  ########################################
+  def publication (self, topic, pubid):
+    return str ({
+      "topic": topic,
+      "data": TopicSelector ().gen_publication (topic),
+      "pubid": pubid,
+      "sent_ns": time.time_ns (),
+      "clock_offset_ns": 0,
+      "clock_error_ns": None,
+      "exp_name": "hotpath"
+    })
+
+  ########################################
+  # a message on the wire: topic:epoch:seq:pubid:<history>
+  ########################################
+  def wire_message (self, topic, seq, depth):
+    history = [self.publication (topic, "pub1") for i in range (depth)]
+    return bytes (topic + ":1:" + str (seq) + ":pub1:" + str (history), "utf-8")
+
+  ########################################
+  # time calls of fn over the repetitions; prepare (untimed) returns its argument
+  ########################################
+  def measure (self, name, prepare, fn, cleanup=None):
+    if self.cases != None and not any (name.startswith (case) for case in self.cases):
+      return
+
+    timings = []
+    for rep in range (self.warmup + self.repeat):
+      arg = prepare ()
+      gc_was_enabled = gc.isenabled ()
+      gc.disable ()
+      try:
+        start = time.perf_counter ()
+        for i in range (self.number):
+          fn (arg)
+        elapsed = time.perf_counter () - start
+      finally:
+        if gc_was_enabled:
+          gc.enable ()
+      if cleanup != None:
+        cleanup ()
+      if rep >= self.warmup:
+        timings.append (elapsed / self.number)
+
+    median = statistics.median (timings)
+    self.results[name] = {
+      "median_us": 1e6 * median,
+      "min_us": 1e6 * min (timings),
+      "stdev_us": 1e6 * (statistics.stdev (timings) if len (timings) > 1 else 0.0),
+      "ops_per_sec": 1 / median,
+      "number": self.number,
+      "repeat": self.repeat,
+    }
+    self.logger.info ("HotPathBench::measure - %-32s %10.2f us", name, 1e6 * median)
+
+  ########################################
+  # PublisherMW.disseminate
+  ########################################
+  def bench_publisher (self, depth):
+    mw = PublisherMW (self.mw_logger)
+    mw.pub = self.context.socket (zmq.PUB) # nobody subscribes, like a publisher whose topic nobody wants yet
+    mw.pub.bind ("inproc://hotpath-pub-{}".format (depth))
+    topic = self.topics[0]
+    history = [self.publication (topic, "pub1") for i in range (depth)]
+    seq = [0]
+
+    def call (arg):
+      seq[0] += 1
+      mw.disseminate ("pub1", topic, history, 1, seq[0])
+
+    self.measure ("publisher.disseminate/h{}".format (depth), lambda: None, call)
+    mw.pub.close ()
+
+  ########################################
+  # SubscriberMW.handle_bytes_on_sub_socket and the upcall
+  ########################################
+  def bench_subscriber (self, depth):
+    appln = SubscriberAppln (self.mw_logger)
+    appln.name = "sub1"
+    appln.freq = 10
+    appln.num_topics = 1
+    appln.pub_num = 1
+    appln.sub_num = 1
+    appln.dissemination = "Direct"
+    appln.timeout = 20000
+    appln.metrics = MetricsSink (self.mw_logger, None) # recording is measured, writing is not
+    topic = self.topics[0]
+    appln.topic_to_history_size_wanted[topic] = depth
+
+    mw = SubscriberMW (self.mw_logger)
+    mw.upcall_obj = appln
+    appln.mw_obj = mw
+    mw.sub, writer = self.socket_pair ("sub-{}".format (depth))
+    seq = [0]
+
+    # the messages of a repetition are queued beforehand, each one newer than the last
+    def prepare ():
+      for i in range (self.number):
+        seq[0] += 1
+        writer.send (self.wire_message (topic, seq[0], depth))
+
+    self.measure ("subscriber.receive/h{}".format (depth), prepare, lambda arg: mw.handle_bytes_on_sub_socket ())
+    mw.sub.close ()
+    writer.close ()
+
+  ########################################
+  # BrokerMW.handle_bytes_on_sub_socket
+  ########################################
+  def bench_broker (self, depth):
+    appln = BrokerAppln (self.mw_logger)
+    appln.load_report_interval = 1e9 # no load reports in the middle of the measurement
+
+    mw = BrokerMW (self.mw_logger)
+    mw.upcall_obj = appln
+    mw.timeout = 20000
+    mw.sub, writer = self.socket_pair ("broker-{}".format (depth))
+    mw.pub = self.context.socket (zmq.PUB)
+    mw.pub.bind ("inproc://hotpath-broker-pub-{}".format (depth))
+    topic = self.topics[0]
+    mw.topics_subscribed.add (topic)
+    message = self.wire_message (topic, 1, depth)
+
+    def prepare ():
+      for i in range (self.number):
+        writer.send (message)
+
+    self.measure ("broker.forward/h{}".format (depth), prepare, lambda arg: mw.handle_bytes_on_sub_socket ())
+    mw.sub.close ()
+    mw.pub.close ()
+    writer.close ()
+
+  ########################################
+  # discovery middleware and application, Centralized lookup
+  ########################################
+  def discovery (self, name, num_pubs):
+    appln = DiscoveryAppln (self.mw_logger)
+    appln.name = "disc1"
+    appln.lookup = "Centralized"
+    appln.dissemination = "Direct"
+    appln.expected_pub_num = num_pubs
+    appln.expected_sub_num = 1
+
+    mw = DiscoveryMW (self.mw_logger)
+    mw.upcall_obj = appln
+    appln.mw_obj = mw
+    mw.router, peer = self.socket_pair (name)
+
+    # publishers on five topics each, as in the experiments
+    for i in range (num_pubs):
+      pub_id = "pub{}".format (i + 1)
+      appln.registered_publishers.add (pub_id)
+      appln.publisher_id_to_ipport_mapping[pub_id] = "10.0.0.{}:{}".format (i % 250 + 1, 7000 + i)
+      for j in range (5):
+        appln.topic_to_publishers_id_mapping.setdefault (self.topics[(i + j) % len (self.topics)], []).append (pub_id)
+    appln.registered_subscribers.add ("sub1")
+
+    return appln, mw, peer
+
+  ########################################
+  # a request as the REQ socket of an entity sends it through the ROUTER
+  ########################################
+  def request_frames (self, disc_req):
+    return [b"\x00\x80\x00\x00\x29", b"", disc_req.SerializeToString ()]
+
+  ########################################
+  # DiscoveryMW.handle_request and the respond_* serializers
+  ########################################
+  def bench_discovery (self, num_pubs):
+    appln, mw, peer = self.discovery ("disc-{}".format (num_pubs), num_pubs)
+
+    # lookup of the topics of a subscriber
+    lookup_req = discovery_pb2.DiscoveryReq ()
+    lookup_req.msg_type = discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC
+    lookup_req.lookup_req.topiclist[:] = self.topics[:5]
+    lookup_req.timestamp_sent = str (time.time ())
+    lookup_frames = self.request_frames (lookup_req)
+
+    def prepare_lookup ():
+      for i in range (self.number):
+        peer.send_multipart (lookup_frames)
+
+    self.measure ("discovery.lookup/p{}".format (num_pubs), prepare_lookup, lambda arg: mw.handle_request (), lambda: self.drain (peer))
+
+    addresses = list (appln.publisher_id_to_ipport_mapping.values ())
+    self.measure ("discovery.respond_lookup/p{}".format (num_pubs), lambda: None,
+                  lambda arg: mw.respond_to_lookup_request (addresses, False, list (lookup_frames), "0"), lambda: self.drain (peer))
+
+    mw.router.close ()
+    peer.close ()
+
+  ########################################
+  # registration and is ready, independent of the number of publishers
+  ########################################
+  def bench_discovery_requests (self):
+    appln, mw, peer = self.discovery ("disc-requests", 10)
+
+    isready_req = discovery_pb2.DiscoveryReq ()
+    isready_req.msg_type = discovery_pb2.TYPE_ISREADY
+    isready_req.timestamp_sent = str (time.time ())
+    isready_frames = self.request_frames (isready_req)
+
+    def prepare_isready ():
+      for i in range (self.number):
+        peer.send_multipart (isready_frames)
+
+    self.measure ("discovery.isready", prepare_isready, lambda arg: mw.handle_request (), lambda: self.drain (peer))
+
+    # registrations of new publishers, the registry starts over every repetition
+    registrations = [0]
+
+    def prepare_register ():
+      appln.registered_publishers.clear ()
+      appln.publisher_id_to_ipport_mapping.clear ()
+      appln.topic_to_publishers_id_mapping.clear ()
+      for i in range (self.number):
+        registrations[0] += 1
+        register_req = discovery_pb2.DiscoveryReq ()
+        register_req.msg_type = discovery_pb2.TYPE_REGISTER
+        register_req.register_req.role = discovery_pb2.ROLE_PUBLISHER
+        register_req.register_req.info.id = "pub{}".format (registrations[0])
+        register_req.register_req.info.addr = "10.0.0.1"
+        register_req.register_req.info.port = 7000 + i
+        register_req.register_req.topiclist[:] = self.topics[:5]
+        register_req.timestamp_sent = str (time.time ())
+        peer.send_multipart (self.request_frames (register_req))
+
+    self.measure ("discovery.register", prepare_register, lambda arg: mw.handle_request (), lambda: self.drain (peer))
+
+    frames = self.request_frames (isready_req)
+    self.measure ("discovery.respond_register", lambda: None, lambda arg: mw.respond_to_register_request (list (frames), True, "", "0"), lambda: self.drain (peer))
+    self.measure ("discovery.respond_isready", lambda: None, lambda arg: mw.respond_to_isready_request (True, list (frames), "0"), lambda: self.drain (peer))
+
+    mw.router.close ()
+    peer.close ()
+
+  ########################################
+  # compare with a baseline, returns the regressions
+  ########################################
+  def compare (self):
+    with open (self.compare_path) as f:
+      baseline = json.load (f)["cases"]
+
+    regressions = []
+    self.logger.info ("**********************************")
+    self.logger.info ("HotPathBench::compare - against %s, regression above %+.0f%%", self.compare_path, 100 * self.threshold)
+    self.logger.info ("{:>32} {:>12} {:>12} {:>9}".format ("case", "baseline us", "now us", "change")) # best repetitions
+    for name, result in self.results.items ():
+      if name not in baseline:
+        self.logger.info ("{:>32} {:>12} {:>12.2f} {:>9}".format (name, "-", result["min_us"], "new"))
+        continue
+      change = result["min_us"] / baseline[name]["min_us"] - 1
+      flag = ""
+      if change > self.threshold:
+        regressions.append (name)
+        flag = "  REGRESSION"
+      self.logger.info ("{:>32} {:>12.2f} {:>12.2f} {:>+8.1f}%{}".format (name, baseline[name]["min_us"], result["min_us"], 100 * change, flag))
+    self.logger.info ("**********************************")
+    return regressions
+
+  ########################################
+  # report
+  ########################################
+  def report (self):
+    self.logger.info ("**********************************")
+    self.logger.info ("HotPathBench::report - time per call over %d repetitions of %d calls", self.repeat, self.number)
+    self.logger.info ("{:>32} {:>10} {:>10} {:>10} {:>12}".format ("case", "median us", "min us", "stdev us", "calls/s"))
+    for name, result in self.results.items ():
+      self.logger.info ("{:>32} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.0f}".format (name, result["median_us"], result["min_us"], result["stdev_us"], result["ops_per_sec"]))
+    self.logger.info ("**********************************")
+
+    if self.save_path:
+      with open (self.save_path, "w") as f:
+        json.dump ({
+          "machine": {"python": platform.python_version (), "zmq": zmq.zmq_version (), "platform": platform.platform (), "processor": platform.processor ()},
+          "cases": self.results,
+        }, f, indent=2, sort_keys=True)
+      self.logger.info ("HotPathBench::report - baseline written to %s", self.save_path)
+
+  ########################################
+  # driver, returns the regressions against the baseline
+  ########################################
+  def driver (self):
+    ''' Driver program '''
+
+    try:
+      self.logger.info ("HotPathBench::driver")
+      for depth in self.history_depths:
+        self.bench_publisher (depth)
+        self.bench_subscriber (depth)
+        self.bench_broker (depth)
+      self.bench_discovery_requests ()
+      for num_pubs in self.pub_counts:
+        self.bench_discovery (num_pubs)
+      self.report ()
+
+      return self.compare () if self.compare_path else []
+
+    except Exception as e:
+      raise e
+
+
+###################################
+#
+# Parse command line arguments
+#
+###################################
+def parseCmdLineArgs ():
+  # instantiate a ArgumentParser object
+  parser = argparse.ArgumentParser (description="Microbenchmarks of the per-message paths")
+
+  parser.add_argument ("-H", "--history", default="1,5", help="Comma separated numbers of publications per message (history depth), default 1,5")
+
+  parser.add_argument ("-P", "--publishers", default="10,100", help="Comma separated numbers of publishers registered with discovery for the lookups, default 10,100")
+
+  parser.add_argument ("-n", "--number", type=int, default=2000, help="Calls per repetition, default 2000")
+
+  parser.add_argument ("-r", "--repeat", type=int, default=15, help="Timed repetitions, default 15")
+
+  parser.add_argument ("-w", "--warmup", type=int, default=2, help="Untimed repetitions before, default 2")
+
+  parser.add_argument ("-k", "--cases", default=None, help="Comma separated prefixes of the cases to run, e.g., subscriber,discovery.lookup, default all")
+
+  parser.add_argument ("-C", "--cpu", type=int, default=None, help="Pin the process to this CPU")
+
+  parser.add_argument ("--save", default=None, help="Write the results as a baseline to this JSON file")
+
+  parser.add_argument ("--compare", default=None, help="Compare the results with this baseline, exit status 1 on a regression")
+
+  parser.add_argument ("--threshold", type=float, default=0.10, help="Slowdown of the best repetition (fraction) reported as a regression, default 0.10")
+
+  parser.add_argument ("-L", "--mw_loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level of the middleware during the measurement, default 20=logging.INFO")
+
+  parser.add_argument ("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+
+  return parser.parse_args()
+
+
+###################################
+#
+# Main program
+#
+###################################
+def main ():
+  try:
+    # obtain a system wide logger and initialize it to debug level to begin with
+    logging.info ("Main - acquire a child logger and then log messages in the child")
+    logger = logging.getLogger ("HotPathBench")
+
+    # first parse the arguments
+    logger.debug ("Main: parse command line arguments")
+    args = parseCmdLineArgs ()
+
+    # reset the log level to as specified
+    logger.debug ("Main: resetting log level to {}".format (args.loglevel))
+    logger.setLevel (args.loglevel)
+    logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
+
+    # Obtain the benchmark object
+    logger.debug ("Main: obtain the HotPathBench object")
+    bench = HotPathBench (logger)
+
+    # configure the object
+    logger.debug ("Main: configure the HotPathBench object")
+    bench.configure (args)
+
+    # now invoke the driver program
+    logger.debug ("Main: invoke the HotPathBench driver")
+    regressions = bench.driver ()
+
+  except Exception as e:
+    logger.error ("Exception caught in main - {}".format (e))
+    sys.exit (2)
+
+  if regressions:
+    logger.error ("Regressions in {}".format (", ".join (regressions)))
+    sys.exit (1)
+
+
+###################################
+#
+# Main entry point
+#
+###################################
+if __name__ == "__main__":
+
+  # set underlying default logging capabilities
+  logging.basicConfig (level=logging.DEBUG,
+                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+  main ()
@@ -0,0 +1,605 @@
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose:
+#
+# Latency analysis of the measurements of the experiments, in place of the
+# ad hoc queries of Latency_Statistics_Visualization.ipynb.
+#
+# Reads the latencies (and the discovery request latencies, dht_latencies)
+# the subscribers and publishers recorded through their metrics sink, from
+# any mix of
+#
+#    - SQLite files (metrics.db of the local_bench.py runs)
+#    - directories of CSV or Parquet files written by the sink
+#    - the MySQL tables of SQL_scripts.sql (--mysql, with the server in the
+#      [Metrics] section of -c)
+#
+# Directories are searched recursively. The rows are read in chunks of -C
+# and each chunk goes into per-experiment histograms with NumPy, so memory
+# does not grow with the number of rows, only with that of experiments.
+# The histogram buckets are 1% wide (1 us to 10000 s), so the percentiles
+# are within 1% of the exact ones; count, mean, min and max are exact.
+#
+# Written to -o:
+#
+#    summary.csv     per experiment: configuration, publications received,
+#                    throughput (per second between the first and the last
+#                    one received), mean, p50, p90, p95, p99 and max latency,
+#                    largest error bound of the clock offsets (--clock_sync)
+#    comparison.csv  per configuration (publishers, subscribers, frequency,
+#                    topics) and dissemination strategy, all experiments of
+#                    it together, with p50 and p99 relative to the best one
+#    cdf.csv         the latency CDF of every experiment
+#    requests.csv    discovery request latencies per lookup strategy, request
+#                    type, ring size and number of entities
+#    load.csv        per experiment and rate offered by the publishers started
+#                    with --load: publications received, throughput, mean, p50,
+#                    p99 and max latency, to find where the latency takes off
+#    cdf.png, percentiles.png   when matplotlib is installed
+#
+# Example (all runs of a local_bench.py output directory):
+#
+#    python3 latency_analysis.py local_bench -o analysis
+
+import os
+import csv
+import math
+import fnmatch
+import sqlite3
+import argparse # argument parsing
+import itertools
+import configparser
+import logging # for logging. Use it in place of print statements.
+
+import numpy as np
+
+# upper bounds of the latency buckets in seconds, 1% apart, from 1 us to 10000 s;
+# the first bucket takes whatever is below (clock skew makes some negative)
+RESOLUTION = 0.01
+EDGES = 1e-6 * (1 + RESOLUTION) ** np.arange (int (math.log (1e10) / math.log (1 + RESOLUTION)) + 1)
+NUM_BUCKETS = len (EDGES) + 1
+
+# the columns we read of each table
+LATENCY_COLUMNS = ["experiment_name", "dissemination", "pub_num", "sub_num", "frequency", "num_topics", "latency_sec", "received_at", "offered_rate", "clock_error"]
+REQUEST_COLUMNS = ["lookup_strategy", "type_of_request", "dht_num", "pub_num", "sub_num", "latency_sec"]
+NUMERIC_COLUMNS = {"pub_num", "sub_num", "frequency", "num_topics", "dht_num", "latency_sec", "received_at", "offered_rate", "clock_error"}
+# added later, files of earlier runs do not have them (read as NULL)
+OPTIONAL_COLUMNS = {"offered_rate", "clock_error"}
+
+
+##################################
+# latency histogram of a group of rows
+##################################
+class LatencyHistogram ():
+
+  def __init__ (self):
+    self.buckets = np.zeros (NUM_BUCKETS, dtype=np.int64)
+    self.count = 0
+    self.sum = 0.0
+    self.min = math.inf
+    self.max = -math.inf
+    self.first_received = math.inf # received_at of the first and the last publication
+    self.last_received = -math.inf
+    self.num_received = 0 # rows with a received_at
+    self.clock_error = -math.inf # largest error bound of the clock offsets (--clock_sync)
+
+  def add (self, latencies, received_at=None, clock_error=None):
+    self.buckets += np.bincount (np.searchsorted (EDGES, latencies, side="right"), minlength=NUM_BUCKETS)
+    self.count += len (latencies)
+    self.sum += float (latencies.sum ())
+    self.min = min (self.min, float (latencies.min ()))
+    self.max = max (self.max, float (latencies.max ()))
+    if received_at is not None:
+      received_at = received_at[~np.isnan (received_at)]
+      if len (received_at):
+        self.first_received = min (self.first_received, float (received_at.min ()))
+        self.last_received = max (self.last_received, float (received_at.max ()))
+        self.num_received += len (received_at)
+    if clock_error is not None:
+      clock_error = clock_error[~np.isnan (clock_error)]
+      if len (clock_error):
+        self.clock_error = max (self.clock_error, float (clock_error.max ()))
+
+  def merge (self, other):
+    self.buckets += other.buckets
+    self.count += other.count
+    self.sum += other.sum
+    self.min = min (self.min, other.min)
+    self.max = max (self.max, other.max)
+    self.first_received = min (self.first_received, other.first_received)
+    self.last_received = max (self.last_received, other.last_received)
+    self.num_received += other.num_received
+    self.clock_error = max (self.clock_error, other.clock_error)
+
+  def mean (self):
+    return self.sum / self.count if self.count else math.nan
+
+  # nearest rank, the middle of its bucket (the exact min or max at the ends)
+  def percentile (self, p):
+    if self.count == 0:
+      return math.nan
+    rank = max (1, math.ceil (p / 100 * self.count))
+    bucket = int (np.searchsorted (np.cumsum (self.buckets), rank))
+    if bucket == 0:
+      return self.min
+    if bucket == NUM_BUCKETS - 1:
+      return self.max
+    return min (max (math.sqrt (EDGES[bucket - 1] * EDGES[bucket]), self.min), self.max)
+
+  def throughput (self):
+    window = self.last_received - self.first_received
+    return self.num_received / window if self.num_received > 1 and window > 0 else math.nan
+
+  # unknown unless publishers and subscribers synchronized their clocks
+  def max_clock_error (self):
+    return self.clock_error if self.clock_error > -math.inf else math.nan
+
+  # (upper bound of the bucket, fraction of the rows up to it) of the non-empty buckets
+  def cdf (self):
+    filled = np.nonzero (self.buckets)[0]
+    fractions = np.cumsum (self.buckets)[filled] / self.count
+    bounds = np.append (EDGES, self.max)[filled]
+    return zip (bounds, fractions)
+
+
+##################################
+#       LatencyAnalysis class
+##################################
+class LatencyAnalysis ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, logger):
+    self.logger = logger
+    self.inputs = None      # files and directories to read
+    self.mysql = None       # [Metrics] section with the MySQL server, or None
+    self.chunk_size = None  # rows per chunk
+    self.patterns = None    # experiment names to keep (fnmatch patterns), None for all
+    self.out_dir = None
+    self.experiments = {}   # experiment name -> (dissemination, pubs, subs, freq, topics), LatencyHistogram
+    self.requests = {}      # (lookup, request type, ring size, entities) -> LatencyHistogram
+    self.loads = {}         # (experiment name, offered rate) -> LatencyHistogram
+    self.num_rows = 0
+
+  ########################################
+  # configure
+  ########################################
+  def configure (self, args):
+    ''' Initialize the object '''
+
+    try:
+      self.logger.info ("LatencyAnalysis::configure")
+
+      self.inputs = args.inputs
+      if args.mysql:
+        config = configparser.ConfigParser ()
+        config.read (args.config)
+        self.mysql = config['Metrics'] if config.has_section ('Metrics') else {}
+      if not self.inputs and self.mysql == None:
+        raise ValueError ("Nothing to read, give metrics files or directories, or --mysql")
+      self.chunk_size = args.chunk_size
+      self.patterns = args.experiments.split (",") if args.experiments else None
+      self.out_dir = args.out_dir
+      os.makedirs (self.out_dir, exist_ok=True)
+
+      self.logger.info ("LatencyAnalysis::configure - configuration complete")
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # the metrics files under the inputs: (kind, table, path)
+  ########################################
+  def find_sources (self):
+    paths = []
+    for path in self.inputs:
+      if os.path.isdir (path):
+        for directory, _, files in sorted (os.walk (path)):
+          paths.extend (os.path.join (directory, name) for name in sorted (files))
+      else:
+        paths.append (path)
+
+    sources = []
+    seen = set () # a file under two of the inputs is read once
+    for path in paths:
+      if os.path.realpath (path) in seen:
+        continue
+      seen.add (os.path.realpath (path))
+      name = os.path.basename (path)
+      if name.endswith (".db") or name.endswith (".sqlite"):
+        sources.append (("SQLite", "latencies", path))
+        sources.append (("SQLite", "dht_latencies", path))
+      elif name.endswith (".csv") and name.split ("-")[0] in ("latencies", "dht_latencies"):
+        # latencies-<name>-<pid>.csv written by the CSV sink
+        sources.append (("CSV", name.split ("-")[0], path))
+      elif name.endswith (".parquet") and os.path.basename (os.path.dirname (path)) in ("latencies", "dht_latencies"):
+        # <table>/<name>-<pid>-<batch>.parquet written by the Parquet sink
+        sources.append (("Parquet", os.path.basename (os.path.dirname (path)), path))
+    return sources
+
+  ########################################
+  # what to select of a table with the given columns, NULL for missing optional ones
+  ########################################
+  def select_list (self, available, columns):
+    return ", ".join (column if column in available or column not in OPTIONAL_COLUMNS else "NULL" for column in columns)
+
+  ########################################
+  # readers, each yields a list of column arrays per chunk of rows
+  ########################################
+  def read_sqlite (self, path, table, columns):
+    connection = sqlite3.connect ("file:{}?mode=ro".format (path), uri=True)
+    try:
+      available = {row[1] for row in connection.execute ("PRAGMA table_info ({})".format (table))}
+      cursor = connection.execute ("SELECT {} FROM {}".format (self.select_list (available, columns), table))
+    except sqlite3.OperationalError:
+      connection.close () # no such table (or column), nothing of this kind in it
+      return
+    try:
+      while True:
+        rows = cursor.fetchmany (self.chunk_size)
+        if not rows:
+          break
+        yield list (zip (*rows))
+    finally:
+      connection.close ()
+
+  def read_csv (self, path, table, columns):
+    with open (path, newline="") as f:
+      reader = csv.reader (f)
+      header = next (reader, None)
+      if header == None:
+        return
+      indexes = [header.index (column) if column in header or column not in OPTIONAL_COLUMNS else None for column in columns]
+      while True:
+        rows = list (itertools.islice (reader, self.chunk_size))
+        if not rows:
+          break
+        values = list (zip (*rows))
+        yield [values[i] if i != None else ("",) * len (rows) for i in indexes]
+
+  def read_parquet (self, path, table, columns):
+    import pyarrow.parquet
+    parquet_file = pyarrow.parquet.ParquetFile (path)
+    present = [column for column in columns if column in parquet_file.schema_arrow.names or column not in OPTIONAL_COLUMNS]
+    for batch in parquet_file.iter_batches (batch_size=self.chunk_size, columns=present):
+      arrays = {column: batch.column (i).to_numpy (zero_copy_only=False) for i, column in enumerate (present)}
+      yield [arrays[column] if column in arrays else np.full (batch.num_rows, np.nan) for column in columns]
+
+  def read_mysql (self, table, columns):
+    import mysql.connector
+    connection = mysql.connector.connect (host=self.mysql.get ('Host', 'localhost'), database=self.mysql.get ('Database', 'distributed_hw1'), user=self.mysql.get ('User', 'root'), password=self.mysql.get ('Password', ''))
+    try:
+      cursor = connection.cursor ()
+      cursor.execute ("SHOW COLUMNS FROM {}".format (table))
+      available = {row[0] for row in cursor.fetchall ()}
+      cursor.execute ("SELECT {} FROM {}".format (self.select_list (available, columns), table))
+      while True:
+        rows = cursor.fetchmany (self.chunk_size)
+        if not rows:
+          break
+        yield list (zip (*rows))
+      cursor.close ()
+    finally:
+      connection.close ()
+
+  ########################################
+  # a chunk as a dict of NumPy arrays, NULL and empty numbers become NaN
+  ########################################
+  def to_arrays (self, columns, values):
+    arrays = {}
+    for column, column_values in zip (columns, values):
+      if column in NUMERIC_COLUMNS:
+        array = np.asarray (column_values)
+        if array.dtype.kind in "US": # CSV
+          array = np.where (array == "", "nan", array)
+        arrays[column] = array.astype (float)
+      else:
+        arrays[column] = np.asarray (column_values).astype (str)
+    return arrays
+
+  ########################################
+  # groups of a chunk: yields (key index, rows of it) for every distinct key
+  ########################################
+  def groups (self, keys):
+    unique, first, inverse = np.unique (keys, return_index=True, return_inverse=True)
+    order = np.argsort (inverse, kind="stable")
+    bounds = np.cumsum (np.bincount (inverse, minlength=len (unique)))
+    start = 0
+    for i in range (len (unique)):
+      yield unique[i], first[i], order[start:bounds[i]]
+      start = bounds[i]
+
+  ########################################
+  # add a chunk of latencies
+  ########################################
+  def add_latencies (self, chunk):
+    latencies = chunk["latency_sec"]
+    valid = ~np.isnan (latencies)
+    for name, first, rows in self.groups (chunk["experiment_name"]):
+      if self.patterns != None and not any (fnmatch.fnmatchcase (name, pattern) for pattern in self.patterns):
+        continue
+      rows = rows[valid[rows]]
+      if len (rows) == 0:
+        continue
+      if name not in self.experiments:
+        self.experiments[name] = ((chunk["dissemination"][first], int (chunk["pub_num"][first]), int (chunk["sub_num"][first]),
+                                   chunk["frequency"][first], int (chunk["num_topics"][first])), LatencyHistogram ())
+      self.experiments[name][1].add (latencies[rows], chunk["received_at"][rows], chunk["clock_error"][rows])
+      self.num_rows += len (rows)
+
+      # publications of the load generators, per offered rate
+      offered = chunk["offered_rate"][rows]
+      rows = rows[~np.isnan (offered)]
+      if len (rows) == 0:
+        continue
+      for rate, _, rate_rows in self.groups (chunk["offered_rate"][rows]):
+        self.loads.setdefault ((name, float (rate)), LatencyHistogram ()).add (latencies[rows[rate_rows]], chunk["received_at"][rows[rate_rows]])
+
+  ########################################
+  # add a chunk of discovery request latencies
+  ########################################
+  def add_requests (self, chunk):
+    latencies = chunk["latency_sec"]
+    valid = ~np.isnan (latencies)
+    entities = chunk["pub_num"] + chunk["sub_num"]
+    # one string key per row, so that the grouping stays vectorized
+    keys = np.char.add (np.char.add (np.char.add (chunk["lookup_strategy"], "|"), np.char.add (chunk["type_of_request"], "|")),
+                        np.char.add (np.char.add (np.nan_to_num (chunk["dht_num"], nan=0).astype (int).astype (str), "|"), entities.astype (int).astype (str)))
+    for key, first, rows in self.groups (keys):
+      rows = rows[valid[rows]]
+      if len (rows) == 0:
+        continue
+      lookup, request, dht_num, num_entities = key.split ("|")
+      self.requests.setdefault ((lookup, request, int (dht_num), int (num_entities)), LatencyHistogram ()).add (latencies[rows])
+
+  ########################################
+  # read everything
+  ########################################
+  def read (self):
+    sources = self.find_sources ()
+    if self.mysql != None:
+      sources += [("MySQL", "latencies", None), ("MySQL", "dht_latencies", None)]
+    self.logger.info ("LatencyAnalysis::read - %d sources", len (sources))
+
+    for kind, table, path in sources:
+      columns = LATENCY_COLUMNS if table == "latencies" else REQUEST_COLUMNS
+      self.logger.debug ("LatencyAnalysis::read - %s %s %s", kind, table, path)
+      try:
+        if kind == "SQLite":
+          chunks = self.read_sqlite (path, table, columns)
+        elif kind == "CSV":
+          chunks = self.read_csv (path, table, columns)
+        elif kind == "Parquet":
+          chunks = self.read_parquet (path, table, columns)
+        else:
+          chunks = self.read_mysql (table, columns)
+
+        for values in chunks:
+          chunk = self.to_arrays (columns, values)
+          if table == "latencies":
+            self.add_latencies (chunk)
+          else:
+            self.add_requests (chunk)
+
+      except (ImportError, ValueError, OSError, sqlite3.DatabaseError) as e:
+        # one unreadable file (or a missing reader) should not stop the analysis
+        self.logger.error ("LatencyAnalysis::read - skipping %s %s: %s", kind, path if path else table, e)
+
+    self.logger.info ("LatencyAnalysis::read - %d latencies of %d experiments", self.num_rows, len (self.experiments))
+
+  ########################################
+  # comparison of the dissemination strategies per configuration
+  ########################################
+  def compare (self):
+    merged = {} # (pubs, subs, freq, topics) -> dissemination -> [experiments, LatencyHistogram]
+    for name, (attributes, histogram) in self.experiments.items ():
+      dissemination, pubs, subs, freq, topics = attributes
+      entry = merged.setdefault ((pubs, subs, freq, topics), {}).setdefault (dissemination, [0, LatencyHistogram ()])
+      entry[0] += 1
+      entry[1].merge (histogram)
+
+    rows = []
+    for configuration in sorted (merged):
+      strategies = merged[configuration]
+      best_p50 = min (histogram.percentile (50) for _, histogram in strategies.values ())
+      best_p99 = min (histogram.percentile (99) for _, histogram in strategies.values ())
+      for dissemination in sorted (strategies):
+        num_experiments, histogram = strategies[dissemination]
+        p50 = histogram.percentile (50)
+        p99 = histogram.percentile (99)
+        rows.append (configuration + (dissemination, num_experiments, histogram.count, 1000 * histogram.mean (), 1000 * p50, 1000 * p99,
+                                      p50 / best_p50 if best_p50 > 0 else math.nan, p99 / best_p99 if best_p99 > 0 else math.nan))
+    return rows
+
+  ########################################
+  # write a CSV file of the output directory
+  ########################################
+  def write_csv (self, name, header, rows):
+    with open (os.path.join (self.out_dir, name), "w", newline="") as f:
+      writer = csv.writer (f)
+      writer.writerow (header)
+      writer.writerows (rows)
+
+  ########################################
+  # report
+  ########################################
+  def report (self):
+    summary = []
+    for name in sorted (self.experiments):
+      attributes, histogram = self.experiments[name]
+      summary.append ((name,) + attributes + (histogram.count, histogram.throughput (), 1000 * histogram.mean ())
+                      + tuple (1000 * histogram.percentile (p) for p in (50, 90, 95, 99)) + (1000 * histogram.max, 1000 * histogram.max_clock_error ()))
+    self.write_csv ("summary.csv", ["experiment", "dissemination", "pubs", "subs", "freq", "topics", "received", "throughput", "mean_ms", "p50_ms", "p90_ms", "p95_ms", "p99_ms", "max_ms", "clock_error_ms"], summary)
+
+    comparison = self.compare ()
+    self.write_csv ("comparison.csv", ["pubs", "subs", "freq", "topics", "dissemination", "experiments", "received", "mean_ms", "p50_ms", "p99_ms", "p50_vs_best", "p99_vs_best"], comparison)
+
+    self.write_csv ("cdf.csv", ["experiment", "latency_ms", "fraction"],
+                    ((name, 1000 * bound, fraction) for name in sorted (self.experiments) for bound, fraction in self.experiments[name][1].cdf ()))
+
+    requests = [key + (histogram.count, 1000 * histogram.mean (), 1000 * histogram.percentile (50), 1000 * histogram.percentile (99))
+                for key, histogram in sorted (self.requests.items ())]
+    self.write_csv ("requests.csv", ["lookup", "request", "dht_num", "entities", "count", "mean_ms", "p50_ms", "p99_ms"], requests)
+
+    loads = [(name, self.experiments[name][0][0], rate, histogram.count, histogram.throughput (), 1000 * histogram.mean (),
+              1000 * histogram.percentile (50), 1000 * histogram.percentile (99), 1000 * histogram.max)
+             for (name, rate), histogram in sorted (self.loads.items ())]
+    if loads:
+      self.write_csv ("load.csv", ["experiment", "dissemination", "offered_rate", "received", "throughput", "mean_ms", "p50_ms", "p99_ms", "max_ms"], loads)
+
+    self.logger.info ("**********************************")
+    self.logger.info ("LatencyAnalysis::report - latencies in ms, throughput in publications received per second")
+    self.logger.info ("{:>20} {:>8} {:>9} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}".format ("experiment", "dissem", "received", "msgs/s", "mean", "p50", "p95", "p99", "max"))
+    for row in summary:
+      self.logger.info ("{:>20} {:>8} {:>9} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format (row[0], row[1], row[6], row[7], row[8], row[9], row[11], row[12], row[13]))
+    if requests:
+      self.logger.info ("{:>12} {:>20} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}".format ("lookup", "request", "ring", "entities", "count", "mean", "p50", "p99"))
+      for row in requests:
+        self.logger.info ("{:>12} {:>20} {:>8} {:>9} {:>9} {:>9.2f} {:>9.2f} {:>9.2f}".format (*row))
+    if loads:
+      self.logger.info ("{:>20} {:>8} {:>9} {:>9} {:>10} {:>9} {:>9} {:>9}".format ("experiment", "dissem", "offered", "received", "msgs/s", "p50", "p99", "max"))
+      for row in loads:
+        self.logger.info ("{:>20} {:>8} {:>9g} {:>9} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format (row[0], row[1], row[2], row[3], row[4], row[6], row[7], row[8]))
+    self.logger.info ("results written to %s", self.out_dir)
+    self.logger.info ("**********************************")
+
+    self.plot (comparison)
+
+  ########################################
+  # plots, only with matplotlib
+  ########################################
+  def plot (self, comparison):
+    try:
+      import matplotlib
+      matplotlib.use ("Agg") # no display needed
+      import matplotlib.pyplot as plt
+    except ImportError:
+      self.logger.warning ("LatencyAnalysis::plot - matplotlib is not installed, no plots")
+      return
+
+    # latency CDF of every experiment
+    figure, axes = plt.subplots (figsize=(10, 6))
+    for name in sorted (self.experiments):
+      bounds, fractions = zip (*self.experiments[name][1].cdf ())
+      axes.step (1000 * np.array (bounds), fractions, where="post", label=name)
+    axes.set_xscale ("log")
+    axes.set_xlabel ("latency (ms)")
+    axes.set_ylabel ("fraction of publications")
+    if len (self.experiments) <= 20:
+      axes.legend (fontsize="small")
+    figure.tight_layout ()
+    figure.savefig (os.path.join (self.out_dir, "cdf.png"))
+    plt.close (figure)
+
+    # p50 and p99 per configuration, one bar per dissemination strategy
+    configurations = sorted (set (row[:4] for row in comparison))
+    strategies = sorted (set (row[4] for row in comparison))
+    values = {(row[:4], row[4]): (row[8], row[9]) for row in comparison}
+    positions = np.arange (len (configurations))
+    width = 0.8 / max (len (strategies), 1)
+    figure, axes = plt.subplots (2, 1, figsize=(max (8, len (configurations)), 8), sharex=True)
+    for i, strategy in enumerate (strategies):
+      for j, title in enumerate (("p50", "p99")):
+        heights = [values.get ((configuration, strategy), (math.nan, math.nan))[j] for configuration in configurations]
+        axes[j].bar (positions + i * width, heights, width, label=strategy)
+        axes[j].set_ylabel ("{} latency (ms)".format (title))
+    axes[1].set_xticks (positions + width * (len (strategies) - 1) / 2)
+    axes[1].set_xticklabels (["P{}S{}F{:g}T{}".format (*configuration) for configuration in configurations], rotation=45, ha="right")
+    axes[0].legend ()
+    figure.tight_layout ()
+    figure.savefig (os.path.join (self.out_dir, "percentiles.png"))
+    plt.close (figure)
+
+  ########################################
+  # driver
+  ########################################
+  def driver (self):
+    ''' Driver program '''
+
+    try:
+      self.logger.info ("LatencyAnalysis::driver")
+      self.read ()
+      self.report ()
+
+    except Exception as e:
+      raise e
+
+
+###################################
+#
+# Parse command line arguments
+#
+###################################
+def parseCmdLineArgs ():
+  # instantiate a ArgumentParser object
+  parser = argparse.ArgumentParser (description="Latency analysis of the experiments")
+
+  parser.add_argument ("inputs", nargs="*", help="SQLite files, and directories searched for SQLite, CSV and Parquet metrics files")
+
+  parser.add_argument ("--mysql", action="store_true", default=False, help="Also read the MySQL tables, server as in the [Metrics] section of -c")
+
+  parser.add_argument ("-c", "--config", default="config.ini", help="configuration file with the [Metrics] section for --mysql, default config.ini")
+
+  parser.add_argument ("-e", "--experiments", default=None, help="Comma separated experiment names to analyze, wildcards allowed (e.g., P5S5*), default all")
+
+  parser.add_argument ("-C", "--chunk_size", type=int, default=100000, help="Rows read at a time, default 100000")
+
+  parser.add_argument ("-o", "--out_dir", default="analysis", help="Directory for the tables and plots, default analysis")
+
+  parser.add_argument ("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+
+  return parser.parse_args()
+
+
+###################################
+#
+# Main program
+#
+###################################
+def main ():
+  try:
+    # obtain a system wide logger and initialize it to debug level to begin with
+    logging.info ("Main - acquire a child logger and then log messages in the child")
+    logger = logging.getLogger ("LatencyAnalysis")
+
+    # first parse the arguments
+    logger.debug ("Main: parse command line arguments")
+    args = parseCmdLineArgs ()
+
+    # reset the log level to as specified
+    logger.debug ("Main: resetting log level to {}".format (args.loglevel))
+    logger.setLevel (args.loglevel)
+    logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
+
+    # Obtain the analysis object
+    logger.debug ("Main: obtain the LatencyAnalysis object")
+    analysis = LatencyAnalysis (logger)
+
+    # configure the object
+    logger.debug ("Main: configure the LatencyAnalysis object")
+    analysis.configure (args)
+
+    # now invoke the driver program
+    logger.debug ("Main: invoke the LatencyAnalysis driver")
+    analysis.driver ()
+
+  except Exception as e:
+    logger.error ("Exception caught in main - {}".format (e))
+    return
+
+
+###################################
+#
+# Main entry point
+#
+###################################
+if __name__ == "__main__":
+
+  # set underlying default logging capabilities
+  logging.basicConfig (level=logging.DEBUG,
+                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+  main ()
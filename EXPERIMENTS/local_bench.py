@@ -0,0 +1,458 @@
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose:
+#
+# Local multi-process benchmark harness, no Mininet or root needed.
+#
+# For every combination of the parameter matrix (publishers, subscribers,
+# frequency, topics, lookup and dissemination strategy) it starts discovery,
+# brokers, publishers and subscribers as processes on this host, each on
+# its own localhost port, and waits for the run to finish:
+#
+#    - the publishers exit after their last iteration
+#    - the subscribers exit once they received nothing for the quiet
+#      period (-q) since their lookup or their last publication, i.e., the
+#      publications in flight were delivered
+#    - the discovery and broker processes are then terminated
+#
+# With the Broker dissemination the discovery service only reports the system
+# ready once the broker of every group registered (-B of DiscoveryAppln.py),
+# so no publisher or subscriber starts with only some of the groups.
+#
+# So a run takes as long as it needs rather than a fixed sleep. A run that
+# does not finish within -W seconds is stopped and reported as such.
+#
+# Every run gets its own directory under -o with the logs of all the
+# processes, the config.ini they used (a copy of -c with the strategies of
+# the run and a SQLite metrics sink, see [Metrics]) and the metrics.db the
+# subscribers wrote their latencies to. The report (printed, and written to
+# report.csv in -o) has per run the publications received, the throughput
+# (publications received per second between the first and the last one) and
+# the latency percentiles.
+#
+# With -G the publishers are open-loop load generators with that profile
+# (see CS6381_MW/LoadProfile.py) in place of -f, and of -i unless the profile
+# is constant. The latency of a publication then counts from when it was due;
+# latency_analysis.py breaks the runs down per offered rate (load.csv) to
+# find where each dissemination strategy saturates.
+#
+# With -K publishers and subscribers estimate the offset of their clock from
+# the one of the discovery service every -K seconds (CS6381_MW/ClockSync.py)
+# and the latencies are corrected with it.
+#
+# With the ZooKeeper lookup strategy a ZooKeeper server must be running (-z).
+# With DHT, the harness writes a ring of -N discovery nodes on localhost.
+#
+# Example (1 and 5 publishers, 10 Hz, 3 topics, Centralized and ZooKeeper
+# lookup, both ways of dissemination, 100 iterations each):
+#
+#    python3 local_bench.py -P 1,5 -S 2 -f 10 -T 3 -L Centralized,ZooKeeper -D Direct,Broker -i 100
+
+import os
+import sys
+import time
+import json
+import queue
+import socket
+import sqlite3
+import argparse # argument parsing
+import threading
+import subprocess
+import configparser
+import logging # for logging. Use it in place of print statements.
+
+# the applications live in the parent directory
+REPO_DIR = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+sys.path.append (REPO_DIR)
+
+from CS6381_MW.DhtRing import hash_func
+
+
+##################################
+#       LocalBench class
+##################################
+class LocalBench ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, logger):
+    self.logger = logger
+    self.pub_counts = None   # list of numbers of publishers
+    self.sub_counts = None   # list of numbers of subscribers
+    self.frequencies = None  # list of publication frequencies
+    self.topic_counts = None # list of numbers of topics per entity
+    self.lookups = None      # list of lookup strategies
+    self.disseminations = None # list of dissemination strategies
+    self.iters = None        # iterations per publisher
+    self.load = None         # load profile of the publishers, None for closed-loop
+    self.clock_sync = 0      # seconds between clock offset estimations, 0 for none
+    self.num_discovery = None # DHT nodes, or discovery replicas with ZooKeeper
+    self.quiet_period = None # seconds without data after which a subscriber is done
+    self.run_timeout = None  # seconds a run may take
+    self.zookeeper = None    # addr:port of ZooKeeper
+    self.base_config = None  # config.ini the runs start from
+    self.out_dir = None      # where the runs and the report go
+    self.results = []        # one row per run
+
+  ########################################
+  # configure
+  ########################################
+  def configure (self, args):
+    ''' Initialize the object '''
+
+    try:
+      self.logger.info ("LocalBench::configure")
+
+      self.pub_counts = [int (count) for count in args.publishers.split (",")]
+      self.sub_counts = [int (count) for count in args.subscribers.split (",")]
+      self.frequencies = [float (freq) for freq in args.frequencies.split (",")]
+      self.topic_counts = [int (count) for count in args.topics.split (",")]
+      self.lookups = args.lookups.split (",")
+      self.disseminations = args.disseminations.split (",")
+      self.iters = args.iters
+      self.load = args.load
+      self.clock_sync = args.clock_sync
+      self.num_discovery = args.num_discovery
+      self.quiet_period = args.quiet_period
+      self.run_timeout = args.run_timeout
+      self.zookeeper = args.zookeeper
+      self.base_config = args.config
+      self.out_dir = os.path.abspath (args.out_dir)
+      os.makedirs (self.out_dir, exist_ok=True)
+
+      self.logger.info ("LocalBench::configure - configuration complete")
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # a port nobody listens on right now
+  ########################################
+  def free_port (self):
+    with socket.socket (socket.AF_INET, socket.SOCK_STREAM) as s:
+      s.bind (("localhost", 0))
+      return s.getsockname ()[1]
+
+  ########################################
+  # config.ini of a run
+  ########################################
+  def write_config (self, run_dir, lookup, dissemination):
+    config = configparser.ConfigParser ()
+    config.optionxform = str # keep the case of the keys
+    config.read (self.base_config)
+    config["Discovery"]["Strategy"] = lookup
+    config["Dissemination"]["Strategy"] = dissemination
+    if not config.has_section ("Metrics"):
+      config.add_section ("Metrics")
+    config["Metrics"]["Sink"] = "SQLite"
+    config["Metrics"]["Path"] = os.path.join (run_dir, "metrics.db")
+
+    path = os.path.join (run_dir, "config.ini")
+    with open (path, "w") as f:
+      config.write (f)
+    return path, config
+
+  ########################################
+  # ring of discovery nodes on localhost for the DHT lookup
+  ########################################
+  def write_dht_file (self, run_dir):
+    nodes = []
+    for i in range (self.num_discovery):
+      port = self.free_port ()
+      id = "disc{}".format (i + 1)
+      nodes.append ({"id": id, "hash": hash_func (id + ":127.0.0.1:" + str (port)), "IP": "127.0.0.1", "port": port, "host": "localhost"})
+
+    path = os.path.join (run_dir, "dht.json")
+    with open (path, "w") as f:
+      json.dump ({"dht": nodes}, f)
+    return path, nodes
+
+  ########################################
+  # start an application, its output goes to run_dir/<name>.out
+  ########################################
+  def spawn (self, run_dir, name, script, args):
+    log = open (os.path.join (run_dir, name + ".out"), "w")
+    proc = subprocess.Popen ([sys.executable, script] + [str (arg) for arg in args], cwd=REPO_DIR, stdout=log, stderr=subprocess.STDOUT)
+    log.close ()
+    proc.name = name
+    return proc
+
+  ########################################
+  # tell exits apart from the event queue
+  ########################################
+  def watch_exit (self, proc, exits):
+    threading.Thread (target=lambda: exits.put ((proc, proc.wait ())), daemon=True).start ()
+
+  ########################################
+  # stop processes, harder if they do not listen
+  ########################################
+  def stop (self, procs):
+    for proc in procs:
+      if proc.poll () == None:
+        proc.terminate ()
+    deadline = time.time () + 5
+    for proc in procs:
+      try:
+        proc.wait (max (deadline - time.time (), 0))
+      except subprocess.TimeoutExpired:
+        proc.kill ()
+        proc.wait ()
+
+  ########################################
+  # wait for the ephemeral discovery leader of the last run to go away
+  ########################################
+  def wait_for_zookeeper_cleanup (self):
+    from CS6381_MW.InMemoryZooKeeper import zookeeper_client
+
+    zk_client = zookeeper_client (self.zookeeper)
+    zk_client.start ()
+    gone = threading.Event ()
+    zk_client.DataWatch ("/discovery/leader", lambda data, stat: gone.set () if stat == None else None)
+    if not gone.wait (30):
+      self.logger.warning ("LocalBench::wait_for_zookeeper_cleanup - /discovery/leader is still there")
+    zk_client.stop ()
+    zk_client.close ()
+
+  ########################################
+  # one run of the matrix
+  ########################################
+  def run (self, num_pubs, num_subs, freq, num_topics, lookup, dissemination):
+    ''' Start everything, wait for the subscribers, collect the latencies '''
+
+    try:
+      name = "P{}S{}F{:g}T{}L{}D{}".format (num_pubs, num_subs, freq, num_topics, lookup[0], dissemination[0])
+      self.logger.info ("LocalBench::run - %s", name)
+
+      run_dir = os.path.join (self.out_dir, name)
+      os.makedirs (run_dir, exist_ok=True)
+      for leftover in ("metrics.db", "metrics.db-wal", "metrics.db-shm"):
+        if os.path.exists (os.path.join (run_dir, leftover)):
+          os.remove (os.path.join (run_dir, leftover))
+
+      config_path, config = self.write_config (run_dir, lookup, dissemination)
+      common = ["-c", config_path, "-P", num_pubs, "-S", num_subs, "-l", logging.INFO]
+      discovery = "localhost:5555" # only used by the Centralized lookup
+      dht_path = os.path.join (run_dir, "dht.json")
+      infrastructure = [] # discovery and brokers, stopped once the subscribers are done
+
+      # one broker per group of topics, all of them registered before anybody is ready
+      groups = list (config["GroupToTopicMapping"]) if (dissemination == "Broker") else []
+      common_disc = common + ["-B", len (groups)]
+
+      if (lookup == "DHT"):
+        dht_path, nodes = self.write_dht_file (run_dir)
+        for node in nodes:
+          infrastructure.append (self.spawn (run_dir, node["id"], "DiscoveryAppln.py", common_disc + ["-n", node["id"], "-a", "127.0.0.1", "-p", node["port"], "-j", dht_path, "-t", 3600]))
+      elif (lookup == "ZooKeeper"):
+        for i in range (self.num_discovery):
+          infrastructure.append (self.spawn (run_dir, "disc{}".format (i + 1), "DiscoveryAppln.py", common_disc + ["-n", "disc{}".format (i + 1), "-a", "localhost", "-p", self.free_port (), "-s", self.free_port (), "-z", self.zookeeper, "-t", 3600]))
+      else:
+        port = self.free_port ()
+        discovery = "localhost:{}".format (port)
+        infrastructure.append (self.spawn (run_dir, "disc1", "DiscoveryAppln.py", common_disc + ["-n", "disc1", "-p", port, "-t", 3600]))
+
+      for i, group in enumerate (groups):
+        infrastructure.append (self.spawn (run_dir, "broker{}".format (i + 1), "BrokerAppln.py", ["-c", config_path, "-n", "broker{}".format (i + 1), "-a", "localhost", "-p", self.free_port (), "-d", discovery, "-j", dht_path, "-z", self.zookeeper, "-g", group, "-t", 3600]))
+
+      start = time.time ()
+      load = ["--load", self.load] if self.load else []
+      clock_sync = ["--clock_sync", self.clock_sync] if self.clock_sync else []
+      pubs = [self.spawn (run_dir, "pub{}".format (i + 1), "PublisherAppln.py", common + load + clock_sync + ["-n", "pub{}".format (i + 1), "-a", "localhost", "-p", self.free_port (), "-d", discovery, "-j", dht_path, "-z", self.zookeeper, "-T", num_topics, "-f", freq, "-i", self.iters, "-en", name]) for i in range (num_pubs)]
+      subs = [self.spawn (run_dir, "sub{}".format (i + 1), "SubscriberAppln.py", common + clock_sync + ["-n", "sub{}".format (i + 1), "-p", self.free_port (), "-d", discovery, "-j", dht_path, "-z", self.zookeeper, "-T", num_topics, "-f", max (int (freq), 1), "-t", self.quiet_period]) for i in range (num_subs)]
+
+      # wait for the subscribers to be done, or anything else to die on us
+      exits = queue.Queue ()
+      for proc in infrastructure + pubs + subs:
+        self.watch_exit (proc, exits)
+
+      status = "ok"
+      running_subs = set (subs)
+      while running_subs:
+        try:
+          proc, code = exits.get (timeout=max (start + self.run_timeout - time.time (), 0))
+        except queue.Empty:
+          status = "timeout"
+          break
+        if proc in running_subs:
+          running_subs.discard (proc)
+        elif proc in infrastructure:
+          status = "{} exited".format (proc.name)
+          break
+        if code != 0:
+          status = "{} exited with {}".format (proc.name, code)
+          break
+      wall = time.time () - start
+
+      self.stop (infrastructure + pubs + subs)
+      if (lookup == "ZooKeeper"):
+        self.wait_for_zookeeper_cleanup ()
+
+      self.results.append (dict (self.summarize (run_dir), name=name, pubs=num_pubs, subs=num_subs, freq=freq, topics=num_topics, lookup=lookup, dissemination=dissemination, status=status, wall=wall))
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # latencies of a run from the metrics.db of its subscribers
+  ########################################
+  def summarize (self, run_dir):
+    rows = []
+    path = os.path.join (run_dir, "metrics.db")
+    if os.path.exists (path):
+      connection = sqlite3.connect (path)
+      try:
+        rows = connection.execute ("SELECT latency_sec, received_at FROM latencies").fetchall ()
+      except sqlite3.OperationalError:
+        rows = [] # nobody got as far as creating the table
+      connection.close ()
+
+    latencies = sorted (row[0] for row in rows)
+    received = [row[1] for row in rows if row[1] != None]
+    window = max (received) - min (received) if len (received) > 1 else 0.0
+
+    def percentile (p):
+      return 1000 * latencies[min (len (latencies) - 1, int (p / 100 * len (latencies)))] if latencies else 0.0
+
+    return {
+      "received": len (latencies),
+      "throughput": len (received) / window if window > 0 else 0.0,
+      "p50": percentile (50),
+      "p95": percentile (95),
+      "p99": percentile (99),
+      "max": 1000 * latencies[-1] if latencies else 0.0,
+    }
+
+  ########################################
+  # report
+  ########################################
+  def report (self):
+    columns = ["name", "pubs", "subs", "freq", "topics", "lookup", "dissemination", "status", "wall", "received", "throughput", "p50", "p95", "p99", "max"]
+    with open (os.path.join (self.out_dir, "report.csv"), "w") as f:
+      f.write (",".join (columns) + "\n")
+      for row in self.results:
+        f.write (",".join (str (row[column]) for column in columns) + "\n")
+
+    self.logger.info ("**********************************")
+    self.logger.info ("LocalBench::report - latencies in ms, throughput in publications received per second")
+    self.logger.info ("{:>16} {:>11} {:>8} {:>9} {:>10} {:>9} {:>9} {:>9} {:>9}  {}".format ("run", "lookup", "wall s", "received", "msgs/s", "p50", "p95", "p99", "max", "status"))
+    for row in self.results:
+      self.logger.info ("{:>16} {:>11} {:>8.1f} {:>9} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}  {}".format (row["name"], row["lookup"], row["wall"], row["received"], row["throughput"], row["p50"], row["p95"], row["p99"], row["max"], row["status"]))
+    self.logger.info ("report written to %s", os.path.join (self.out_dir, "report.csv"))
+    self.logger.info ("**********************************")
+
+  ########################################
+  # driver
+  ########################################
+  def driver (self):
+    ''' Driver program '''
+
+    try:
+      self.logger.info ("LocalBench::driver")
+      for lookup in self.lookups:
+        for dissemination in self.disseminations:
+          for num_pubs in self.pub_counts:
+            for num_subs in self.sub_counts:
+              for freq in self.frequencies:
+                for num_topics in self.topic_counts:
+                  self.run (num_pubs, num_subs, freq, num_topics, lookup, dissemination)
+      self.report ()
+
+    except Exception as e:
+      raise e
+
+
+###################################
+#
+# Parse command line arguments
+#
+###################################
+def parseCmdLineArgs ():
+  # instantiate a ArgumentParser object
+  parser = argparse.ArgumentParser (description="Local multi-process benchmark harness")
+
+  parser.add_argument ("-P", "--publishers", default="1,5", help="Comma separated numbers of publishers, default 1,5")
+
+  parser.add_argument ("-S", "--subscribers", default="1,5", help="Comma separated numbers of subscribers, default 1,5")
+
+  parser.add_argument ("-f", "--frequencies", default="10", help="Comma separated publication frequencies in Hz, default 10")
+
+  parser.add_argument ("-T", "--topics", default="5", help="Comma separated numbers of topics each publisher and subscriber picks (1 to 9), default 5")
+
+  parser.add_argument ("-L", "--lookups", default="Centralized", help="Comma separated lookup strategies among Centralized, DHT and ZooKeeper, default Centralized")
+
+  parser.add_argument ("-D", "--disseminations", default="Direct", help="Comma separated dissemination strategies among Direct and Broker, default Direct")
+
+  parser.add_argument ("-i", "--iters", type=int, default=100, help="Iterations of every publisher, default 100")
+
+  parser.add_argument ("-G", "--load", default=None, help="Load profile of the publishers, e.g., poisson:step:50,50,10,8 (see CS6381_MW/LoadProfile.py), default none: closed-loop at -f for -i iterations")
+
+  parser.add_argument ("-K", "--clock_sync", type=float, default=0, help="Seconds between the clock offset estimations of the publishers and subscribers, default 0: none")
+
+  parser.add_argument ("-N", "--num_discovery", type=int, default=3, help="Discovery nodes in the DHT ring, or discovery replicas with ZooKeeper, default 3")
+
+  parser.add_argument ("-q", "--quiet_period", type=int, default=5, help="Seconds without publications (since its lookup or its last publication) after which a subscriber is done, default 5")
+
+  parser.add_argument ("-W", "--run_timeout", type=float, default=600, help="Seconds after which a run is stopped, default 600")
+
+  parser.add_argument ("-z", "--zookeeper", default="localhost:2181", help="Address of the ZooKeeper server for the ZooKeeper lookup, default localhost:2181")
+
+  parser.add_argument ("-c", "--config", default=os.path.join (REPO_DIR, "config.ini"), help="config.ini the runs start from, default the one of the repository")
+
+  parser.add_argument ("-o", "--out_dir", default="local_bench", help="Directory for the logs, metrics and report of the runs, default local_bench")
+
+  parser.add_argument ("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+
+  return parser.parse_args()
+
+
+###################################
+#
+# Main program
+#
+###################################
+def main ():
+  try:
+    # obtain a system wide logger and initialize it to debug level to begin with
+    logging.info ("Main - acquire a child logger and then log messages in the child")
+    logger = logging.getLogger ("LocalBench")
+
+    # first parse the arguments
+    logger.debug ("Main: parse command line arguments")
+    args = parseCmdLineArgs ()
+
+    # reset the log level to as specified
+    logger.debug ("Main: resetting log level to {}".format (args.loglevel))
+    logger.setLevel (args.loglevel)
+    logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
+
+    # Obtain the benchmark object
+    logger.debug ("Main: obtain the LocalBench object")
+    bench = LocalBench (logger)
+
+    # configure the object
+    logger.debug ("Main: configure the LocalBench object")
+    bench.configure (args)
+
+    # now invoke the driver program
+    logger.debug ("Main: invoke the LocalBench driver")
+    bench.driver ()
+
+  except Exception as e:
+    logger.error ("Exception caught in main - {}".format (e))
+    return
+
+
+###################################
+#
+# Main entry point
+#
+###################################
+if __name__ == "__main__":
+
+  # set underlying default logging capabilities
+  logging.basicConfig (level=logging.DEBUG,
+                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+  main ()
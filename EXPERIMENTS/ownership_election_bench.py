@@ -0,0 +1,353 @@
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose:
+#
+# Benchmark of the ownership strength election of the publishers.
+#
+# Every publisher of a topic creates a sequential, ephemeral node under
+# /topic/<topic> and the one with the smallest sequence number disseminates.
+# This script starts P publishers of one topic against a running ZooKeeper
+# (each one a PublisherAppln object with its own ZooKeeper session, no
+# middleware, no discovery), kills publishers one at a time and counts the
+# ZooKeeper requests the surviving publishers make until things settle down,
+# along with the time it takes until a new leader takes over.
+#
+# Two recipes can be compared:
+#
+#    predecessor  what PublisherAppln does: watch only the node before ours
+#    herd         the old recipe: a ChildrenWatch on the topic node, so every
+#                 publisher re-reads all the children on every change
+#
+# Example (ZooKeeper on localhost:2181):
+#
+#    python3 ownership_election_bench.py -P 10,50,100,200 -f 5 -r both
+
+import os
+import sys
+import time
+import random # random number generation
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+import collections
+
+# we reuse the publisher application which lives in the parent directory
+sys.path.append (os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from kazoo.client import KazooClient
+from CS6381_MW.InMemoryZooKeeper import zookeeper_client
+
+from PublisherAppln import PublisherAppln
+
+
+##################################
+# Kazoo client that counts the requests it sends to ZooKeeper
+##################################
+class CountingKazooClient (KazooClient):
+
+  def __init__ (self, *args, **kwargs):
+    super ().__init__ (*args, **kwargs)
+    self.ops = collections.Counter ()  # request type -> count
+
+  # every synchronous and asynchronous operation of kazoo ends up here
+  def _call (self, request, async_object):
+    self.ops[type (request).__name__] += 1
+    return super ()._call (request, async_object)
+
+
+##################################
+# Counting client for the address, the in-memory stand-in counts by itself
+##################################
+def counting_zookeeper_client (hosts):
+  if hosts.startswith ("inmemory"):
+    return zookeeper_client (hosts)
+  return CountingKazooClient (hosts=hosts)
+
+
+##################################
+# Publisher with the old election recipe, kept for comparison
+##################################
+class HerdPublisherAppln (PublisherAppln):
+
+  def set_up_watch_for_topic_ownership_strength (self, path_to_topic, topic):
+    @self.zk_client.ChildrenWatch (path_to_topic)
+    def watch_children (children):
+      if (len (children) == 0):
+        return
+
+      # Find the lowest sequence number, that indicates who is the leader
+      min_node_sequence = min (int (child[child.rfind ('-') + 1:]) for child in children)
+      if (min_node_sequence == self.topic_to_strength_ownership[topic]):
+        self.am_leader_for_topic[topic] = True
+      return
+
+
+##################################
+#       ElectionBench class
+##################################
+class ElectionBench ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, logger):
+    self.logger = logger
+    self.zookeeper_addr = None
+    self.pub_counts = None   # list of number of publishers to try
+    self.failovers = None    # publishers killed per publisher count
+    self.recipes = None      # list of recipes to compare
+    self.kill = None         # leader or random
+    self.quiet_period = None # seconds without requests after which we consider things settled
+    self.timeout = None      # seconds to wait for a new leader
+    self.rng = None
+    self.pub_logger = None   # logger handed to the publisher objects
+    self.results = []        # one row per (recipe, publisher count)
+
+  ########################################
+  # configure
+  ########################################
+  def configure (self, args):
+    ''' Initialize the object '''
+
+    try:
+      self.logger.info ("ElectionBench::configure")
+
+      self.zookeeper_addr = args.zookeeper
+      self.pub_counts = [int (count) for count in args.publishers.split (",")]
+      self.failovers = args.failovers
+      self.recipes = ["predecessor", "herd"] if args.recipe == "both" else [args.recipe]
+      self.kill = args.kill
+      self.quiet_period = args.quiet_period
+      self.timeout = args.timeout
+      self.rng = random.Random (args.seed)
+
+      # the publishers log a line per election change, keep them quiet unless debugging
+      self.pub_logger = logging.getLogger ("PublisherAppln")
+      self.pub_logger.setLevel (logging.DEBUG if args.loglevel == logging.DEBUG else logging.WARNING)
+
+      self.logger.info ("ElectionBench::configure - configuration complete")
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # start a publisher of the topic with its own session
+  ########################################
+  def start_publisher (self, recipe, name, topic):
+    pub = HerdPublisherAppln (self.pub_logger) if recipe == "herd" else PublisherAppln (self.pub_logger)
+    pub.name = name
+    pub.topiclist = [topic]
+    pub.zk_client = counting_zookeeper_client (self.zookeeper_addr)
+    pub.zk_client.start ()
+    pub.create_zookeeper_nodes ()
+    return pub
+
+  ########################################
+  # stop a publisher, its ephemeral nodes go away with the session
+  ########################################
+  def stop_publisher (self, pub):
+    pub.zk_client.stop ()
+    pub.zk_client.close ()
+
+  ########################################
+  # requests sent by the given publishers so far
+  ########################################
+  def count_ops (self, pubs):
+    total = collections.Counter ()
+    for pub in pubs:
+      total.update (pub.zk_client.ops)
+    return total
+
+  ########################################
+  # the current leader of the topic, if any
+  ########################################
+  def leader (self, pubs, topic):
+    for pub in pubs:
+      if (pub.am_leader_for_topic[topic]):
+        return pub
+    return None
+
+  ########################################
+  # wait until the publishers stop sending requests
+  ########################################
+  def wait_until_quiet (self, pubs):
+    last = sum (self.count_ops (pubs).values ())
+    quiet_since = time.time ()
+    while (time.time () - quiet_since < self.quiet_period):
+      time.sleep (0.01)
+      now = sum (self.count_ops (pubs).values ())
+      if (now != last):
+        last = now
+        quiet_since = time.time ()
+
+  ########################################
+  # run the failovers for one recipe and publisher count
+  ########################################
+  def run (self, recipe, pub_count):
+    ''' Start the publishers, kill some of them, count requests '''
+
+    try:
+      self.logger.info ("ElectionBench::run - recipe %s with %d publishers", recipe, pub_count)
+
+      topic = "bench-{}-{}-{}".format (recipe, pub_count, int (time.time () * 1000))
+      pubs = [self.start_publisher (recipe, "{}-pub{}".format (topic, i), topic) for i in range (pub_count)]
+      self.wait_until_quiet (pubs)
+
+      ops_per_failover = []
+      latencies = []
+      breakdown = collections.Counter ()
+      for i in range (min (self.failovers, pub_count - 1)):
+        old_leader = self.leader (pubs, topic)
+        victim = old_leader if (self.kill == "leader" or old_leader == None) else self.rng.choice (pubs)
+        pubs.remove (victim)
+
+        before = self.count_ops (pubs)
+        start = time.time ()
+        self.stop_publisher (victim)
+
+        # wait for a new leader when we killed the leader
+        if (victim is old_leader):
+          while (self.leader (pubs, topic) == None):
+            if (time.time () - start > self.timeout):
+              raise Exception ("no new leader after {} s".format (self.timeout))
+            time.sleep (0.001)
+          latencies.append (time.time () - start)
+
+        self.wait_until_quiet (pubs)
+        ops = self.count_ops (pubs)
+        ops.subtract (before)
+        breakdown.update (ops)
+        ops_per_failover.append (sum (ops.values ()))
+
+      for pub in pubs:
+        self.stop_publisher (pub)
+
+      # clean up the topic node
+      cleanup = zookeeper_client (self.zookeeper_addr)
+      cleanup.start ()
+      cleanup.delete ("/topic/" + topic, recursive=True)
+      cleanup.stop ()
+      cleanup.close ()
+
+      failovers = max (len (ops_per_failover), 1)
+      self.results.append ({
+        "recipe": recipe,
+        "publishers": pub_count,
+        "failovers": len (ops_per_failover),
+        "ops": sum (ops_per_failover) / failovers,
+        "max_ops": max (ops_per_failover, default=0),
+        "latency_ms": 1000 * sum (latencies) / max (len (latencies), 1),
+        "breakdown": {name: count / failovers for name, count in breakdown.items ()},
+      })
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # report
+  ########################################
+  def report (self):
+    self.logger.info ("**********************************")
+    self.logger.info ("ElectionBench::report - ZooKeeper requests per failover (kill = %s)", self.kill)
+    self.logger.info ("{:>12} {:>10} {:>9} {:>10} {:>9} {:>12}  {}".format ("recipe", "publishers", "failovers", "ops/fail", "max ops", "latency ms", "breakdown"))
+    for row in self.results:
+      breakdown = ", ".join ("{} {:.1f}".format (name, count) for name, count in sorted (row["breakdown"].items ()))
+      self.logger.info ("{:>12} {:>10} {:>9} {:>10.1f} {:>9} {:>12.2f}  {}".format (row["recipe"], row["publishers"], row["failovers"], row["ops"], row["max_ops"], row["latency_ms"], breakdown))
+    self.logger.info ("**********************************")
+
+  ########################################
+  # driver
+  ########################################
+  def driver (self):
+    ''' Driver program '''
+
+    try:
+      self.logger.info ("ElectionBench::driver")
+      for pub_count in self.pub_counts:
+        for recipe in self.recipes:
+          self.run (recipe, pub_count)
+      self.report ()
+
+    except Exception as e:
+      raise e
+
+
+###################################
+#
+# Parse command line arguments
+#
+###################################
+def parseCmdLineArgs ():
+  # instantiate a ArgumentParser object
+  parser = argparse.ArgumentParser (description="Ownership strength election benchmark")
+
+  parser.add_argument ("-z", "--zookeeper", default="localhost:2181", help="Address of the Zookeeper instance, inmemory://<name> for the in-memory stand-in")
+
+  parser.add_argument ("-P", "--publishers", default="10,50,100", help="Comma separated numbers of publishers of the topic, default 10,50,100")
+
+  parser.add_argument ("-f", "--failovers", type=int, default=5, help="Publishers killed per publisher count, default 5")
+
+  parser.add_argument ("-r", "--recipe", default="both", choices=["predecessor", "herd", "both"], help="Election recipe to measure, default both")
+
+  parser.add_argument ("-k", "--kill", default="leader", choices=["leader", "random"], help="Which publisher to kill, default leader")
+
+  parser.add_argument ("-q", "--quiet_period", type=float, default=0.5, help="Seconds without requests after which a failover is over, default 0.5")
+
+  parser.add_argument ("-t", "--timeout", type=float, default=10, help="Seconds to wait for a new leader, default 10")
+
+  parser.add_argument ("-S", "--seed", type=int, default=42, help="Random seed, default 42")
+
+  parser.add_argument ("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+
+  return parser.parse_args()
+
+
+###################################
+#
+# Main program
+#
+###################################
+def main ():
+  try:
+    # obtain a system wide logger and initialize it to debug level to begin with
+    logging.info ("Main - acquire a child logger and then log messages in the child")
+    logger = logging.getLogger ("ElectionBench")
+
+    # first parse the arguments
+    logger.debug ("Main: parse command line arguments")
+    args = parseCmdLineArgs ()
+
+    # reset the log level to as specified
+    logger.debug ("Main: resetting log level to {}".format (args.loglevel))
+    logger.setLevel (args.loglevel)
+    logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
+
+    # Obtain the benchmark object
+    logger.debug ("Main: obtain the ElectionBench object")
+    bench = ElectionBench (logger)
+
+    # configure the object
+    logger.debug ("Main: configure the ElectionBench object")
+    bench.configure (args)
+
+    # now invoke the driver program
+    logger.debug ("Main: invoke the ElectionBench driver")
+    bench.driver ()
+
+  except Exception as e:
+    logger.error ("Exception caught in main - {}".format (e))
+    return
+
+
+###################################
+#
+# Main entry point
+#
+###################################
+if __name__ == "__main__":
+
+  # set underlying default logging capabilities
+  logging.basicConfig (level=logging.DEBUG,
+                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+  main ()
@@ -0,0 +1,301 @@
+# Author: Aniruddha Gokhale
+# Vanderbilt University
+#
+# Purpose:
+#
+# Benchmark of the ZooKeeper bootstrap of the publishers at cold start.
+#
+# Before a publisher can publish it creates its /pubs node, a sequential node
+# (ownership strength) under every topic it publishes and finds out if it is
+# the leader of the topic or whom it has to watch. This script starts P
+# publishers at the same time against a running ZooKeeper (each one a
+# PublisherAppln object in its own thread with its own session, no middleware,
+# no discovery) and measures, per publisher, the time from the start of the
+# bootstrap until the ownership of all its topics is resolved, i.e., until it
+# could send its first publication. PublisherAppln itself logs the time to its
+# first publication in a full deployment.
+#
+# Two variants can be compared:
+#
+#    pipelined  what PublisherAppln does: one multi-op transaction for all the
+#               nodes, then asynchronous get_children/exists for all topics
+#    serial     the old way: ensure_path, create and election per topic, one
+#               synchronous round trip after the other
+#
+# Example (ZooKeeper on localhost:2181, 9 topics per publisher):
+#
+#    python3 zk_bootstrap_bench.py -P 1,10,50,100 -T 9 -v both
+
+import os
+import sys
+import time
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+import threading
+import collections
+
+# we reuse the publisher application which lives in the parent directory
+sys.path.append (os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+
+from PublisherAppln import PublisherAppln
+from topic_selector import TopicSelector
+
+from CS6381_MW.InMemoryZooKeeper import zookeeper_client
+from ownership_election_bench import counting_zookeeper_client
+
+
+##################################
+# Publisher with the old, serial bootstrap, kept for comparison
+##################################
+class SerialPublisherAppln (PublisherAppln):
+
+  def create_zookeeper_nodes (self):
+    self.zk_client.create ('/pubs/' + self.name, ephemeral=True, makepath=True, value=bytes (self.name, 'utf-8'))
+
+    for topic in self.topiclist:
+      path_to_topic = '/topic/' + topic
+      self.zk_client.ensure_path (path_to_topic)
+      path_without_sequence = path_to_topic + '/' + self.name + '-'
+      new_node_path = self.zk_client.create (path_without_sequence, sequence=True, ephemeral=True, value=bytes (topic, 'utf-8'))
+      self.topic_to_strength_ownership[topic] = int (new_node_path.replace (path_without_sequence, ""))
+      self.am_leader_for_topic[topic] = False
+
+      # synchronous election: read the children and watch the predecessor
+      my_sequence = self.topic_to_strength_ownership[topic]
+      sequences = {int (child[child.rfind ('-') + 1:]): child for child in self.zk_client.get_children (path_to_topic)}
+      smaller = [sequence for sequence in sequences if sequence < my_sequence]
+      if (len (smaller) == 0):
+        self.am_leader_for_topic[topic] = True
+      else:
+        self.zk_client.exists (path_to_topic + '/' + sequences[max (smaller)])
+
+
+##################################
+#       BootstrapBench class
+##################################
+class BootstrapBench ():
+
+  ########################################
+  # constructor
+  ########################################
+  def __init__ (self, logger):
+    self.logger = logger
+    self.zookeeper_addr = None
+    self.pub_counts = None   # list of number of publishers to try
+    self.num_topics = None   # topics per publisher
+    self.variants = None     # list of variants to compare
+    self.timeout = None      # seconds to wait for a publisher to be ready
+    self.pub_logger = None   # logger handed to the publisher objects
+    self.results = []        # one row per (variant, publisher count)
+
+  ########################################
+  # configure
+  ########################################
+  def configure (self, args):
+    ''' Initialize the object '''
+
+    try:
+      self.logger.info ("BootstrapBench::configure")
+
+      self.zookeeper_addr = args.zookeeper
+      self.pub_counts = [int (count) for count in args.publishers.split (",")]
+      self.num_topics = args.num_topics
+      self.variants = ["pipelined", "serial"] if args.variant == "both" else [args.variant]
+      self.timeout = args.timeout
+
+      # keep the publishers quiet unless debugging
+      self.pub_logger = logging.getLogger ("PublisherAppln")
+      self.pub_logger.setLevel (logging.DEBUG if args.loglevel == logging.DEBUG else logging.WARNING)
+
+      self.logger.info ("BootstrapBench::configure - configuration complete")
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # bootstrap one publisher, runs in its own thread
+  ########################################
+  def bootstrap (self, pub, barrier, timings):
+    try:
+      pub.zk_client.start ()
+
+      # everybody starts at the same time, as in a cold start of the system
+      barrier.wait ()
+      start = time.time ()
+      pub.create_zookeeper_nodes ()
+      while (len (pub.topics_pending_election) > 0):
+        if (time.time () - start > self.timeout):
+          raise Exception ("{} not ready after {} s".format (pub.name, self.timeout))
+        time.sleep (0.0005)
+      timings[pub.name] = time.time () - start
+
+    except Exception as e:
+      self.logger.error ("BootstrapBench::bootstrap - {}".format (e))
+
+  ########################################
+  # percentile of a sorted list
+  ########################################
+  def percentile (self, values, p):
+    if (len (values) == 0):
+      return 0.0
+    return values[min (len (values) - 1, int (p / 100 * len (values)))]
+
+  ########################################
+  # start pub_count publishers at once with the given variant
+  ########################################
+  def run (self, variant, pub_count):
+    ''' Bootstrap the publishers, measure the time until they are ready '''
+
+    try:
+      self.logger.info ("BootstrapBench::run - variant %s with %d publishers", variant, pub_count)
+
+      # every run uses its own topics so that all the nodes are created from scratch
+      prefix = "boot-{}-{}-{}".format (variant, pub_count, int (time.time () * 1000))
+      topics = ["{}-{}".format (prefix, topic) for topic in TopicSelector ().interest (self.num_topics)]
+
+      pubs = []
+      for i in range (pub_count):
+        pub = SerialPublisherAppln (self.pub_logger) if variant == "serial" else PublisherAppln (self.pub_logger)
+        pub.name = "{}-pub{}".format (prefix, i)
+        pub.topiclist = topics
+        pub.zk_client = counting_zookeeper_client (self.zookeeper_addr)
+        pubs.append (pub)
+
+      timings = {}
+      barrier = threading.Barrier (pub_count)
+      threads = [threading.Thread (target=self.bootstrap, args=(pub, barrier, timings)) for pub in pubs]
+      for thread in threads:
+        thread.start ()
+      for thread in threads:
+        thread.join ()
+
+      ops = collections.Counter ()
+      for pub in pubs:
+        ops.update (pub.zk_client.ops)
+        pub.zk_client.stop ()
+        pub.zk_client.close ()
+
+      # clean up the topic nodes
+      cleanup = zookeeper_client (self.zookeeper_addr)
+      cleanup.start ()
+      for topic in topics:
+        cleanup.delete ("/topic/" + topic, recursive=True)
+      cleanup.stop ()
+      cleanup.close ()
+
+      values = sorted (timings.values ())
+      self.results.append ({
+        "variant": variant,
+        "publishers": pub_count,
+        "ready": len (values),
+        "p50": 1000 * self.percentile (values, 50),
+        "p95": 1000 * self.percentile (values, 95),
+        "max": 1000 * (values[-1] if values else 0.0),
+        "ops": sum (ops.values ()) / pub_count,
+      })
+
+    except Exception as e:
+      raise e
+
+  ########################################
+  # report
+  ########################################
+  def report (self):
+    self.logger.info ("**********************************")
+    self.logger.info ("BootstrapBench::report - time until ready to publish, %d topics per publisher", self.num_topics)
+    self.logger.info ("{:>10} {:>10} {:>6} {:>10} {:>10} {:>10} {:>9}".format ("variant", "publishers", "ready", "p50 ms", "p95 ms", "max ms", "ops/pub"))
+    for row in self.results:
+      self.logger.info ("{:>10} {:>10} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>9.1f}".format (row["variant"], row["publishers"], row["ready"], row["p50"], row["p95"], row["max"], row["ops"]))
+    self.logger.info ("**********************************")
+
+  ########################################
+  # driver
+  ########################################
+  def driver (self):
+    ''' Driver program '''
+
+    try:
+      self.logger.info ("BootstrapBench::driver")
+      for pub_count in self.pub_counts:
+        for variant in self.variants:
+          self.run (variant, pub_count)
+      self.report ()
+
+    except Exception as e:
+      raise e
+
+
+###################################
+#
+# Parse command line arguments
+#
+###################################
+def parseCmdLineArgs ():
+  # instantiate a ArgumentParser object
+  parser = argparse.ArgumentParser (description="Publisher ZooKeeper bootstrap benchmark")
+
+  parser.add_argument ("-z", "--zookeeper", default="localhost:2181", help="Address of the Zookeeper instance, inmemory://<name> for the in-memory stand-in")
+
+  parser.add_argument ("-P", "--publishers", default="1,10,50", help="Comma separated numbers of publishers starting together, default 1,10,50")
+
+  parser.add_argument ("-T", "--num_topics", type=int, choices=range(1,10), default=9, help="Number of topics per publisher, default 9")
+
+  parser.add_argument ("-v", "--variant", default="both", choices=["pipelined", "serial", "both"], help="Bootstrap variant to measure, default both")
+
+  parser.add_argument ("-t", "--timeout", type=float, default=30, help="Seconds to wait for a publisher to be ready, default 30")
+
+  parser.add_argument ("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+
+  return parser.parse_args()
+
+
+###################################
+#
+# Main program
+#
+###################################
+def main ():
+  try:
+    # obtain a system wide logger and initialize it to debug level to begin with
+    logging.info ("Main - acquire a child logger and then log messages in the child")
+    logger = logging.getLogger ("BootstrapBench")
+
+    # first parse the arguments
+    logger.debug ("Main: parse command line arguments")
+    args = parseCmdLineArgs ()
+
+    # reset the log level to as specified
+    logger.debug ("Main: resetting log level to {}".format (args.loglevel))
+    logger.setLevel (args.loglevel)
+    logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
+
+    # Obtain the benchmark object
+    logger.debug ("Main: obtain the BootstrapBench object")
+    bench = BootstrapBench (logger)
+
+    # configure the object
+    logger.debug ("Main: configure the BootstrapBench object")
+    bench.configure (args)
+
+    # now invoke the driver program
+    logger.debug ("Main: invoke the BootstrapBench driver")
+    bench.driver ()
+
+  except Exception as e:
+    logger.error ("Exception caught in main - {}".format (e))
+    return
+
+
+###################################
+#
+# Main entry point
+#
+###################################
+if __name__ == "__main__":
+
+  # set underlying default logging capabilities
+  logging.basicConfig (level=logging.DEBUG,
+                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+  main ()
@@ -49,7 +49,8 @@ import time   # for sleep
 import argparse # for argument parsing
 import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
-import mysql.connector # for working with mysql for analytics
+from CS6381_MW.AsyncLogging import setup_logging # logs written by a listener thread
+import ast # for the publications of a trace we replay
 
 # Import our topic selector. Feel free to use alternate way to
 # get your topics of interest
@@ -64,8 +65,13 @@ from CS6381_MW import discovery_pb2
 from enum import Enum  # for an enumeration we are using to describe what state we are in
 
 # Objects to interact with Zookeeper
-from kazoo.client import KazooClient
-from kazoo.exceptions import NodeExistsError
+from CS6381_MW.InMemoryZooKeeper import zookeeper_client # kazoo client, or the in-memory stand-in for inmemory:// addresses
+from CS6381_MW.MetricsSink import create_metrics_sink # where our measurements go
+from CS6381_MW.LoadProfile import LoadProfile # when we publish as an open-loop load generator
+from CS6381_MW.TraceFile import TraceReader # the publications we replay
+from kazoo.exceptions import NodeExistsError, NoNodeError
+from kazoo.protocol.states import KazooState
+import threading # we create our nodes again outside of the kazoo threads
 import json
 
 # For choosing a history size per topic
@@ -103,26 +109,55 @@ class PublisherAppln ():
     self.logger = logger  # internal logger for print statements
     self.experiment_name = None
     self.imready_timestamp = ""
-    self.register_latency_statistics = []
-    self.isready_latency_statistics = []
+    self.metrics = None # sink for the register and isready latencies, [Metrics] of config.ini
     self.pub_num = None   # number of publishers in the system
     self.sub_num = None   # number of subscribers in the system
 
     # Zookeeper-related variables
     self.zk_client = None
     self.discovery = None
-    self.discovery_leader_addr = None 
-    self.discovery_leader_port = None
+    self.static_discovery_leaders = '' # Leaders in [Discovery] of config.ini, used without ZooKeeper
     self.addr = None
     self.port = None
 
     # Variables for ownership strength
     self.topic_to_strength_ownership = {}
     self.am_leader_for_topic = {}
+    self.topics_pending_election = set()  # topics for which we do not yet know if we lead or whom we follow
+    self.ownership_generation = 0 # bumped when our session is lost, older election callbacks are ignored
+
+    # Variables for surviving the loss of our ZooKeeper connection/session
+    self.paused_topics = set() # topics we lead whose publications only go to the history meanwhile
+    self.zk_session_lost = False # our ephemeral nodes are gone, create them again once we have a new session
+    self.reregistration_pending = False # register again with the discovery service
+    self.reregistering = False # the register request in flight is such a registration
+
+    # Variables for cold start timing
+    self.start_time = None
+    self.first_publication_time = None
+
+    # Variables for the dissemination rounds
+    self.iters_done = 0
+    self.next_publication_time = None
+
+    # Variables for the open-loop load generator (--load)
+    self.load_profile = None # LoadProfile fixing when each round is due, None when closed-loop
+    self.load_start = None # time the first round was due
+    self.rounds_late = 0 # rounds sent later than intended
+    self.max_send_lag = 0.0 # longest a round waited past its intended time
+
+    # Variables for replaying a trace (--replay)
+    self.replay = None # TraceReader of the trace, None when not replaying
+    self.replay_speed = None # times the speed of the trace, 0 for as fast as we can
+    self.replay_records = None # the records of the trace still to come
+    self.replay_next = None # (seconds into the trace, message) of the next one, None at the end
+    self.replay_first = None # seconds into the trace of the first record
+    self.total_send_lag = 0.0 # sum of the lags of the publications replayed
 
     # Variables for history
     self.topic_to_history_size = {}
     self.topic_to_history_queue = {}
+    self.topic_to_publication_seq = {} # topic -> sequence number of our latest publication on it
     
 
   ########################################
@@ -137,6 +172,7 @@ class PublisherAppln ():
 
       # set our current state to CONFIGURE state
       self.state = self.State.CONFIGURE
+      self.start_time = time.time()
       
       # initialize our variables
       self.name = args.name # our name
@@ -144,6 +180,12 @@ class PublisherAppln ():
       self.sub_num = args.subscribers    # number of subscribers in the system
       self.iters = args.iters  # num of iterations
       self.frequency = args.frequency # frequency with which topics are disseminated
+      self.load_profile = LoadProfile (args.load) if args.load else None
+      if args.replay:
+        if self.load_profile != None:
+          raise ValueError ("PublisherAppln::configure - --load and --replay do not go together")
+        self.replay = TraceReader (args.replay)
+        self.replay_speed = args.speed
       self.num_topics = args.num_topics  # total num of topics we publish
       self.experiment_name = args.experiment_name
       self.addr = args.addr
@@ -155,11 +197,18 @@ class PublisherAppln ():
       config.read (args.config)
       self.lookup = config["Discovery"]["Strategy"]
       self.dissemination = config["Dissemination"]["Strategy"]
+      self.static_discovery_leaders = config["Discovery"].get("Leaders", self.static_discovery_leaders)
+      self.metrics = create_metrics_sink (config, self.logger, self.name)
     
       # Now get our topic list of interest
       self.logger.debug ("PublisherAppln::configure - selecting our topic list")
       ts = TopicSelector ()
-      self.topiclist = ts.interest (self.num_topics)  # let topic selector give us the desired num of topics
+      if self.replay != None:
+        # the topics of the trace
+        self.topiclist = sorted (set (message.split (b":", 1)[0].decode () for _, message in self.replay))
+        self.num_topics = len (self.topiclist)
+      else:
+        self.topiclist = ts.interest (self.num_topics)  # let topic selector give us the desired num of topics
 
       # Now setup up our underlying middleware object to which we delegate
       # everything
@@ -176,61 +225,39 @@ class PublisherAppln ():
       # pass remainder of the args to the m/w object
       self.mw_obj.configure (args) 
 
+      # the measurements waiting for the writer thread of the metrics sink
+      if self.mw_obj.loop_metrics != None:
+        self.mw_obj.loop_metrics.queue ("metrics_sink", self.metrics.queue.qsize)
+
 
       # Connect to Zookeeper to establish connection with Primary Discovery
       if(self.lookup == 'ZooKeeper'):
         self.zookeeper_addr = args.zookeeper
-        self.zk_client = KazooClient(hosts=self.zookeeper_addr)
+        self.zk_client = zookeeper_client(self.zookeeper_addr)
         self.zk_client.start()
+        self.zk_client.add_listener(self.zk_state_changed)
         
-        # Create a node for yourself /pubs/%name%
-        self.create_pub_node()
-
-        # Set up nodes and watches for ownership strength
-        self.create_topic_nodes_for_strength_ownership()
+        # Create a node for yourself /pubs/%name% along with the nodes and watches for ownership strength
+        bootstrap_start = time.time()
+        self.create_zookeeper_nodes()
+        self.logger.info ("PublisherAppln::configure - ZooKeeper nodes created in {:.1f} ms".format (1000 * (time.time() - bootstrap_start)))
 
         # Set up history parameters and queues
         self.set_up_history_for_topics()
 
-        # Set up a watch for discovery leader to get notified when it changes
-        @self.zk_client.ChildrenWatch('/discovery')
-        def watch_discovery_children(children):
-          # No children means the discovery died, so we can disconnect from the old one
-          if (len(children) == 0):
-            # Disconnect from the old one if there is an old one
-            if(self.discovery_leader_addr != None):
-              self.mw_obj.disconnect_from_old_discovery_leader(self.discovery_leader_addr, self.discovery_leader_port)
-
-            # Update the info about the discovery leader
-            self.discovery_leader_addr = None
-            self.discovery_leader_port = None
-
-            return
-
-          # There is a child, so there is a primary discovery
-          else:
-            # Retrieve info about the leader
-            leader_info = self.get_data_about_discovery_leader()
-
-            # If the leader has changed, connect to the new leader
-            if(leader_info['addr'] != self.discovery_leader_addr):
-            
-              # Disconnect from old one if we are still connected (i.e. )
-              if(self.discovery_leader_addr != None):
-                self.mw_obj.disconnect_from_old_discovery_leader(self.discovery_leader_addr, self.discovery_leader_port)
-              
-              # Connect to the new discovery and subscribe for updates from it
-              self.mw_obj.connect_to_discovery_leader(leader_info['addr'], leader_info['port'])
-
-              # Update info about discovery leader
-              self.discovery_leader_addr = leader_info['addr'] 
-              self.discovery_leader_port = leader_info['port']
-          return
+        # Follow the discovery leader and connect to it once there is one
+        self.mw_obj.watch_discovery_leader(self.zk_client, self.static_discovery_leaders)
+        self.mw_obj.wait_for_discovery_leader()
         
 
       # If using a Centralized Discovery lookup
       else:
         self.discovery = args.discovery
+
+        # Without ZooKeeper there is no ownership election, we publish on all our topics
+        self.set_up_history_for_topics()
+        for topic in self.topiclist:
+          self.am_leader_for_topic[topic] = True
       
       
       self.logger.info ("PublisherAppln::configure - configuration complete")
@@ -258,87 +285,196 @@ class PublisherAppln ():
 
 
   ########################################
-  # create_topic_nodes_for_strength_ownership
+  # create_zookeeper_nodes
+  #
+  # Our /pubs node and our sequential node (ownership strength) under every
+  # topic are created in a single multi-op transaction, i.e., one round trip
+  # to ZooKeeper instead of several per topic. The parent nodes are only
+  # created if the transaction fails because one of them does not exist yet.
   ########################################
-  def create_topic_nodes_for_strength_ownership(self):
-    for topic in self.topiclist:
-      path_to_topic = '/topic/' + topic
-      # Ensure there is a node for the topic
-      self.zk_client.ensure_path(path_to_topic)
-
-      # Create a node for yourself
-      path_without_sequence = path_to_topic + '/' + self.name + '-'
-      new_node_path = self.zk_client.create(path_without_sequence, sequence=True, ephemeral=True, value=bytes(topic, 'utf-8'))
-      
+  def create_zookeeper_nodes(self):
+    results = self.commit_zookeeper_nodes()
+
+    # Create the missing parents (all requests in flight at once) and try again
+    if (any(isinstance(result, NoNodeError) for result in results)):
+      parents = ['/pubs'] + ['/topic/' + topic for topic in self.topiclist]
+      for async_result in [self.zk_client.ensure_path_async(path) for path in parents]:
+        async_result.get()
+      results = self.commit_zookeeper_nodes()
+
+    for result in results:
+      if (isinstance(result, Exception)):
+        raise result
+
+    # results[0] is our /pubs node, the rest are the topic nodes in order
+    for topic, new_node_path in zip(self.topiclist, results[1:]):
       # Get Sequence number assigned by zookeeper
-      sequence_number = int(new_node_path.replace(path_without_sequence, ""))
+      sequence_number = int(new_node_path[new_node_path.rfind('-') + 1:])
       self.logger.info(f'Ownership Strength for topic {topic}: {sequence_number}')
 
       # Assign strength ownership
       self.topic_to_strength_ownership[topic] = sequence_number
       self.am_leader_for_topic[topic] = False
+      self.topics_pending_election.add(topic)
 
-      # Set up a watch to get notified whenever there are changes
-      self.set_up_watch_for_topic_ownership_strength(path_to_topic, topic)
+    # Set up the watches to get notified whenever there are changes. These
+    # are asynchronous so the requests for all the topics are pipelined
+    for topic in self.topiclist:
+      self.set_up_watch_for_topic_ownership_strength('/topic/' + topic, topic)
 
     return
+
+
+  ########################################
+  # commit_zookeeper_nodes
+  ########################################
+  def commit_zookeeper_nodes(self):
+    # Data to store in our pubs node
+    data_dict = {
+      'addr': self.addr,
+      'port': self.port,
+      'name': self.name
+    }
+    data_bytes = json.dumps(data_dict).encode('utf-8')
+
+    transaction = self.zk_client.transaction()
+    transaction.create('/pubs/' + self.name, value=data_bytes, ephemeral=True)
+    for topic in self.topiclist:
+      transaction.create('/topic/' + topic + '/' + self.name + '-', value=bytes(topic, 'utf-8'), sequence=True, ephemeral=True)
+
+    # A failed transaction returns the error of the failing operation (the others are rolled back)
+    return transaction.commit()
   
 
   ########################################
   # set_up_watch_for_topic_ownership_strength
+  #
+  # Standard ZooKeeper election recipe: instead of watching all the children
+  # of the topic node (which wakes up every publisher of the topic on every
+  # change), we only watch the node right before ours in sequence order. We
+  # become the leader once there is no node before ours. When the node we
+  # watch goes away, only we get notified and we look for the next one.
   ########################################
   def set_up_watch_for_topic_ownership_strength(self, path_to_topic, topic):
-    @self.zk_client.ChildrenWatch(path_to_topic)
-    def watch_children(children):
-      if(len(children) == 0):
+    my_sequence = self.topic_to_strength_ownership[topic]
+    generation = self.ownership_generation
+
+    # Called by kazoo when the node we watch changes (gets deleted)
+    def watch_predecessor(event):
+      if (generation == self.ownership_generation):
+        self.set_up_watch_for_topic_ownership_strength(path_to_topic, topic)
+
+    # Called with the result of the exists request on the predecessor
+    def predecessor_checked(async_result, predecessor):
+      # Our node of that election is gone with our old session
+      if (generation != self.ownership_generation):
         return
 
-      # Find the lowest sequence number, that indicates who is the leader and should disseminate
-      min_node_sequence = 1000000
-      for child in children:
-        beginning_of_sequence = (child.find('-') + 1)
-        node_sequence_number = int(child[beginning_of_sequence:])
-        min_node_sequence = min(min_node_sequence, node_sequence_number)
+      try:
+        # If it is already gone, look again
+        if (async_result.get() == None):
+          self.set_up_watch_for_topic_ownership_strength(path_to_topic, topic)
+          return
+
+        self.logger.info(f"Watching predecessor {predecessor} for topic {topic}")
+        self.topics_pending_election.discard(topic)
+      except Exception as e:
+        self.logger.error(f"PublisherAppln::set_up_watch_for_topic_ownership_strength - {topic}: {e}")
+
+    # Called with the children of the topic node
+    def children_received(async_result):
+      if (generation != self.ownership_generation):
+        return
 
-      self.logger.info(f"min_node_sequence: {min_node_sequence}")
+      try:
+        # Find the node with the largest sequence number below ours
+        predecessor = None
+        predecessor_sequence = -1
+        for child in async_result.get():
+          node_sequence_number = int(child[child.rfind('-') + 1:])
+          if (predecessor_sequence < node_sequence_number < my_sequence):
+            predecessor = child
+            predecessor_sequence = node_sequence_number
+
+        # Nobody before us, so we are the publisher with the highest ownership strength
+        if (predecessor == None):
+          if (not self.am_leader_for_topic[topic]):
+            self.logger.info(f"We became a leader for topic {topic}")
+          self.am_leader_for_topic[topic] = True
+          self.topics_pending_election.discard(topic)
+          return
 
-      # Check if our sequence number is the smallest
-      if(min_node_sequence == self.topic_to_strength_ownership[topic]):
-        # If so, we are the publisher with the highest ownership strength
-        self.logger.info(f"We became a leader for topic {topic}")
-        self.am_leader_for_topic[topic] = True
+        # Watch the predecessor
+        self.zk_client.exists_async(path_to_topic + '/' + predecessor, watch=watch_predecessor).rawlink(
+          lambda exists_result: predecessor_checked(exists_result, predecessor))
+      except Exception as e:
+        self.logger.error(f"PublisherAppln::set_up_watch_for_topic_ownership_strength - {topic}: {e}")
 
-      return
+    self.zk_client.get_children_async(path_to_topic).rawlink(children_received)
     return
 
+
+
   ########################################
-  # create_pub_node
+  # zk_state_changed
+  #
+  # Called by kazoo when our connection to ZooKeeper changes. While it is
+  # suspended, our session and our nodes may well survive, so we only hold
+  # back the publications of the topics we lead. They keep going to the
+  # history of the topic, which we send in full with the next publication
+  # once we are back, so subscribers miss nothing and nobody reconnects.
+  # If the session is lost, our ephemeral nodes (/pubs and our place in
+  # the topic elections) are gone and the discovery leader tells everybody
+  # to disconnect from us. As soon as we have a new session we create them
+  # again and register with discovery again. Kazoo does not let listeners
+  # talk to ZooKeeper, so that happens in a thread of its own.
   ########################################
-  def create_pub_node(self):
-    my_pub_node_path = '/pubs/' + self.name
-    # Data to store in the node
-    data_dict = {
-      'addr': self.addr,
-      'port': self.port,
-      'name': self.name
-    }
-    data_bytes = json.dumps(data_dict).encode('utf-8')
+  def zk_state_changed(self, state):
+    leading = set(topic for topic in self.topiclist if self.am_leader_for_topic.get(topic, False))
+
+    if (state == KazooState.SUSPENDED):
+      self.logger.info("PublisherAppln::zk_state_changed - connection suspended, holding back the publications of {}".format(leading))
+      self.paused_topics = self.paused_topics | leading
+
+    elif (state == KazooState.LOST):
+      self.logger.info("PublisherAppln::zk_state_changed - session lost")
+      self.ownership_generation += 1
+      self.paused_topics = self.paused_topics | leading
+      for topic in self.topiclist:
+        self.am_leader_for_topic[topic] = False
+      self.zk_session_lost = True
+
+    elif (state == KazooState.CONNECTED):
+      if (self.zk_session_lost):
+        self.zk_session_lost = False
+        threading.Thread(target=self.restore_zookeeper_nodes, daemon=True).start()
+      else:
+        self.logger.info("PublisherAppln::zk_state_changed - connection back, same session")
+        self.paused_topics = set()
 
-    # Create a pubs node for yourself
-    self.zk_client.create(my_pub_node_path, ephemeral=True, makepath=True, value=data_bytes)
     return
 
 
-
   ########################################
-  # get_data_about_discovery_leader
+  # restore_zookeeper_nodes
+  #
+  # Create our nodes again after our session was lost (one transaction)
   ########################################
-  def get_data_about_discovery_leader(self):
-    disc_leader_data, _ = self.zk_client.get('/discovery/leader')
-    data_dict = json.loads(disc_leader_data.decode('utf-8'))
-    return data_dict
+  def restore_zookeeper_nodes(self):
+    try:
+      restore_start = time.time()
+      self.create_zookeeper_nodes()
+      self.logger.info("PublisherAppln::restore_zookeeper_nodes - ZooKeeper nodes created again in {:.1f} ms".format(1000 * (time.time() - restore_start)))
 
+      # Discovery forgot about us if it noticed our /pubs node was gone
+      if (self.state in (self.State.ISREADY, self.State.DISSEMINATE)):
+        self.reregistration_pending = True
+      self.paused_topics = set()
 
+    except Exception as e:
+      self.logger.error("PublisherAppln::restore_zookeeper_nodes - {}".format(e))
+
+    return
 
 
   ########################################
@@ -389,12 +525,24 @@ class PublisherAppln ():
     ''' Invoke operating depending on state  '''
 
     try:
-      self.logger.info ("PublisherAppln::invoke_operation – Current State is %s", str(self.state))
+      self.logger.debug ("PublisherAppln::invoke_operation – Current State is %s", self.state)
 
       # check what state are we in. If we are in REGISTER state,
       # we send register request to discovery service. If we are in
       # ISREADY state, then we keep checking with the discovery
       # service.
+      # Our ZooKeeper session was lost and discovery may have dropped us, so
+      # register again. The reply comes back through the event loop, while
+      # disseminating we do not wait for it but keep publishing meanwhile
+      if (self.reregistration_pending and not self.reregistering):
+        self.logger.info ("PublisherAppln::invoke_operation - register again with the discovery service")
+        self.reregistration_pending = False
+        self.reregistering = True
+        self.mw_obj.register (self.name, self.topiclist)
+        if (self.state == self.State.DISSEMINATE and self.next_publication_time != None):
+          return 1000 * max (self.next_publication_time - time.time (), 0)
+        return None
+
       if (self.state == self.State.REGISTER):
         # send a register msg to discovery service
         self.logger.debug ("PublisherAppln::invoke_operation - register with the discovery service")
@@ -428,60 +576,31 @@ class PublisherAppln ():
 
         # We are here because both registration and is ready is done. So the only thing
         # left for us as a publisher is dissemination, which we do it actively here.
-        self.logger.debug ("PublisherAppln::invoke_operation - start Disseminating")
-
-        # Now disseminate topics at the rate at which we have configured ourselves.
-        ts = TopicSelector ()
-        for i in range (self.iters):
-          # I leave it to you whether you want to disseminate all the topics of interest in
-          # each iteration OR some subset of it. Please modify the logic accordingly.
-          # Here, we choose to disseminate on all topics that we publish.  Also, we don't care
-          # about their values. But in future assignments, this can change.
-          iter_diss_topics = []
-          for topic in self.topiclist:
-
-            # Do not publish unless we are the leader for the topic (i.e. we are a publisher with the highest ownership strength)
-            if (not self.am_leader_for_topic[topic]):
-              continue
-            
-            # Array for logging purposes
-            # What topics we disseminated to on this iteration
-            iter_diss_topics.append(topic)
-
-            # For now, we have chosen to send info in the form "topic name: topic value"
-            # In later assignments, we should be using more complex encodings using
-            # protobuf.  In fact, I am going to do this once my basic logic is working.
-            data_for_topic = ts.gen_publication (topic)
-
-            dissemination_data = str({
-              "topic":topic, 
-              "data":data_for_topic,
-              "pubid":self.name,
-              "sent_timestamp":str(time.time()),
-              "exp_name": self.experiment_name
-              })
-            
-
-            # Remove old messages for the topic from history
-            max_size = self.topic_to_history_size[topic]
-            while(len(self.topic_to_history_queue[topic]) > max_size-1):
-              # Remove first element
-              self.topic_to_history_queue[topic].pop(0)
-
-            # Add the data to the history for the topic
-            self.topic_to_history_queue[topic].append(dissemination_data)
-
-            # Send last N messages
-            self.mw_obj.disseminate (self.name, topic, self.topic_to_history_queue[topic])
-            
-            self.logger.debug ("Sent to topic: %s, data: %s", topic, dissemination_data)
-            #self.logger.info ("Sent to topic: %s", topic)
-
-          # Now sleep for an interval of time to ensure we disseminate at the
+        #
+        # Each invocation is one round of publications. In between, we return to the
+        # event loop with a timeout until the next round, so that it can handle the
+        # replies from discovery and the changes of the discovery leader meanwhile.
+        if (self.load_profile != None):
+          return self.generate_load ()
+        if (self.replay != None):
+          return self.replay_trace ()
+
+        if (self.next_publication_time == None):
+          self.logger.debug ("PublisherAppln::invoke_operation - start Disseminating")
+          self.next_publication_time = time.time ()
+
+        wait = self.next_publication_time - time.time ()
+        if (wait > 0):
+          return 1000 * wait
+
+        self.disseminate_round ()
+        self.iters_done += 1
+
+        if (self.iters_done < self.iters):
+          # Now wait for an interval of time to ensure we disseminate at the
           # frequency that was configured.
-          self.logger.info (f"Sent msgs to topics: {str(iter_diss_topics)}")
-          time.sleep (1/float (self.frequency))  # ensure we get a floating point num
-          
+          self.next_publication_time += 1/float (self.frequency)  # ensure we get a floating point num
+          return 1000 * max (self.next_publication_time - time.time (), 0)
 
         self.logger.debug ("PublisherAppln::invoke_operation - Dissemination completed")
 
@@ -496,6 +615,9 @@ class PublisherAppln ():
         # we are done. Time to break the event loop. So we created this special method on the
         # middleware object to kill its event loop
         self.mw_obj.disable_event_loop ()
+
+        # write out whatever measurements are still queued
+        self.metrics.close ()
         return None
 
       else:
@@ -505,6 +627,197 @@ class PublisherAppln ():
     except Exception as e:
       raise e
 
+  ########################################
+  # generate_load
+  #
+  # Dissemination as an open-loop load generator. The rounds are due when
+  # the load profile says, however long the ones before them took. Rounds
+  # that are overdue go out right away, stamped with their intended time,
+  # a bounded number per upcall so that the event loop keeps handling the
+  # replies from discovery. Returns the timeout until the next round.
+  ########################################
+  MAX_ROUNDS_PER_UPCALL = 100
+
+  def generate_load (self):
+    if (self.load_start == None):
+      self.logger.info ("PublisherAppln::generate_load - start the load profile {}".format (self.load_profile.spec))
+      self.load_start = time.time ()
+      self.next_publication_time = self.load_start
+
+    now = time.time ()
+    for _ in range (self.MAX_ROUNDS_PER_UPCALL):
+      if (self.next_publication_time > now):
+        break
+
+      intended = self.next_publication_time
+      elapsed = intended - self.load_start
+      lag = now - intended
+      if (lag > 1 / self.load_profile.rate (elapsed)):
+        self.rounds_late += 1
+      self.max_send_lag = max (self.max_send_lag, lag)
+
+      self.disseminate_round (intended, self.load_profile.rate (elapsed))
+      self.iters_done += 1
+
+      # a constant profile runs our iterations, ramp and step their duration
+      elapsed = self.load_profile.next_round (elapsed)
+      if (elapsed == None or (self.load_profile.duration == None and self.iters_done >= self.iters)):
+        self.logger.info ("PublisherAppln::generate_load - {} rounds in {:.1f} s, {} late by more than a round, longest lag {:.1f} ms".format (
+          self.iters_done, time.time () - self.load_start, self.rounds_late, 1000 * self.max_send_lag))
+        self.state = self.State.COMPLETED
+        return 0
+
+      self.next_publication_time = self.load_start + elapsed
+      now = time.time ()
+
+    return 1000 * max (self.next_publication_time - time.time (), 0)
+
+  ########################################
+  # replay_trace
+  #
+  # Dissemination of the publications of a trace, at the moments they were
+  # received when it was recorded, scaled by the speed (0 for as fast as we
+  # can). Like the load generator, publications go out stamped with the time
+  # they were due, a bounded number per upcall. Returns the timeout until
+  # the next one.
+  ########################################
+  def replay_trace (self):
+    if (self.replay_records == None):
+      self.logger.info ("PublisherAppln::replay_trace - replay {} at {}".format (self.replay.path, "{:g}x".format (self.replay_speed) if self.replay_speed > 0 else "full speed"))
+      self.replay_records = iter (self.replay)
+      self.replay_next = next (self.replay_records, None)
+      self.replay_first = self.replay_next[0] if self.replay_next != None else 0.0
+      self.load_start = time.time ()
+
+    now = time.time ()
+    for _ in range (self.MAX_ROUNDS_PER_UPCALL):
+      if (self.replay_next == None):
+        break
+      offset, message = self.replay_next
+      intended = self.load_start + (offset - self.replay_first) / self.replay_speed if self.replay_speed > 0 else now
+      if (intended > now):
+        break
+
+      lag = now - intended
+      self.total_send_lag += lag
+      self.max_send_lag = max (self.max_send_lag, lag)
+
+      self.replay_publication (message, intended)
+      self.iters_done += 1
+      self.replay_next = next (self.replay_records, None)
+      now = time.time ()
+
+    if (self.replay_next == None):
+      self.logger.info ("PublisherAppln::replay_trace - {} publications in {:.1f} s, lag mean {:.2f} ms, longest {:.1f} ms".format (
+        self.iters_done, time.time () - self.load_start, 1000 * self.total_send_lag / max (self.iters_done, 1), 1000 * self.max_send_lag))
+      self.state = self.State.COMPLETED
+      return 0
+
+    offset = self.replay_next[0]
+    if (self.replay_speed <= 0):
+      return 0
+    return 1000 * max (self.load_start + (offset - self.replay_first) / self.replay_speed - time.time (), 0)
+
+  ########################################
+  # replay_publication
+  #
+  # Publish the data of a traced publication, its newest message, as ours
+  ########################################
+  def replay_publication (self, message, intended_time):
+    topic, epoch, seq, pubid, payload = message.decode ().split (":", 4)
+    try:
+      data_for_topic = ast.literal_eval (ast.literal_eval (payload)[-1])["data"]
+    except (ValueError, SyntaxError, TypeError, KeyError, IndexError):
+      data_for_topic = payload # not in the format of our publications, send it as it is
+
+    self.publish_on_topic (topic, data_for_topic, intended_time)
+
+  ########################################
+  # disseminate_round
+  #
+  # One publication on every topic we lead. The load generator passes the
+  # time the round was intended for and the rate it offers.
+  ########################################
+  def disseminate_round (self, intended_time=None, offered_rate=None):
+    # I leave it to you whether you want to disseminate all the topics of interest in
+    # each iteration OR some subset of it. Please modify the logic accordingly.
+    # Here, we choose to disseminate on all topics that we publish.  Also, we don't care
+    # about their values. But in future assignments, this can change.
+    ts = TopicSelector ()
+    iter_diss_topics = []
+    for topic in self.topiclist:
+
+      # For now, we have chosen to send info in the form "topic name: topic value"
+      # In later assignments, we should be using more complex encodings using
+      # protobuf.  In fact, I am going to do this once my basic logic is working.
+      data_for_topic = ts.gen_publication (topic)
+
+      # Array for logging purposes
+      # What topics we disseminated to on this iteration
+      if (self.publish_on_topic (topic, data_for_topic, intended_time, offered_rate)):
+        iter_diss_topics.append(topic)
+
+    if self.mw_obj.log_sampler.sample ("rounds"):
+      self.logger.info ("Sent msgs to topics: %s", iter_diss_topics)
+    return
+
+  ########################################
+  # publish_on_topic
+  #
+  # One publication, returns whether it was sent
+  ########################################
+  def publish_on_topic (self, topic, data_for_topic, intended_time=None, offered_rate=None):
+    # Do not publish unless we are the leader for the topic (i.e. we are a publisher with the highest ownership strength)
+    # While our ZooKeeper connection is down, the topics we led only go to the history
+    paused_topics = self.paused_topics
+    if (not self.am_leader_for_topic[topic] and topic not in paused_topics):
+      return False
+
+    # times are integer ns on the clock of the discovery service (see
+    # CS6381_MW/ClockSync.py), with the offset we applied and its error bound
+    sent_ns, clock_offset_ns, clock_error_ns = self.mw_obj.clock.stamp ()
+    publication = {
+      "topic":topic, 
+      "data":data_for_topic,
+      "pubid":self.name,
+      "sent_ns":sent_ns,
+      "clock_offset_ns":clock_offset_ns,
+      "clock_error_ns":clock_error_ns,
+      "exp_name": self.experiment_name
+      }
+    # subscribers measure the latency from when the round was due
+    if (intended_time != None):
+      publication["intended_ns"] = self.mw_obj.clock.reference_ns (intended_time)
+      publication["offered_rate"] = offered_rate
+    dissemination_data = str(publication)
+    
+
+    # Remove old messages for the topic from history
+    max_size = self.topic_to_history_size[topic]
+    while(len(self.topic_to_history_queue[topic]) > max_size-1):
+      # Remove first element
+      self.topic_to_history_queue[topic].pop(0)
+
+    # Add the data to the history for the topic
+    self.topic_to_history_queue[topic].append(dissemination_data)
+    self.topic_to_publication_seq[topic] = self.topic_to_publication_seq.get(topic, 0) + 1
+
+    if (topic in paused_topics):
+      return False
+
+    # Send last N messages, along with our ownership epoch and sequence number
+    epoch = self.topic_to_strength_ownership.get(topic, 0)
+    self.mw_obj.disseminate (self.name, topic, self.topic_to_history_queue[topic], epoch, self.topic_to_publication_seq[topic])
+
+    # Cold start time, from configure to our first publication
+    if (self.first_publication_time == None):
+      self.first_publication_time = time.time()
+      self.logger.info ("PublisherAppln::publish_on_topic - first publication {:.3f} s after start".format (self.first_publication_time - self.start_time))
+    
+    self.logger.debug ("Sent to topic: %s, data: %s", topic, dissemination_data)
+    #self.logger.info ("Sent to topic: %s", topic)
+    return True
+
   ########################################
   # handle register response method called as part of upcall
   #
@@ -518,6 +831,14 @@ class PublisherAppln ():
 
     try:
       self.logger.info ("PublisherAppln::register_response")
+
+      # A registration again after our ZooKeeper session was lost. If discovery
+      # says we are registered already, it never noticed we were gone
+      if (self.reregistering):
+        self.reregistering = False
+        self.logger.info ("PublisherAppln::register_response - registered again, status {}, {}".format (reg_resp.status, reg_resp.reason))
+        return 0
+
       if (reg_resp.status == discovery_pb2.STATUS_SUCCESS):
         self.logger.debug ("PublisherAppln::register_response - registration is a success")
 
@@ -528,8 +849,8 @@ class PublisherAppln ():
         # Save statistics about register latency
         cur_timestamp = time.time()
         sent_timestamp = float(timestamp_sent)
-        register_latency = str(cur_timestamp - sent_timestamp)
-        self.register_latency_statistics.append((
+        register_latency = cur_timestamp - sent_timestamp
+        self.metrics.record ('dht_latencies', (
           "REGISTER",
           register_latency,
           self.lookup, # lookup strategy
@@ -580,8 +901,8 @@ class PublisherAppln ():
         # Save statistics about is_ready latency
         cur_timestamp = time.time()
         sent_timestamp = float(timestamp_sent)
-        isready_latency = str(cur_timestamp - sent_timestamp)
-        self.isready_latency_statistics.append((
+        isready_latency = cur_timestamp - sent_timestamp
+        self.metrics.record ('dht_latencies', (
           "ISREADY",
           isready_latency,
           self.lookup, # lookup strategy
@@ -591,9 +912,6 @@ class PublisherAppln ():
           self.name # id of publisher
           ))
         
-        # save statistics data to the database
-        # self.save_dht_statistics()
-        
       # return timeout of 0 so event loop calls us back in the invoke_operation
       # method, where we take action based on what state we are in.
       return 0
@@ -601,41 +919,6 @@ class PublisherAppln ():
     except Exception as e:
       raise e
 
-  ########################################
-  # save_dht_statistics
-  ########################################
-  def save_dht_statistics(self):
-    try:
-      connection = mysql.connector.connect(host='18.212.88.188',
-                                          database='dht',
-                                          user='root',
-                                          password='password')
-
-      mySql_insert_query = """INSERT INTO dht_latencies(type_of_request, latency_sec, lookup_strategy, pub_num, sub_num, dht_num, entity_id) 
-      VALUES (%s,%s,%s,%s,%s,%s,%s)"""
-
-      all_data = self.register_latency_statistics + self.isready_latency_statistics
-
-      cursor = connection.cursor()
-      cursor.executemany(mySql_insert_query, all_data)
-      connection.commit()
-
-      self.logger.info (f"register: {str(self.register_latency_statistics)}")
-      self.logger.info (f"isready: {str(self.isready_latency_statistics)}")
-
-      self.logger.info ("Publisher::save_dht_statistics - {} records inserted successfully into dht_latencies table".format(cursor.rowcount))
-      cursor.close()
-
-    except mysql.connector.Error as error:
-      self.logger.error ("Publisher::save_dht_statistics - Failed to insert records into Latencies table: {}".format(error))
-
-    finally:
-      if connection and connection.is_connected():
-          connection.close()
-          self.logger.info("Publisher::save_dht_statistics - MySQL connection is closed")
-
-    return
-
 
   ########################################
   # generate_history_size_for_topic
@@ -663,6 +946,9 @@ class PublisherAppln ():
       self.logger.info ("     TopicList: {}".format (self.topiclist))
       self.logger.info ("     Iterations: {}".format (self.iters))
       self.logger.info ("     Frequency: {}".format (self.frequency))
+      self.logger.info ("     Load profile: {}".format (self.load_profile.spec if self.load_profile else "closed-loop"))
+      if self.replay != None:
+        self.logger.info ("     Replay: {} at speed {}".format (self.replay.path, self.replay_speed))
       self.logger.info ("**********************************")
 
     except Exception as e:
@@ -713,6 +999,20 @@ def parseCmdLineArgs ():
   # address of Zookeeper
   parser.add_argument("-z", "--zookeeper", default='localhost:2181', help="Address of the Zookeeper instance")
   
+  parser.add_argument ("--metrics_port", type=int, default=0, help="Serve the event loop metrics in the Prometheus text format on this port (http://localhost:<port>/metrics), default 0: no metrics")
+
+  parser.add_argument ("--replay", default=None, help="Publish the publications of this trace (written by a subscriber or broker with --trace) on its topics, with its inter-arrival times (-T, -f and -i are then ignored). Default none")
+
+  parser.add_argument ("--speed", type=float, default=1.0, help="Speed of the replay, e.g., 1 as recorded, 10 ten times faster, 0 as fast as we can. Default 1")
+
+  parser.add_argument ("--load", default=None, help="Publish as an open-loop load generator with this profile of rounds per second: constant:R, ramp:R0,R1,T or step:R0,dR,T,N, optionally prefixed with poisson: for Poisson arrivals (-f is then ignored). Default none: closed-loop at -f")
+
+  parser.add_argument ("--clock_sync", type=float, default=0, help="Estimate the offset of our clock from the one of the discovery service every this many seconds and stamp the publications with the corrected time, default 0: our clock as it is")
+
+  parser.add_argument ("--log_json", action="store_true", help="Write the logs as JSON lines, with the fields of every record, default: plain text")
+
+  parser.add_argument ("--log_every", type=int, default=100, help="Log 1 in N of the messages per topic, default 100")
+
   return parser.parse_args()
 
 
@@ -734,6 +1034,7 @@ def main ():
     # reset the log level to as specified
     logger.debug ("Main: resetting log level to {}".format (args.loglevel))
     logger.setLevel (args.loglevel)
+    setup_logging (level=logging.DEBUG, structured=args.log_json)
     logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
 
     # Obtain a publisher application
@@ -764,9 +1065,8 @@ def main ():
 ###################################
 if __name__ == "__main__":
 
-  # set underlying default logging capabilities
-  logging.basicConfig (level=logging.DEBUG,
-                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  # set underlying default logging capabilities, written off the event loop
+  setup_logging (level=logging.DEBUG)
 
 
   main ()
@@ -9,9 +9,26 @@ create table latencies (
     pub_id VARCHAR(255),
     sub_id VARCHAR(255),
     experiment_name VARCHAR(255),
+    received_at DOUBLE,
+    offered_rate DOUBLE,
+    clock_offset DOUBLE,
+    clock_error DOUBLE,
     PRIMARY KEY (entry_id)
 );
 
+-- received_at (time.time () of the subscriber) was added for the throughput of an experiment
+ALTER TABLE latencies ADD COLUMN received_at DOUBLE;
+
+-- offered_rate (rounds per second of a publisher started with --load, NULL otherwise)
+-- was added for the load generator
+ALTER TABLE latencies ADD COLUMN offered_rate DOUBLE;
+
+-- clock_offset (seconds the clock offsets of the subscriber and the publisher
+-- changed the latency by) and clock_error (its error bound, NULL unless both
+-- ran with --clock_sync) were added for the clock offset estimation
+ALTER TABLE latencies ADD COLUMN clock_offset DOUBLE;
+ALTER TABLE latencies ADD COLUMN clock_error DOUBLE;
+
         --   "ISREADY",
         --   isready_latency,
         --   self.lookup, # lookup strategy
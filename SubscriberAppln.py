@@ -34,11 +34,12 @@ import time   # for sleep
 import argparse # for argument parsing
 import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
+from CS6381_MW.AsyncLogging import setup_logging # logs written by a listener thread
 import ast # for working with subsrption data (converting it back to dictionary)
-import mysql.connector # for working with mysql for analytics
 
 # For choosing a history size per topic
 import random
+import hashlib # to pick a broker instance
 
 # Import our topic selector. Feel free to use alternate way to
 # get your topics of interest
@@ -53,8 +54,9 @@ from CS6381_MW import discovery_pb2
 from enum import Enum  # for an enumeration we are using to describe what state we are in
 
 # Objects to interact with Zookeeper
-from kazoo.client import KazooClient
-from kazoo.exceptions import NodeExistsError
+from CS6381_MW.InMemoryZooKeeper import zookeeper_client # kazoo client, or the in-memory stand-in for inmemory:// addresses
+from CS6381_MW.MetricsSink import create_metrics_sink # where our measurements go
+from kazoo.exceptions import NodeExistsError, NoNodeError
 import json
 
 
@@ -89,23 +91,24 @@ class SubscriberAppln ():
     self.pub_num = None
     self.sub_num = None
     self.freq = None
-    self.latency_data = []
     self.imready_timestamp = "" # for is ready statistics
-    self.register_latency_statistics = []
-    self.isready_latency_statistics = []
-    self.lookup_latency_statistics = []
+    self.metrics = None # sink for the latencies we measure, [Metrics] of config.ini
 
     # Zookeeper-related variables
     self.zk_client = None
     self.discovery = None
-    self.discovery_leader_addr = None 
-    self.discovery_leader_port = None
-    self.discovery_leader_sync_port = None
+    self.static_discovery_leaders = '' # Leaders in [Discovery] of config.ini, used without ZooKeeper
     self.count_msg_rcvd = 0
 
     # History-related variables
     self.topic_to_history_size_wanted = {}
 
+    # Load-balancing-related variables
+    self.hot_standby = False # connect to the standby brokers ahead of time
+    self.broker_replicas = {} # group -> set of ip:port of its brokers (leader and standbys)
+    self.autoscale = False # the broker groups may run several instances
+    self.other_broker_instances = {} # group -> set of ip:port of the instances serving other subscribers
+
 
 
   ########################################
@@ -135,6 +138,12 @@ class SubscriberAppln ():
       config.read (args.config)
       self.lookup = config["Discovery"]["Strategy"]
       self.dissemination = config["Dissemination"]["Strategy"]
+      self.static_discovery_leaders = config["Discovery"].get("Leaders", self.static_discovery_leaders)
+      self.metrics = create_metrics_sink (config, self.logger, self.name)
+      if config.has_section('Broker'):
+        self.hot_standby = config['Broker'].getboolean('HotStandby', self.hot_standby)
+      if config.has_section('Autoscale'):
+        self.autoscale = config['Autoscale'].getboolean('Enabled', self.autoscale)
     
       # Now get our topic list of interest
       self.logger.debug ("SubscriberAppln::configure - selecting our topic list")
@@ -156,42 +165,35 @@ class SubscriberAppln ():
       # pass remainder of the args to the m/w object
       self.mw_obj.configure (args) 
 
+      # the measurements waiting for the writer thread of the metrics sink
+      if self.mw_obj.loop_metrics != None:
+        self.mw_obj.loop_metrics.queue ("metrics_sink", self.metrics.queue.qsize)
+
+      # Set up history wanted sizes
+      for topic in self.topiclist:
+        self.topic_to_history_size_wanted[topic] = random.randint(1, 5)
+      self.logger.info(f'History Sizes per topic: {str(self.topic_to_history_size_wanted)}')
+
       # Connect to Zookeeper to establish connection with Primary Discovery
       if(self.lookup == 'ZooKeeper'):
         self.zookeeper_addr = args.zookeeper
-        self.zk_client = KazooClient(hosts=self.zookeeper_addr)
+        self.zk_client = zookeeper_client(self.zookeeper_addr)
         self.zk_client.start()
-
-        # Set up history wanted sizes
-        for topic in self.topiclist:
-          self.topic_to_history_size_wanted[topic] = random.randint(1, 5)
-        self.logger.info(f'History Sizes per topic: {str(self.topic_to_history_size_wanted)}')
-        
         
-        # If exists, get value, set up watch
-        # If doesn't exist, set up a watch
-        discovery_leader_path = '/discovery/leader'
-
-        # spin while we are waiting for primary discovery to appear
-        while True:
-          if(self.zk_client.exists(discovery_leader_path)):
-            # Retrieve info about the leader
-            leader_info = self.get_data_about_discovery_leader()
-
-            # update discovery leader info
-            self.discovery_leader_addr = leader_info['addr']
-            self.discovery_leader_port = leader_info['port']
-            self.discovery_leader_sync_port = leader_info['sub_port']
-            
-            # Connect to the new discovery and subscribe for updates from it
-            self.mw_obj.connect_to_discovery_leader(leader_info['addr'], leader_info['port'], leader_info['sub_port'])
-
-            break
-
-          else:
-            # Node does not exist yet, so we wait
-            time.sleep(1)
+        # Follow the discovery leader and connect to it once there is one
+        self.mw_obj.watch_discovery_leader(self.zk_client, self.static_discovery_leaders)
+        self.mw_obj.wait_for_discovery_leader()
+
+        # Our watches hand what they see to the event loop
+        self.mw_obj.watch_zk_events()
 
+        # Connect to the standby brokers too, a new leader then has nothing to wait for
+        if(self.dissemination == 'Broker' and self.hot_standby):
+          self.set_up_watch_for_broker_replicas()
+
+        # Receive from one of the instances of each broker group
+        if(self.dissemination == 'Broker' and self.autoscale):
+          self.set_up_watch_for_broker_instances()
         
 
       # If using a Centralized Discovery lookup
@@ -206,14 +208,158 @@ class SubscriberAppln ():
 
 
   ########################################
-  # get_data_about_discovery_leader
+  # set_up_watch_for_broker_replicas
+  #
+  # Every broker (leader or standby) has a node /broker_replicas/<group>/<name>
   ########################################
-  def get_data_about_discovery_leader(self):
-    disc_leader_data, _ = self.zk_client.get('/discovery/leader')
-    data_dict = json.loads(disc_leader_data.decode('utf-8'))
-    return data_dict
+  def set_up_watch_for_broker_replicas(self):
+    self.zk_client.ensure_path('/broker_replicas')
+    watched_groups = set() # only touched by this watch
+
+    @self.zk_client.ChildrenWatch('/broker_replicas')
+    def watch_groups(groups):
+      for group in groups:
+        if(group not in watched_groups):
+          watched_groups.add(group)
+          self.set_up_watch_for_group_replicas(group)
+      return
+
+
+  ########################################
+  # set_up_watch_for_group_replicas
+  #
+  # The watch runs in a kazoo thread, the event loop connects to the
+  # brokers (handle_zk_event)
+  ########################################
+  def set_up_watch_for_group_replicas(self, group):
+    @self.zk_client.ChildrenWatch('/broker_replicas/' + group)
+    def watch_replicas(children):
+      self.fetch_group_members('replicas:' + group, '/broker_replicas/' + group, children)
+      return
+
+
+  ########################################
+  # fetch_group_members
+  #
+  # Runs in the watch thread of kazoo. Reads the ip:port of all the
+  # children in parallel and posts them as one event, {child: ip:port},
+  # once all reads are done
+  ########################################
+  def fetch_group_members(self, kind, path, children):
+    generation = self.mw_obj.new_zk_event_generation(kind)
+    if(len(children) == 0):
+      self.mw_obj.post_zk_event(kind, {}, generation)
+      return
+
+    # the completions all run in the completion thread of kazoo, one after the other
+    members = {}
+    done = []
+    def member_fetched(child, async_result):
+      try:
+        data_bytes, _ = async_result.get()
+        data_dict = json.loads(data_bytes.decode('utf-8'))
+        members[child] = data_dict['addr'] + ':' + str(data_dict['port'])
+      except NoNodeError:
+        # gone already, the next watch event tells us
+        pass
+      done.append(child)
+      if(len(done) == len(children)):
+        self.mw_obj.post_zk_event(kind, members, generation)
+
+    for child in children:
+      self.zk_client.get_async(path + '/' + child).rawlink(lambda async_result, child=child: member_fetched(child, async_result))
+    return
+
+
+  ########################################
+  # handle_zk_event
+  #
+  # Upcall from the event loop of the middleware with the latest event of
+  # a kind posted by our ZooKeeper watches
+  ########################################
+  def handle_zk_event(self, kind, payload):
+    kind, group = kind.split(':', 1)
+    if(kind == 'replicas'):
+      self.update_broker_replicas(group, set(payload.values()))
+    elif(kind == 'instances'):
+      self.update_broker_instances(group, payload)
+    return
+
+
+  ########################################
+  # update_broker_replicas
+  #
+  # Connect to the new brokers of a group, disconnect from the ones that are gone
+  ########################################
+  def update_broker_replicas(self, group, ipports):
+    current = self.broker_replicas.get(group, set())
+    self.mw_obj.connect_to_publishers(list(ipports - current))
+    for ipport in current - ipports:
+      self.mw_obj.disconnect_from_publisher(ipport)
+
+    self.broker_replicas[group] = ipports
+    return
+
+
+  ########################################
+  # set_up_watch_for_broker_instances
+  #
+  # With autoscaling, every instance of a broker group has a node
+  # /broker_instances/<group>/<name>
+  ########################################
+  def set_up_watch_for_broker_instances(self):
+    self.zk_client.ensure_path('/broker_instances')
+    watched_groups = set() # only touched by this watch
+
+    @self.zk_client.ChildrenWatch('/broker_instances')
+    def watch_groups(groups):
+      for group in groups:
+        if(group not in watched_groups):
+          watched_groups.add(group)
+          self.set_up_watch_for_group_instances(group)
+      return
+
+
+  ########################################
+  # set_up_watch_for_group_instances
+  #
+  # The watch runs in a kazoo thread, the event loop picks the instance
+  # (handle_zk_event)
+  ########################################
+  def set_up_watch_for_group_instances(self, group):
+    @self.zk_client.ChildrenWatch('/broker_instances/' + group)
+    def watch_instances(children):
+      self.fetch_group_members('instances:' + group, '/broker_instances/' + group, children)
+      return
+
+
+  ########################################
+  # update_broker_instances
+  #
+  # Every subscriber picks the instance with the highest hash of its own
+  # name and the name of the instance (rendezvous hashing). The subscribers
+  # spread evenly, and when an instance comes or goes only the subscribers
+  # that pick it (or picked it) move
+  ########################################
+  def update_broker_instances(self, group, instances):
+    # No instance left, whatever the discovery service tells us next
+    if(len(instances) == 0):
+      self.other_broker_instances[group] = set()
+      self.mw_obj.excluded_ipports = set().union(*self.other_broker_instances.values())
+      return
+
+    chosen = max(instances, key=lambda child: hashlib.md5((self.name + '/' + child).encode('utf-8')).digest())
+    self.logger.info(f"SubscriberAppln::update_broker_instances - receiving {group} from {chosen} ({len(instances)} instances)")
+    self.other_broker_instances[group] = set(instances.values()) - {instances[chosen]}
+    self.mw_obj.excluded_ipports = set().union(*self.other_broker_instances.values())
+
+    # Connect first, then leave the instance we used before
+    self.mw_obj.connect_to_publishers([instances[chosen]])
+    for ipport in self.other_broker_instances[group]:
+      self.mw_obj.disconnect_from_publisher(ipport)
+    return
+
 
-  
   ########################################
   # driver program
   ########################################
@@ -323,8 +469,8 @@ class SubscriberAppln ():
         # middleware object to kill its event loop
         self.mw_obj.disable_event_loop ()
 
-        # Send data to database
-        # self.send_latency_data_to_db()
+        # write out whatever measurements are still queued
+        self.metrics.close ()
 
         return None
 
@@ -336,38 +482,6 @@ class SubscriberAppln ():
       raise e
 
 
-  ########################################
-  # Sending collected data about 
-  # latencies for further analysis 
-  # into mysql database on aws
-  ########################################
-  def send_latency_data_to_db(self):
-    try:
-      connection = mysql.connector.connect(host='34.227.58.170',
-                                          database='distributed_hw1',
-                                          user='root',
-                                          password='Password2023!')
-
-      mySql_insert_query = """INSERT INTO latencies(latency_sec, frequency, num_topics, pub_num, sub_num, dissemination, pub_id, sub_id, experiment_name) 
-      VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)"""
-
-      cursor = connection.cursor()
-      cursor.executemany(mySql_insert_query, self.latency_data)
-      connection.commit()
-
-      self.logger.info ("SubscriberAppln::send_latency_data_to_db - {} records inserted successfully into Latencies table".format(cursor.rowcount))
-      cursor.close()
-
-    except mysql.connector.Error as error:
-      self.logger.error ("SubscriberAppln::send_latency_data_to_db - Failed to insert records into Latencies table: {}".format(error))
-
-    finally:
-      if connection.is_connected():
-          connection.close()
-          self.logger.info("SubscriberAppln::send_latency_data_to_db - MySQL connection is closed")
-
-    return
-
   ########################################
   # handle register response method called as part of upcall
   #
@@ -391,8 +505,8 @@ class SubscriberAppln ():
         # Save statistics about register latency
         cur_timestamp = time.time()
         sent_timestamp = float(timestamp_sent)
-        register_latency = str(cur_timestamp - sent_timestamp)
-        self.register_latency_statistics.append((
+        register_latency = cur_timestamp - sent_timestamp
+        self.metrics.record ('dht_latencies', (
           "REGISTER",
           register_latency,
           self.lookup, # lookup strategy
@@ -444,8 +558,8 @@ class SubscriberAppln ():
         # Save statistics about is_ready latency
         cur_timestamp = time.time()
         sent_timestamp = float(timestamp_sent)
-        isready_latency = str(cur_timestamp - sent_timestamp)
-        self.isready_latency_statistics.append((
+        isready_latency = cur_timestamp - sent_timestamp
+        self.metrics.record ('dht_latencies', (
           "ISREADY",
           isready_latency,
           self.lookup, # lookup strategy
@@ -477,8 +591,8 @@ class SubscriberAppln ():
       # Save statistics about lookup latency
       cur_timestamp = time.time()
       sent_timestamp = float(timestamp_sent)
-      lookup_latency = str(cur_timestamp - sent_timestamp)
-      self.lookup_latency_statistics.append((
+      lookup_latency = cur_timestamp - sent_timestamp
+      self.metrics.record ('dht_latencies', (
         "LOOKUP",
         lookup_latency,
         self.lookup, # lookup strategy
@@ -488,55 +602,20 @@ class SubscriberAppln ():
         self.name, # id of sub
       ))
 
-      # save statistics data to the database
-      # self.save_dht_statistics()
-
       # connect to all publishers and subscribe to the topics we are interested in
       self.mw_obj.connect_to_publishers(lookup_resp.addressesToConnectTo)
       self.mw_obj.subscribe_to_topics(self.topiclist)
         
       self.state = self.State.RECEIVE_DATA
       
-      # return standard timeout for subscription data
-      # if we do not receive data for this many milliseconds, we finish application
-      # CHANGE IF NEEDED TO self.timeout
-      return None
+      # the publishers are ready too, so if nothing comes in for the timeout
+      # for subscription data (e.g., none of them publishes our topics), we are done
+      return self.timeout
     
     except Exception as e:
       raise e
 
 
-  ########################################
-  # save_dht_statistics
-  ########################################
-  def save_dht_statistics(self):
-    try:
-      connection = mysql.connector.connect(host='18.212.88.188',
-                                          database='dht',
-                                          user='root',
-                                          password='password')
-
-      mySql_insert_query = """INSERT INTO dht_latencies(type_of_request, latency_sec, lookup_strategy, pub_num, sub_num, dht_num, entity_id) 
-      VALUES (%s,%s,%s,%s,%s,%s,%s)"""
-
-      all_data = self.register_latency_statistics + self.isready_latency_statistics + self.lookup_latency_statistics
-
-      cursor = connection.cursor()
-      cursor.executemany(mySql_insert_query, all_data)
-      connection.commit()
-
-      self.logger.info ("Subscriber::save_dht_statistics - {} records inserted successfully into dht_latencies table".format(cursor.rowcount))
-      cursor.close()
-
-    except mysql.connector.Error as error:
-      self.logger.error ("Subscriber::save_dht_statistics - Failed to insert records into Latencies table: {}".format(error))
-
-    finally:
-      if connection and connection.is_connected():
-          connection.close()
-          self.logger.info("Subscriber::save_dht_statistics - MySQL connection is closed")
-    return
-
   ########################################
   # handle receipt of subscription data 
   ########################################
@@ -550,28 +629,42 @@ class SubscriberAppln ():
       # beginning_of_payload = (string_received.find(':') + 1)
       # string_received = string_received[beginning_of_payload:]
 
-      # save latency information locally so that it can be sent to the database later
+      # record the dissemination latency of the newest publication
       data = ast.literal_eval(messages_array[-1])
       # data = messages_array[-1]
-      cur_timestamp = time.time()
-      sent_timestamp = float(data['sent_timestamp'])
-      latency = str(cur_timestamp - sent_timestamp)
-
-
-      self.logger.info(f"RECEIVED DATA from {data['pubid']}")
+      # both ends stamp with their clock corrected by its offset from the discovery
+      # service (CS6381_MW/ClockSync.py), as integer ns
+      cur_ns, clock_offset_ns, clock_error_ns = self.mw_obj.clock.stamp ()
+      # publications of a load generator count from when they were due to be sent
+      sent_ns = data.get('intended_ns', data['sent_ns'])
+      latency = (cur_ns - sent_ns) / 1e9
+
+      # how much the offsets changed the latency, and how far off they may be (unknown
+      # unless both ends synchronized their clock)
+      clock_offset = (clock_offset_ns - data['clock_offset_ns']) / 1e9
+      clock_error = None
+      if (clock_error_ns != None and data['clock_error_ns'] != None):
+        clock_error = (clock_error_ns + data['clock_error_ns']) / 1e9
+
+
+      if self.mw_obj.log_sampler.sample (data['pubid']):
+        self.logger.info("RECEIVED DATA from %s", data['pubid'], extra={"topic": data['topic']})
       # self.count_msg_rcvd = self.count_msg_rcvd + 1
 
-      # INSERT INTO latencies(latency_sec, frequency, num_topics, pub_num, sub_num, pub_id, sub_id, experiment_name) VALUES ();
-      # self.latency_data.append((
-      #   latency, 
-      #   self.freq, 
-      #   self.num_topics, 
-      #   self.pub_num,
-      #   self.sub_num,
-      #   self.dissemination,
-      #   data['pubid'], 
-      #   self.name, 
-      #   data['exp_name']))
+      self.metrics.record ('latencies', (
+        latency,
+        self.freq,
+        self.num_topics,
+        self.pub_num,
+        self.sub_num,
+        self.dissemination,
+        data['pubid'],
+        self.name,
+        data['exp_name'],
+        cur_ns / 1e9,
+        data.get('offered_rate'),
+        clock_offset,
+        clock_error))
       
       # self.latency_data.append(cur_timestamp)
       
@@ -587,7 +680,7 @@ class SubscriberAppln ():
       
       # return standard timeout for subscription data
       # if we do not receive data for this many milliseconds, we finish application
-      return None
+      return self.timeout
     
     except Exception as e:
       raise e
@@ -652,6 +745,16 @@ def parseCmdLineArgs ():
   parser.add_argument("-z", "--zookeeper", default='localhost:2181', help="Address of the Zookeeper instance")
 
   
+  parser.add_argument ("--metrics_port", type=int, default=0, help="Serve the event loop metrics in the Prometheus text format on this port (http://localhost:<port>/metrics), default 0: no metrics")
+
+  parser.add_argument ("--trace", default=None, help="Write the publications we receive, with the time they came in, to this trace file (compressed if it ends in .gz) for PublisherAppln.py --replay, default none")
+
+  parser.add_argument ("--clock_sync", type=float, default=0, help="Estimate the offset of our clock from the one of the discovery service every this many seconds and correct the latencies with it, default 0: our clock as it is")
+
+  parser.add_argument ("--log_json", action="store_true", help="Write the logs as JSON lines, with the fields of every record, default: plain text")
+
+  parser.add_argument ("--log_every", type=int, default=100, help="Log 1 in N of the messages per topic, default 100")
+
   return parser.parse_args()
 
 
@@ -679,6 +782,7 @@ def main ():
     # reset the log level to as specified
     logger.debug ("Main: resetting log level to {}".format (args.loglevel))
     logger.setLevel (args.loglevel)
+    setup_logging (level=logging.DEBUG, structured=args.log_json)
     logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
 
     # Obtain a Subscruber application
@@ -709,9 +813,8 @@ def main ():
 ###################################
 if __name__ == "__main__":
 
-  # set underlying default logging capabilities
-  logging.basicConfig (level=logging.DEBUG,
-                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  # set underlying default logging capabilities, written off the event loop
+  setup_logging (level=logging.DEBUG)
 
 
   main ()
\ No newline at end of file